@@ -0,0 +1,233 @@
+"""
+Допуск тяжёлых запросов к выполнению
+
+Быстрые действия (переходы по меню, добавление расхода) выполняются
+сразу. Тяжёлые (все графики, подробная аналитика, выгрузка документа)
+проходят через очередь с приоритетами: одновременно выполняется не
+больше max_running тяжёлых запросов всего и per_user от одного
+пользователя. Ожидающему пользователю сообщается его место в очереди,
+а при переполнении очереди запрос отклоняется с просьбой повторить позже.
+
+Так всплеск отчётов в конце месяца не забирает у быстрых действий
+цикл событий и процессор.
+
+Стоимость обработчика задаётся флагом при регистрации
+(flags={'cost': HEAVY}) или, для общего обработчика главного меню,
+текстом кнопки (BUTTON_COSTS).
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+logger = logging.getLogger(__name__)
+
+# Классы стоимости; число - приоритет в очереди (меньше - раньше)
+LIGHT = 'light'
+CHART = 'chart'
+HEAVY = 'heavy'
+
+PRIORITIES = {CHART: 0, HEAVY: 1}
+
+# Кнопки главного меню, запускающие построение графиков и отчётов
+BUTTON_COSTS = {
+    "📈 График капитала": CHART,
+    "📋 Отчёт": CHART,
+    "📊 Сравнение периодов": CHART,
+    "💹 График баланса": CHART,
+    "🥧 Диаграмма расходов": CHART,
+    "📉 График кредитов": CHART,
+    "📊 Подробный отчёт": HEAVY,
+    "📈 Все графики": HEAVY,
+}
+
+
+class AdmissionRejected(Exception):
+    """Запрос не допущен: превышен лимит пользователя или очередь полна"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionController:
+    """Очередь с приоритетами и ограничениями одновременных тяжёлых запросов"""
+
+    def __init__(self, max_running: int = 2, per_user: int = 1, max_waiting: int = 200):
+        """
+        Args:
+            max_running: Тяжёлых запросов, выполняемых одновременно
+            per_user: Тяжёлых запросов одного пользователя (выполняемых и ожидающих)
+            max_waiting: Длина очереди ожидания
+        """
+        self.max_running = max_running
+        self.per_user = per_user
+        self.max_waiting = max_waiting
+        self.running = 0
+        self._waiting: List[list] = []  # куча [приоритет, номер, future]
+        self._user_jobs: Counter = Counter()
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+
+    @property
+    def waiting(self) -> int:
+        """Количество ожидающих запросов"""
+        return sum(1 for entry in self._waiting if not entry[2].done())
+
+    def _position(self, entry: list) -> int:
+        """Место запроса в очереди, начиная с 1"""
+        return 1 + sum(
+            1 for other in self._waiting
+            if other[:2] < entry[:2] and not other[2].done()
+        )
+
+    def _release(self):
+        """Освободить место и допустить следующий запрос из очереди"""
+        self.running -= 1
+        while self._waiting:
+            _, _, future = heapq.heappop(self._waiting)
+            if not future.done():
+                self.running += 1
+                future.set_result(None)
+                break
+
+    async def run(self, user_id: int, priority: int, handler: Callable[[], Awaitable[Any]],
+                  on_queued: Optional[Callable[[int], Awaitable[Any]]] = None) -> Any:
+        """
+        Выполнить тяжёлый запрос, дождавшись своей очереди
+
+        Args:
+            user_id: ID пользователя
+            priority: Приоритет (меньше - раньше)
+            handler: Функция без аргументов, выполняющая запрос
+            on_queued: Вызывается с местом в очереди, если запрос ждёт
+
+        Returns:
+            Результат handler()
+
+        Raises:
+            AdmissionRejected: Лимит пользователя исчерпан или очередь полна
+        """
+        if self._user_jobs[user_id] >= self.per_user:
+            self.rejected += 1
+            raise AdmissionRejected('user_busy')
+
+        must_wait = self.running >= self.max_running or self.waiting > 0
+        if must_wait and self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise AdmissionRejected('queue_full')
+
+        self._user_jobs[user_id] += 1
+        try:
+            if must_wait:
+                future = asyncio.get_running_loop().create_future()
+                entry = [priority, next(self._seq), future]
+                heapq.heappush(self._waiting, entry)
+                self.queued += 1
+                try:
+                    if on_queued is not None:
+                        try:
+                            await on_queued(self._position(entry))
+                        except Exception as e:
+                            logger.error(f"Error sending queue position to user {user_id}: {e}")
+                    await future
+                except asyncio.CancelledError:
+                    if future.done() and not future.cancelled():
+                        self._release()  # Место уже выдано, но запрос отменён
+                    else:
+                        future.cancel()
+                    raise
+            else:
+                self.running += 1
+
+            self.admitted += 1
+            try:
+                return await handler()
+            finally:
+                self._release()
+        finally:
+            self._user_jobs[user_id] -= 1
+            if not self._user_jobs[user_id]:
+                del self._user_jobs[user_id]
+
+    def stats(self) -> Dict:
+        """Счётчики очереди"""
+        return {
+            'running': self.running,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'rejected': self.rejected
+        }
+
+
+def handler_cost(event: TelegramObject, data: Dict[str, Any]) -> str:
+    """Класс стоимости обработчика: флаг 'cost' или кнопка главного меню"""
+    cost = get_flag(data, 'cost')
+    if cost:
+        return cost
+    if isinstance(event, Message) and event.text:
+        return BUTTON_COSTS.get(event.text, LIGHT)
+    return LIGHT
+
+
+class AdmissionMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware сообщений и callback-запросов
+
+    Лёгкие обработчики вызываются сразу, остальные - через AdmissionController.
+    """
+
+    QUEUED_TEXT = "⏳ Много запросов, ваш в очереди: {position}-й. Отвечу, как только дойдёт очередь."
+    USER_BUSY_TEXT = "⏳ Предыдущий запрос ещё выполняется. Дождитесь результата."
+    QUEUE_FULL_TEXT = "⚠️ Бот сейчас перегружен отчётами. Попробуйте через минуту."
+
+    def __init__(self, controller: AdmissionController):
+        self.controller = controller
+
+    @staticmethod
+    async def _reply(event: TelegramObject, text: str, queued: bool = False):
+        """
+        Ответить пользователю
+
+        На callback-запрос ожидающего обработчика отвечает сообщением в чат:
+        сам callback ещё ответит обработчик.
+        """
+        if isinstance(event, CallbackQuery):
+            if queued and event.message:
+                await event.message.answer(text)
+            elif not queued:
+                await event.answer(text)
+        elif isinstance(event, Message):
+            await event.answer(text)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        cost = handler_cost(event, data)
+        user = data.get('event_from_user')
+        if cost not in PRIORITIES or user is None:
+            return await handler(event, data)
+
+        async def on_queued(position: int):
+            await self._reply(event, self.QUEUED_TEXT.format(position=position), queued=True)
+
+        try:
+            return await self.controller.run(
+                user.id, PRIORITIES[cost], lambda: handler(event, data), on_queued
+            )
+        except AdmissionRejected as e:
+            logger.info(f"Request of user {user.id} rejected: {e.reason}")
+            await self._reply(event, self.USER_BUSY_TEXT if e.reason == 'user_busy' else self.QUEUE_FULL_TEXT)
@@ -3,11 +3,14 @@
 Предоставляет подробные отчеты с графиками и интеллектуальными рекомендациями
 """
 
+import asyncio
 import random
 from datetime import datetime, date, timedelta
-from typing import Dict, List, Tuple
+from functools import cached_property
+from typing import AsyncIterator, Callable, Dict, List, Tuple
 from database import Database
 from calculations import FinancialCalculator
+from cache import metrics_cache, request_flight, versioned_key
 
 
 class AnalyticsPhrases:
@@ -406,87 +409,285 @@ class AnalyticsPhrases:
         return random.choice(cls.TIME_MARKERS)
 
 
+class ReportMetrics:
+    """
+    Общие показатели для аналитического отчёта
+
+    Данные пользователя и производные величины (итоги, активные кредиты,
+    коэффициенты) вычисляются лениво и не более одного раза. Все разделы
+    отчёта строятся из одного экземпляра.
+    """
+
+    def __init__(self, db: Database, user_id: int, period_days: int = 30):
+        self.db = db
+        self.user_id = user_id
+        self.period_days = period_days
+
+        today = date.today()
+        self.start_date = (today - timedelta(days=period_days)).isoformat()
+        self.end_date = today.isoformat()
+
+    # ---------- Исходные данные ----------
+    # Загружаются при первом обращении, чтобы первые разделы отчёта
+    # не ждали данных, нужных только последующим
+
+    @cached_property
+    def credits(self) -> List[Dict]:
+        return self.db.get_user_credits(self.user_id)
+
+    @cached_property
+    def debts(self) -> List[Dict]:
+        return self.db.get_user_debts(self.user_id, unpaid_only=False)
+
+    @cached_property
+    def categories(self) -> List[Dict]:
+        return self.db.get_user_categories(self.user_id)
+
+    @cached_property
+    def incomes(self) -> List[Dict]:
+        return self.db.get_user_incomes(self.user_id, self.start_date, self.end_date)
+
+    @cached_property
+    def expenses(self) -> List[Dict]:
+        return self.db.get_user_expenses(self.user_id, self.start_date, self.end_date)
+
+    @cached_property
+    def investments(self) -> List[Dict]:
+        return self.db.get_user_investments(self.user_id)
+
+    @cached_property
+    def savings(self) -> float:
+        savings_data = self.db.get_latest_savings(self.user_id)
+        return savings_data['amount'] if savings_data else 0
+
+    # ---------- Капитал и категории ----------
+
+    @cached_property
+    def net_worth(self) -> Dict:
+        return FinancialCalculator.calculate_net_worth(self.savings, self.credits, self.debts, self.investments)
+
+    @cached_property
+    def category_summary(self) -> Dict:
+        return FinancialCalculator.calculate_category_summary(self.incomes, self.expenses, self.categories)
+
+    @property
+    def total_income(self) -> float:
+        return self.category_summary['total_income']
+
+    @property
+    def total_expense(self) -> float:
+        return self.category_summary['total_expense']
+
+    @property
+    def balance(self) -> float:
+        return self.category_summary['balance']
+
+    @cached_property
+    def sorted_income(self) -> List[Tuple]:
+        return sorted(self.category_summary['income_by_category'].items(), key=lambda x: x[1], reverse=True)
+
+    @cached_property
+    def sorted_expense(self) -> List[Tuple]:
+        return sorted(self.category_summary['expense_by_category'].items(), key=lambda x: x[1], reverse=True)
+
+    # ---------- Кредиты ----------
+
+    @cached_property
+    def active_credits(self) -> List[Dict]:
+        return [c for c in self.credits if c['is_active']]
+
+    @cached_property
+    def total_credit_debt(self) -> float:
+        return sum(c['remaining_debt'] for c in self.active_credits)
+
+    @cached_property
+    def monthly_credit_payment(self) -> float:
+        return sum(c['monthly_payment'] for c in self.active_credits)
+
+    @cached_property
+    def credit_details(self) -> List[Dict]:
+        """
+        Расчётные показатели по каждому активному кредиту
+
+        Переплата оценивается как сумма оставшихся платежей за вычетом
+        остатка долга (проценты, которые ещё предстоит заплатить).
+        """
+        details = []
+        for credit in self.active_credits:
+            remaining_months = FinancialCalculator.calculate_remaining_months(credit)
+            details.append({
+                'credit': credit,
+                'remaining_months': remaining_months,
+                'next_payment': FinancialCalculator.calculate_next_payment_date(credit),
+                'overpayment': max(credit['monthly_payment'] * remaining_months - credit['remaining_debt'], 0)
+            })
+        return details
+
+    @cached_property
+    def avg_credit_rate(self) -> float:
+        if not self.active_credits:
+            return 0
+        return sum(c['interest_rate'] for c in self.active_credits) / len(self.active_credits)
+
+    # ---------- Долги ----------
+
+    @cached_property
+    def unpaid_debts(self) -> List[Dict]:
+        return [d for d in self.debts if not d['is_paid']]
+
+    @cached_property
+    def debts_given(self) -> List[Dict]:
+        return [d for d in self.unpaid_debts if d['debt_type'] == 'given']
+
+    @cached_property
+    def debts_taken(self) -> List[Dict]:
+        return [d for d in self.unpaid_debts if d['debt_type'] == 'taken']
+
+    # ---------- Инвестиции ----------
+
+    @cached_property
+    def total_invested(self) -> float:
+        return sum(i['invested_amount'] for i in self.investments)
+
+    @property
+    def total_investment_value(self) -> float:
+        return self.net_worth['investments']
+
+    @property
+    def investment_profit(self) -> float:
+        return self.total_investment_value - self.total_invested
+
+    @property
+    def investment_return_pct(self) -> float:
+        return (self.investment_profit / self.total_invested * 100) if self.total_invested > 0 else 0
+
+    # ---------- Коэффициенты ----------
+
+    @property
+    def months_covered(self) -> float:
+        """Финансовая подушка в месяцах расходов"""
+        return (self.savings / self.total_expense) if self.total_expense > 0 else 0
+
+    @property
+    def monthly_income(self) -> float:
+        """Доход за период, приведённый к среднему месяцу"""
+        return self.total_income / self.period_days * 365 / 12
+
+    @property
+    def debt_to_income(self) -> float:
+        return (self.monthly_credit_payment / self.monthly_income * 100) if self.total_income > 0 else 0
+
+    @property
+    def debt_to_asset(self) -> float:
+        total_assets = self.net_worth['total_assets']
+        return (self.net_worth['total_liabilities'] / total_assets * 100) if total_assets > 0 else 0
+
+    @property
+    def savings_rate(self) -> float:
+        """Доля дохода за период, оставшаяся после расходов"""
+        return ((self.total_income - self.total_expense) / self.total_income * 100) if self.total_income > 0 else 0
+
+    @property
+    def financial_independence(self) -> float:
+        return (self.net_worth['net_worth'] / self.total_income * 100) if self.total_income > 0 else 0
+
+
 class FinancialAnalytics:
     """Класс для создания подробных аналитических отчётов"""
-    
+
+    SEPARATOR = "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
+
     def __init__(self, db: Database):
         self.db = db
         self.phrases = AnalyticsPhrases()
-    
+
+    def collect_metrics(self, user_id: int, period_days: int = 30) -> ReportMetrics:
+        """
+        Загрузить данные пользователя и подготовить общие показатели
+
+        Показатели кэшируются по версии данных пользователя, поэтому
+        повторный отчёт без изменений данных не обращается к базе.
+        """
+        key = versioned_key('analytics', self.db.db_path, user_id,
+                            self.db.get_data_version(user_id), period_days)
+        metrics = metrics_cache.get(key)
+        if metrics is None:
+            metrics = ReportMetrics(self.db, user_id, period_days)
+            metrics_cache.set(key, metrics)
+        return metrics
+
+    def report_sections(self) -> List[Callable[[ReportMetrics], str]]:
+        """Функции построения разделов отчёта в порядке вывода"""
+        return [
+            self._generate_header,
+            self._generate_capital_overview,
+            self._generate_income_analysis,
+            self._generate_expense_analysis,
+            self._generate_credit_analysis,
+            self._generate_debt_analysis,
+            self._generate_investment_analysis,
+            self._generate_savings_analysis,
+            self._generate_financial_ratios,
+            self._generate_recommendations,
+            self._generate_footer,
+        ]
+
+    async def iter_report_sections(self, user_id: int, period_days: int = 30) -> AsyncIterator[str]:
+        """
+        Строит отчёт по разделам, отдавая каждый сразу после расчёта
+
+        Обращения к базе и расчёты выполняются в отдельном потоке, чтобы
+        не блокировать цикл событий бота.
+
+        Args:
+            user_id: ID пользователя
+            period_days: Период анализа в днях
+
+        Yields:
+            Текст очередного раздела
+        """
+        # Одновременные запросы того же отчёта ждут один расчёт показателей
+        key = versioned_key('analytics', self.db.db_path, user_id,
+                            self.db.get_data_version(user_id), period_days)
+        metrics = await request_flight.run(
+            key, lambda: asyncio.to_thread(self.collect_metrics, user_id, period_days)
+        )
+        for render in self.report_sections():
+            yield await asyncio.to_thread(render, metrics)
+
     def generate_comprehensive_report(self, user_id: int, period_days: int = 30) -> str:
         """
         Генерирует максимально подробный финансовый отчёт
-        
+
         Args:
             user_id: ID пользователя
             period_days: Период анализа в днях
-            
+
         Returns:
             Подробный текстовый отчёт
         """
-        today = date.today()
-        start_date = (today - timedelta(days=period_days)).isoformat()
-        end_date = today.isoformat()
-        
-        # Получаем все данные
-        credits = self.db.get_user_credits(user_id)
-        debts = self.db.get_user_debts(user_id, unpaid_only=False)
-        categories = self.db.get_user_categories(user_id)
-        incomes = self.db.get_user_incomes(user_id, start_date, end_date)
-        expenses = self.db.get_user_expenses(user_id, start_date, end_date)
-        investments = self.db.get_user_investments(user_id)
-        savings_data = self.db.get_latest_savings(user_id)
-        
-        savings = savings_data['amount'] if savings_data else 0
-        
-        # Рассчитываем показатели
-        net_worth = FinancialCalculator.calculate_net_worth(savings, credits, debts, investments)
-        category_summary = FinancialCalculator.calculate_category_summary(incomes, expenses, categories)
-        
-        # Начинаем формировать отчёт
-        report = f"""
+        metrics = self.collect_metrics(user_id, period_days)
+        return "".join(render(metrics) for render in self.report_sections())
+
+    def _generate_header(self, m: ReportMetrics) -> str:
+        """Заголовок отчёта"""
+        return f"""
 ╔═══════════════════════════════════════════════════════╗
 ║     🎯 РАСШИРЕННЫЙ ФИНАНСОВЫЙ АНАЛИЗ     ║
 ╚═══════════════════════════════════════════════════════╝
 
 {self.phrases.get_greeting()}
 
-📅 Период анализа: {start_date} → {end_date}
+📅 Период анализа: {m.start_date} → {m.end_date}
 ⏰ Дата формирования отчёта: {datetime.now().strftime('%d.%m.%Y %H:%M')}
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
 """
-        
-        # Раздел 1: Обзор капитала
-        report += self._generate_capital_overview(net_worth)
-        
-        # Раздел 2: Детальный анализ доходов
-        report += self._generate_income_analysis(incomes, category_summary, categories)
-        
-        # Раздел 3: Детальный анализ расходов
-        report += self._generate_expense_analysis(expenses, category_summary, categories)
-        
-        # Раздел 4: Анализ кредитов
-        report += self._generate_credit_analysis(credits)
-        
-        # Раздел 5: Анализ долгов
-        report += self._generate_debt_analysis(debts)
-        
-        # Раздел 6: Анализ инвестиций
-        report += self._generate_investment_analysis(investments)
-        
-        # Раздел 7: Анализ сбережений
-        report += self._generate_savings_analysis(savings, category_summary)
-        
-        # Раздел 8: Коэффициенты и показатели
-        report += self._generate_financial_ratios(net_worth, category_summary, credits, savings)
-        
-        # Раздел 9: Рекомендации
-        report += self._generate_recommendations(net_worth, category_summary, credits, savings)
-        
-        # Завершение
-        report += f"""
+
+    def _generate_footer(self, m: ReportMetrics) -> str:
+        """Завершение отчёта"""
+        return f"""
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
 {self.phrases.get_emotional_response()} {self.phrases.get_conclusion()}
@@ -503,29 +704,17 @@ class FinancialAnalytics:
 ║  Отчёт сформирован системой DoHot Analytics  ║
 ╚═══════════════════════════════════════════════════════╝
 """
-        
-        return report
-    
-    def _generate_capital_overview(self, net_worth: Dict) -> str:
+
+    def _generate_capital_overview(self, m: ReportMetrics) -> str:
         """Генерирует обзор капитала"""
-        
-        # Вычисляем процент доходности инвестиций
-        investment_return_pct = 0
-        investments_data = self.db.get_user_investments(self.user_id)
-        
-        if investments_data:
-            total_invested = sum(inv['invested_amount'] for inv in investments_data)
-            total_current = sum(inv['current_value'] for inv in investments_data)
-            
-            if total_invested > 0:
-                investment_return_pct = ((total_current - total_invested) / total_invested) * 100
-        
-        section = f"""
+        net_worth = m.net_worth
+
+        return f"""
     ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
     ┃  💎 РАЗДЕЛ 1: СТРУКТУРА КАПИТАЛА  ┃
     ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
 
-    {self.phrases.get_random_phrase('BALANCE_PHRASES', 
+    {self.phrases.get_random_phrase('BALANCE_PHRASES',
         amount=f'{net_worth["net_worth"]:,.2f} руб.',
         status='положительный' if net_worth['net_worth'] >= 0 else 'требует внимания')}
 
@@ -535,7 +724,7 @@ class FinancialAnalytics:
     └─ {self._get_savings_comment(net_worth['savings'])}
 
     📈 Инвестиции:       {net_worth['investments']:>15,.2f} руб.
-    └─ {self._get_investment_comment(net_worth['investments'], investment_return_pct)}
+    └─ {self._get_portfolio_comment(net_worth['investments'], m.investment_return_pct)}
 
     💸 Долги выданные:   {net_worth['debts_given']:>15,.2f} руб.
     └─ Деньги, которые вам должны
@@ -565,14 +754,21 @@ class FinancialAnalytics:
     ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
     """
-        return section
-    
-    def _generate_income_analysis(self, incomes: List, category_summary: Dict, categories: List) -> str:
+
+    def _render_category_rows(self, sorted_items: List[Tuple], total: float, emoji_getter) -> List[str]:
+        """Строки рейтинга категорий с полосой доли"""
+        rows = []
+        for i, (cat_name, amount) in enumerate(sorted_items, 1):
+            percent = (amount / total * 100) if total > 0 else 0
+            rows.append(f"{emoji_getter(i)} {i}. {cat_name:<25} {amount:>12,.2f} руб. ({percent:>5.1f}%)\n")
+            rows.append(f"   {'▓' * int(percent / 2)}{'░' * (50 - int(percent / 2))}\n\n")
+        return rows
+
+    def _generate_income_analysis(self, m: ReportMetrics) -> str:
         """Генерирует анализ доходов"""
-        total_income = category_summary['total_income']
-        income_by_category = category_summary['income_by_category']
-        
-        section = f"""
+        total_income = m.total_income
+
+        parts = [f"""
 ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
 ┃  💰 РАЗДЕЛ 2: АНАЛИЗ ДОХОДОВ  ┃
 ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
@@ -582,44 +778,34 @@ class FinancialAnalytics:
 ┌─ ОБЩИЕ ПОКАЗАТЕЛИ ───────────────────────────────────┐
 
 💵 Всего доходов:    {total_income:>15,.2f} руб.
-📊 Количество операций: {len(incomes):>10} шт.
-📈 Средний чек:      {(total_income / len(incomes) if incomes else 0):>15,.2f} руб.
+📊 Количество операций: {len(m.incomes):>10} шт.
+📈 Средний чек:      {(total_income / len(m.incomes) if m.incomes else 0):>15,.2f} руб.
 
 └──────────────────────────────────────────────────────┘
 
-"""
-        
-        if income_by_category:
-            section += "┌─ ДОХОДЫ ПО КАТЕГОРИЯМ ───────────────────────────────┐\n\n"
-            
-            sorted_income = sorted(income_by_category.items(), key=lambda x: x[1], reverse=True)
-            
-            for i, (cat_name, amount) in enumerate(sorted_income, 1):
-                percent = (amount / total_income * 100) if total_income > 0 else 0
-                emoji = self._get_category_emoji(i)
-                
-                section += f"{emoji} {i}. {cat_name:<25} {amount:>12,.2f} руб. ({percent:>5.1f}%)\n"
-                section += f"   {'▓' * int(percent / 2)}{'░' * (50 - int(percent / 2))}\n\n"
-            
-            section += "└──────────────────────────────────────────────────────┘\n\n"
-            
+"""]
+
+        if m.sorted_income:
+            parts.append("┌─ ДОХОДЫ ПО КАТЕГОРИЯМ ───────────────────────────────┐\n\n")
+            parts.extend(self._render_category_rows(m.sorted_income, total_income, self._get_category_emoji))
+            parts.append("└──────────────────────────────────────────────────────┘\n\n")
+
             # Добавляем комментарии
-            top_category = sorted_income[0]
-            section += f"🏆 Лидер по доходам: {top_category[0]} с суммой {top_category[1]:,.2f} руб.\n"
-            section += f"   {self._get_income_category_comment(top_category[0], top_category[1])}\n\n"
+            top_category = m.sorted_income[0]
+            parts.append(f"🏆 Лидер по доходам: {top_category[0]} с суммой {top_category[1]:,.2f} руб.\n")
+            parts.append(f"   {self._get_income_category_comment(top_category[0], top_category[1])}\n\n")
         else:
-            section += "⚠️ Доходы за период не зарегистрированы\n\n"
-        
-        section += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        
-        return section
-    
-    def _generate_expense_analysis(self, expenses: List, category_summary: Dict, categories: List) -> str:
+            parts.append("⚠️ Доходы за период не зарегистрированы\n\n")
+
+        parts.append(self.SEPARATOR)
+
+        return "".join(parts)
+
+    def _generate_expense_analysis(self, m: ReportMetrics) -> str:
         """Генерирует анализ расходов"""
-        total_expense = category_summary['total_expense']
-        expense_by_category = category_summary['expense_by_category']
-        
-        section = f"""
+        total_expense = m.total_expense
+
+        parts = [f"""
 ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
 ┃  🛒 РАЗДЕЛ 3: АНАЛИЗ РАСХОДОВ  ┃
 ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
@@ -629,127 +815,121 @@ class FinancialAnalytics:
 ┌─ ОБЩИЕ ПОКАЗАТЕЛИ ───────────────────────────────────┐
 
 💸 Всего расходов:   {total_expense:>15,.2f} руб.
-📊 Количество операций: {len(expenses):>10} шт.
-📉 Средний чек:      {(total_expense / len(expenses) if expenses else 0):>15,.2f} руб.
+📊 Количество операций: {len(m.expenses):>10} шт.
+📉 Средний чек:      {(total_expense / len(m.expenses) if m.expenses else 0):>15,.2f} руб.
 
 └──────────────────────────────────────────────────────┘
 
-"""
-        
-        if expense_by_category:
-            section += "┌─ РАСХОДЫ ПО КАТЕГОРИЯМ ──────────────────────────────┐\n\n"
-            
-            sorted_expense = sorted(expense_by_category.items(), key=lambda x: x[1], reverse=True)
-            
-            for i, (cat_name, amount) in enumerate(sorted_expense, 1):
-                percent = (amount / total_expense * 100) if total_expense > 0 else 0
-                emoji = self._get_expense_emoji(i)
-                
-                section += f"{emoji} {i}. {cat_name:<25} {amount:>12,.2f} руб. ({percent:>5.1f}%)\n"
-                section += f"   {'▓' * int(percent / 2)}{'░' * (50 - int(percent / 2))}\n\n"
-            
-            section += "└──────────────────────────────────────────────────────┘\n\n"
-            
+"""]
+
+        if m.sorted_expense:
+            parts.append("┌─ РАСХОДЫ ПО КАТЕГОРИЯМ ──────────────────────────────┐\n\n")
+            parts.extend(self._render_category_rows(m.sorted_expense, total_expense, self._get_expense_emoji))
+            parts.append("└──────────────────────────────────────────────────────┘\n\n")
+
             # Добавляем комментарии
-            top_expense = sorted_expense[0]
-            section += f"🔝 Самая затратная категория: {top_expense[0]} с суммой {top_expense[1]:,.2f} руб.\n"
-            section += f"   {self._get_expense_category_comment(top_expense[0], top_expense[1])}\n\n"
-            
+            top_expense = m.sorted_expense[0]
+            parts.append(f"🔝 Самая затратная категория: {top_expense[0]} с суммой {top_expense[1]:,.2f} руб.\n")
+            parts.append(f"   {self._get_expense_category_comment(top_expense[0], top_expense[1])}\n\n")
+
             # Анализ структуры расходов
-            section += self._analyze_expense_structure(sorted_expense, total_expense)
-            
+            parts.append(self._analyze_expense_structure(m.sorted_expense, total_expense))
         else:
-            section += "✅ Расходов за период не зарегистрировано\n\n"
-        
-        section += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        
-        return section
-    
-    def _generate_credit_analysis(self, credits: List) -> str:
+            parts.append("✅ Расходов за период не зарегистрировано\n\n")
+
+        parts.append(self.SEPARATOR)
+
+        return "".join(parts)
+
+    def _generate_credit_analysis(self, m: ReportMetrics) -> str:
         """Генерирует анализ кредитов"""
-        active_credits = [c for c in credits if c['is_active']]
-        
-        section = f"""
+        active_credits = m.active_credits
+
+        parts = ["""
 ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
 ┃  💳 РАЗДЕЛ 4: АНАЛИЗ КРЕДИТОВ  ┃
 ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
 
-"""
-        
+"""]
+
         if not active_credits:
-            section += "✅ У вас нет активных кредитов! Отличная финансовая дисциплина!\n\n"
-            section += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-            return section
-        
-        total_debt = sum(c['remaining_debt'] for c in active_credits)
-        total_monthly = sum(c['monthly_payment'] for c in active_credits)
-        avg_rate = sum(c['interest_rate'] for c in active_credits) / len(active_credits)
-        
-        section += f"""
+            parts.append("✅ У вас нет активных кредитов! Отличная финансовая дисциплина!\n\n")
+            parts.append(self.SEPARATOR)
+            return "".join(parts)
+
+        parts.append(f"""
 ┌─ ОБЩИЕ ПОКАЗАТЕЛИ ───────────────────────────────────┐
 
-💰 Общий долг:       {total_debt:>15,.2f} руб.
-📅 Ежемесячный платёж: {total_monthly:>13,.2f} руб.
+💰 Общий долг:       {m.total_credit_debt:>15,.2f} руб.
+📅 Ежемесячный платёж: {m.monthly_credit_payment:>13,.2f} руб.
 📊 Активных кредитов: {len(active_credits):>14} шт.
-% Средняя ставка:   {avg_rate:>15.2f}%
+% Средняя ставка:   {m.avg_credit_rate:>15.2f}%
 
 └──────────────────────────────────────────────────────┘
 
 ┌─ ДЕТАЛИЗАЦИЯ ПО КРЕДИТАМ ────────────────────────────┐
 
-"""
-        
-        for i, credit in enumerate(active_credits, 1):
-            remaining_months = FinancialCalculator.calculate_remaining_months(credit)
-            next_payment = FinancialCalculator.calculate_next_payment_date(credit)
-            overpayment = FinancialCalculator.calculate_overpayment(credit)
-            
-            section += f"""
+""")
+
+        for i, detail in enumerate(m.credit_details, 1):
+            credit = detail['credit']
+
+            parts.append(f"""
 {i}. 🏦 {credit['display_name']}
    ├─ Остаток долга:     {credit['remaining_debt']:>12,.2f} руб.
    ├─ Ежемесячный платёж: {credit['monthly_payment']:>11,.2f} руб.
    ├─ Процентная ставка: {credit['interest_rate']:>12.2f}%
-   ├─ Осталось месяцев:  {remaining_months:>12} мес.
-   ├─ Следующий платёж:  {next_payment}
-   ├─ Переплата:         {overpayment:>12,.2f} руб.
+   ├─ Осталось месяцев:  {detail['remaining_months']:>12} мес.
+   ├─ Следующий платёж:  {detail['next_payment']}
+   ├─ Переплата:         {detail['overpayment']:>12,.2f} руб.
    └─ {self._get_credit_comment(credit)}
 
-"""
-        
-        section += "└──────────────────────────────────────────────────────┘\n\n"
-        
+""")
+
+        parts.append("└──────────────────────────────────────────────────────┘\n\n")
+
         # Добавляем рекомендации
         recommendation = FinancialCalculator.recommend_early_payment_strategy(active_credits)
         if recommendation:
-            section += f"💡 РЕКОМЕНДАЦИЯ ПО ДОСРОЧНОМУ ПОГАШЕНИЮ:\n"
-            section += f"   {recommendation['explanation']}\n\n"
-        
-        section += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        
-        return section
-    
-    def _generate_debt_analysis(self, debts: List) -> str:
+            parts.append("💡 РЕКОМЕНДАЦИЯ ПО ДОСРОЧНОМУ ПОГАШЕНИЮ:\n")
+            parts.append(f"   {recommendation['explanation']}\n\n")
+
+        parts.append(self.SEPARATOR)
+
+        return "".join(parts)
+
+    def _render_debt_list(self, title: str, debts: List[Dict]) -> List[str]:
+        """Строки списка долгов в рамке"""
+        rows = [title]
+        for i, debt in enumerate(debts, 1):
+            rows.append(f"{i}. 👤 {debt['person_name']:<20} {debt['amount']:>12,.2f} руб.\n")
+            if debt.get('description'):
+                rows.append(f"   📝 {debt['description']}\n")
+            rows.append(f"   📅 Дата: {debt['date']}\n\n")
+        rows.append("└──────────────────────────────────────────────────────┘\n\n")
+        return rows
+
+    def _generate_debt_analysis(self, m: ReportMetrics) -> str:
         """Генерирует анализ долгов"""
-        unpaid_debts = [d for d in debts if not d['is_paid']]
-        debts_given = [d for d in unpaid_debts if d['debt_type'] == 'given']
-        debts_taken = [d for d in unpaid_debts if d['debt_type'] == 'taken']
-        
-        section = f"""
+        debts_given = m.debts_given
+        debts_taken = m.debts_taken
+
+        parts = ["""
 ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
 ┃  💸 РАЗДЕЛ 5: АНАЛИЗ ДОЛГОВ  ┃
 ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
 
-"""
-        
-        if not unpaid_debts:
-            section += "✅ У вас нет непогашенных долгов! Превосходно!\n\n"
-            section += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-            return section
-        
-        total_given = sum(d['amount'] for d in debts_given)
-        total_taken = sum(d['amount'] for d in debts_taken)
-        
-        section += f"""
+"""]
+
+        if not m.unpaid_debts:
+            parts.append("✅ У вас нет непогашенных долгов! Превосходно!\n\n")
+            parts.append(self.SEPARATOR)
+            return "".join(parts)
+
+        total_given = m.net_worth['debts_given']
+        total_taken = m.net_worth['debts_taken']
+
+        parts.append(f"""
 ┌─ ОБЩИЕ ПОКАЗАТЕЛИ ───────────────────────────────────┐
 
 💰 Вам должны:       {total_given:>15,.2f} руб. ({len(debts_given)} долгов)
@@ -758,54 +938,44 @@ class FinancialAnalytics:
 
 └──────────────────────────────────────────────────────┘
 
-"""
-        
+""")
+
         if debts_given:
-            section += "┌─ ВАМ ДОЛЖНЫ ─────────────────────────────────────────┐\n\n"
-            for i, debt in enumerate(debts_given, 1):
-                section += f"{i}. 👤 {debt['person_name']:<20} {debt['amount']:>12,.2f} руб.\n"
-                if debt.get('description'):
-                    section += f"   📝 {debt['description']}\n"
-                section += f"   📅 Дата: {debt['date']}\n\n"
-            section += "└──────────────────────────────────────────────────────┘\n\n"
-        
+            parts.extend(self._render_debt_list(
+                "┌─ ВАМ ДОЛЖНЫ ─────────────────────────────────────────┐\n\n", debts_given))
+
         if debts_taken:
-            section += "┌─ ВЫ ДОЛЖНЫ ──────────────────────────────────────────┐\n\n"
-            for i, debt in enumerate(debts_taken, 1):
-                section += f"{i}. 👤 {debt['person_name']:<20} {debt['amount']:>12,.2f} руб.\n"
-                if debt.get('description'):
-                    section += f"   📝 {debt['description']}\n"
-                section += f"   📅 Дата: {debt['date']}\n\n"
-            section += "└──────────────────────────────────────────────────────┘\n\n"
-        
-        section += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        
-        return section
-    
-    def _generate_investment_analysis(self, investments: List) -> str:
+            parts.extend(self._render_debt_list(
+                "┌─ ВЫ ДОЛЖНЫ ──────────────────────────────────────────┐\n\n", debts_taken))
+
+        parts.append(self.SEPARATOR)
+
+        return "".join(parts)
+
+    def _generate_investment_analysis(self, m: ReportMetrics) -> str:
         """Генерирует анализ инвестиций"""
-        section = f"""
+        investments = m.investments
+
+        parts = ["""
 ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
 ┃  📈 РАЗДЕЛ 6: АНАЛИЗ ИНВЕСТИЦИЙ  ┃
 ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
 
-"""
-        
+"""]
+
         if not investments:
-            section += "⚠️ У вас пока нет инвестиций. Рассмотрите возможность создания инвестиционного портфеля!\n\n"
-            section += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-            return section
-        
-        total_invested = sum(i['invested_amount'] for i in investments)
-        total_current = sum(i['current_value'] for i in investments)
-        total_profit = total_current - total_invested
-        total_return = (total_profit / total_invested * 100) if total_invested > 0 else 0
-        
-        section += f"""
+            parts.append("⚠️ У вас пока нет инвестиций. Рассмотрите возможность создания инвестиционного портфеля!\n\n")
+            parts.append(self.SEPARATOR)
+            return "".join(parts)
+
+        total_profit = m.investment_profit
+        total_return = m.investment_return_pct
+
+        parts.append(f"""
 ┌─ ОБЩИЕ ПОКАЗАТЕЛИ ───────────────────────────────────┐
 
-💎 Инвестировано:    {total_invested:>15,.2f} руб.
-📊 Текущая стоимость: {total_current:>14,.2f} руб.
+💎 Инвестировано:    {m.total_invested:>15,.2f} руб.
+📊 Текущая стоимость: {m.total_investment_value:>14,.2f} руб.
 {'📈' if total_profit >= 0 else '📉'} Прибыль/убыток:  {total_profit:>15,.2f} руб.
 % Доходность:       {total_return:>15.2f}%
 🔢 Активов в портфеле: {len(investments):>12} шт.
@@ -814,19 +984,20 @@ class FinancialAnalytics:
 
 ┌─ ДЕТАЛИЗАЦИЯ ПО АКТИВАМ ─────────────────────────────┐
 
-"""
-        
-        # Сортируем по доходности
-        sorted_investments = sorted(investments, 
-                                   key=lambda x: ((x['current_value'] - x['invested_amount']) / x['invested_amount'] * 100) if x['invested_amount'] > 0 else 0,
-                                   reverse=True)
-        
-        for i, inv in enumerate(sorted_investments, 1):
+""")
+
+        # Доходность каждого актива считаем один раз и сортируем по ней
+        rated = []
+        for inv in investments:
             profit = inv['current_value'] - inv['invested_amount']
             return_pct = (profit / inv['invested_amount'] * 100) if inv['invested_amount'] > 0 else 0
+            rated.append((return_pct, profit, inv))
+        rated.sort(key=lambda x: x[0], reverse=True)
+
+        for i, (return_pct, profit, inv) in enumerate(rated, 1):
             emoji = '🥇' if i == 1 else '🥈' if i == 2 else '🥉' if i == 3 else '📊'
-            
-            section += f"""
+
+            parts.append(f"""
 {emoji} {i}. {inv['asset_name']}
    ├─ Вложено:          {inv['invested_amount']:>12,.2f} руб.
    ├─ Текущая стоимость: {inv['current_value']:>11,.2f} руб.
@@ -834,35 +1005,34 @@ class FinancialAnalytics:
    ├─ Доходность:        {return_pct:>12.2f}%
    └─ {self._get_investment_comment(inv['asset_name'], return_pct)}
 
-"""
-        
-        section += "└──────────────────────────────────────────────────────┘\n\n"
-        
+""")
+
+        parts.append("└──────────────────────────────────────────────────────┘\n\n")
+
         # Общий вердикт
         if total_return > 10:
-            section += "🌟 Отличная доходность портфеля! Продолжайте в том же духе!\n"
+            parts.append("🌟 Отличная доходность портфеля! Продолжайте в том же духе!\n")
         elif total_return > 0:
-            section += "✅ Портфель приносит прибыль, но есть потенциал для роста!\n"
+            parts.append("✅ Портфель приносит прибыль, но есть потенциал для роста!\n")
         else:
-            section += "⚠️ Портфель показывает убыток. Рекомендуется пересмотреть стратегию!\n"
-        
-        section += "\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        
-        return section
-    
-    def _generate_savings_analysis(self, savings: float, category_summary: Dict) -> str:
+            parts.append("⚠️ Портфель показывает убыток. Рекомендуется пересмотреть стратегию!\n")
+
+        parts.append("\n" + self.SEPARATOR)
+
+        return "".join(parts)
+
+    def _generate_savings_analysis(self, m: ReportMetrics) -> str:
         """Генерирует анализ сбережений"""
-        total_income = category_summary['total_income']
-        total_expense = category_summary['total_expense']
-        balance = category_summary['balance']
-        
+        savings = m.savings
+        balance = m.balance
+
         # Оценка финансовой подушки (сколько месяцев хватит)
-        months_covered = (savings / total_expense) if total_expense > 0 else 0
-        
-        # Норма сбережений (отношение к доходу)
-        savings_rate = (savings / total_income * 100) if total_income > 0 else 0
-        
-        section = f"""
+        months_covered = m.months_covered
+
+        # Норма сбережений (отношение накоплений к доходу)
+        savings_rate = (savings / m.total_income * 100) if m.total_income > 0 else 0
+
+        parts = [f"""
 ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
 ┃  🏦 РАЗДЕЛ 7: АНАЛИЗ СБЕРЕЖЕНИЙ  ┃
 ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
@@ -876,66 +1046,62 @@ class FinancialAnalytics:
 
 └──────────────────────────────────────────────────────┘
 
-"""
-        
+"""]
+
         # Оценка и рекомендации
-        section += "┌─ ОЦЕНКА ФИНАНСОВОЙ ПОДУШКИ ──────────────────────────┐\n\n"
-        
+        parts.append("┌─ ОЦЕНКА ФИНАНСОВОЙ ПОДУШКИ ──────────────────────────┐\n\n")
+
         if months_covered >= 6:
-            section += "🌟 ОТЛИЧНО! Ваша финансовая подушка покрывает более 6 месяцев\n"
-            section += "   расходов. Это обеспечивает высокий уровень финансовой\n"
-            section += "   безопасности!\n\n"
+            parts.append(
+                "🌟 ОТЛИЧНО! Ваша финансовая подушка покрывает более 6 месяцев\n"
+                "   расходов. Это обеспечивает высокий уровень финансовой\n"
+                "   безопасности!\n\n"
+            )
         elif months_covered >= 3:
-            section += "✅ ХОРОШО! У вас есть резерв на 3-6 месяцев. Рекомендуется\n"
-            section += "   постепенно увеличивать подушку до 6 месяцев расходов.\n\n"
+            parts.append(
+                "✅ ХОРОШО! У вас есть резерв на 3-6 месяцев. Рекомендуется\n"
+                "   постепенно увеличивать подушку до 6 месяцев расходов.\n\n"
+            )
         elif months_covered >= 1:
-            section += "⚠️ ВНИМАНИЕ! Резерва хватит на 1-3 месяца. Стоит активно\n"
-            section += "   формировать финансовую подушку для большей стабильности.\n\n"
+            parts.append(
+                "⚠️ ВНИМАНИЕ! Резерва хватит на 1-3 месяца. Стоит активно\n"
+                "   формировать финансовую подушку для большей стабильности.\n\n"
+            )
         else:
-            section += "🚨 КРИТИЧНО! Финансовая подушка менее 1 месяца расходов.\n"
-            section += "   Настоятельно рекомендуется начать экстренное накопление!\n\n"
-        
-        section += "└──────────────────────────────────────────────────────┘\n\n"
-        
-        section += "┌─ РЕКОМЕНДАЦИИ ПО СБЕРЕЖЕНИЯМ ────────────────────────┐\n\n"
-        
+            parts.append(
+                "🚨 КРИТИЧНО! Финансовая подушка менее 1 месяца расходов.\n"
+                "   Настоятельно рекомендуется начать экстренное накопление!\n\n"
+            )
+
+        parts.append("└──────────────────────────────────────────────────────┘\n\n")
+
+        parts.append("┌─ РЕКОМЕНДАЦИИ ПО СБЕРЕЖЕНИЯМ ────────────────────────┐\n\n")
+
         if savings_rate < 10:
-            section += "💡 Увеличьте долю сбережений до 10-20% от дохода\n"
+            parts.append("💡 Увеличьте долю сбережений до 10-20% от дохода\n")
         elif savings_rate < 20:
-            section += "💡 Хорошая норма сбережений! Попробуйте довести до 20%\n"
+            parts.append("💡 Хорошая норма сбережений! Попробуйте довести до 20%\n")
         else:
-            section += "💡 Отличная норма сбережений! Рассмотрите инвестиции\n"
-        
-        section += "💡 Автоматизируйте отчисления на сберегательный счёт\n"
-        section += "💡 Держите резерв на высоколиквидных счетах\n"
-        section += "💡 Разделите подушку: экстренный фонд + целевые накопления\n\n"
-        
-        section += "└──────────────────────────────────────────────────────┘\n\n"
-        
-        section += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        
-        return section
-    
-    def _generate_financial_ratios(self, net_worth: Dict, category_summary: Dict, 
-                                   credits: List, savings: float) -> str:
+            parts.append("💡 Отличная норма сбережений! Рассмотрите инвестиции\n")
+
+        parts.append(
+            "💡 Автоматизируйте отчисления на сберегательный счёт\n"
+            "💡 Держите резерв на высоколиквидных счетах\n"
+            "💡 Разделите подушку: экстренный фонд + целевые накопления\n\n"
+        )
+
+        parts.append("└──────────────────────────────────────────────────────┘\n\n")
+        parts.append(self.SEPARATOR)
+
+        return "".join(parts)
+
+    def _generate_financial_ratios(self, m: ReportMetrics) -> str:
         """Генерирует ключевые финансовые коэффициенты"""
-        total_income = category_summary['total_income']
-        total_expense = category_summary['total_expense']
-        total_assets = net_worth['total_assets']
-        total_liabilities = net_worth['total_liabilities']
-        
-        # Активные кредиты
-        active_credits = [c for c in credits if c['is_active']]
-        monthly_credit_payment = sum(c['monthly_payment'] for c in active_credits)
-        
-        # Коэффициенты
-        debt_to_income = (monthly_credit_payment / (total_income / 30 * 365 / 12) * 100) if total_income > 0 else 0
-        debt_to_asset = (total_liabilities / total_assets * 100) if total_assets > 0 else 0
-        liquidity_ratio = (savings / total_expense) if total_expense > 0 else 0
-        savings_rate = ((total_income - total_expense) / total_income * 100) if total_income > 0 else 0
-        financial_independence = (net_worth['net_worth'] / total_income * 100) if total_income > 0 else 0
-        
-        section = f"""
+        debt_to_income = m.debt_to_income
+        liquidity_ratio = m.months_covered
+        savings_rate = m.savings_rate
+
+        return f"""
 ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
 ┃  📊 РАЗДЕЛ 8: ФИНАНСОВЫЕ КОЭФФИЦИЕНТЫ  ┃
 ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
@@ -947,8 +1113,8 @@ class FinancialAnalytics:
    {self._get_dti_verdict(debt_to_income)}
 
 2️⃣ Отношение долга к активам
-   ⚖️ {debt_to_asset:.1f}% активов покрыто обязательствами
-   {self._get_debt_to_asset_verdict(debt_to_asset)}
+   ⚖️ {m.debt_to_asset:.1f}% активов покрыто обязательствами
+   {self._get_debt_to_asset_verdict(m.debt_to_asset)}
 
 3️⃣ Коэффициент ликвидности
    💧 Сбережения покрывают {liquidity_ratio:.1f} месяцев расходов
@@ -959,8 +1125,8 @@ class FinancialAnalytics:
    {self._get_savings_rate_verdict(savings_rate)}
 
 5️⃣ Коэффициент финансовой независимости
-   🎯 Капитал составляет {financial_independence:.1f}% годового дохода
-   {self._get_independence_verdict(financial_independence)}
+   🎯 Капитал составляет {m.financial_independence:.1f}% годового дохода
+   {self._get_independence_verdict(m.financial_independence)}
 
 └──────────────────────────────────────────────────────┘
 
@@ -973,16 +1139,15 @@ class FinancialAnalytics:
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
 """
-        
-        return section
-    
-    def _generate_recommendations(self, net_worth: Dict, category_summary: Dict, 
-                                 credits: List, savings: float) -> str:
+
+    def _generate_recommendations(self, m: ReportMetrics) -> str:
         """Генерирует персонализированные рекомендации"""
+        net_worth = m.net_worth
+        savings = m.savings
         recommendations = []
-        
+
         # Анализируем ситуацию и формируем рекомендации
-        
+
         # 1. По чистому капиталу
         if net_worth['net_worth'] < 0:
             recommendations.append(
@@ -997,68 +1162,59 @@ class FinancialAnalytics:
                 "   • Увеличьте долю инвестиций\n"
                 "   • Минимизируйте кредитную нагрузку"
             )
-        
+
         # 2. По сбережениям
-        total_expense = category_summary['total_expense']
-        months_covered = (savings / total_expense) if total_expense > 0 else 0
-        
-        if months_covered < 3:
+        if m.months_covered < 3:
             recommendations.append(
                 "💰 Недостаточная финансовая подушка\n"
                 "   • Цель: накопить на 6 месяцев расходов\n"
                 "   • Автоматизируйте ежемесячные отчисления\n"
                 "   • Откладывайте 10-20% дохода"
             )
-        
+
         # 3. По кредитам
-        active_credits = [c for c in credits if c['is_active']]
-        if active_credits:
-            total_credit_debt = sum(c['remaining_debt'] for c in active_credits)
-            avg_rate = sum(c['interest_rate'] for c in active_credits) / len(active_credits)
-            
-            if avg_rate > 12:
+        if m.active_credits:
+            if m.avg_credit_rate > 12:
                 recommendations.append(
                     "💳 Высокая процентная ставка по кредитам\n"
                     "   • Рассмотрите рефинансирование\n"
                     "   • Досрочное погашение самого дорогого кредита\n"
                     "   • Стратегия Avalanche для минимизации переплаты"
                 )
-            
-            if total_credit_debt > net_worth['total_assets'] * 0.5:
+
+            if m.total_credit_debt > net_worth['total_assets'] * 0.5:
                 recommendations.append(
                     "⚖️ Высокая долговая нагрузка\n"
                     "   • Приоритет - погашение долгов\n"
                     "   • Избегайте новых кредитов\n"
                     "   • Увеличьте ежемесячные платежи если возможно"
                 )
-        
+
         # 4. По доходам и расходам
-        balance = category_summary['balance']
-        
-        if balance < 0:
+        if m.balance < 0:
             recommendations.append(
                 "📉 Расходы превышают доходы!\n"
                 "   • СРОЧНО сократите необязательные траты\n"
                 "   • Проанализируйте каждую категорию расходов\n"
                 "   • Составьте строгий бюджет"
             )
-        elif balance < category_summary['total_income'] * 0.1:
+        elif m.balance < m.total_income * 0.1:
             recommendations.append(
                 "💸 Низкий уровень сбережений\n"
                 "   • Стремитесь откладывать минимум 10% дохода\n"
                 "   • Оптимизируйте расходы\n"
                 "   • Используйте правило 50/30/20"
             )
-        
+
         # 5. По инвестициям
-        if net_worth['investments'] == 0 and savings > total_expense * 3:
+        if net_worth['investments'] == 0 and savings > m.total_expense * 3:
             recommendations.append(
                 "📈 Пора начать инвестировать!\n"
                 "   • У вас есть достаточная финансовая подушка\n"
                 "   • Рассмотрите консервативный портфель\n"
                 "   • Начните с фондового рынка или ПИФов"
             )
-        
+
         # 6. Общие советы
         if len(recommendations) == 0:
             recommendations.append(
@@ -1068,29 +1224,124 @@ class FinancialAnalytics:
                 "   • Рассмотрите благотворительность\n"
                 "   • Инвестируйте в личное развитие"
             )
-        
-        section = f"""
+
+        parts = ["""
 ┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
 ┃  💡 РАЗДЕЛ 9: ПЕРСОНАЛЬНЫЕ РЕКОМЕНДАЦИИ  ┃
 ┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
 
 На основе анализа ваших финансов:
 
-"""
-        
-        for i, rec in enumerate(recommendations, 1):
-            section += f"{i}. {rec}\n\n"
-        
+"""]
+
+        parts.extend(f"{i}. {rec}\n\n" for i, rec in enumerate(recommendations, 1))
+
         # Добавляем случайные общие советы
-        section += "┌─ ДОПОЛНИТЕЛЬНЫЕ СОВЕТЫ ──────────────────────────────┐\n\n"
-        
-        for _ in range(3):
-            section += f"   {self.phrases.get_recommendation()}\n"
-        
-        section += "\n└──────────────────────────────────────────────────────┘\n\n"
-        
-        return section
+        parts.append("┌─ ДОПОЛНИТЕЛЬНЫЕ СОВЕТЫ ──────────────────────────────┐\n\n")
+        parts.extend(f"   {self.phrases.get_recommendation()}\n" for _ in range(3))
+        parts.append("\n└──────────────────────────────────────────────────────┘\n\n")
+
+        return "".join(parts)
     
+    # ==================== СРАВНЕНИЕ ПЕРИОДОВ ====================
+
+    def generate_period_comparison(self, user_id: int, periods: int = 6, window: int = 3) -> str:
+        """
+        Сравнение месяцев: динамика итогов, приросты по категориям,
+        скользящие средние и сравнение с тем же месяцем год назад
+
+        Строится по помесячным итогам (Database.get_category_period_comparison),
+        поэтому не зависит от количества операций пользователя.
+
+        Args:
+            user_id: ID пользователя
+            periods: Количество месяцев для сравнения
+            window: Окно скользящего среднего в месяцах
+
+        Returns:
+            Текстовый отчёт
+        """
+        rows = self.db.get_category_period_comparison(user_id, periods, window)
+
+        if not any(row['total'] for row in rows):
+            return (
+                "📊 СРАВНЕНИЕ ПЕРИОДОВ\n\n"
+                f"⚠️ За последние {periods} мес. нет доходов и расходов для сравнения."
+            )
+
+        months = sorted({row['month'] for row in rows})
+        current_month = months[-1]
+        previous_month = months[-2] if len(months) > 1 else None
+
+        totals = {month: {'income': 0, 'expense': 0} for month in months}
+        latest = {'income': [], 'expense': []}
+        for row in rows:
+            totals[row['month']][row['kind']] += row['total']
+            if row['month'] == current_month and (row['total'] or row['prev_total']):
+                latest[row['kind']].append(row)
+
+        parts = [
+            "📊 СРАВНЕНИЕ ПЕРИОДОВ\n",
+            f"Последние {len(months)} мес. (текущий месяц — по сегодняшний день)\n\n",
+            "📅 ИТОГИ ПО МЕСЯЦАМ\n",
+            "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n",
+        ]
+
+        prev_expense = None
+        for month in months:
+            income = totals[month]['income']
+            expense = totals[month]['expense']
+            trend = self._format_growth(expense, prev_expense) if prev_expense is not None else ""
+            parts.append(
+                f"{self._format_month(month)}: 💰 {income:,.0f}  🛒 {expense:,.0f}"
+                f"{f' ({trend})' if trend else ''}  ⚖️ {income - expense:,.0f}\n"
+            )
+            prev_expense = expense
+
+        sections = (
+            ('expense', "🛒 РАСХОДЫ ПО КАТЕГОРИЯМ"),
+            ('income', "💰 ДОХОДЫ ПО КАТЕГОРИЯМ"),
+        )
+        for kind, title in sections:
+            if not latest[kind]:
+                continue
+
+            parts.append(f"\n{title}\n")
+            if previous_month:
+                parts.append(
+                    f"{self._format_month(current_month)} к {self._format_month(previous_month)}, "
+                    f"среднее за {window} мес., год назад\n"
+                )
+            parts.append("━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n")
+
+            for row in latest[kind]:
+                delta = row['total'] - (row['prev_total'] or 0)
+                parts.append(
+                    f"• {row['category_name']}: {row['total']:,.2f} руб.\n"
+                    f"   Δ {delta:+,.2f} руб. ({self._format_growth(row['total'], row['prev_total'])})\n"
+                    f"   Среднее: {row['rolling_avg']:,.2f} руб.\n"
+                )
+                if row['year_ago_total']:
+                    parts.append(
+                        f"   Год назад: {row['year_ago_total']:,.2f} руб. "
+                        f"({self._format_growth(row['total'], row['year_ago_total'])})\n"
+                    )
+
+        return "".join(parts)
+
+    @staticmethod
+    def _format_growth(current: float, previous: float) -> str:
+        """Темп прироста в процентах или отметка о новой категории"""
+        if not previous:
+            return "новое" if current else "—"
+        return f"{(current - previous) / previous * 100:+.1f}%"
+
+    @staticmethod
+    def _format_month(month: str) -> str:
+        """'YYYY-MM' -> 'MM.YYYY'"""
+        year, month_num = month.split('-')
+        return f"{month_num}.{year}"
+
     # Вспомогательные методы для комментариев
     
     def _get_savings_comment(self, amount: float) -> str:
@@ -1104,16 +1355,11 @@ class FinancialAnalytics:
         else:
             return "Впечатляющие накопления!"
     
-    def _get_investment_comment(self, amount: float) -> str:
-        """Комментарий к инвестициям"""
+    def _get_portfolio_comment(self, amount: float, return_pct: float) -> str:
+        """Комментарий к инвестиционному портфелю в целом"""
         if amount == 0:
             return "Рассмотрите возможность инвестирования"
-        elif amount < 100000:
-            return "Начало положено"
-        elif amount < 1000000:
-            return "Хороший инвестиционный портфель"
-        else:
-            return "Серьёзный инвестор!"
+        return self._get_investment_comment('', return_pct)
     
     def _get_credit_burden_comment(self, amount: float) -> str:
         """Комментарий к кредитной нагрузке"""
@@ -5,8 +5,12 @@
 Использование:
     python backup.py                    # Создать резервную копию
     python backup.py --restore backup.db # Восстановить из копии
+    python backup.py --incremental      # Инкрементальная копия
+    python backup.py --restore-to "2025-01-01 12:00" --output restored.db  # На момент времени
     python backup.py --list             # Показать список копий
+    python backup.py --chain            # Показать цепочку копий
     python backup.py --cleanup          # Удалить старые копии
+    python backup.py --maintenance      # ANALYZE, incremental_vacuum, проверка таблиц
 """
 
 import argparse
@@ -18,6 +22,9 @@ from datetime import datetime
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from utils import BackupManager, DatabaseValidator
+from backup_jobs import get_last_runs
+from change_journal import restore_to_point
+from maintenance import DatabaseMaintenance
 from logger_config import setup_logger
 
 logger = setup_logger("backup")
@@ -35,10 +42,16 @@ def create_backup(backup_manager: BackupManager) -> bool:
     """
     print("🔄 Создание резервной копии...")
     
-    backup_path = backup_manager.create_backup()
+    def show_progress(copied: int, total: int):
+        percent = copied / total * 100 if total else 100
+        print(f"\r   📄 Страниц: {copied}/{total} ({percent:.0f}%)", end="", flush=True)
+    
+    backup_path = backup_manager.create_backup(progress=show_progress)
+    print()
     
     if backup_path:
         print(f"✅ Резервная копия создана: {backup_path}")
+        print("✅ Проверка quick_check пройдена")
         
         # Проверяем размер
         size_mb = os.path.getsize(backup_path) / (1024 * 1024)
@@ -87,6 +100,110 @@ def restore_backup(backup_manager: BackupManager, backup_path: str) -> bool:
         return False
 
 
+def restore_to_time(backup_manager: BackupManager, moment: str, output_path: str) -> bool:
+    """
+    Восстановить базу на момент времени в новый файл
+    
+    Args:
+        backup_manager: Менеджер резервных копий
+        moment: Момент в формате "ГГГГ-ММ-ДД ЧЧ:ММ[:СС]" (локальное время)
+        output_path: Путь к новому файлу базы
+        
+    Returns:
+        True при успехе
+    """
+    try:
+        target_time = datetime.fromisoformat(moment)
+    except ValueError:
+        print(f"❌ Неверный формат времени: {moment} (нужно ГГГГ-ММ-ДД ЧЧ:ММ[:СС])")
+        return False
+    
+    print(f"🔄 Восстановление на {target_time.strftime('%d.%m.%Y %H:%M:%S')} в {output_path}...")
+    
+    def show_progress(applied: int, last_ts: str):
+        print(f"\r   📝 Применено изменений: {applied} (до {last_ts or '—'} UTC)", end="", flush=True)
+    
+    journal_dir = backup_manager.journal_dir
+    result = restore_to_point(
+        backup_manager, journal_dir, target_time, output_path,
+        source_db=backup_manager.db_path, progress=show_progress
+    )
+    print()
+    
+    print(f"📦 Базовая копия: {result['base_backup']}")
+    print(f"✅ Применено изменений журнала: {result['applied']}")
+    
+    if DatabaseValidator(output_path).quick_check():
+        print("✅ Проверка quick_check пройдена")
+    else:
+        print("⚠️  Предупреждение: проблемы с целостностью восстановленной базы")
+        return False
+    
+    print(f"💡 Проверьте {output_path} и замените им рабочую базу при остановленном боте")
+    return True
+
+
+# Типы копий цепочки для вывода
+CHAIN_KINDS = {'full': "полная", 'delta': "разностная", 'journal': "по журналу"}
+
+
+def create_incremental_backup(backup_manager: BackupManager, full: bool = False) -> bool:
+    """
+    Добавить копию в инкрементальную цепочку
+    
+    Args:
+        backup_manager: Менеджер резервных копий
+        full: Начать новую цепочку с полной копии
+        
+    Returns:
+        True при успехе
+    """
+    print("🔄 Создание инкрементальной копии...")
+    
+    manifest = backup_manager.create_incremental_backup(full=full)
+    
+    if manifest:
+        kind = CHAIN_KINDS.get(manifest['kind'], manifest['kind'])
+        print(f"✅ Копия {manifest['id']} создана ({kind})")
+        if manifest['kind'] == 'journal':
+            print(f"📝 Записей журнала: {manifest['records']}")
+        else:
+            print(f"📄 Изменено страниц: {manifest['changed_pages']} из {manifest['page_count']}")
+        print(f"📦 Записано: {manifest['stored_bytes'] / 1024:.2f} KB за {manifest['duration_seconds']:.2f} сек.")
+        return True
+    else:
+        print("❌ Ошибка при создании инкрементальной копии")
+        return False
+
+
+def list_chain(backup_manager: BackupManager):
+    """
+    Показать инкрементальную цепочку копий
+    
+    Args:
+        backup_manager: Менеджер резервных копий
+    """
+    chain = backup_manager.list_chain()
+    
+    if not chain:
+        print("📭 Инкрементальных копий не найдено")
+        return
+    
+    print(f"\n🔗 Копий в цепочке: {len(chain)}\n")
+    print(f"{'ID':<24} {'Тип':<8} {'Изменений':>9} {'Записано':>12}")
+    print("-" * 56)
+    
+    for manifest in chain:
+        changes = manifest['records'] if manifest['kind'] == 'journal' else manifest['changed_pages']
+        print(f"{manifest['id']:<24} {manifest['kind']:<8} {changes:>9} "
+              f"{manifest['stored_bytes'] / 1024:>9.2f} KB")
+    
+    total = sum(m['stored_bytes'] for m in chain) / (1024 * 1024)
+    print("-" * 56)
+    print(f"Всего записано: {total:.2f} MB")
+    print("\nВосстановление: python backup.py --restore <ID>")
+
+
 def list_backups(backup_manager: BackupManager):
     """
     Показать список резервных копий
@@ -115,44 +232,87 @@ def list_backups(backup_manager: BackupManager):
     print(f"Общий размер: {total_size:.2f} MB")
 
 
-def cleanup_old_backups(backup_manager: BackupManager, keep_count: int = 10):
+def cleanup_old_backups(backup_manager: BackupManager, keep_count: int = 10, keep_full: int = 2):
     """
     Удалить старые резервные копии
     
     Args:
         backup_manager: Менеджер резервных копий
         keep_count: Количество копий для сохранения
+        keep_full: Количество полных копий цепочки для сохранения
     """
     backups = backup_manager.list_backups()
+    chain = backup_manager.list_chain()
+    fulls = [m for m in chain if m['kind'] == 'full']
     
-    if len(backups) <= keep_count:
-        print(f"✅ Всего {len(backups)} копий, очистка не требуется")
+    to_delete_count = max(len(backups) - keep_count, 0)
+    chain_cleanup = len(fulls) > keep_full
+    
+    if not to_delete_count and not chain_cleanup:
+        print(f"✅ Всего {len(backups)} копий и {len(fulls)} полных копий в цепочке, очистка не требуется")
         return
     
-    to_delete_count = len(backups) - keep_count
-    print(f"🗑️  Будет удалено {to_delete_count} старых копий (оставим последние {keep_count})")
+    if to_delete_count:
+        print(f"🗑️  Будет удалено {to_delete_count} старых копий (оставим последние {keep_count})")
+    if chain_cleanup:
+        print(f"🗑️  В цепочке останутся последние {keep_full} полных копий с их изменениями")
     
     response = input("Продолжить? (yes/no): ")
     if response.lower() != 'yes':
         print("❌ Отменено")
         return
     
-    backup_manager.cleanup_old_backups(keep_count)
-    print(f"✅ Удалено {to_delete_count} старых копий")
+    if to_delete_count:
+        backup_manager.cleanup_old_backups(keep_count)
+        print(f"✅ Удалено {to_delete_count} старых копий")
+    if chain_cleanup:
+        removed = backup_manager.cleanup_chain(keep_full)
+        print(f"✅ Удалено {removed} копий из цепочки")
+
+
+def show_job_status(backup_dir: str):
+    """
+    Показать результаты последних фоновых задач резервного копирования
+    
+    Args:
+        backup_dir: Директория резервных копий
+    """
+    last_runs = get_last_runs(backup_dir)
+    
+    if not last_runs:
+        print("📭 Фоновые задачи ещё не запускались")
+        return
+    
+    print("\n⏱  Последние запуски фоновых задач:\n")
+    for job, record in last_runs.items():
+        status = "✅" if record.get('ok') else "❌"
+        size_kb = record.get('size_bytes', 0) / 1024
+        print(f"{status} {job}: {record['started']}, {record['duration_seconds']:.2f} сек., {size_kb:.2f} KB")
 
 
-def check_database(validator: DatabaseValidator):
+def check_database(validator: DatabaseValidator, full: bool = False):
     """
     Проверить базу данных
     
     Args:
         validator: Валидатор базы данных
+        full: Полная проверка integrity_check вместо quick_check
+            и поочерёдной проверки таблиц
     """
     print("🔍 Проверка базы данных...\n")
     
     # Проверка целостности
-    print("1️⃣  Проверка целостности...")
-    if validator.check_integrity():
+    if full:
+        print("1️⃣  Полная проверка целостности...")
+        ok = validator.check_integrity()
+    else:
+        print("1️⃣  Быстрая проверка целостности...")
+        maintenance = DatabaseMaintenance(validator.db_path)
+        ok = validator.quick_check()
+        checked = maintenance.check_tables_incrementally()
+        ok = ok and all(result['ok'] for result in checked.values())
+        print(f"   🔎 Полностью проверены таблицы: {', '.join(checked) or '—'}")
+    if ok:
         print("   ✅ OK")
     else:
         print("   ❌ Обнаружены проблемы!")
@@ -188,6 +348,39 @@ def check_database(validator: DatabaseValidator):
     
     if 'investments_count' in stats:
         print(f"   📊 Инвестиций: {stats['investments_count']}")
+    
+    if stats.get('estimated'):
+        print("   ℹ️  Количество записей - оценка по статистике ANALYZE")
+
+
+def run_maintenance(db_path: str, enable_incremental: bool = False) -> bool:
+    """
+    Выполнить плановое обслуживание базы
+    
+    Args:
+        db_path: Путь к базе данных
+        enable_incremental: Сначала перевести базу в режим incremental auto_vacuum
+        
+    Returns:
+        True если проверенные таблицы в порядке
+    """
+    maintenance = DatabaseMaintenance(db_path)
+    
+    if enable_incremental:
+        print("🔄 Перевод базы в режим incremental auto_vacuum (полный VACUUM)...")
+        maintenance.enable_incremental_vacuum()
+    
+    print("🔧 Обслуживание базы данных...")
+    result = maintenance.run_scheduled()
+    print(f"   📊 ANALYZE/optimize: {result['analyze_seconds']:.3f} сек.")
+    print(f"   🧹 Освобождено страниц: {result['freed_pages']}")
+    print(f"   🔎 Проверены таблицы: {', '.join(result['checked_tables']) or '—'}")
+    
+    if result['ok']:
+        print("✅ Обслуживание завершено")
+    else:
+        print(f"❌ Ошибки в таблицах: {', '.join(result['failed_tables'])}")
+    return result['ok']
 
 
 def main():
@@ -199,9 +392,17 @@ def main():
 Примеры использования:
   python backup.py                               # Создать резервную копию
   python backup.py --restore backups/backup.db   # Восстановить из копии
+  python backup.py --incremental                 # Инкрементальная копия
+  python backup.py --restore 20250101_030000_000000  # Восстановить копию из цепочки
   python backup.py --list                        # Показать список копий
+  python backup.py --chain                       # Показать цепочку копий
+  python backup.py --restore-to "2025-01-01 12:00" --output restored.db
+                                                 # Восстановить на момент времени
   python backup.py --cleanup --keep 5            # Оставить только 5 последних копий
+  python backup.py --status                      # Последние фоновые копии бота
   python backup.py --check                       # Проверить базу данных
+  python backup.py --check --full                # Полная проверка integrity_check
+  python backup.py --maintenance                 # Плановое обслуживание базы
         """
     )
     
@@ -217,10 +418,61 @@ def main():
         help='Директория для резервных копий (по умолчанию: backups)'
     )
     
+    parser.add_argument(
+        '--pages',
+        type=int,
+        default=BackupManager.PAGES_PER_STEP,
+        help=f'Страниц за один шаг копирования (по умолчанию: {BackupManager.PAGES_PER_STEP})'
+    )
+    
+    parser.add_argument(
+        '--sleep',
+        type=float,
+        default=BackupManager.STEP_SLEEP,
+        help=f'Пауза между шагами в секундах (по умолчанию: {BackupManager.STEP_SLEEP})'
+    )
+    
     parser.add_argument(
         '--restore',
-        metavar='BACKUP_FILE',
-        help='Восстановить базу данных из резервной копии'
+        metavar='BACKUP',
+        help='Восстановить базу данных из файла копии или по ID копии из цепочки'
+    )
+    
+    parser.add_argument(
+        '--restore-to',
+        metavar='TIME',
+        help='Восстановить на момент времени "ГГГГ-ММ-ДД ЧЧ:ММ[:СС]" (нужен --output)'
+    )
+    
+    parser.add_argument(
+        '--output',
+        help='С --restore-to: путь к новому файлу базы'
+    )
+    
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Создать инкрементальную копию (только изменённые страницы)'
+    )
+    
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='С --incremental: начать новую цепочку с полной копии; '
+             'с --check: полная проверка integrity_check'
+    )
+    
+    parser.add_argument(
+        '--chain',
+        action='store_true',
+        help='Показать инкрементальную цепочку копий'
+    )
+    
+    parser.add_argument(
+        '--keep-full',
+        type=int,
+        default=2,
+        help='Сколько полных копий цепочки оставлять при очистке (по умолчанию: 2)'
     )
     
     parser.add_argument(
@@ -242,16 +494,34 @@ def main():
         help='Количество копий для сохранения при очистке (по умолчанию: 10)'
     )
     
+    parser.add_argument(
+        '--status',
+        action='store_true',
+        help='Показать последние запуски фоновых задач бота'
+    )
+    
     parser.add_argument(
         '--check',
         action='store_true',
         help='Проверить целостность базы данных'
     )
     
+    parser.add_argument(
+        '--maintenance',
+        action='store_true',
+        help='Обслуживание: ANALYZE/optimize, incremental_vacuum, проверка таблиц'
+    )
+    
+    parser.add_argument(
+        '--enable-incremental-vacuum',
+        action='store_true',
+        help='С --maintenance: перевести базу в режим incremental auto_vacuum (при остановленном боте)'
+    )
+    
     args = parser.parse_args()
     
     # Создаём менеджер и валидатор
-    backup_manager = BackupManager(args.db, args.backup_dir)
+    backup_manager = BackupManager(args.db, args.backup_dir, args.pages, args.sleep)
     validator = DatabaseValidator(args.db)
     
     # Выполняем запрошенное действие
@@ -259,18 +529,40 @@ def main():
         success = restore_backup(backup_manager, args.restore)
         sys.exit(0 if success else 1)
     
+    elif args.restore_to:
+        if not args.output:
+            parser.error("--restore-to требует --output")
+        success = restore_to_time(backup_manager, args.restore_to, args.output)
+        sys.exit(0 if success else 1)
+    
+    elif args.incremental:
+        success = create_incremental_backup(backup_manager, args.full)
+        sys.exit(0 if success else 1)
+    
     elif args.list:
         list_backups(backup_manager)
         sys.exit(0)
     
+    elif args.chain:
+        list_chain(backup_manager)
+        sys.exit(0)
+    
     elif args.cleanup:
-        cleanup_old_backups(backup_manager, args.keep)
+        cleanup_old_backups(backup_manager, args.keep, args.keep_full)
+        sys.exit(0)
+    
+    elif args.status:
+        show_job_status(args.backup_dir)
         sys.exit(0)
     
     elif args.check:
-        check_database(validator)
+        check_database(validator, args.full)
         sys.exit(0)
     
+    elif args.maintenance:
+        success = run_maintenance(args.db, args.enable_incremental_vacuum)
+        sys.exit(0 if success else 1)
+    
     else:
         # По умолчанию создаём резервную копию
         success = create_backup(backup_manager)
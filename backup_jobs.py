@@ -0,0 +1,225 @@
+"""
+Фоновые задачи резервного копирования
+
+Планировщик бота (main.py) периодически добавляет копию в инкрементальную
+цепочку, чистит старые копии, проверяет целостность базы и обслуживает
+её (см. maintenance.py). Все задачи
+выполняются в одном рабочем потоке, а копирование идёт порциями с паузами
+(см. BackupManager), поэтому обработка сообщений не останавливается.
+
+Если включён журнал изменений (change_journal.py), его записи
+периодически переносятся в архив backup_dir/journal для восстановления
+на момент времени.
+
+Результат последнего запуска каждой задачи (время, длительность, объём)
+сохраняется в backup_dir/last_runs.json.
+
+В режиме шардов (DB_SHARDS, см. partitions.py) у каждого файла-шарда
+свои задачи и своя цепочка копий в backup_dir/shards/shard_NNN, а все
+задачи по-прежнему идут по очереди в одном рабочем потоке (см.
+create_backup_runners).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional
+
+from change_journal import archive_journal, prune_segments
+from maintenance import DatabaseMaintenance
+from utils import BackupManager, DatabaseValidator
+
+logger = logging.getLogger(__name__)
+
+
+class BackupJobRunner:
+    """Запуск задач резервного копирования в рабочем потоке"""
+
+    STATUS_FILENAME = "last_runs.json"
+    JOURNAL_DIRNAME = "journal"
+
+    def __init__(self, db_path: str = "dohot.db", backup_dir: str = "backups",
+                 pages_per_step: int = BackupManager.PAGES_PER_STEP,
+                 step_sleep: float = BackupManager.STEP_SLEEP,
+                 keep_count: int = 10, keep_full: int = 2,
+                 executor: Optional[ThreadPoolExecutor] = None):
+        self.manager = BackupManager(db_path, backup_dir, pages_per_step, step_sleep,
+                                     journal_dir=os.path.join(backup_dir, self.JOURNAL_DIRNAME))
+        self.validator = DatabaseValidator(db_path)
+        self.maintenance = DatabaseMaintenance(db_path)
+        self.keep_count = keep_count
+        self.keep_full = keep_full
+        self.status_path = os.path.join(backup_dir, self.STATUS_FILENAME)
+        self.journal_dir = self.manager.journal_dir
+        self.last_runs = self._load_status()
+
+        # Один поток: задачи не конкурируют друг с другом за диск.
+        # Задачи шардов получают общий поток основной базы
+        self._executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix='backup')
+
+    def _load_status(self) -> Dict[str, Dict]:
+        """Прочитать результаты прошлых запусков"""
+        try:
+            with open(self.status_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_status(self):
+        """Сохранить результаты запусков"""
+        try:
+            with open(self.status_path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump(self.last_runs, f, ensure_ascii=False, indent=2)
+            os.replace(self.status_path + ".tmp", self.status_path)
+        except OSError as e:
+            logger.error(f"Error saving backup job status: {e}")
+
+    async def _run(self, job: str, func: Callable[[], Dict]) -> Dict:
+        """
+        Выполнить задачу в рабочем потоке и записать результат
+
+        Args:
+            job: Название задачи
+            func: Функция, возвращающая словарь с результатом ('ok', 'size_bytes', ...)
+
+        Returns:
+            Запись о запуске
+        """
+        started = datetime.now()
+        started_clock = time.monotonic()
+        loop = asyncio.get_running_loop()
+
+        try:
+            result = await loop.run_in_executor(self._executor, func)
+        except Exception as e:
+            logger.error(f"Error running backup job {job}: {e}")
+            result = {'ok': False, 'error': str(e)}
+
+        record = {
+            'started': started.isoformat(timespec='seconds'),
+            'duration_seconds': round(time.monotonic() - started_clock, 3),
+            **result
+        }
+        self.last_runs[job] = record
+        self._save_status()
+
+        log = logger.info if record.get('ok') else logger.error
+        log(f"Backup job {job} finished: {record}")
+        return record
+
+    # ==================== ЗАДАЧИ ====================
+
+    def _backup(self) -> Dict:
+        manifest = self.manager.create_incremental_backup()
+        if manifest is None:
+            return {'ok': False, 'size_bytes': 0}
+        return {
+            'ok': True,
+            'id': manifest['id'],
+            'kind': manifest['kind'],
+            'changed_pages': manifest['changed_pages'],
+            'records': manifest.get('records', 0),
+            'size_bytes': manifest['stored_bytes']
+        }
+
+    def _retention(self) -> Dict:
+        self.manager.cleanup_old_backups(self.keep_count)
+        removed = self.manager.cleanup_chain(self.keep_full)
+        # Сегменты журнала до самой старой хранимой основы восстановлению не нужны
+        kept_seqs = [m['journal_seq'] for m in self.manager.list_chain() if m.get('journal_active')]
+        segments = prune_segments(self.journal_dir, min(kept_seqs)) if kept_seqs else 0
+        chain_dir = self.manager.chain_dir
+        size = sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(chain_dir) for name in names
+        ) if os.path.exists(chain_dir) else 0
+        return {'ok': True, 'removed': removed, 'segments_removed': segments, 'size_bytes': size}
+
+    def _integrity_check(self) -> Dict:
+        return {
+            'ok': self.validator.quick_check(),
+            'size_bytes': os.path.getsize(self.validator.db_path) if os.path.exists(self.validator.db_path) else 0
+        }
+
+    def _maintenance(self) -> Dict:
+        result = self.maintenance.run_scheduled()
+        result['size_bytes'] = os.path.getsize(self.maintenance.db_path)
+        return result
+
+    def _journal_archive(self) -> Dict:
+        result = archive_journal(self.manager.db_path, self.journal_dir)
+        return {
+            'ok': True,
+            'records': result['records'],
+            'size_bytes': os.path.getsize(result['path']) if result['path'] else 0
+        }
+
+    async def run_backup(self) -> Dict:
+        """Добавить копию в инкрементальную цепочку"""
+        return await self._run('backup', self._backup)
+
+    async def run_retention(self) -> Dict:
+        """Удалить старые копии по правилам хранения"""
+        return await self._run('retention', self._retention)
+
+    async def run_integrity_check(self) -> Dict:
+        """Проверить целостность рабочей базы (PRAGMA quick_check)"""
+        return await self._run('integrity_check', self._integrity_check)
+
+    async def run_maintenance(self) -> Dict:
+        """ANALYZE/optimize, incremental_vacuum и поочерёдная проверка таблиц"""
+        return await self._run('maintenance', self._maintenance)
+
+    async def run_journal_archive(self) -> Dict:
+        """Перенести записи журнала изменений в архив"""
+        return await self._run('journal_archive', self._journal_archive)
+
+    def status(self) -> Dict[str, Dict]:
+        """Результаты последних запусков задач"""
+        return dict(self.last_runs)
+
+    def shutdown(self, wait: bool = True):
+        """Остановить рабочий поток"""
+        self._executor.shutdown(wait=wait)
+
+
+def create_backup_runners(db_path: str, backup_dir: str, shard_paths: Iterable[str] = (),
+                          **kwargs) -> List[BackupJobRunner]:
+    """
+    Задачи резервного копирования для основной базы и каждого шарда
+
+    Копии шарда лежат в backup_dir/shards/<имя файла шарда>. Все задачи
+    выполняются в одном рабочем потоке.
+
+    Args:
+        db_path: Путь к основной базе
+        backup_dir: Директория копий основной базы
+        shard_paths: Файлы-шарды (Database.shard_paths(); основная база пропускается)
+        **kwargs: Параметры BackupJobRunner
+
+    Returns:
+        Список задач: первой - основная база
+    """
+    main_runner = BackupJobRunner(db_path, backup_dir, **kwargs)
+    runners = [main_runner]
+    for path in shard_paths:
+        if os.path.abspath(path) == os.path.abspath(db_path):
+            continue
+        shard_backup_dir = os.path.join(
+            backup_dir, "shards", os.path.splitext(os.path.basename(path))[0]
+        )
+        runners.append(BackupJobRunner(path, shard_backup_dir, executor=main_runner._executor, **kwargs))
+    return runners
+
+
+def get_last_runs(backup_dir: str = "backups") -> Optional[Dict[str, Dict]]:
+    """Прочитать результаты последних запусков (например, из backup.py)"""
+    try:
+        with open(os.path.join(backup_dir, BackupJobRunner.STATUS_FILENAME), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк аналитического отчёта
+
+Замеряет время отчёта в зависимости от объёма истории пользователя:
+время до первого сообщения при потоковой отправке разделов, время
+всего отчёта и повторный запрос из кэша показателей.
+
+Использование:
+    python benchmarks/bench_report.py
+    python benchmarks/bench_report.py --sizes 1000 10000 100000 --repeat 5
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from analytics import FinancialAnalytics
+from cache import metrics_cache
+from database import Database
+from utils import pack_sections
+
+USER_ID = 1
+
+
+def seed_history(db: Database, size: int):
+    """Наполнить базу синтетической историей: size доходов и расходов за год"""
+    db.add_user(USER_ID, "bench", "Bench User")
+    income_cats = [db.add_category(USER_ID, name, 'income') for name in ("Зарплата", "Фриланс", "Кэшбэк")]
+    expense_cats = [db.add_category(USER_ID, f"Категория {i}", 'expense') for i in range(12)]
+
+    for i in range(3):
+        db.add_credit(USER_ID, f"Банк {i}", 15000 + i * 5000, 60, 9 + i * 3, 500000 + i * 200000,
+                      (date.today() - timedelta(days=400)).isoformat())
+    for i in range(4):
+        db.add_debt(USER_ID, f"Человек {i}", 10000 * (i + 1), 'given' if i % 2 else 'taken')
+    for i in range(5):
+        db.add_investment(USER_ID, f"Актив {i}", 100000, 100000 * random.uniform(0.8, 1.3))
+    db.add_savings(USER_ID, 300000)
+
+    today = date.today()
+    rnd = random.Random(42)
+    incomes = [
+        (USER_ID, rnd.uniform(1000, 80000), rnd.choice(income_cats),
+         (today - timedelta(days=rnd.randint(0, 365))).isoformat())
+        for _ in range(size // 10)
+    ]
+    expenses = [
+        (USER_ID, rnd.uniform(100, 10000), rnd.choice(expense_cats),
+         (today - timedelta(days=rnd.randint(0, 365))).isoformat())
+        for _ in range(size)
+    ]
+
+    conn = db.get_connection()
+    conn.executemany("INSERT INTO incomes (user_id, amount, category_id, date) VALUES (?, ?, ?, ?)", incomes)
+    conn.executemany("INSERT INTO expenses (user_id, amount, category_id, date) VALUES (?, ?, ?, ?)", expenses)
+    conn.commit()
+    conn.close()
+
+
+async def stream_report(analytics: FinancialAnalytics) -> tuple:
+    """Потоковая сборка отчёта: время до первого сообщения, общее время и длина"""
+    started = time.perf_counter()
+    first = None
+    chars = 0
+    async for part in pack_sections(analytics.iter_report_sections(USER_ID, 30)):
+        if first is None:
+            first = time.perf_counter() - started
+        chars += len(part)
+    return first, time.perf_counter() - started, chars
+
+
+def bench(size: int, repeat: int) -> dict:
+    """Замер для одного объёма истории"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "bench.db"))
+        seed_history(db, size)
+        analytics = FinancialAnalytics(db)
+
+        first_times, full_times, cached_times = [], [], []
+        for _ in range(repeat):
+            metrics_cache.clear()
+            first, full, chars = asyncio.run(stream_report(analytics))
+            first_times.append(first)
+            full_times.append(full)
+
+            # Повторный запрос без изменения данных
+            started = time.perf_counter()
+            analytics.collect_metrics(USER_ID, 30)
+            cached_times.append(time.perf_counter() - started)
+
+    return {
+        'size': size,
+        'first_ms': min(first_times) * 1000,
+        'full_ms': min(full_times) * 1000,
+        'cached_us': min(cached_times) * 1e6,
+        'report_chars': chars
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк аналитического отчёта')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 50000],
+                        help='Количество расходов в истории')
+    parser.add_argument('--repeat', type=int, default=3, help='Повторов на каждый размер')
+    args = parser.parse_args()
+
+    print(f"{'Расходов':>10} {'Первое сообщение, мс':>21} {'Весь отчёт, мс':>15} {'Из кэша, мкс':>14} {'Символов':>10}")
+    for size in args.sizes:
+        result = bench(size, args.repeat)
+        print(f"{result['size']:>10} {result['first_ms']:>21.1f} {result['full_ms']:>15.1f} "
+              f"{result['cached_us']:>14.1f} {result['report_chars']:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Стоимость маршрутизации обновления в зависимости от размера меню
+
+Для каждого размера меню строятся два диспетчера с пустыми
+обработчиками кнопок: с фильтрами F.text == "..." (каждое обновление
+проверяется фильтрами по очереди) и с таблицей DispatchTable (один
+поиск в словаре). Через каждый прогоняются одни и те же сообщения -
+нажатия случайных кнопок меню и обычный текст, не совпадающий ни с
+одной кнопкой (его фильтры проверяют все до последнего), - и
+замеряется время dp.feed_update на одно обновление.
+
+Использование:
+    python benchmarks/bench_routing.py
+    python benchmarks/bench_routing.py --sizes 10 50 200 1000 --updates 5000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher, F
+from aiogram.types import Update
+
+from routing import DispatchTable
+
+# Токен нужного формата: запросы к Telegram стенд не отправляет
+BENCH_TOKEN = "123456:BENCH-routing-token-not-used-for-requests"
+
+# Доля обновлений с текстом, не совпадающим ни с одной кнопкой
+FREE_TEXT_SHARE = 0.2
+
+
+async def noop(message):
+    pass
+
+
+def button(index: int) -> str:
+    """Текст index-й кнопки меню"""
+    return f"📋 Кнопка {index}"
+
+
+def make_dispatcher(size: int, use_table: bool) -> Dispatcher:
+    """Диспетчер с size кнопками и обработчиком остального текста в конце"""
+    dp = Dispatcher()
+    if use_table:
+        table = DispatchTable()
+        for index in range(size):
+            table.add_text(button(index), noop)
+        table.register(dp)
+    else:
+        for index in range(size):
+            dp.message.register(noop, F.text == button(index))
+    dp.message.register(noop)
+    return dp
+
+
+def make_updates(size: int, count: int, seed: int = 1) -> list:
+    """Сообщения: нажатия случайных кнопок и обычный текст"""
+    rng = random.Random(seed)
+    updates = []
+    for update_id in range(count):
+        if rng.random() < FREE_TEXT_SHARE:
+            text = "1500 обед"
+        else:
+            text = button(rng.randrange(size))
+        updates.append(Update.model_validate({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': 1700000000,
+                'chat': {'id': 1, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': False, 'first_name': 'Bench'},
+                'text': text
+            }
+        }))
+    return updates
+
+
+async def measure(dp: Dispatcher, bot: Bot, updates: list) -> float:
+    """Среднее время обработки обновления, мкс"""
+    for update in updates[:200]:  # прогрев
+        await dp.feed_update(bot, update)
+    start = time.perf_counter()
+    for update in updates:
+        await dp.feed_update(bot, update)
+    return (time.perf_counter() - start) / len(updates) * 1e6
+
+
+async def run(sizes: list, count: int):
+    bot = Bot(token=BENCH_TOKEN)
+    try:
+        print(f"Обновлений на замер: {count}, обычного текста: {FREE_TEXT_SHARE:.0%}")
+        print(f"{'Кнопок':>7} {'Фильтры, мкс':>13} {'Таблица, мкс':>13} {'Ускорение':>10}")
+        for size in sizes:
+            updates = make_updates(size, count)
+            filters = await measure(make_dispatcher(size, use_table=False), bot, updates)
+            table = await measure(make_dispatcher(size, use_table=True), bot, updates)
+            print(f"{size:>7} {filters:>13.1f} {table:>13.1f} {filters / table:>9.1f}x")
+    finally:
+        await bot.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Стоимость маршрутизации обновления по кнопкам меню')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 200, 1000],
+                        help='Количество кнопок меню для сравнения')
+    parser.add_argument('--updates', type=int, default=1000, help='Обновлений на замер')
+    args = parser.parse_args()
+
+    asyncio.run(run(args.sizes, args.updates))
+
+
+if __name__ == '__main__':
+    main()
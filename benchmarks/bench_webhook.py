@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный стенд webhook
+
+Отправляет POST-запросами синтетические обновления (текстовые сообщения
+от разных пользователей) и измеряет задержку ответа webhook, задержку
+обработки и пропускную способность.
+
+Без --url поднимает локально приложение webhook с тестовым обработчиком,
+который имитирует работу обработчика бота задержкой --handler-ms, и
+сравнивает несколько значений max_in_flight. С --url нагружает уже
+запущенный бот (замеряются только ответы webhook; обновления от
+несуществующих пользователей бот обработает как обычные сообщения).
+
+Использование:
+    python benchmarks/bench_webhook.py
+    python benchmarks/bench_webhook.py --updates 5000 --concurrency 200 --in-flight 10 100 500
+    python benchmarks/bench_webhook.py --url http://127.0.0.1:8080/webhook --secret SECRET
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from aiohttp import ClientSession, web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+
+from webhook import WEBHOOK_HANDLER_KEY, create_webhook_app
+
+# Токен нужного формата: запросы к Telegram стенд не отправляет
+BENCH_TOKEN = "123456:BENCH-webhook-token-not-used-for-requests"
+BENCH_SECRET = "bench-secret"
+BENCH_PATH = "/webhook"
+
+
+def make_update(update_id: int, users: int) -> dict:
+    """Синтетическое обновление: текстовое сообщение от одного из users пользователей"""
+    user_id = 100000 + update_id % users
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench'},
+            'text': '📊 Статистика'
+        }
+    }
+
+
+async def send_updates(url: str, secret: str, updates: int, concurrency: int, users: int) -> dict:
+    """
+    Отправить updates обновлений не более чем concurrency запросами одновременно
+
+    Returns:
+        Словарь: sent, errors, seconds, latencies (задержки ответов, сек.)
+    """
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    latencies = []
+    errors = 0
+    next_id = iter(range(1, updates + 1))
+
+    async def worker(session: ClientSession):
+        nonlocal errors
+        for update_id in next_id:
+            started = time.perf_counter()
+            try:
+                async with session.post(url, json=make_update(update_id, users), headers=headers) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    return {
+        'sent': updates,
+        'errors': errors,
+        'seconds': time.perf_counter() - started,
+        'latencies': sorted(latencies)
+    }
+
+
+def percentile(values: list, p: float) -> float:
+    """Перцентиль отсортированного списка, мс"""
+    if not values:
+        return 0
+    return values[min(int(len(values) * p), len(values) - 1)] * 1000
+
+
+async def bench_local(args, max_in_flight: int) -> dict:
+    """Замер на локальном приложении webhook с тестовым обработчиком"""
+    dp = Dispatcher()
+    handler_delay = args.handler_ms / 1000
+
+    @dp.message()
+    async def handle(message: Message):
+        # Имитация запроса к базе и ответа пользователю
+        await asyncio.sleep(handler_delay)
+
+    bot = Bot(token=BENCH_TOKEN)
+    app = create_webhook_app(dp, bot, path=BENCH_PATH, secret_token=BENCH_SECRET, max_in_flight=max_in_flight)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    handler = app[WEBHOOK_HANDLER_KEY]
+
+    try:
+        started = time.perf_counter()
+        result = await send_updates(
+            f"http://127.0.0.1:{port}{BENCH_PATH}", BENCH_SECRET,
+            args.updates, args.concurrency, args.users
+        )
+        await handler.drain()
+        total = time.perf_counter() - started
+        stats = handler.stats()
+    finally:
+        await runner.cleanup()
+
+    return {**result, 'total_seconds': total, 'processed': stats['processed'],
+            'process_p50_ms': stats['p50_ms'], 'process_p99_ms': stats['p99_ms']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный стенд webhook')
+    parser.add_argument('--url', help='Адрес запущенного webhook (без него - локальный стенд)')
+    parser.add_argument('--secret', default='', help='Секрет webhook (WEBHOOK_SECRET) для --url')
+    parser.add_argument('--updates', type=int, default=2000, help='Количество обновлений')
+    parser.add_argument('--concurrency', type=int, default=100, help='Одновременных запросов')
+    parser.add_argument('--users', type=int, default=500, help='Количество разных пользователей')
+    parser.add_argument('--handler-ms', type=float, default=20,
+                        help='Время работы тестового обработчика, мс (локальный стенд)')
+    parser.add_argument('--in-flight', type=int, nargs='+', default=[10, 100, 1000],
+                        help='Значения max_in_flight для сравнения (локальный стенд)')
+    args = parser.parse_args()
+
+    if args.url:
+        result = asyncio.run(send_updates(args.url, args.secret, args.updates, args.concurrency, args.users))
+        latencies = result['latencies']
+        print(f"Отправлено: {result['sent']}, ошибок: {result['errors']}, за {result['seconds']:.2f} с")
+        print(f"Пропускная способность: {result['sent'] / result['seconds']:.0f} обновлений/с")
+        print(f"Ответ webhook: p50 {percentile(latencies, 0.5):.1f} мс, "
+              f"p95 {percentile(latencies, 0.95):.1f} мс, p99 {percentile(latencies, 0.99):.1f} мс")
+        return
+
+    print(f"Обновлений: {args.updates}, одновременных запросов: {args.concurrency}, "
+          f"обработчик: {args.handler_ms:g} мс")
+    print(f"{'В обработке':>12} {'Обновлений/с':>13} {'Ответ p50, мс':>14} {'Ответ p99, мс':>14} "
+          f"{'Обработка p50, мс':>18} {'Обработка p99, мс':>18} {'Ошибок':>7}")
+    for max_in_flight in args.in_flight:
+        result = asyncio.run(bench_local(args, max_in_flight))
+        latencies = result['latencies']
+        print(f"{max_in_flight:>12} {result['processed'] / result['total_seconds']:>13.0f} "
+              f"{percentile(latencies, 0.5):>14.1f} {percentile(latencies, 0.99):>14.1f} "
+              f"{result['process_p50_ms']:>18.1f} {result['process_p99_ms']:>18.1f} {result['errors']:>7}")
+
+
+if __name__ == '__main__':
+    main()
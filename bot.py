@@ -12,6 +12,7 @@ from apscheduler.triggers.cron import CronTrigger
 
 from database import Database
 from calculations import FinancialCalculator
+from utils import TextHelper
 from visualization import ChartGenerator
 
 # Настройка логирования
@@ -268,104 +269,113 @@ async def cmd_help(message: types.Message):
 
 # ==================== ОБРАБОТЧИКИ МЕНЮ ====================
 
+async def show_credit_menu(message: types.Message, state: FSMContext):
+    """Меню кредитов"""
+    await message.answer(
+        "💳 Управление кредитами\n\n"
+        "Здесь вы можете:\n"
+        "• Добавить новый кредит\n"
+        "• Посмотреть список кредитов\n"
+        "• Внести очередной платёж\n"
+        "• Сделать досрочное погашение\n"
+        "• Получить рекомендации\n"
+        "• Настроить возможности кредита",
+        reply_markup=get_credit_menu_keyboard()
+    )
+
+
+async def show_debt_menu(message: types.Message, state: FSMContext):
+    """Меню долгов"""
+    await message.answer(
+        "💸 Управление долгами\n\n"
+        "Учёт долгов без процентов:\n"
+        "• Взятых у людей\n"
+        "• Выданных людям",
+        reply_markup=get_debt_menu_keyboard()
+    )
+
+
+async def show_income_menu(message: types.Message, state: FSMContext):
+    """Меню доходов"""
+    await message.answer(
+        "💰 Управление доходами",
+        reply_markup=get_income_expense_keyboard(income=True)
+    )
+
+
+async def show_expense_menu(message: types.Message, state: FSMContext):
+    """Меню расходов"""
+    await message.answer(
+        "🛒 Управление расходами",
+        reply_markup=get_income_expense_keyboard(income=False)
+    )
+
+
+async def show_investment_menu(message: types.Message, state: FSMContext):
+    """Меню инвестиций"""
+    await message.answer(
+        "📊 Управление инвестициями",
+        reply_markup=get_investment_menu_keyboard()
+    )
+
+
+async def ask_savings_amount(message: types.Message, state: FSMContext):
+    """Запрос текущей суммы сбережений"""
+    await message.answer(
+        "🏦 Укажите текущую сумму сбережений:",
+        reply_markup=get_cancel_keyboard()
+    )
+    await state.set_state(SavingsStates.waiting_amount)
+
+
+async def show_budget_menu(message: types.Message, state: FSMContext):
+    """Меню бюджета"""
+    await message.answer(
+        "📅 Планирование бюджета\n\n"
+        "Здесь вы можете:\n"
+        "• Создать бюджет на месяц\n"
+        "• Посмотреть существующие бюджеты\n"
+        "• Увидеть прогноз с учетом кредитов",
+        reply_markup=get_budget_menu_keyboard()
+    )
+
+
+async def _handlers_action(name: str, message: types.Message):
+    """Действие из handlers (отложенный импорт: handlers импортирует этот модуль)"""
+    import handlers
+    await getattr(handlers, name)(message)
+
+
+# Кнопка главного меню -> действие (message, state)
+MAIN_MENU_ACTIONS = {
+    "💳 Кредиты": show_credit_menu,
+    "💸 Долги": show_debt_menu,
+    "💰 Доходы": show_income_menu,
+    "🛒 Расходы": show_expense_menu,
+    "📊 Инвестиции": show_investment_menu,
+    "🏦 Сбережения": ask_savings_amount,
+    "📈 График капитала": lambda message, state: show_capital_chart(message),
+    "📋 Отчёт": lambda message, state: show_financial_report(message),
+    "📅 Бюджет": show_budget_menu,
+    "⚙️ Категории": lambda message, state: show_categories_menu(message),
+    "📊 Аналитика": lambda message, state: _handlers_action('show_analytics_menu', message),
+    "📊 Подробный отчёт": lambda message, state: _handlers_action('generate_detailed_analytics', message),
+    "📊 Сравнение периодов": lambda message, state: _handlers_action('show_period_comparison', message),
+    "📄 Отчёт файлом": lambda message, state: _handlers_action('request_report_document', message),
+    "📈 Все графики": lambda message, state: _handlers_action('generate_all_charts', message),
+    "💹 График баланса": lambda message, state: show_balance_trend_chart(message),
+    "🥧 Диаграмма расходов": lambda message, state: show_expense_pie_chart(message),
+    "📉 График кредитов": lambda message, state: show_credits_timeline_chart(message),
+}
+
+
 async def handle_main_menu(message: types.Message, state: FSMContext):
-    """Обработчик кнопок главного меню"""
+    """Обработчик кнопок главного меню (действие по MAIN_MENU_ACTIONS)"""
     await state.clear()
     
-    if message.text == "💳 Кредиты":
-        await message.answer(
-            "💳 Управление кредитами\n\n"
-            "Здесь вы можете:\n"
-            "• Добавить новый кредит\n"
-            "• Посмотреть список кредитов\n"
-            "• Внести очередной платёж\n"
-            "• Сделать досрочное погашение\n"
-            "• Получить рекомендации\n"
-            "• Настроить возможности кредита",
-            reply_markup=get_credit_menu_keyboard()
-        )
-    
-    elif message.text == "💸 Долги":
-        await message.answer(
-            "💸 Управление долгами\n\n"
-            "Учёт долгов без процентов:\n"
-            "• Взятых у людей\n"
-            "• Выданных людям",
-            reply_markup=get_debt_menu_keyboard()
-        )
-    
-    elif message.text == "💰 Доходы":
-        await message.answer(
-            "💰 Управление доходами",
-            reply_markup=get_income_expense_keyboard(income=True)
-        )
-    
-    elif message.text == "🛒 Расходы":
-        await message.answer(
-            "🛒 Управление расходами",
-            reply_markup=get_income_expense_keyboard(income=False)
-        )
-    
-    elif message.text == "📊 Инвестиции":
-        await message.answer(
-            "📊 Управление инвестициями",
-            reply_markup=get_investment_menu_keyboard()
-        )
-    
-    elif message.text == "🏦 Сбережения":
-        await message.answer(
-            "🏦 Укажите текущую сумму сбережений:",
-            reply_markup=get_cancel_keyboard()
-        )
-        await state.set_state(SavingsStates.waiting_amount)
-    
-    elif message.text == "📈 График капитала":
-        await show_capital_chart(message)
-    
-    elif message.text == "📋 Отчёт":
-        await show_financial_report(message)
-    
-    elif message.text == "📅 Бюджет":
-        await message.answer(
-            "📅 Планирование бюджета\n\n"
-            "Здесь вы можете:\n"
-            "• Создать бюджет на месяц\n"
-            "• Посмотреть существующие бюджеты\n"
-            "• Увидеть прогноз с учетом кредитов",
-            reply_markup=get_budget_menu_keyboard()
-        )
-    
-    elif message.text == "⚙️ Категории":
-        await show_categories_menu(message)
-    
-    elif message.text == "📊 Аналитика":
-        from handlers import show_analytics_menu
-        await show_analytics_menu(message)
-    
-    elif message.text == "📊 Подробный отчёт":
-        from handlers import generate_detailed_analytics
-        await generate_detailed_analytics(message)
-    
-    elif message.text == "📈 Все графики":
-        from handlers import generate_all_charts
-        await generate_all_charts(message)
-    
-    elif message.text == "💹 График баланса":
-        await show_balance_trend_chart(message)
-    
-    elif message.text == "🥧 Диаграмма расходов":
-        await show_expense_pie_chart(message)
-    
-    elif message.text == "📉 График кредитов":
-        await show_credits_timeline_chart(message)
-    elif message.text == "🗑 Удалить последний доход":
-        await handlers.handle_delete_last_income(message)
-    elif message.text == "🗑 Удалить доход по ID":
-        await handlers.handle_delete_income_by_id(message, state)
-    elif message.text == "🗑 Удалить последний расход":
-        await handlers.handle_delete_last_expense(message)
-    elif message.text == "🗑 Удалить расход по ID":
-        await handlers.handle_delete_expense_by_id(message, state)
+    action = MAIN_MENU_ACTIONS.get(message.text)
+    if action is not None:
+        await action(message, state)
 
 
 # ==================== ОБРАБОТЧИКИ КРЕДИТОВ ====================
@@ -661,16 +671,12 @@ async def show_capital_chart(message: types.Message):
 
 async def show_financial_report(message: types.Message):
     """Генерация и отправка подробного финансового отчёта"""
+    # Отчёт кэшируется по версии данных, в том числе ночным предрасчётом
     report = FinancialCalculator.generate_financial_report(message.from_user.id, db)
     
-    # Разбиваем отчёт на части если он слишком длинный
-    max_length = 4000
-    if len(report) > max_length:
-        parts = [report[i:i+max_length] for i in range(0, len(report), max_length)]
-        for part in parts:
-            await message.answer(part)
-    else:
-        await message.answer(report)
+    # Длинный отчёт разбиваем по границам строк
+    for part in TextHelper.split_message(report):
+        await message.answer(part)
     
     await message.answer(
         "Готово!",
@@ -682,20 +688,19 @@ async def show_financial_report(message: types.Message):
 
 async def check_payment_reminders(bot: Bot):
     """Проверка и отправка напоминаний о платежах"""
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    
-    # Получаем все активные кредиты
-    cursor.execute("""
-        SELECT c.*, u.user_id 
-        FROM credits c
-        JOIN users u ON c.user_id = u.user_id
-        WHERE c.is_active = 1
-    """)
-    
-    columns = [description[0] for description in cursor.description]
-    credits = [dict(zip(columns, row)) for row in cursor.fetchall()]
-    conn.close()
+    # Получаем все активные кредиты (по всем шардам базы)
+    credits = []
+    for conn in db.iter_connections():
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT c.*, u.user_id 
+            FROM credits c
+            JOIN users u ON c.user_id = u.user_id
+            WHERE c.is_active = 1
+        """)
+        
+        columns = [description[0] for description in cursor.description]
+        credits.extend(dict(zip(columns, row)) for row in cursor.fetchall())
     
     today = date.today()
     
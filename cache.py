@@ -0,0 +1,308 @@
+"""
+Кэши результатов для бота DoHot
+
+Графики и отчёты дорого строить, поэтому готовые результаты складываются
+в ограниченные по размеру LRU-кэши. Их наполняют как обработчики, так и
+ночной предрасчёт (см. precompute.py).
+"""
+
+import asyncio
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш с ограничением размера и временем жизни записей"""
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        """
+        Args:
+            maxsize: Максимальное количество записей
+            ttl: Время жизни записи в секундах (None = бессрочно)
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Получить значение по ключу (None/default если нет или устарело)"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Сохранить значение, вытесняя самые старые записи при переполнении"""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Удалить запись и вернуть её значение"""
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[0] if item is not None else default
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]) -> int:
+        """
+        Удалить все записи, ключ которых удовлетворяет условию
+
+        Returns:
+            Количество удалённых записей
+        """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def clear(self):
+        """Очистить кэш"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict:
+        """Статистика использования кэша"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / total * 100) if total else 0
+            }
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных расчётов
+
+    Пока расчёт с данным ключом выполняется, повторные запросы ждут его
+    результат, а не запускают свой. Готовый результат ещё ttl секунд
+    отдаётся из кэша, поэтому многократное нажатие кнопки не умножает
+    нагрузку. Ошибки не кэшируются. Работает в пределах цикла событий.
+    """
+
+    def __init__(self, ttl: float = 30, maxsize: int = 1024):
+        """
+        Args:
+            ttl: Время хранения готового результата в секундах
+            maxsize: Максимальное количество хранимых результатов
+        """
+        self._results = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.started = 0
+        self.joined = 0
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Получить результат расчёта func() по ключу
+
+        Расчёт выполняется отдельной задачей: отмена одного из ожидающих
+        не прерывает его для остальных.
+
+        Args:
+            key: Ключ расчёта, например (user_id, операция, параметры...)
+            func: Функция без аргументов, возвращающая awaitable с результатом
+        """
+        item = self._results.get(key, _MISSING)
+        if item is not _MISSING:
+            return item
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            self.started += 1
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.joined += 1
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Hashable, task: asyncio.Task):
+        """Сохранить результат завершённого расчёта"""
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self._results.set(key, task.result())
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Забыть готовые результаты, ключ которых удовлетворяет условию"""
+        return self._results.invalidate(predicate)
+
+    def clear(self):
+        """Забыть готовые результаты"""
+        self._results.clear()
+
+    def stats(self) -> Dict:
+        """Статистика: запущено расчётов, присоединилось к идущим, попаданий в кэш"""
+        return {
+            'in_flight': len(self._inflight),
+            'started': self.started,
+            'joined': self.joined,
+            'cached': self._results.hits
+        }
+
+
+# Отметка отсутствия значения (None - допустимый результат расчёта)
+_MISSING = object()
+
+
+class EntityCache:
+    """
+    Кэш редко меняющихся сущностей пользователя (категории, кредиты, карты)
+
+    У каждого вида сущностей пользователя есть номер поколения, входящий
+    в ключ. Изменяющий метод после фиксации транзакции увеличивает номер
+    (invalidate), и старые записи перестают запрашиваться, а затем
+    вытесняются. Поколение берётся до чтения из базы, поэтому
+    прочитанное до изменения не попадёт под новый номер.
+
+    Номера поколений хранятся в LRU того же размера, что и кэш: номер,
+    вытесненный вместе с записями, при следующем обращении заменяется
+    новым, под которым в кэше ничего нет, - данные просто читаются заново.
+
+    Кэш живёт в процессе: все изменения пользователя проходят через
+    процесс, который обрабатывает его обновления (см. sharding.py).
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: Optional[float] = 600):
+        """
+        Args:
+            maxsize: Максимальное количество записей
+            ttl: Время жизни записи в секундах
+        """
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._generations = LRUCache(maxsize=maxsize)
+        self._next_generation = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _generation(self, generation_key: tuple) -> int:
+        """Текущий номер поколения (новый, если номера нет)"""
+        with self._lock:
+            generation = self._generations.get(generation_key)
+            if generation is None:
+                generation = next(self._next_generation)
+                self._generations.set(generation_key, generation)
+            return generation
+
+    def get_or_load(self, kind: str, db_path: str, user_id: int, params: tuple,
+                    loader: Callable[[], list]) -> list:
+        """
+        Получить список сущностей из кэша или загрузить его
+
+        Args:
+            kind: Вид сущностей ('categories', 'credits', 'cards')
+            db_path: Путь к базе данных
+            user_id: ID пользователя
+            params: Параметры выборки (тип категории, только активные и т.п.)
+            loader: Функция чтения из базы
+
+        Returns:
+            Копия списка словарей: вызывающий может его менять
+        """
+        generation = self._generation((kind, db_path, user_id))
+        key = (kind, db_path, user_id, generation) + params
+
+        rows = self._cache.get(key)
+        if rows is None:
+            rows = loader()
+            self._cache.set(key, rows)
+        return [dict(row) for row in rows]
+
+    def invalidate(self, kind: str, db_path: str, user_id: int):
+        """Сбросить сущности вида kind пользователя"""
+        with self._lock:
+            self._generations.set((kind, db_path, user_id), next(self._next_generation))
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Удалить записи, ключ которых удовлетворяет условию"""
+        return self._cache.invalidate(predicate)
+
+    def clear(self):
+        """Очистить кэш и номера поколений"""
+        with self._lock:
+            self._cache.clear()
+            self._generations.clear()
+
+    def stats(self) -> Dict:
+        """Статистика попаданий"""
+        return self._cache.stats()
+
+
+def versioned_key(kind: str, db_path: str, user_id: int, version: int, *params) -> tuple:
+    """
+    Ключ кэша для результата, построенного по данным пользователя
+
+    Версия данных меняется при любом изменении (см. Database.get_data_version),
+    поэтому устаревшие записи просто перестают запрашиваться и вытесняются.
+    Дата входит в ключ, так как периоды отчётов отсчитываются от сегодня.
+
+    Args:
+        kind: Вид результата ('financial', 'analytics', 'dashboard', ...)
+        db_path: Путь к базе данных
+        user_id: ID пользователя
+        version: Версия данных пользователя
+        params: Параметры расчёта (период и т.п.)
+    """
+    return (kind, db_path, user_id, version, date.today().isoformat()) + params
+
+
+# Готовые комплекты графиков: versioned_key('dashboard', ...) -> [пути к файлам]
+chart_cache = LRUCache(maxsize=512, ttl=24 * 3600)
+
+# Готовые текстовые отчёты: versioned_key('financial', ..., период) -> текст
+report_cache = LRUCache(maxsize=512, ttl=24 * 3600)
+
+# Показатели аналитики: versioned_key('analytics', ..., период) -> ReportMetrics
+metrics_cache = LRUCache(maxsize=256, ttl=24 * 3600)
+
+# Идущие расчёты графиков и аналитики по запросам пользователей
+request_flight = SingleFlight(ttl=30)
+
+# Категории, кредиты и карты пользователей: (вид, база, пользователь, поколение, параметры...) -> список
+entity_cache = EntityCache(maxsize=4096, ttl=600)
+
+
+def invalidate_database(db_path: str) -> int:
+    """
+    Сбросить все кэшированные результаты по базе данных
+
+    Нужно после восстановления базы из копии: версии данных в ней
+    откатываются и могут совпасть с ключами устаревших записей.
+
+    Returns:
+        Количество удалённых записей
+    """
+    target = os.path.abspath(db_path)
+    return sum(
+        cache.invalidate(lambda key: os.path.abspath(key[1]) == target)
+        for cache in (chart_cache, report_cache, metrics_cache, request_flight)
+    ) + entity_cache.invalidate_where(lambda key: os.path.abspath(key[1]) == target)
@@ -3,6 +3,10 @@ from dateutil.relativedelta import relativedelta
 from typing import List, Dict, Tuple
 import math
 
+import numpy as np
+
+from cache import report_cache, versioned_key
+
 
 class FinancialCalculator:
     
@@ -174,25 +178,23 @@ class FinancialCalculator:
         }
 
     @staticmethod
-    def calculate_monthly_credit_expenses(credits: List[Dict], month: int, year: int) -> Dict:
+    def _month_index(year: int, month: int) -> int:
+        """Порядковый номер месяца для арифметики по месяцам"""
+        return year * 12 + month - 1
+    
+    @staticmethod
+    def calculate_credit_windows(credits: List[Dict]) -> List[Tuple[int, int, Dict]]:
         """
-        Рассчитывает расходы по кредитам на конкретный месяц
+        Рассчитывает для активных кредитов диапазон месяцев, в которые идут платежи
         
-        Args:
-            credits: Список кредитов
-            month: Месяц (1-12)
-            year: Год
+        Даты начала разбираются один раз, дальше попадание кредита в месяц
+        проверяется сравнением номеров месяцев.
         
         Returns:
-            Словарь с деталями расходов по кредитам
+            Список (первый месяц, месяц после последнего, кредит), где месяц
+            задан номером из _month_index
         """
-        from datetime import date
-        from dateutil.relativedelta import relativedelta
-        
-        target_date = date(year, month, 1)
-        total_payment = 0
-        credit_details = []
-        
+        windows = []
         for credit in credits:
             if not credit['is_active']:
                 continue
@@ -200,67 +202,170 @@ class FinancialCalculator:
             start_date = datetime.strptime(credit['start_date'], '%Y-%m-%d').date()
             end_date = start_date + relativedelta(months=credit['total_months'])
             
-            # Проверяем, попадает ли кредит в этот месяц
-            if start_date <= target_date < end_date:
-                total_payment += credit['monthly_payment']
-                credit_details.append({
-                    'display_name': credit['display_name'],
-                    'monthly_payment': credit['monthly_payment'],
-                    'remaining_debt': credit['remaining_debt']
-                })
+            # Кредит учитывается в месяце, если start_date <= 1-е число < end_date
+            first = FinancialCalculator._month_index(start_date.year, start_date.month)
+            if start_date.day > 1:
+                first += 1
+            stop = FinancialCalculator._month_index(end_date.year, end_date.month)
+            if end_date.day > 1:
+                stop += 1
+            windows.append((first, stop, credit))
+        
+        return windows
+    
+    @staticmethod
+    def _credit_expenses_from_windows(windows: List[Tuple[int, int, Dict]], month_index: int) -> Dict:
+        """Расходы по кредитам на месяц по заранее рассчитанным диапазонам"""
+        credit_details = [
+            {
+                'display_name': credit['display_name'],
+                'monthly_payment': credit['monthly_payment'],
+                'remaining_debt': credit['remaining_debt']
+            }
+            for first, stop, credit in windows
+            if first <= month_index < stop
+        ]
         
         return {
-            'total': total_payment,
+            'total': sum(c['monthly_payment'] for c in credit_details),
             'credits': credit_details,
             'count': len(credit_details)
         }
     
     @staticmethod
-    def generate_budget_forecast(user_id: int, db, months_ahead: int = 6) -> List[Dict]:
+    def calculate_monthly_credit_expenses(credits: List[Dict], month: int, year: int) -> Dict:
+        """
+        Рассчитывает расходы по кредитам на конкретный месяц
+        
+        Args:
+            credits: Список кредитов
+            month: Месяц (1-12)
+            year: Год
+        
+        Returns:
+            Словарь с деталями расходов по кредитам
+        """
+        return FinancialCalculator._credit_expenses_from_windows(
+            FinancialCalculator.calculate_credit_windows(credits),
+            FinancialCalculator._month_index(year, month)
+        )
+    
+    @staticmethod
+    def estimate_monthly_series(history: List[Dict], first_index: int, count: int) -> np.ndarray:
+        """
+        Оценка помесячных сумм по истории: линейный тренд плюс сезонность
+        
+        Тренд подбирается методом наименьших квадратов, сезонная поправка —
+        средний остаток по календарному месяцу (при истории от года).
+        Месяцы без операций внутри истории считаются нулевыми.
+        
+        Args:
+            history: Итоги по завершённым месяцам [{'month': 'YYYY-MM', 'total': float}]
+            first_index: Номер первого прогнозируемого месяца (_month_index)
+            count: Количество прогнозируемых месяцев
+        
+        Returns:
+            Массив оценок длиной count (неотрицательные значения)
+        """
+        if not history or count <= 0:
+            return np.zeros(max(count, 0))
+        
+        indices = np.array([
+            FinancialCalculator._month_index(int(row['month'][:4]), int(row['month'][5:7]))
+            for row in history
+        ])
+        origin = int(indices.min())
+        length = max(first_index - origin, 1)
+        
+        series = np.zeros(length)
+        mask = indices < origin + length
+        np.add.at(series, indices[mask] - origin, np.array([row['total'] for row in history])[mask])
+        
+        future = np.arange(first_index, first_index + count) - origin
+        if length < 3:
+            return np.full(count, series.mean())
+        
+        x = np.arange(length)
+        slope, intercept = np.polyfit(x, series, 1)
+        estimate = intercept + slope * future
+        
+        if length >= 12:
+            residuals = series - (intercept + slope * x)
+            calendar_months = (origin + x) % 12
+            counts = np.bincount(calendar_months, minlength=12)
+            seasonal = np.bincount(calendar_months, weights=residuals, minlength=12) / np.maximum(counts, 1)
+            estimate = estimate + seasonal[(origin + future) % 12]
+        
+        return np.clip(estimate, 0, None)
+    
+    @staticmethod
+    def generate_budget_forecast(user_id: int, db, months_ahead: int = 6,
+                                 history_months: int = 24) -> List[Dict]:
         """
         Генерирует прогноз бюджета на несколько месяцев вперед
         
+        Бюджеты за весь горизонт загружаются одним запросом, диапазоны
+        платежей по кредитам рассчитываются один раз. Для месяцев без
+        бюджета доходы и расходы оцениваются по помесячной истории
+        (тренд и сезонность).
+        
+        Платёж по кредиту входит в месяц, если кредит действует на 1-е
+        число этого месяца - в том числе в текущем месяце: кредит,
+        взятый после 1-го числа, учитывается со следующего месяца (как
+        и в calculate_monthly_credit_expenses).
+        
         Args:
             user_id: ID пользователя
             db: Экземпляр Database
             months_ahead: Количество месяцев для прогноза
+            history_months: Сколько завершённых месяцев истории учитывать
         
         Returns:
             Список с прогнозом по месяцам
         """
-        from datetime import date
-        from dateutil.relativedelta import relativedelta
+        current_date = date.today().replace(day=1)
+        first_index = FinancialCalculator._month_index(current_date.year, current_date.month)
+        last_date = current_date + relativedelta(months=months_ahead - 1)
+        
+        budgets = db.get_budgets_in_range(user_id, current_date.month, current_date.year,
+                                          last_date.month, last_date.year)
+        windows = FinancialCalculator.calculate_credit_windows(db.get_user_credits(user_id))
+        
+        # История нужна только если есть месяцы без бюджета
+        income_estimate = expense_estimate = np.zeros(months_ahead)
+        has_history = False
+        if len(budgets) < months_ahead:
+            income_history = db.get_monthly_totals(user_id, 'income', history_months)
+            expense_history = db.get_monthly_totals(user_id, 'expense', history_months)
+            has_history = bool(income_history or expense_history)
+            income_estimate = FinancialCalculator.estimate_monthly_series(income_history, first_index, months_ahead)
+            expense_estimate = FinancialCalculator.estimate_monthly_series(expense_history, first_index, months_ahead)
         
         forecast = []
-        credits = db.get_user_credits(user_id)
-        
-        current_date = date.today()
-        
         for i in range(months_ahead):
             target_date = current_date + relativedelta(months=i)
-            month = target_date.month
-            year = target_date.year
+            budget = budgets.get((target_date.year, target_date.month))
+            credit_expenses = FinancialCalculator._credit_expenses_from_windows(windows, first_index + i)
             
-            # Получаем существующий бюджет или создаем пустой
-            budget = db.get_budget(user_id, month, year)
-            
-            # Рассчитываем расходы по кредитам
-            credit_expenses = FinancialCalculator.calculate_monthly_credit_expenses(
-                credits, month, year
-            )
+            if budget:
+                income = budget['planned_income']
+                expenses = budget['planned_expenses']
+            else:
+                income = float(income_estimate[i])
+                expenses = float(expense_estimate[i])
             
             forecast.append({
-                'month': month,
-                'year': year,
+                'month': target_date.month,
+                'year': target_date.year,
                 'month_name': target_date.strftime('%B %Y'),
                 'has_budget': budget is not None,
-                'planned_income': budget['planned_income'] if budget else 0,
-                'planned_expenses': budget['planned_expenses'] if budget else 0,
+                'is_estimate': budget is None and has_history,
+                'planned_income': income,
+                'planned_expenses': expenses,
                 'credit_expenses': credit_expenses['total'],
                 'credit_details': credit_expenses['credits'],
-                'total_expenses': (budget['planned_expenses'] if budget else 0) + credit_expenses['total'],
-                'balance': (budget['planned_income'] if budget else 0) - 
-                          ((budget['planned_expenses'] if budget else 0) + credit_expenses['total'])
+                'total_expenses': expenses + credit_expenses['total'],
+                'balance': income - (expenses + credit_expenses['total'])
             })
         
         return forecast
@@ -293,7 +398,22 @@ class FinancialCalculator:
     
     @staticmethod
     def generate_financial_report(user_id: int, db, period_days: int = 30) -> str:
-        """Генерирует подробный финансовый отчет"""
+        """
+        Генерирует подробный финансовый отчет
+        
+        Готовый отчёт кэшируется по версии данных пользователя: пока данные
+        не менялись, повторный запрос не обращается к расчётам.
+        """
+        key = versioned_key('financial', db.db_path, user_id, db.get_data_version(user_id), period_days)
+        report = report_cache.get(key)
+        if report is None:
+            report = FinancialCalculator.build_financial_report(user_id, db, period_days)
+            report_cache.set(key, report)
+        return report
+    
+    @staticmethod
+    def build_financial_report(user_id: int, db, period_days: int = 30) -> str:
+        """Строит подробный финансовый отчет без использования кэша"""
         today = date.today()
         start_date = (today - timedelta(days=period_days)).isoformat()
         end_date = today.isoformat()
@@ -0,0 +1,434 @@
+"""
+Журнал изменений для восстановления на момент времени
+
+Триггеры AFTER INSERT/UPDATE/DELETE на таблицах с данными записывают
+образы строк в таблицу change_journal. Архиватор периодически переносит
+накопленные записи в сжатые сегменты (journal_<первый>_<последний>.jsonl.gz)
+и удаляет их из базы.
+
+Каждая копия инкрементальной цепочки (BackupManager) помнит номер
+последней записи журнала, вошедшей в снимок. Восстановление на момент T
+собирает последнюю копию, снятую не позже T, в новый файл и
+последовательно применяет к ней записи журнала до T.
+
+Журналируются таблицы с целочисленным первичным ключом (псевдоним rowid).
+Производные таблицы (помесячные итоги, статистика расходов) после
+применения журнала пересчитываются заново.
+"""
+
+import gzip
+import itertools
+import json
+import logging
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from migrations import BackfillRunner, Migration008_DerivedTables
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_TABLE = "change_journal"
+TRIGGER_PREFIX = "journal_"
+SEGMENT_PREFIX = "journal_"
+SEGMENT_SUFFIX = ".jsonl.gz"
+
+# Служебные таблицы, которые не журналируются
+EXCLUDED_TABLES = {JOURNAL_TABLE, 'schema_migrations', 'sqlite_sequence', 'sqlite_stat1'}
+
+# Формат меток времени журнала (UTC)
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%f'
+
+
+# ==================== ТРИГГЕРЫ ====================
+
+def _journaled_tables(cursor: sqlite3.Cursor) -> Dict[str, List[str]]:
+    """
+    Таблицы с целочисленным первичным ключом и их столбцы
+
+    Returns:
+        Словарь {таблица: [столбцы]}
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+    tables = {}
+    for (table,) in cursor.fetchall():
+        if table in EXCLUDED_TABLES:
+            continue
+        columns = cursor.execute(f'PRAGMA table_info("{table}")').fetchall()
+        pk_columns = [col for col in columns if col[5]]
+        if len(pk_columns) == 1 and pk_columns[0][2].upper() == 'INTEGER':
+            tables[table] = [col[1] for col in columns]
+    return tables
+
+
+def drop_journal_triggers(cursor: sqlite3.Cursor):
+    """Удалить все триггеры журнала"""
+    cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE ?",
+        (f"{TRIGGER_PREFIX}%",)
+    )
+    for (name,) in cursor.fetchall():
+        cursor.execute(f'DROP TRIGGER IF EXISTS "{name}"')
+
+
+def install_change_journal(db_path: str) -> List[str]:
+    """
+    Создать таблицу журнала и (пере)создать триггеры по текущей схеме
+
+    Вызывается при запуске бота, поэтому столбцы, добавленные миграциями,
+    сразу попадают в журнал.
+
+    Returns:
+        Список журналируемых таблиц
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {JOURNAL_TABLE} (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts TEXT NOT NULL,
+            table_name TEXT NOT NULL,
+            op TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            data TEXT
+        )
+    """)
+
+    drop_journal_triggers(cursor)
+    tables = _journaled_tables(cursor)
+
+    for table, columns in tables.items():
+        def row_image(prefix: str) -> str:
+            pairs = ", ".join(f"'{col}', {prefix}.\"{col}\"" for col in columns)
+            return f"json_object({pairs})"
+
+        for event, op, ref, image in (
+            ('INSERT', 'I', 'NEW', row_image('NEW')),
+            ('UPDATE', 'U', 'NEW', row_image('NEW')),
+            ('DELETE', 'D', 'OLD', 'NULL'),
+        ):
+            cursor.execute(f"""
+                CREATE TRIGGER "{TRIGGER_PREFIX}{table}_{event.lower()}"
+                AFTER {event} ON "{table}"
+                BEGIN
+                    INSERT INTO {JOURNAL_TABLE} (ts, table_name, op, row_id, data)
+                    VALUES (strftime('{TIMESTAMP_FORMAT}', 'now'), '{table}', '{op}', {ref}.rowid, {image});
+                END
+            """)
+
+    conn.commit()
+    conn.close()
+
+    logger.info(f"Change journal installed for tables: {sorted(tables)}")
+    return sorted(tables)
+
+
+def last_journal_seq(conn: sqlite3.Connection) -> int:
+    """Номер последней записи журнала в базе (0, если журнала нет)"""
+    try:
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (JOURNAL_TABLE,)).fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] if row else 0
+
+
+# ==================== АРХИВ ====================
+
+def _segment_range(filename: str) -> tuple:
+    """(первый, последний) номер записи в сегменте по имени файла"""
+    first, last = filename[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)].split('_')
+    return int(first), int(last)
+
+
+def list_segments(archive_dir: str) -> List[Dict]:
+    """
+    Сегменты архива журнала по возрастанию номеров
+
+    Returns:
+        Список {'path', 'first_seq', 'last_seq'}
+    """
+    if not os.path.exists(archive_dir):
+        return []
+
+    segments = []
+    for filename in os.listdir(archive_dir):
+        if filename.startswith(SEGMENT_PREFIX) and filename.endswith(SEGMENT_SUFFIX):
+            first, last = _segment_range(filename)
+            segments.append({'path': os.path.join(archive_dir, filename), 'first_seq': first, 'last_seq': last})
+    segments.sort(key=lambda s: s['first_seq'])
+    return segments
+
+
+def archive_journal(db_path: str, archive_dir: str, chunk_size: int = 5000) -> Dict:
+    """
+    Перенести накопленные записи журнала в сжатый сегмент архива
+
+    Сегмент записывается и сбрасывается на диск до удаления записей из
+    базы, поэтому сбой между шагами не теряет изменения (записи просто
+    окажутся в архиве повторно и будут пропущены при применении).
+
+    Returns:
+        {'records': количество, 'path': путь к сегменту или None}
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        bounds = cursor.execute(f"SELECT MIN(seq), MAX(seq) FROM {JOURNAL_TABLE}").fetchone()
+    except sqlite3.OperationalError:
+        conn.close()
+        return {'records': 0, 'path': None}
+
+    first, last = bounds
+    if first is None:
+        conn.close()
+        return {'records': 0, 'path': None}
+
+    path = os.path.join(archive_dir, f"{SEGMENT_PREFIX}{first:012d}_{last:012d}{SEGMENT_SUFFIX}")
+    records = 0
+    cursor.execute(f"""
+        SELECT seq, ts, table_name, op, row_id, data FROM {JOURNAL_TABLE}
+        WHERE seq <= ? ORDER BY seq
+    """, (last,))
+
+    with gzip.open(path + ".tmp", 'wt', encoding='utf-8') as f:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for seq, ts, table, op, row_id, data in rows:
+                f.write(json.dumps({
+                    'seq': seq, 'ts': ts, 'table': table, 'op': op, 'rowid': row_id,
+                    'data': json.loads(data) if data else None
+                }, ensure_ascii=False) + '\n')
+            records += len(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+    cursor.execute(f"DELETE FROM {JOURNAL_TABLE} WHERE seq <= ?", (last,))
+    conn.commit()
+    conn.close()
+
+    logger.info(f"Archived {records} journal records to {path}")
+    return {'records': records, 'path': path}
+
+
+def prune_segments(archive_dir: str, upto_seq: int) -> int:
+    """
+    Удалить сегменты архива, все записи которых не новее upto_seq
+
+    Args:
+        archive_dir: Директория архива журнала
+        upto_seq: Номер записи, на котором снята самая старая хранимая копия
+
+    Returns:
+        Количество удалённых сегментов
+    """
+    removed = 0
+    for segment in list_segments(archive_dir):
+        if segment['last_seq'] <= upto_seq:
+            os.remove(segment['path'])
+            removed += 1
+    if removed:
+        logger.info(f"Removed {removed} journal segments up to seq {upto_seq}")
+    return removed
+
+
+def iter_journal(archive_dir: str, after_seq: int, source_db: Optional[str] = None,
+                 chunk_size: int = 5000) -> Iterator[Dict]:
+    """
+    Поток записей журнала с номером больше after_seq по возрастанию
+
+    Сначала читаются сегменты архива, затем ещё не архивированные записи
+    из source_db (если база доступна).
+    """
+    last_seen = after_seq
+    for segment in list_segments(archive_dir):
+        if segment['last_seq'] <= last_seen:
+            continue
+        with gzip.open(segment['path'], 'rt', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                if record['seq'] > last_seen:
+                    last_seen = record['seq']
+                    yield record
+
+    if source_db and os.path.exists(source_db):
+        conn = sqlite3.connect(source_db)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT seq, ts, table_name, op, row_id, data FROM {JOURNAL_TABLE}
+                WHERE seq > ? ORDER BY seq
+            """, (last_seen,))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for seq, ts, table, op, row_id, data in rows:
+                    yield {'seq': seq, 'ts': ts, 'table': table, 'op': op, 'rowid': row_id,
+                           'data': json.loads(data) if data else None}
+        except sqlite3.OperationalError:
+            pass
+        finally:
+            conn.close()
+
+
+# ==================== ВОССТАНОВЛЕНИЕ ====================
+
+def to_journal_time(moment: datetime) -> str:
+    """Перевести момент (локальное время, если без пояса) в формат меток журнала"""
+    if moment.tzinfo is None:
+        moment = moment.astimezone()
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+
+def _apply_record(cursor: sqlite3.Cursor, record: Dict):
+    """Применить одну запись журнала"""
+    table = record['table']
+    if record['op'] == 'D':
+        cursor.execute(f'DELETE FROM "{table}" WHERE rowid = ?', (record['rowid'],))
+        return
+
+    data = record['data']
+    columns = ", ".join(f'"{col}"' for col in data)
+    placeholders = ", ".join("?" for _ in data)
+    cursor.execute(
+        f'INSERT OR REPLACE INTO "{table}" (rowid, {columns}) VALUES (?, {placeholders})',
+        (record['rowid'], *data.values())
+    )
+
+
+def replay_journal(db_path: str, records: Iterable[Dict], base_seq: int,
+                   progress: Optional[Callable[[int, str], None]] = None,
+                   batch_size: int = 1000, keep_triggers: bool = False) -> Dict:
+    """
+    Применить записи журнала к копии базы
+
+    Триггеры журнала на время применения удаляются, журнал копии
+    очищается (его записи относятся к старой линии времени), а счётчик
+    журнала продолжается с последней применённой записи. Производные
+    таблицы пересчитываются по восстановленным данным.
+
+    Args:
+        db_path: Копия базы
+        records: Записи журнала по возрастанию номеров
+        base_seq: Номер последней записи, уже вошедшей в копию
+        progress: Функция progress(применено записей, метка времени последней)
+        batch_size: Записей в одной транзакции
+        keep_triggers: Пересоздать триггеры журнала после применения
+
+    Returns:
+        {'applied', 'last_ts', 'last_seq'}
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    # Триггеры не должны срабатывать при применении журнала
+    drop_journal_triggers(cursor)
+    conn.commit()
+
+    applied = 0
+    last_ts = None
+    last_seq = base_seq
+    for record in records:
+        _apply_record(cursor, record)
+        applied += 1
+        last_ts = record['ts']
+        last_seq = record['seq']
+        if applied % batch_size == 0:
+            conn.commit()
+            if progress:
+                progress(applied, last_ts)
+    conn.commit()
+    if progress:
+        progress(applied, last_ts)
+
+    # Записи журнала в копии относятся к старой линии времени
+    try:
+        cursor.execute(f"DELETE FROM {JOURNAL_TABLE}")
+        cursor.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = ?", (last_seq, JOURNAL_TABLE))
+    except sqlite3.OperationalError:
+        pass
+
+    conn.commit()
+    conn.close()
+
+    # Производные таблицы пересчитываются по восстановленным данным
+    runner = BackfillRunner(db_path, sleep=0)
+    for backfill in Migration008_DerivedTables.backfills:
+        runner.run(backfill)
+
+    if keep_triggers:
+        install_change_journal(db_path)
+
+    return {'applied': applied, 'last_ts': last_ts, 'last_seq': last_seq}
+
+
+def _backup_completed(manifest: Dict) -> datetime:
+    """Момент, после которого изменения в копию не попадали"""
+    if 'completed' in manifest:
+        return datetime.fromisoformat(manifest['completed'])
+    # В старых манифестах момента окончания нет: начало плюс длительность
+    # снятия - верхняя граница
+    return datetime.fromisoformat(manifest['created']) + \
+        timedelta(seconds=manifest.get('duration_seconds', 0))
+
+
+def restore_to_point(backup_manager, archive_dir: str, target_time: datetime, output_path: str,
+                     source_db: Optional[str] = None,
+                     progress: Optional[Callable[[int, str], None]] = None,
+                     batch_size: int = 1000) -> Dict:
+    """
+    Восстановить базу на момент target_time в новый файл
+
+    Args:
+        backup_manager: BackupManager с инкрементальной цепочкой
+        archive_dir: Директория архива журнала
+        target_time: Момент восстановления (локальное время, если без пояса)
+        output_path: Путь к новому файлу базы (не должен существовать)
+        source_db: Рабочая база для ещё не архивированных записей
+        progress: Функция progress(применено записей, метка времени последней)
+        batch_size: Записей в одной транзакции
+
+    Returns:
+        {'base_backup', 'base_seq', 'applied', 'last_ts', 'output'}
+    """
+    if os.path.exists(output_path):
+        raise FileExistsError(f"Файл {output_path} уже существует")
+
+    target_local = target_time.astimezone() if target_time.tzinfo else target_time
+    target_ts = to_journal_time(target_time)
+
+    # Последняя копия цепочки, снятие которой закончилось не позже
+    # целевого момента: в более поздней могут быть изменения после него.
+    # Копия без журнала не подходит: изменения между ней и включением
+    # журнала не записаны и были бы потеряны
+    candidates = [
+        m for m in backup_manager.list_chain()
+        if m.get('journal_active') and _backup_completed(m) <= target_local.replace(tzinfo=None)
+    ]
+    if not candidates:
+        raise ValueError("Нет копии с журналом, снятой до указанного момента")
+    base = candidates[-1]
+
+    backup_manager.materialize_chain_backup(base['id'], output_path)
+    records = itertools.takewhile(
+        lambda record: record['ts'] <= target_ts,
+        iter_journal(archive_dir, base['journal_seq'], source_db)
+    )
+    result = replay_journal(output_path, records, base['journal_seq'], progress, batch_size)
+    applied, last_ts = result['applied'], result['last_ts']
+
+    logger.info(f"Point-in-time restore to {target_ts} UTC: base {base['id']}, {applied} records applied")
+    return {
+        'base_backup': base['id'],
+        'base_seq': base['journal_seq'],
+        'applied': applied,
+        'last_ts': last_ts,
+        'output': output_path
+    }
@@ -1,5 +1,6 @@
 import os
 from dataclasses import dataclass
+from typing import Optional
 
 
 @dataclass
@@ -11,6 +12,8 @@ class BotConfig:
     
     # База данных
     db_path: str = "dohot.db"
+    # Файлы-шарды с данными пользователей (0 - всё в одном файле, см. partitions.py)
+    db_shards: int = 0
     
     # Директории
     charts_dir: str = "charts"
@@ -19,6 +22,51 @@ class BotConfig:
     reminder_time_hour: int = 9
     reminder_time_minute: int = 0
     
+    # Ночной предрасчёт графиков и отчётов
+    precompute_hour: int = 4
+    precompute_minute: int = 0
+    precompute_workers: int = 2
+    precompute_active_days: int = 7
+    
+    # Резервное копирование
+    backup_enabled: bool = True
+    backup_dir: str = "backups"
+    backup_interval_hours: int = 6
+    backup_retention_hour: int = 3
+    backup_check_hour: int = 5
+    maintenance_hour: int = 2
+    backup_keep_count: int = 10
+    backup_keep_full: int = 2
+    backup_pages_per_step: int = 256
+    backup_step_sleep: float = 0.05
+    
+    # Хранилище состояний диалогов: "sqlite" или "memory"
+    fsm_storage: str = "sqlite"
+    fsm_db_path: Optional[str] = None
+    fsm_flush_interval: float = 0.5
+    
+    # Журнал изменений для восстановления на момент времени
+    journal_enabled: bool = True
+    journal_archive_minutes: int = 15
+    
+    # Рабочие процессы: обновления распределяются по ним по user_id (0 - один процесс)
+    workers: int = 0
+    worker_max_in_flight: int = 100
+    
+    # Тяжёлые запросы (графики, аналитика, документы): одновременно всего и от пользователя
+    heavy_max_running: int = 2
+    heavy_per_user: int = 1
+    heavy_max_waiting: int = 200
+    
+    # Webhook: пустой webhook_url - режим long polling
+    webhook_url: str = ""
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8080
+    webhook_path: str = "/webhook"
+    webhook_secret: str = ""
+    webhook_max_in_flight: int = 100
+    webhook_max_connections: int = 40
+    
     @classmethod
     def from_env(cls):
         """Создание конфигурации из переменных окружения"""
@@ -34,9 +82,41 @@ class BotConfig:
         return cls(
             bot_token=bot_token,
             db_path=os.getenv("DB_PATH", "dohot.db"),
+            db_shards=int(os.getenv("DB_SHARDS", "0")),
             charts_dir=os.getenv("CHARTS_DIR", "charts"),
             reminder_time_hour=int(os.getenv("REMINDER_HOUR", "9")),
-            reminder_time_minute=int(os.getenv("REMINDER_MINUTE", "0"))
+            reminder_time_minute=int(os.getenv("REMINDER_MINUTE", "0")),
+            precompute_hour=int(os.getenv("PRECOMPUTE_HOUR", "4")),
+            precompute_minute=int(os.getenv("PRECOMPUTE_MINUTE", "0")),
+            precompute_workers=int(os.getenv("PRECOMPUTE_WORKERS", "2")),
+            precompute_active_days=int(os.getenv("PRECOMPUTE_ACTIVE_DAYS", "7")),
+            backup_enabled=os.getenv("BACKUP_ENABLED", "1").lower() not in ("0", "false", "no"),
+            backup_dir=os.getenv("BACKUP_DIR", "backups"),
+            backup_interval_hours=int(os.getenv("BACKUP_INTERVAL_HOURS", "6")),
+            backup_retention_hour=int(os.getenv("BACKUP_RETENTION_HOUR", "3")),
+            backup_check_hour=int(os.getenv("BACKUP_CHECK_HOUR", "5")),
+            maintenance_hour=int(os.getenv("MAINTENANCE_HOUR", "2")),
+            backup_keep_count=int(os.getenv("BACKUP_KEEP_COUNT", "10")),
+            backup_keep_full=int(os.getenv("BACKUP_KEEP_FULL", "2")),
+            backup_pages_per_step=int(os.getenv("BACKUP_PAGES_PER_STEP", "256")),
+            backup_step_sleep=float(os.getenv("BACKUP_STEP_SLEEP", "0.05")),
+            fsm_storage=os.getenv("FSM_STORAGE", "sqlite"),
+            fsm_db_path=os.getenv("FSM_DB_PATH") or None,
+            fsm_flush_interval=float(os.getenv("FSM_FLUSH_INTERVAL", "0.5")),
+            journal_enabled=os.getenv("JOURNAL_ENABLED", "1").lower() not in ("0", "false", "no"),
+            journal_archive_minutes=int(os.getenv("JOURNAL_ARCHIVE_MINUTES", "15")),
+            workers=int(os.getenv("WORKERS", "0")),
+            worker_max_in_flight=int(os.getenv("WORKER_MAX_IN_FLIGHT", "100")),
+            heavy_max_running=int(os.getenv("HEAVY_MAX_RUNNING", "2")),
+            heavy_per_user=int(os.getenv("HEAVY_PER_USER", "1")),
+            heavy_max_waiting=int(os.getenv("HEAVY_MAX_WAITING", "200")),
+            webhook_url=os.getenv("WEBHOOK_URL", ""),
+            webhook_host=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+            webhook_port=int(os.getenv("WEBHOOK_PORT", "8080")),
+            webhook_path=os.getenv("WEBHOOK_PATH", "/webhook"),
+            webhook_secret=os.getenv("WEBHOOK_SECRET", ""),
+            webhook_max_in_flight=int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", "100")),
+            webhook_max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
         )
 
 
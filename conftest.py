@@ -0,0 +1,35 @@
+import os
+import sys
+import time
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_update(update_id: int, user_id: Optional[int] = None, text: str = 'test',
+                data: Optional[str] = None) -> dict:
+    """
+    Обновление Telegram в виде словаря: сообщение или callback-запрос
+
+    Args:
+        update_id: ID обновления (и сообщения)
+        user_id: ID пользователя и чата (по умолчанию - update_id)
+        text: Текст сообщения
+        data: callback_data - тогда обновление является нажатием inline-кнопки
+    """
+    user_id = update_id if user_id is None else user_id
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'Test'}
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': user,
+        'text': text
+    }
+    if data is None:
+        return {'update_id': update_id, 'message': message}
+    return {
+        'update_id': update_id,
+        'callback_query': {'id': str(update_id), 'from': user, 'chat_instance': '1',
+                           'message': message, 'data': data}
+    }
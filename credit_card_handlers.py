@@ -11,7 +11,7 @@ from credit_cards import CreditCardManager
 from database import Database
 
 db = Database()
-card_manager = CreditCardManager()
+card_manager = CreditCardManager(db.db_path, db.shards)  # карты и версии данных — в базе пользователя
 
 
 async def handle_credit_cards_menu(message: types.Message):
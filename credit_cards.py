@@ -3,58 +3,28 @@
 Отдельная реализация от обычных кредитов
 """
 
-import sqlite3
 from datetime import date, datetime
 from typing import List, Dict, Optional
 
+from cache import entity_cache
+from database import Database, bump_data_version, bump_data_version_for_row
+
 
 class CreditCardManager:
     """Менеджер для управления кредитными картами"""
     
-    def __init__(self, db_path: str = 'financial_bot.db'):
+    def __init__(self, db_path: str = 'financial_bot.db', shards: Optional[int] = None):
         self.db_path = db_path
-        self._init_tables()
+        self._db = Database(db_path, shards)
     
-    def _init_tables(self):
-        """Инициализация таблиц для кредитных карт"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS credit_cards (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                card_name TEXT NOT NULL,
-                bank_name TEXT NOT NULL,
-                credit_limit REAL NOT NULL,
-                current_balance REAL NOT NULL,
-                interest_rate REAL NOT NULL,
-                minimum_payment_percent REAL NOT NULL,
-                grace_period_days INTEGER DEFAULT 55,
-                is_active INTEGER DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS credit_card_transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                card_id INTEGER NOT NULL,
-                transaction_date DATE NOT NULL,
-                transaction_type TEXT NOT NULL,
-                amount REAL NOT NULL,
-                balance_before REAL NOT NULL,
-                balance_after REAL NOT NULL,
-                interest_charged REAL DEFAULT 0,
-                notes TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (card_id) REFERENCES credit_cards(id)
-            )
-        """)
-        
-        conn.commit()
-        conn.close()
+    def get_connection(self, user_id: Optional[int] = None):
+        """Подключение к базе (в режиме шардов - к шарду пользователя)"""
+        return self._db.get_connection(user_id)
+    
+    def _invalidate_cards(self, user_id: Optional[int]):
+        """Сбросить кэш карт пользователя (вызывать после commit)"""
+        if user_id is not None:
+            entity_cache.invalidate('cards', self.db_path, user_id)
     
     def add_credit_card(self, user_id: int, card_name: str, bank_name: str,
                        credit_limit: float, interest_rate: float,
@@ -75,7 +45,7 @@ class CreditCardManager:
         Returns:
             ID созданной карты
         """
-        conn = sqlite3.connect(self.db_path)
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -87,13 +57,21 @@ class CreditCardManager:
               interest_rate, minimum_payment_percent, grace_period_days))
         
         card_id = cursor.lastrowid
+        bump_data_version(cursor, user_id)
         conn.commit()
         conn.close()
+        self._invalidate_cards(user_id)
         return card_id
     
     def get_user_credit_cards(self, user_id: int, active_only: bool = True) -> List[Dict]:
-        """Получить кредитные карты пользователя"""
-        conn = sqlite3.connect(self.db_path)
+        """Получить кредитные карты пользователя (через кэш сущностей)"""
+        return entity_cache.get_or_load(
+            'cards', self.db_path, user_id, (active_only,),
+            lambda: self._load_user_credit_cards(user_id, active_only)
+        )
+    
+    def _load_user_credit_cards(self, user_id: int, active_only: bool) -> List[Dict]:
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         
         query = "SELECT * FROM credit_cards WHERE user_id = ?"
@@ -110,7 +88,7 @@ class CreditCardManager:
     
     def get_card_by_id(self, card_id: int) -> Optional[Dict]:
         """Получить карту по ID"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM credit_cards WHERE id = ?", (card_id,))
         columns = [description[0] for description in cursor.description]
@@ -160,7 +138,7 @@ class CreditCardManager:
         if transaction_date is None:
             transaction_date = date.today().isoformat()
         
-        conn = sqlite3.connect(self.db_path)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         card = self.get_card_by_id(card_id)
@@ -206,8 +184,11 @@ class CreditCardManager:
         """, (card_id, transaction_date, 'repayment', amount,
               balance_before, new_balance, interest_charged, notes))
         
+        bump_data_version_for_row(cursor, 'credit_cards', card_id)
+        
         conn.commit()
         conn.close()
+        self._invalidate_cards(card['user_id'])
         
         return {
             'balance_before': balance_before,
@@ -236,7 +217,7 @@ class CreditCardManager:
         if transaction_date is None:
             transaction_date = date.today().isoformat()
         
-        conn = sqlite3.connect(self.db_path)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         card = self.get_card_by_id(card_id)
@@ -266,8 +247,11 @@ class CreditCardManager:
         """, (card_id, transaction_date, 'purchase', amount,
               balance_before, new_balance, notes))
         
+        bump_data_version_for_row(cursor, 'credit_cards', card_id)
+        
         conn.commit()
         conn.close()
+        self._invalidate_cards(card['user_id'])
         
         return {
             'balance_before': balance_before,
@@ -319,7 +303,7 @@ class CreditCardManager:
     
     def get_card_transactions(self, card_id: int, limit: int = 50) -> List[Dict]:
         """Получить историю транзакций по карте"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -336,8 +320,12 @@ class CreditCardManager:
     
     def deactivate_card(self, card_id: int):
         """Деактивировать карту"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute("UPDATE credit_cards SET is_active = 0 WHERE id = ?", (card_id,))
+        bump_data_version_for_row(cursor, 'credit_cards', card_id)
+        cursor.execute("SELECT user_id FROM credit_cards WHERE id = ?", (card_id,))
+        owner = cursor.fetchone()
         conn.commit()
-        conn.close()
\ No newline at end of file
+        conn.close()
+        self._invalidate_cards(owner[0] if owner else None)
\ No newline at end of file
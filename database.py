@@ -1,13 +1,97 @@
 import sqlite3
+from contextlib import contextmanager
 from datetime import datetime, date
-from typing import List, Optional, Dict
+from typing import Iterator, List, Optional, Dict, Tuple
 import json
 
+from cache import entity_cache
+from migrations import ensure_schema
+from partitions import ShardRouter, current_user_id
+
+
+# Порог выявления необычных расходов: не меньше ANOMALY_MIN_SAMPLES
+# предыдущих трат в категории и отклонение от среднего в ANOMALY_Z_THRESHOLD сигм
+ANOMALY_MIN_SAMPLES = 5
+ANOMALY_Z_THRESHOLD = 3.0
+
+# Количество шардов для экземпляров Database без явного shards
+# (BotConfig.db_shards, задаётся при запуске бота и рабочих процессов)
+_default_shards = 0
+
+
+def set_default_shards(shards: int):
+    """
+    Задать количество шардов для экземпляров Database без явного shards
+
+    Модули обработчиков создают Database при импорте, до загрузки
+    конфигурации, поэтому такие экземпляры читают значение при первом
+    обращении к шардам.
+    """
+    global _default_shards
+    _default_shards = shards
+
+
+def bump_data_version(cursor, user_id: int):
+    """
+    Увеличить версию данных пользователя
+
+    Вызывается внутри транзакции изменяющего метода, поэтому версия
+    меняется атомарно вместе с самими данными.
+    """
+    cursor.execute("""
+        INSERT INTO user_data_versions (user_id, version, updated_at)
+        VALUES (?, 1, CURRENT_TIMESTAMP)
+        ON CONFLICT(user_id) DO UPDATE SET
+            version = version + 1,
+            updated_at = CURRENT_TIMESTAMP
+    """, (user_id,))
+
+
+def bump_data_version_for_row(cursor, table: str, row_id: int):
+    """
+    Увеличить версию данных владельца строки
+
+    Args:
+        cursor: Курсор открытой транзакции
+        table: Таблица с колонкой user_id
+        row_id: ID строки в этой таблице
+    """
+    cursor.execute(f"""
+        INSERT INTO user_data_versions (user_id, version, updated_at)
+        SELECT user_id, 1, CURRENT_TIMESTAMP FROM {table} WHERE id = ?
+        ON CONFLICT(user_id) DO UPDATE SET
+            version = version + 1,
+            updated_at = CURRENT_TIMESTAMP
+    """, (row_id,))
+
 
 class Database:
-    def __init__(self, db_path: str = "dohot.db"):
+    def __init__(self, db_path: str = "dohot.db", shards: Optional[int] = None):
+        """
+        Args:
+            db_path: Путь к базе данных
+            shards: Количество файлов-шардов с данными пользователей
+                (0 или 1 - всё в одном файле, None - см. set_default_shards)
+        """
         self.db_path = db_path
-        self.init_database()
+        self._shards = shards
+        self._router: Optional[ShardRouter] = None
+        ensure_schema(db_path)
+    
+    @property
+    def shards(self) -> int:
+        """Количество файлов-шардов"""
+        return _default_shards if self._shards is None else self._shards
+    
+    @property
+    def router(self) -> Optional[ShardRouter]:
+        """Выбор шарда пользователя (None - всё в одном файле)"""
+        shards = self.shards
+        if shards <= 1:
+            return None
+        if self._router is None or self._router.shards != shards:
+            self._router = ShardRouter(self.db_path, shards)
+        return self._router
         
     def get_credit_expenses_for_budget(self, user_id: int) -> float:
         """
@@ -22,169 +106,289 @@ class Database:
         for credit in credits:
             total_credit_expenses += credit['monthly_payment']
         
-        card_manager = CreditCardManager(self.db_path)
+        card_manager = CreditCardManager(self.db_path, self.shards)
         total_card_payment = card_manager.get_total_minimum_payment(user_id)
         total_credit_expenses += total_card_payment
         
         return total_credit_expenses
     
-    def get_connection(self):
-        return sqlite3.connect(self.db_path, check_same_thread=False)
+    def get_connection(self, user_id: Optional[int] = None):
+        """
+        Подключение к базе с данными пользователя
+
+        В режиме шардов возвращается подключение к шарду пользователя из
+        пула; если user_id не передан, используется пользователь текущего
+        обновления (current_user_id).
+        """
+        if self.router is None:
+            return sqlite3.connect(self.db_path, check_same_thread=False)
+
+        if user_id is None:
+            user_id = current_user_id.get()
+        if user_id is None:
+            raise RuntimeError("Sharded database needs user_id or current_user_id to pick a shard")
+        return self.router.connect(user_id)
+
+    def path_for_user(self, user_id: int) -> str:
+        """Файл базы с данными пользователя"""
+        return self.router.path_for(user_id) if self.router else self.db_path
+
+    def shard_paths(self) -> List[str]:
+        """Файлы с данными пользователей: все шарды или основная база"""
+        return self.router.paths() if self.router else [self.db_path]
+
+    def iter_connections(self) -> Iterator:
+        """
+        Подключения ко всем файлам с данными пользователей по очереди
+
+        Для общих отчётов и рассылок, которые обходят всех пользователей.
+        """
+        for path in self.shard_paths():
+            conn = self.router.connect_path(path) if self.router else self.get_connection()
+            try:
+                yield conn
+            finally:
+                conn.close()
+
+    @contextmanager
+    def user_scope(self, user_id: int):
+        """Выполнять методы по ID записей в шарде пользователя user_id"""
+        token = current_user_id.set(user_id)
+        try:
+            yield
+        finally:
+            current_user_id.reset(token)
+
+    def _credit_owner(self, cursor, credit_id: int) -> Optional[int]:
+        """Владелец кредита: для сброса кэша кредитов после изменения по ID"""
+        cursor.execute("SELECT user_id FROM credits WHERE id = ?", (credit_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def _invalidate_credits(self, user_id: Optional[int]):
+        """Сбросить кэш кредитов пользователя (вызывать после commit)"""
+        if user_id is not None:
+            entity_cache.invalidate('credits', self.db_path, user_id)
     
-    def init_database(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    # ==================== ПОМЕСЯЧНЫЕ ИТОГИ ====================
+    
+    def _apply_rollup(self, cursor, user_id: int, kind: str, category_id: Optional[int],
+                      op_date: str, amount: float, count: int = 1):
+        """
+        Учесть операцию в помесячных итогах
         
-        # Таблица пользователей
+        Args:
+            cursor: Курсор открытой транзакции
+            user_id: ID пользователя
+            kind: 'income' или 'expense'
+            category_id: ID категории (None = без категории)
+            op_date: Дата операции в формате YYYY-MM-DD
+            amount: Сумма (отрицательная при удалении)
+            count: Изменение количества операций (+1 / -1)
+        """
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+            INSERT INTO monthly_rollups (user_id, kind, category_id, month, total, count)
+            VALUES (?, ?, ?, substr(?, 1, 7), ?, ?)
+            ON CONFLICT(user_id, kind, category_id, month) DO UPDATE SET
+                total = total + excluded.total,
+                count = count + excluded.count
+        """, (user_id, kind, category_id or 0, op_date, amount, count))
+    
+    def get_monthly_totals(self, user_id: int, kind: str, months: int = 24) -> List[Dict]:
+        """
+        Итоги по месяцам за последние months завершённых месяцев
         
-        # Таблица кредитов
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS credits (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                bank_name TEXT NOT NULL,
-                display_name TEXT NOT NULL,
-                monthly_payment REAL NOT NULL,
-                total_months INTEGER NOT NULL,
-                interest_rate REAL NOT NULL,
-                remaining_debt REAL NOT NULL,
-                start_date DATE NOT NULL,
-                current_month INTEGER DEFAULT 0,
-                has_early_full BOOLEAN DEFAULT 1,
-                has_early_partial_period BOOLEAN DEFAULT 1,
-                has_early_partial_payment BOOLEAN DEFAULT 1,
-                has_holidays BOOLEAN DEFAULT 1,
-                is_active BOOLEAN DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
+        Текущий (неполный) месяц не учитывается. Месяцы без операций
+        в результат не попадают.
         
-        # Таблица платежей по кредитам
+        Returns:
+            Список {'month': 'YYYY-MM', 'total': float} по возрастанию месяца
+        """
+        conn = self.get_connection(user_id)
+        cursor = conn.cursor()
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS credit_payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                credit_id INTEGER NOT NULL,
-                payment_date DATE NOT NULL,
-                amount REAL NOT NULL,
-                payment_type TEXT NOT NULL,
-                notes TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (credit_id) REFERENCES credits(id)
-            )
-        """)
+            SELECT month, SUM(total) FROM monthly_rollups
+            WHERE user_id = ? AND kind = ?
+              AND month >= strftime('%Y-%m', 'now', 'localtime', 'start of month', ?)
+              AND month < strftime('%Y-%m', 'now', 'localtime')
+            GROUP BY month
+            ORDER BY month
+        """, (user_id, kind, f'-{months} months'))
+        rows = cursor.fetchall()
+        conn.close()
+        return [{'month': month, 'total': total} for month, total in rows]
+    
+    # ==================== СТАТИСТИКА РАСХОДОВ ====================
+    
+    def _update_expense_stats(self, cursor, user_id: int, category_id: Optional[int], amount: float):
+        """
+        Учесть новый расход в статистике категории за O(1)
         
-        # Таблица кредитных каникул
+        Шаг алгоритма Уэлфорда выполняется одним UPSERT: в правой части
+        SET используются значения строки до обновления.
+        """
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS credit_holidays (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                credit_id INTEGER NOT NULL,
-                start_date DATE NOT NULL,
-                end_date DATE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (credit_id) REFERENCES credits(id)
-            )
-        """)
-        
-        # Таблица долгов (взятых/выданных)
+            INSERT INTO expense_category_stats (user_id, category_id, count, mean, m2)
+            VALUES (?, ?, 1, ?, 0)
+            ON CONFLICT(user_id, category_id) DO UPDATE SET
+                count = count + 1,
+                mean = mean + (excluded.mean - mean) / (count + 1),
+                m2 = m2 + (excluded.mean - mean) * (excluded.mean - (mean + (excluded.mean - mean) / (count + 1)))
+        """, (user_id, category_id or 0, amount))
+    
+    def _remove_from_expense_stats(self, cursor, user_id: int, category_id: Optional[int], amount: float):
+        """Исключить удалённый расход из статистики (обратный шаг Уэлфорда)"""
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS debts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                person_name TEXT NOT NULL,
-                amount REAL NOT NULL,
-                debt_type TEXT NOT NULL,
-                description TEXT,
-                date DATE NOT NULL,
-                is_paid BOOLEAN DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
+            SELECT count, mean, m2 FROM expense_category_stats
+            WHERE user_id = ? AND category_id = ?
+        """, (user_id, category_id or 0))
+        row = cursor.fetchone()
+        if not row:
+            return
         
-        # Таблица категорий
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS categories (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                name TEXT NOT NULL,
-                type TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
+        count, mean, m2 = row
+        if count <= 1:
+            count, mean, m2 = 0, 0, 0
+        else:
+            new_mean = (count * mean - amount) / (count - 1)
+            m2 = max(m2 - (amount - new_mean) * (amount - mean), 0)
+            count, mean = count - 1, new_mean
         
-        # Таблица доходов
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS incomes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                category_id INTEGER,
-                amount REAL NOT NULL,
-                description TEXT,
-                date DATE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id),
-                FOREIGN KEY (category_id) REFERENCES categories(id)
-            )
-        """)
+            UPDATE expense_category_stats SET count = ?, mean = ?, m2 = ?
+            WHERE user_id = ? AND category_id = ?
+        """, (count, mean, m2, user_id, category_id or 0))
+    
+    def check_expense_anomaly(self, user_id: int, category_id: Optional[int], amount: float) -> Dict:
+        """
+        Проверить, не является ли расход необычно крупным для категории
         
-        # Таблица расходов
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS expenses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                category_id INTEGER,
-                amount REAL NOT NULL,
-                description TEXT,
-                date DATE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id),
-                FOREIGN KEY (category_id) REFERENCES categories(id)
-            )
-        """)
+        Сравнивает сумму с накопленной статистикой категории (одно чтение
+        по первичному ключу, без просмотра истории). Вызывается до
+        добавления расхода.
         
-        # Таблица инвестиций
+        Returns:
+            Dict: {
+                'is_anomaly': bool,
+                'count': int,
+                'mean': float,
+                'std': float,
+                'z_score': float,
+                'ratio': float  # во сколько раз больше среднего
+            }
+        """
+        conn = self.get_connection(user_id)
+        cursor = conn.cursor()
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS investments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                asset_name TEXT NOT NULL,
-                invested_amount REAL NOT NULL,
-                current_value REAL NOT NULL,
-                last_updated DATE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
+            SELECT count, mean, m2 FROM expense_category_stats
+            WHERE user_id = ? AND category_id = ?
+        """, (user_id, category_id or 0))
+        row = cursor.fetchone()
+        conn.close()
         
-        # Таблица сбережений
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS savings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                amount REAL NOT NULL,
-                date DATE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
+        count, mean, m2 = row if row else (0, 0, 0)
+        std = (m2 / (count - 1)) ** 0.5 if count > 1 else 0
+        z_score = (amount - mean) / std if std > 0 else 0
+        
+        if count < ANOMALY_MIN_SAMPLES or amount <= mean:
+            is_anomaly = False
+        elif std > 0:
+            is_anomaly = z_score >= ANOMALY_Z_THRESHOLD
+        else:
+            # Все прошлые траты одинаковые — заметным считаем двукратное превышение
+            is_anomaly = amount >= mean * 2
+        
+        return {
+            'is_anomaly': is_anomaly,
+            'count': count,
+            'mean': mean,
+            'std': std,
+            'z_score': z_score,
+            'ratio': amount / mean if mean > 0 else 0
+        }
+    
+    def get_category_period_comparison(self, user_id: int, periods: int = 6,
+                                       window: int = 3) -> List[Dict]:
+        """
+        Сравнение категорий по месяцам за один проход по помесячным итогам
+        
+        Для каждой категории и каждого из последних periods месяцев (включая
+        текущий) возвращает сумму, сумму за предыдущий месяц и за тот же
+        месяц год назад, а также скользящее среднее за window месяцев.
+        Месяцы без операций заполняются нулями. Стоимость запроса зависит
+        от числа категорий и месяцев, но не от количества операций.
+        
+        Args:
+            user_id: ID пользователя
+            periods: Количество месяцев в выборке
+            window: Окно скользящего среднего в месяцах
+        
+        Returns:
+            Список словарей с ключами kind, category_id, category_name, month,
+            total, prev_total, year_ago_total, rolling_avg
+        """
+        periods = max(int(periods), 1)
+        window = max(int(window), 1)
+        
+        # Берём на 12 месяцев больше, чтобы у первого месяца выборки было
+        # значение "год назад" и полное окно скользящего среднего
+        lookback = periods + max(12, window)
+        
+        conn = self.get_connection(user_id)
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            WITH RECURSIVE months(n, month) AS (
+                SELECT 0, strftime('%Y-%m', 'now', 'localtime', 'start of month')
+                UNION ALL
+                SELECT n + 1, strftime('%Y-%m', 'now', 'localtime', 'start of month', '-' || (n + 1) || ' months')
+                FROM months WHERE n + 1 < :lookback
+            ),
+            user_rollups AS (
+                SELECT kind, category_id, month, total
+                FROM monthly_rollups
+                WHERE user_id = :uid AND month >= (SELECT MIN(month) FROM months)
+            ),
+            grid AS (
+                SELECT c.kind, c.category_id, m.month
+                FROM (SELECT DISTINCT kind, category_id FROM user_rollups) c
+                CROSS JOIN months m
+            ),
+            series AS (
+                SELECT g.kind, g.category_id, g.month, IFNULL(r.total, 0) AS total
+                FROM grid g
+                LEFT JOIN user_rollups r
+                    ON r.kind = g.kind AND r.category_id = g.category_id AND r.month = g.month
+            ),
+            compared AS (
+                SELECT kind, category_id, month, total,
+                       LAG(total, 1) OVER w AS prev_total,
+                       LAG(total, 12) OVER w AS year_ago_total,
+                       AVG(total) OVER (
+                           PARTITION BY kind, category_id ORDER BY month
+                           ROWS BETWEEN {window - 1} PRECEDING AND CURRENT ROW
+                       ) AS rolling_avg
+                FROM series
+                WINDOW w AS (PARTITION BY kind, category_id ORDER BY month)
             )
-        """)
+            SELECT cmp.kind, cmp.category_id,
+                   IFNULL(cat.name, 'Без категории') AS category_name,
+                   cmp.month, cmp.total, cmp.prev_total, cmp.year_ago_total, cmp.rolling_avg
+            FROM compared cmp
+            LEFT JOIN categories cat ON cat.id = cmp.category_id
+            WHERE cmp.month >= strftime('%Y-%m', 'now', 'localtime', 'start of month',
+                                        '-' || (:periods - 1) || ' months')
+            ORDER BY cmp.kind, cmp.month, cmp.total DESC
+        """, {'uid': user_id, 'lookback': lookback, 'periods': periods})
         
-        conn.commit()
+        columns = [description[0] for description in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
         conn.close()
+        return rows
     
     # ==================== ПОЛЬЗОВАТЕЛИ ====================
     
     def add_user(self, user_id: int, username: str = None, first_name: str = None):
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         cursor.execute("""
             INSERT OR IGNORE INTO users (user_id, username, first_name)
@@ -192,7 +396,41 @@ class Database:
         """, (user_id, username, first_name))
         conn.commit()
         conn.close()
-    
+
+    def get_data_version(self, user_id: int) -> int:
+        """
+        Получить текущую версию данных пользователя
+
+        Версия монотонно растёт при каждом изменении данных пользователя
+        и используется как часть ключа кэша отчётов и графиков.
+        """
+        conn = self.get_connection(user_id)
+        cursor = conn.cursor()
+        cursor.execute("SELECT version FROM user_data_versions WHERE user_id = ?", (user_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return row[0] if row else 0
+
+    def get_recently_active_users(self, since: str) -> List[int]:
+        """
+        Получить пользователей, изменявших данные начиная с указанного момента
+
+        Args:
+            since: Момент в формате 'YYYY-MM-DD HH:MM:SS' (UTC, как CURRENT_TIMESTAMP)
+
+        Returns:
+            Список ID пользователей
+        """
+        user_ids = []
+        for conn in self.iter_connections():
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT user_id FROM user_data_versions
+                WHERE updated_at >= ?
+            """, (since,))
+            user_ids.extend(row[0] for row in cursor.fetchall())
+        return sorted(user_ids)
+
     # ==================== КРЕДИТЫ ====================
     
     def add_credit(self, user_id: int, bank_name: str, monthly_payment: float,
@@ -202,7 +440,7 @@ class Database:
             start_date = date.today().isoformat()
         
         # Проверяем, есть ли уже кредиты от этого банка
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         cursor.execute("""
             SELECT COUNT(*) FROM credits 
@@ -224,8 +462,10 @@ class Database:
               total_months, interest_rate, remaining_debt, start_date))
         
         credit_id = cursor.lastrowid
+        bump_data_version(cursor, user_id)
         conn.commit()
         conn.close()
+        self._invalidate_credits(user_id)
         return credit_id
     
     def update_credit_capabilities(self, credit_id: int, 
@@ -256,12 +496,21 @@ class Database:
             params.append(credit_id)
             query = f"UPDATE credits SET {', '.join(updates)} WHERE id = ?"
             cursor.execute(query, params)
+            bump_data_version_for_row(cursor, 'credits', credit_id)
+            owner = self._credit_owner(cursor, credit_id)
             conn.commit()
+            self._invalidate_credits(owner)
         
         conn.close()
     
     def get_user_credits(self, user_id: int, active_only: bool = True) -> List[Dict]:
-        conn = self.get_connection()
+        return entity_cache.get_or_load(
+            'credits', self.db_path, user_id, (active_only,),
+            lambda: self._load_user_credits(user_id, active_only)
+        )
+    
+    def _load_user_credits(self, user_id: int, active_only: bool) -> List[Dict]:
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         
         query = "SELECT * FROM credits WHERE user_id = ?"
@@ -294,8 +543,11 @@ class Database:
         cursor.execute("""
             UPDATE credits SET remaining_debt = ? WHERE id = ?
         """, (new_debt, credit_id))
+        bump_data_version_for_row(cursor, 'credits', credit_id)
+        owner = self._credit_owner(cursor, credit_id)
         conn.commit()
         conn.close()
+        self._invalidate_credits(owner)
     
     def add_credit_payment(self, credit_id: int, amount: float, 
                           payment_type: str, payment_date: str = None, notes: str = None):
@@ -325,8 +577,12 @@ class Database:
             WHERE id = ?
         """, (new_debt, credit_id))
         
+        bump_data_version_for_row(cursor, 'credits', credit_id)
+        owner = self._credit_owner(cursor, credit_id)
+        
         conn.commit()
         conn.close()
+        self._invalidate_credits(owner)
     
     def add_credit_holiday(self, credit_id: int, start_date: str, end_date: str):
         conn = self.get_connection()
@@ -335,6 +591,7 @@ class Database:
             INSERT INTO credit_holidays (credit_id, start_date, end_date)
             VALUES (?, ?, ?)
         """, (credit_id, start_date, end_date))
+        bump_data_version_for_row(cursor, 'credits', credit_id)
         conn.commit()
         conn.close()
     
@@ -345,7 +602,7 @@ class Database:
         if debt_date is None:
             debt_date = date.today().isoformat()
         
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         cursor.execute("""
             INSERT INTO debts (user_id, person_name, amount, debt_type, description, date)
@@ -353,12 +610,13 @@ class Database:
         """, (user_id, person_name, amount, debt_type, description, debt_date))
         
         debt_id = cursor.lastrowid
+        bump_data_version(cursor, user_id)
         conn.commit()
         conn.close()
         return debt_id
     
     def get_user_debts(self, user_id: int, unpaid_only: bool = True) -> List[Dict]:
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         
         query = "SELECT * FROM debts WHERE user_id = ?"
@@ -377,13 +635,14 @@ class Database:
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute("UPDATE debts SET is_paid = 1 WHERE id = ?", (debt_id,))
+        bump_data_version_for_row(cursor, 'debts', debt_id)
         conn.commit()
         conn.close()
     
     # ==================== КАТЕГОРИИ ====================
     
     def add_category(self, user_id: int, name: str, cat_type: str) -> int:
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         cursor.execute("""
             INSERT INTO categories (user_id, name, type)
@@ -391,12 +650,20 @@ class Database:
         """, (user_id, name, cat_type))
         
         category_id = cursor.lastrowid
+        bump_data_version(cursor, user_id)
         conn.commit()
         conn.close()
+        entity_cache.invalidate('categories', self.db_path, user_id)
         return category_id
     
     def get_user_categories(self, user_id: int, cat_type: str = None) -> List[Dict]:
-        conn = self.get_connection()
+        return entity_cache.get_or_load(
+            'categories', self.db_path, user_id, (cat_type,),
+            lambda: self._load_user_categories(user_id, cat_type)
+        )
+    
+    def _load_user_categories(self, user_id: int, cat_type: Optional[str]) -> List[Dict]:
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         
         if cat_type:
@@ -418,7 +685,7 @@ class Database:
         if income_date is None:
             income_date = date.today().isoformat()
         
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         cursor.execute("""
             INSERT INTO incomes (user_id, category_id, amount, description, date)
@@ -426,13 +693,15 @@ class Database:
         """, (user_id, category_id, amount, description, income_date))
         
         income_id = cursor.lastrowid
+        self._apply_rollup(cursor, user_id, 'income', category_id, income_date, amount)
+        bump_data_version(cursor, user_id)
         conn.commit()
         conn.close()
         return income_id
     
     def get_user_incomes(self, user_id: int, start_date: str = None, 
                         end_date: str = None) -> List[Dict]:
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         
         query = "SELECT * FROM incomes WHERE user_id = ?"
@@ -458,7 +727,7 @@ class Database:
         if expense_date is None:
             expense_date = date.today().isoformat()
         
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         cursor.execute("""
             INSERT INTO expenses (user_id, category_id, amount, description, date)
@@ -466,13 +735,16 @@ class Database:
         """, (user_id, category_id, amount, description, expense_date))
         
         expense_id = cursor.lastrowid
+        self._apply_rollup(cursor, user_id, 'expense', category_id, expense_date, amount)
+        self._update_expense_stats(cursor, user_id, category_id, amount)
+        bump_data_version(cursor, user_id)
         conn.commit()
         conn.close()
         return expense_id
     
     def get_user_expenses(self, user_id: int, start_date: str = None,
                          end_date: str = None) -> List[Dict]:
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         
         query = "SELECT * FROM expenses WHERE user_id = ?"
@@ -498,7 +770,7 @@ class Database:
         if current_value is None:
             current_value = invested_amount
         
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         cursor.execute("""
             INSERT INTO investments (user_id, asset_name, invested_amount, 
@@ -507,6 +779,7 @@ class Database:
         """, (user_id, asset_name, invested_amount, current_value, date.today().isoformat()))
         
         investment_id = cursor.lastrowid
+        bump_data_version(cursor, user_id)
         conn.commit()
         conn.close()
         return investment_id
@@ -519,11 +792,12 @@ class Database:
             SET current_value = ?, last_updated = ? 
             WHERE id = ?
         """, (new_value, date.today().isoformat(), investment_id))
+        bump_data_version_for_row(cursor, 'investments', investment_id)
         conn.commit()
         conn.close()
     
     def get_user_investments(self, user_id: int) -> List[Dict]:
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM investments WHERE user_id = ?", (user_id,))
         columns = [description[0] for description in cursor.description]
@@ -537,7 +811,7 @@ class Database:
         if savings_date is None:
             savings_date = date.today().isoformat()
         
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         cursor.execute("""
             INSERT INTO savings (user_id, amount, date)
@@ -545,12 +819,13 @@ class Database:
         """, (user_id, amount, savings_date))
         
         savings_id = cursor.lastrowid
+        bump_data_version(cursor, user_id)
         conn.commit()
         conn.close()
         return savings_id
     
     def get_latest_savings(self, user_id: int) -> Optional[Dict]:
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         cursor.execute("""
             SELECT * FROM savings 
@@ -593,7 +868,7 @@ class Database:
         if expense_categories is None:
             expense_categories = {}
         
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         
         # Проверяем, существует ли бюджет
@@ -639,6 +914,8 @@ class Database:
                 credit_expenses, None, notes, income_json, expense_json))
             budget_id = cursor.lastrowid
         
+        bump_data_version(cursor, user_id)
+        
         conn.commit()
         conn.close()
         return budget_id
@@ -694,6 +971,8 @@ class Database:
                 WHERE id = ?
             """, (json.dumps(expense_cats), new_expenses, budget_id))
         
+        bump_data_version_for_row(cursor, 'budget_plans', budget_id)
+        
         conn.commit()
         conn.close()
         return True
@@ -719,6 +998,19 @@ class Database:
         
         return budget
 
+    def get_month_category_total(self, user_id: int, kind: str, category_id: Optional[int],
+                                 month: int, year: int) -> float:
+        """Сумма операций категории за месяц по помесячным итогам"""
+        conn = self.get_connection(user_id)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT total FROM monthly_rollups
+            WHERE user_id = ? AND kind = ? AND category_id = ? AND month = ?
+        """, (user_id, kind, category_id or 0, f"{year}-{month:02d}"))
+        row = cursor.fetchone()
+        conn.close()
+        return row[0] if row else 0
+
     def check_expense_against_budget(self, user_id: int, category_id: int, 
                                     amount: float, expense_date: str) -> Dict:
         """
@@ -772,15 +1064,8 @@ class Database:
         result['category_in_budget'] = True
         result['planned'] = expense_cats[cat_key]
         
-        # Считаем сколько уже потрачено по этой категории за месяц (до добавления нового расхода)
-        start_date = f"{year}-{month:02d}-01"
-        if month == 12:
-            end_date = f"{year + 1}-01-01"
-        else:
-            end_date = f"{year}-{month + 1:02d}-01"
-        
-        expenses = self.get_user_expenses(user_id, start_date, end_date)
-        spent = sum(e['amount'] for e in expenses if e.get('category_id') == category_id)
+        # Сколько уже потрачено по этой категории за месяц (до добавления нового расхода)
+        spent = self.get_month_category_total(user_id, 'expense', category_id, month, year)
         
         result['spent_before'] = spent
         result['spent_after'] = spent + amount
@@ -793,7 +1078,7 @@ class Database:
     
     def get_budget(self, user_id: int, month: int, year: int) -> Optional[Dict]:
         """Получить бюджет на месяц"""
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         
@@ -809,9 +1094,31 @@ class Database:
             return dict(row)
         return None
     
+    def get_budgets_in_range(self, user_id: int, start_month: int, start_year: int,
+                             end_month: int, end_year: int) -> Dict[Tuple[int, int], Dict]:
+        """
+        Получить бюджеты за диапазон месяцев одним запросом
+        
+        Returns:
+            Словарь {(год, месяц): бюджет}, границы диапазона включительно
+        """
+        conn = self.get_connection(user_id)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT * FROM budget_plans
+            WHERE user_id = ? AND year * 12 + month BETWEEN ? AND ?
+        """, (user_id, start_year * 12 + start_month, end_year * 12 + end_month))
+        
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return {(row['year'], row['month']): dict(row) for row in rows}
+    
     def get_user_budgets(self, user_id: int, limit: int = 12) -> List[Dict]:
         """Получить список бюджетов пользователя"""
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         
@@ -832,6 +1139,7 @@ class Database:
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        bump_data_version_for_row(cursor, 'budget_plans', budget_id)
         cursor.execute("DELETE FROM budget_plans WHERE id = ?", (budget_id,))
         deleted = cursor.rowcount > 0
         
@@ -845,17 +1153,24 @@ class Database:
         """Удаляет доход по ID, проверяя владельца.
         Returns True если удалено, False если записи нет или не принадлежит пользователю.
         """
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
+        cursor.execute("SELECT category_id, amount, date FROM incomes WHERE id = ? AND user_id = ?",
+                       (income_id, user_id))
+        row = cursor.fetchone()
         cursor.execute("DELETE FROM incomes WHERE id = ? AND user_id = ?", (income_id, user_id))
         deleted = cursor.rowcount > 0
+        if deleted:
+            category_id, amount, op_date = row
+            self._apply_rollup(cursor, user_id, 'income', category_id, op_date, -amount, -1)
+            bump_data_version(cursor, user_id)
         conn.commit()
         conn.close()
         return deleted
 
     def get_last_income(self, user_id: int):
         """Возвращает последний доход пользователя (dict) или None"""
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         cursor.execute("""SELECT * FROM incomes WHERE user_id = ? ORDER BY id DESC LIMIT 1""", (user_id,))
         row = cursor.fetchone()
@@ -870,17 +1185,25 @@ class Database:
         """Удаляет расход по ID, проверяя владельца.
         Returns True если удалено, False если записи нет или не принадлежит пользователю.
         """
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
+        cursor.execute("SELECT category_id, amount, date FROM expenses WHERE id = ? AND user_id = ?",
+                       (expense_id, user_id))
+        row = cursor.fetchone()
         cursor.execute("DELETE FROM expenses WHERE id = ? AND user_id = ?", (expense_id, user_id))
         deleted = cursor.rowcount > 0
+        if deleted:
+            category_id, amount, op_date = row
+            self._apply_rollup(cursor, user_id, 'expense', category_id, op_date, -amount, -1)
+            self._remove_from_expense_stats(cursor, user_id, category_id, amount)
+            bump_data_version(cursor, user_id)
         conn.commit()
         conn.close()
         return deleted
 
     def get_last_expense(self, user_id: int):
         """Возвращает последний расход пользователя (dict) или None"""
-        conn = self.get_connection()
+        conn = self.get_connection(user_id)
         cursor = conn.cursor()
         cursor.execute("""SELECT * FROM expenses WHERE user_id = ? ORDER BY id DESC LIMIT 1""", (user_id,))
         row = cursor.fetchone()
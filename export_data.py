@@ -2,11 +2,14 @@
 """
 Скрипт для экспорта данных пользователей DoHot
 
-Позволяет экспортировать данные в CSV, JSON для анализа или переноса.
+Позволяет экспортировать данные в CSV, JSON Lines для анализа или переноса.
+Данные выгружаются потоково, по файлу на таблицу, с необязательным
+сжатием gzip или lzma.
 
 Использование:
     python export_data.py --user 12345              # Экспорт данных пользователя
-    python export_data.py --user 12345 --format json # Экспорт в JSON
+    python export_data.py --user 12345 --format json # Экспорт в JSON Lines
+    python export_data.py --user 12345 --compress gzip # Экспорт со сжатием
     python export_data.py --all                     # Экспорт всех пользователей
 """
 
@@ -24,7 +27,21 @@ from utils import DataExporter
 from database import Database
 
 
-def export_user_data_csv(db: Database, user_id: int, output_dir: str = "exports"):
+def print_exported_files(exported: dict):
+    """Вывести список выгруженных файлов"""
+    if not exported:
+        print("⚠️  Нет данных для экспорта")
+        return
+    
+    print("✅ Экспортированы файлы:")
+    for table, info in exported.items():
+        size = os.path.getsize(info['path']) / 1024
+        print(f"   • {table}: {info['path']} ({info['rows']} строк, {size:.2f} KB)")
+    print(f"\n📁 Всего файлов: {len(exported)}")
+
+
+def export_user_data_csv(db: Database, user_id: int, output_dir: str = "exports",
+                         compression: str = None):
     """
     Экспортировать данные пользователя в CSV
     
@@ -32,104 +49,71 @@ def export_user_data_csv(db: Database, user_id: int, output_dir: str = "exports"
         db: Database instance
         user_id: ID пользователя
         output_dir: Директория для сохранения
+        compression: Сжатие: None, 'gzip' или 'lzma'
     """
     print(f"📊 Экспорт данных пользователя {user_id} в CSV...\n")
     
-    exporter = DataExporter(db.db_path)
-    files = exporter.export_to_csv(user_id, output_dir)
-    
-    if files:
-        print("✅ Экспортированы файлы:")
-        for data_type, filepath in files.items():
-            size = os.path.getsize(filepath) / 1024
-            print(f"   • {data_type}: {filepath} ({size:.2f} KB)")
-        print(f"\n📁 Всего файлов: {len(files)}")
-    else:
-        print("⚠️  Нет данных для экспорта")
+    exporter = DataExporter(db.path_for_user(user_id))
+    print_exported_files(exporter.export_user(user_id, output_dir, 'csv', compression))
 
 
-def export_user_data_json(db: Database, user_id: int, output_dir: str = "exports"):
+def export_user_data_json(db: Database, user_id: int, output_dir: str = "exports",
+                          compression: str = None):
     """
-    Экспортировать данные пользователя в JSON
+    Экспортировать данные пользователя в JSON Lines (одна запись на строку)
     
     Args:
         db: Database instance
         user_id: ID пользователя
         output_dir: Директория для сохранения
+        compression: Сжатие: None, 'gzip' или 'lzma'
     """
-    print(f"📊 Экспорт данных пользователя {user_id} в JSON...\n")
-    
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    print(f"📊 Экспорт данных пользователя {user_id} в JSON Lines...\n")
     
-    # Собираем все данные
-    data = {
-        'user_id': user_id,
-        'export_date': datetime.now().isoformat(),
-        'credits': db.get_user_credits(user_id, active_only=False),
-        'debts': db.get_user_debts(user_id, unpaid_only=False),
-        'categories': db.get_user_categories(user_id),
-        'incomes': db.get_user_incomes(user_id),
-        'expenses': db.get_user_expenses(user_id),
-        'investments': db.get_user_investments(user_id),
-        'savings': db.get_latest_savings(user_id)
-    }
-    
-    # Сохраняем в JSON
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"user_{user_id}_data_{timestamp}.json"
-    filepath = os.path.join(output_dir, filename)
-    
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
-    
-    size_kb = os.path.getsize(filepath) / 1024
-    print(f"✅ Данные экспортированы: {filepath} ({size_kb:.2f} KB)")
-    
-    # Статистика
-    print(f"\n📊 Статистика:")
-    print(f"   • Кредитов: {len(data['credits'])}")
-    print(f"   • Долгов: {len(data['debts'])}")
-    print(f"   • Категорий: {len(data['categories'])}")
-    print(f"   • Доходов: {len(data['incomes'])}")
-    print(f"   • Расходов: {len(data['expenses'])}")
-    print(f"   • Инвестиций: {len(data['investments'])}")
+    exporter = DataExporter(db.path_for_user(user_id))
+    print_exported_files(exporter.export_user(user_id, output_dir, 'jsonl', compression))
 
 
-def export_all_users(db: Database, format: str = "csv", output_dir: str = "exports"):
+def export_all_users(db: Database, format: str = "csv", output_dir: str = "exports",
+                     compression: str = None, workers: int = 1):
     """
     Экспортировать данные всех пользователей
     
+    Каждая таблица читается одним проходом, упорядоченным по user_id,
+    строки раскладываются по директориям пользователей. Итог описывается
+    в manifest.json.
+    
     Args:
         db: Database instance
         format: Формат экспорта ('csv' или 'json')
         output_dir: Директория для сохранения
+        compression: Сжатие: None, 'gzip' или 'lzma'
+        workers: Количество процессов для параллельной выгрузки
     """
     print("📊 Экспорт данных всех пользователей...\n")
     
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT DISTINCT user_id FROM users")
-    user_ids = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    
-    if not user_ids:
-        print("⚠️  Пользователи не найдены")
-        return
+    fmt = 'csv' if format == 'csv' else 'jsonl'
+    paths = db.shard_paths()
     
-    print(f"👥 Найдено пользователей: {len(user_ids)}\n")
+    # В режиме шардов базы каждый шард выгружается в свою поддиректорию
+    manifests = []
+    for index, path in enumerate(paths):
+        shard_output = output_dir if len(paths) == 1 else os.path.join(output_dir, f"shard_{index:03d}")
+        manifest_path = DataExporter(path).export_all_sharded(shard_output, fmt, compression, workers)
+        with open(manifest_path, encoding='utf-8') as f:
+            manifests.append((manifest_path, json.load(f)))
     
-    for i, user_id in enumerate(user_ids, 1):
-        print(f"[{i}/{len(user_ids)}] Экспорт пользователя {user_id}...")
-        
-        if format == "csv":
-            export_user_data_csv(db, user_id, output_dir)
-        else:
-            export_user_data_json(db, user_id, output_dir)
-        
-        print()
+    total_users = sum(manifest['total_users'] for _, manifest in manifests)
+    if not total_users:
+        print("⚠️  Нет данных для экспорта")
+        return
     
-    print(f"✅ Экспорт завершён! Данные сохранены в: {output_dir}")
+    print(f"👥 Пользователей: {total_users}")
+    print(f"📄 Строк: {sum(manifest['total_rows'] for _, manifest in manifests)}")
+    print(f"⚙️  Процессов: {max(len(manifest['shards']) for _, manifest in manifests)}")
+    print(f"⏱  Время: {sum(manifest['duration_seconds'] for _, manifest in manifests):.2f} сек.")
+    for manifest_path, _ in manifests:
+        print(f"\n✅ Экспорт завершён! Манифест: {manifest_path}")
 
 
 def generate_summary_report(db: Database, output_dir: str = "exports"):
@@ -142,29 +126,44 @@ def generate_summary_report(db: Database, output_dir: str = "exports"):
     """
     print("📊 Генерация сводного отчёта...\n")
     
-    conn = db.get_connection()
-    cursor = conn.cursor()
+    # Общая статистика: суммируется по всем шардам базы
+    total_users = 0
+    total_credits = total_debt = 0
+    total_debts = total_debt_amount = 0
+    total_incomes_count = total_incomes_amount = 0
+    total_expenses_count = total_expenses_amount = 0
+    total_investments_count = total_investments_value = 0
     
-    # Общая статистика
-    cursor.execute("SELECT COUNT(DISTINCT user_id) FROM users")
-    total_users = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*), SUM(remaining_debt) FROM credits WHERE is_active = 1")
-    total_credits, total_debt = cursor.fetchone()
-    
-    cursor.execute("SELECT COUNT(*), SUM(amount) FROM debts WHERE is_paid = 0")
-    total_debts, total_debt_amount = cursor.fetchone()
-    
-    cursor.execute("SELECT COUNT(*), SUM(amount) FROM incomes")
-    total_incomes_count, total_incomes_amount = cursor.fetchone()
-    
-    cursor.execute("SELECT COUNT(*), SUM(amount) FROM expenses")
-    total_expenses_count, total_expenses_amount = cursor.fetchone()
-    
-    cursor.execute("SELECT COUNT(*), SUM(current_value) FROM investments")
-    total_investments_count, total_investments_value = cursor.fetchone()
-    
-    conn.close()
+    for conn in db.iter_connections():
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT COUNT(DISTINCT user_id) FROM users")
+        total_users += cursor.fetchone()[0]
+        
+        cursor.execute("SELECT COUNT(*), TOTAL(remaining_debt) FROM credits WHERE is_active = 1")
+        count, amount = cursor.fetchone()
+        total_credits += count
+        total_debt += amount
+        
+        cursor.execute("SELECT COUNT(*), TOTAL(amount) FROM debts WHERE is_paid = 0")
+        count, amount = cursor.fetchone()
+        total_debts += count
+        total_debt_amount += amount
+        
+        cursor.execute("SELECT COUNT(*), TOTAL(amount) FROM incomes")
+        count, amount = cursor.fetchone()
+        total_incomes_count += count
+        total_incomes_amount += amount
+        
+        cursor.execute("SELECT COUNT(*), TOTAL(amount) FROM expenses")
+        count, amount = cursor.fetchone()
+        total_expenses_count += count
+        total_expenses_amount += amount
+        
+        cursor.execute("SELECT COUNT(*), TOTAL(current_value) FROM investments")
+        count, amount = cursor.fetchone()
+        total_investments_count += count
+        total_investments_value += amount
     
     # Формируем отчёт
     report = f"""
@@ -230,8 +229,10 @@ def main():
         epilog="""
 Примеры использования:
   python export_data.py --user 12345                   # Экспорт одного пользователя в CSV
-  python export_data.py --user 12345 --format json     # Экспорт в JSON
+  python export_data.py --user 12345 --format json     # Экспорт в JSON Lines
+  python export_data.py --user 12345 --compress gzip   # Экспорт со сжатием
   python export_data.py --all                          # Экспорт всех пользователей
+  python export_data.py --all --workers 4              # То же в 4 процессах
   python export_data.py --summary                      # Сводный отчёт
         """
     )
@@ -257,9 +258,22 @@ def main():
     
     parser.add_argument(
         '--format',
-        choices=['csv', 'json'],
+        choices=['csv', 'json', 'jsonl'],
         default='csv',
-        help='Формат экспорта (по умолчанию: csv)'
+        help='Формат экспорта: csv или json/jsonl — JSON Lines (по умолчанию: csv)'
+    )
+    
+    parser.add_argument(
+        '--compress',
+        choices=['gzip', 'lzma'],
+        help='Сжимать файлы экспорта (gzip или lzma)'
+    )
+    
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Количество процессов для экспорта всех пользователей (по умолчанию: 1)'
     )
     
     parser.add_argument(
@@ -268,6 +282,13 @@ def main():
         help='Директория для сохранения (по умолчанию: exports)'
     )
     
+    parser.add_argument(
+        '--shards',
+        type=int,
+        default=0,
+        help='Количество шардов базы, как DB_SHARDS бота (по умолчанию: 0)'
+    )
+    
     parser.add_argument(
         '--summary',
         action='store_true',
@@ -280,17 +301,17 @@ def main():
         print(f"❌ База данных не найдена: {args.db}")
         sys.exit(1)
     
-    db = Database(args.db)
+    db = Database(args.db, args.shards)
     
     if args.summary:
         generate_summary_report(db, args.output)
     elif args.user:
         if args.format == 'csv':
-            export_user_data_csv(db, args.user, args.output)
+            export_user_data_csv(db, args.user, args.output, args.compress)
         else:
-            export_user_data_json(db, args.user, args.output)
+            export_user_data_json(db, args.user, args.output, args.compress)
     elif args.all:
-        export_all_users(db, args.format, args.output)
+        export_all_users(db, args.format, args.output, args.compress, args.workers)
     else:
         parser.print_help()
         sys.exit(1)
@@ -0,0 +1,208 @@
+"""
+Хранилище состояний FSM в SQLite
+
+Состояния диалогов (мастера кредитов, бюджета и т.п.) хранятся в таблице
+fsm_states, поэтому переживают перезапуск бота и доступны нескольким
+процессам. Чтение идёт из кэша в памяти, запись - в кэш и в очередь,
+которая сбрасывается в базу одной транзакцией раз в flush_interval секунд
+(и при закрытии хранилища).
+
+Данные состояния сериализуются pickle: обработчики кладут в них словари
+с целочисленными ключами, которые JSON превратил бы в строки. Таблицу
+пишет только сам бот.
+
+Кэш процесса считается актуальным, пока записи одного чата обрабатывает
+один процесс (см. распределение пользователей по процессам). Если чат
+могут обрабатывать разные процессы, задайте cache_ttl - запись будет
+перечитываться из базы не реже, чем раз в cache_ttl секунд.
+"""
+
+import asyncio
+import copy
+import logging
+import pickle
+import sqlite3
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from cache import LRUCache
+from migrations import ensure_schema
+
+logger = logging.getLogger(__name__)
+
+# (bot_id, chat_id, user_id, thread_id, destiny)
+RowKey = Tuple[int, int, int, int, str]
+
+# Запись: (состояние, данные)
+Record = Tuple[Optional[str], Dict[str, Any]]
+
+_EMPTY: Record = (None, {})
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище FSM в SQLite с кэшем чтения и отложенной пакетной записью"""
+
+    FLUSH_INTERVAL = 0.5
+    CACHE_SIZE = 10000
+
+    def __init__(self, db_path: str = "dohot.db", flush_interval: float = FLUSH_INTERVAL,
+                 cache_size: int = CACHE_SIZE, cache_ttl: Optional[float] = None):
+        """
+        Args:
+            db_path: Путь к базе данных (рабочая база бота или отдельный файл)
+            flush_interval: Период сброса изменений в базу, сек.
+            cache_size: Записей в кэше чтения
+            cache_ttl: Время жизни записи кэша, сек. (None - бессрочно)
+        """
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self._cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+
+        # Изменения, ещё не записанные в базу, и записываемые сейчас
+        self._dirty: Dict[RowKey, Record] = {}
+        self._inflight: Dict[RowKey, Record] = {}
+
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+        ensure_schema(db_path)
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Получить подключение к базе данных"""
+        return sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+
+    @staticmethod
+    def _row_key(key: StorageKey) -> RowKey:
+        return key.bot_id, key.chat_id, key.user_id, key.thread_id or 0, key.destiny
+
+    # ==================== ЧТЕНИЕ ====================
+
+    def _read_row(self, row_key: RowKey) -> Record:
+        """Прочитать запись из базы (точечный поиск по первичному ключу)"""
+        conn = self.get_connection()
+        row = conn.execute("""
+            SELECT state, data FROM fsm_states
+            WHERE bot_id = ? AND chat_id = ? AND user_id = ? AND thread_id = ? AND destiny = ?
+        """, row_key).fetchone()
+        conn.close()
+        if row is None:
+            return _EMPTY
+        return row[0], pickle.loads(row[1]) if row[1] else {}
+
+    def _get_record(self, row_key: RowKey) -> Record:
+        """Текущая запись: очередь записи, затем кэш, затем база"""
+        record = self._dirty.get(row_key) or self._inflight.get(row_key)
+        if record is not None:
+            return record
+
+        record = self._cache.get(row_key)
+        if record is None:
+            record = self._read_row(row_key)
+            self._cache.set(row_key, record)
+        return record
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._get_record(self._row_key(key))[0]
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return copy.deepcopy(self._get_record(self._row_key(key))[1])
+
+    # ==================== ЗАПИСЬ ====================
+
+    def _put_record(self, row_key: RowKey, record: Record):
+        """Обновить кэш и поставить запись в очередь на сброс"""
+        self._cache.set(row_key, record)
+        self._dirty[row_key] = record
+        if self._flush_task is None and not self._closed:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        row_key = self._row_key(key)
+        state = state.state if isinstance(state, State) else state
+        self._put_record(row_key, (state, self._get_record(row_key)[1]))
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        row_key = self._row_key(key)
+        self._put_record(row_key, (self._get_record(row_key)[0], copy.deepcopy(data)))
+
+    def _write_batch(self, batch: Dict[RowKey, Record]):
+        """Записать пакет изменений одной транзакцией"""
+        upserts = []
+        deletes = []
+        for row_key, (state, data) in batch.items():
+            if state is None and not data:
+                deletes.append(row_key)
+            else:
+                upserts.append((*row_key, state, pickle.dumps(data, pickle.HIGHEST_PROTOCOL)))
+
+        conn = self.get_connection()
+        try:
+            conn.executemany("""
+                INSERT INTO fsm_states (bot_id, chat_id, user_id, thread_id, destiny, state, data, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(bot_id, chat_id, user_id, thread_id, destiny) DO UPDATE SET
+                    state = excluded.state,
+                    data = excluded.data,
+                    updated_at = excluded.updated_at
+            """, upserts)
+            conn.executemany("""
+                DELETE FROM fsm_states
+                WHERE bot_id = ? AND chat_id = ? AND user_id = ? AND thread_id = ? AND destiny = ?
+            """, deletes)
+            conn.commit()
+        finally:
+            conn.close()
+
+    async def flush(self) -> int:
+        """
+        Сбросить накопленные изменения в базу
+
+        Returns:
+            Количество записанных записей
+        """
+        async with self._flush_lock:
+            if not self._dirty:
+                return 0
+
+            batch, self._dirty = self._dirty, {}
+            self._inflight = batch
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write_batch, batch)
+            except Exception as e:
+                logger.error(f"Error flushing FSM storage: {e}")
+                # Возвращаем в очередь то, что не успели перезаписать новыми изменениями
+                for row_key, record in batch.items():
+                    self._dirty.setdefault(row_key, record)
+                return 0
+            finally:
+                self._inflight = {}
+            return len(batch)
+
+    async def _flush_loop(self):
+        """Периодический сброс изменений"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self) -> None:
+        """Остановить фоновый сброс и записать оставшиеся изменения"""
+        self._closed = True
+        if self._flush_task is not None:
+            # Отменяем цикл только между сбросами: пакет, который он уже
+            # пишет, дописывается, иначе поток записи закончил бы его после
+            # последнего сброса и затёр более новые состояния
+            async with self._flush_lock:
+                self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+    def stats(self) -> Dict:
+        """Статистика кэша и очереди записи"""
+        return {**self._cache.stats(), 'pending_writes': len(self._dirty)}
@@ -453,6 +453,20 @@ async def process_expense_description(message: types.Message, state: FSMContext)
     description = None if message.text == "0" else message.text
     expense_date = date.today().isoformat()
     
+    # Проверки выполняются до добавления: бюджет и статистика категории
+    # ещё не учитывают новый расход
+    anomaly_warning = get_expense_anomaly_warning(
+        message.from_user.id,
+        data.get('category_id'),
+        data['amount']
+    )
+    budget_warning = await check_expense_budget_warning(
+        message.from_user.id,
+        data.get('category_id'),
+        data['amount'],
+        expense_date
+    )
+    
     # Добавляем расход в базу
     db.add_expense(
         user_id=message.from_user.id,
@@ -462,19 +476,12 @@ async def process_expense_description(message: types.Message, state: FSMContext)
         expense_date=expense_date
     )
     
-    # Проверяем соответствие бюджету
-    budget_warning = await check_expense_budget_warning(
-        message.from_user.id,
-        data.get('category_id'),
-        data['amount'],
-        expense_date
-    )
-    
     await state.clear()
     
     response_text = f"✅ Расход успешно добавлен!\n\n"
     response_text += f"💸 Сумма: {data['amount']:,.2f} руб.\n"
     response_text += f"📝 Описание: {description or 'не указано'}"
+    response_text += anomaly_warning
     response_text += budget_warning
     
     await message.answer(
@@ -483,6 +490,20 @@ async def process_expense_description(message: types.Message, state: FSMContext)
     )
 
 
+def get_expense_anomaly_warning(user_id: int, category_id: int, amount: float) -> str:
+    """Формирует предупреждение о необычно крупном расходе в категории"""
+    anomaly = db.check_expense_anomaly(user_id, category_id, amount)
+    
+    if not anomaly['is_anomaly']:
+        return ""
+    
+    warning = f"\n\n🔎 НЕОБЫЧНЫЙ РАСХОД\n"
+    warning += f"Сумма в {anomaly['ratio']:.1f} раза больше обычной для этой категории "
+    warning += f"(в среднем {anomaly['mean']:,.2f} руб. по {anomaly['count']} операциям).\n"
+    warning += "Проверьте, не ошиблись ли вы при вводе суммы."
+    return warning
+
+
 async def check_expense_budget_warning(user_id: int, category_id: int, 
                                        amount: float, expense_date: str) -> str:
     """Проверяет расход против бюджета и формирует предупреждение"""
@@ -1504,8 +1525,9 @@ async def show_analytics_menu(message: types.Message):
     """Показать меню аналитики"""
     keyboard = ReplyKeyboardMarkup(
         keyboard=[
-            [KeyboardButton(text="📊 Подробный отчёт")],
-            [KeyboardButton(text="📈 Все графики"), KeyboardButton(text="💹 График баланса")],
+            [KeyboardButton(text="📊 Подробный отчёт"), KeyboardButton(text="📊 Сравнение периодов")],
+            [KeyboardButton(text="📄 Отчёт файлом"), KeyboardButton(text="📈 Все графики")],
+            [KeyboardButton(text="💹 График баланса")],
             [KeyboardButton(text="🥧 Диаграмма расходов"), KeyboardButton(text="📉 График кредитов")],
             [KeyboardButton(text="🔙 Главное меню")]
         ],
@@ -1516,6 +1538,8 @@ async def show_analytics_menu(message: types.Message):
         "📊 РАСШИРЕННАЯ АНАЛИТИКА\n\n"
         "Выберите тип отчёта:\n"
         "• Подробный отчёт - полный текстовый анализ\n"
+        "• Сравнение периодов - динамика по месяцам и категориям\n"
+        "• Отчёт файлом - отчёт и графики одним документом (HTML или PDF)\n"
         "• Все графики - комплект из 6+ графиков\n"
         "• График баланса - динамика доходов/расходов\n"
         "• Диаграмма расходов - топ категорий\n"
@@ -1535,32 +1559,10 @@ async def generate_detailed_analytics(message: types.Message):
         db = Database()
         analytics = FinancialAnalytics(db)
         
-        # Генерируем отчёт
-        report = analytics.generate_comprehensive_report(message.from_user.id, period_days=30)
-        
-        # Разбиваем на части если слишком длинный
-        max_length = 4000
-        if len(report) > max_length:
-            parts = []
-            current_part = ""
-            
-            for line in report.split('\n'):
-                if len(current_part) + len(line) + 1 > max_length:
-                    parts.append(current_part)
-                    current_part = line + '\n'
-                else:
-                    current_part += line + '\n'
-            
-            if current_part:
-                parts.append(current_part)
-            
-            # Отправляем по частям
-            for i, part in enumerate(parts):
-                await message.answer(part)
-                if i < len(parts) - 1:
-                    await asyncio.sleep(0.5)  # Небольшая задержка между сообщениями
-        else:
-            await message.answer(report)
+        # Разделы отправляются по мере готовности, упакованные в сообщения
+        sections = analytics.iter_report_sections(message.from_user.id, period_days=30)
+        async for part in pack_sections(sections):
+            await message.answer(part)
         
         await message.answer(
             "✅ Анализ завершён!\n\n"
@@ -1576,10 +1578,62 @@ async def generate_detailed_analytics(message: types.Message):
         )
 
 
+async def show_period_comparison(message: types.Message):
+    """Сравнение последних месяцев по категориям"""
+    from analytics import FinancialAnalytics
+    
+    try:
+        analytics = FinancialAnalytics(db)
+        report = analytics.generate_period_comparison(message.from_user.id, periods=6, window=3)
+        await message.answer(report, reply_markup=get_analytics_keyboard())
+    except Exception as e:
+        logger.error(f"Error generating period comparison: {e}")
+        await message.answer("❌ Ошибка при сравнении периодов.")
+
+
+async def request_report_document(message: types.Message):
+    """Выбор формата документа с отчётом"""
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="🌐 HTML", callback_data="report_doc_html"),
+        InlineKeyboardButton(text="📑 PDF", callback_data="report_doc_pdf")
+    ]])
+    
+    await message.answer(
+        "📄 Отчёт и графики будут собраны в один файл.\n\n"
+        "Выберите формат:",
+        reply_markup=keyboard
+    )
+
+
+async def send_report_document(callback: types.CallbackQuery):
+    """Сборка и отправка отчёта одним документом"""
+    from report_document import build_report_document_async, document_filename
+    
+    fmt = callback.data.split("_")[2]
+    await callback.answer()
+    await callback.message.edit_text("⏳ Готовлю документ с отчётом и графиками...")
+    
+    content = await build_report_document_async(db, callback.from_user.id, fmt)
+    if content is None:
+        await callback.message.edit_text(
+            "❌ Произошла ошибка при подготовке документа.\n"
+            "Попробуйте позже или обратитесь к администратору."
+        )
+        return
+    
+    await callback.message.delete()
+    await callback.message.answer_document(
+        types.BufferedInputFile(content, filename=document_filename(fmt)),
+        caption="📄 Подробный финансовый отчёт с графиками",
+        reply_markup=get_analytics_keyboard()
+    )
+
+
 async def generate_all_charts(message: types.Message):
     """Генерирует все графики"""
     from visualization import ChartGenerator
     from database import Database
+    from precompute import get_dashboard_charts_async
     
     await message.answer("📊 Создаю графики... Подождите немного.")
     
@@ -1587,7 +1641,8 @@ async def generate_all_charts(message: types.Message):
         db = Database()
         chart_gen = ChartGenerator()
         
-        charts = chart_gen.generate_full_financial_dashboard(message.from_user.id, db)
+        # Берём графики из ночного предрасчёта, если данные не менялись
+        charts = await get_dashboard_charts_async(db, chart_gen, message.from_user.id)
         
         if charts:
             await message.answer(f"✅ Создано {len(charts)} графиков!")
@@ -1619,8 +1674,9 @@ def get_analytics_keyboard() -> ReplyKeyboardMarkup:
     """Клавиатура меню аналитики"""
     return ReplyKeyboardMarkup(
         keyboard=[
-            [KeyboardButton(text="📊 Подробный отчёт")],
-            [KeyboardButton(text="📈 Все графики"), KeyboardButton(text="💹 График баланса")],
+            [KeyboardButton(text="📊 Подробный отчёт"), KeyboardButton(text="📊 Сравнение периодов")],
+            [KeyboardButton(text="📄 Отчёт файлом"), KeyboardButton(text="📈 Все графики")],
+            [KeyboardButton(text="💹 График баланса")],
             [KeyboardButton(text="🥧 Диаграмма расходов"), KeyboardButton(text="📉 График кредитов")],
             [KeyboardButton(text="🔙 Главное меню")]
         ],
@@ -1686,6 +1742,14 @@ async def show_budget_forecast(message: types.Message):
             text += f"     ├─ Планируемые: {period['planned_expenses']:,.2f} руб.\n"
             text += f"     └─ Кредиты: {period['credit_expenses']:,.2f} руб.\n"
             text += f"   {balance_emoji} Баланс: {period['balance']:,.2f} руб.\n"
+        elif period['is_estimate']:
+            text += f"   📈 Оценка по истории операций:\n"
+            text += f"   💰 Доход: ~{period['planned_income']:,.0f} руб.\n"
+            text += f"   📊 Расходы: ~{period['total_expenses']:,.0f} руб.\n"
+            text += f"     ├─ Обычные: ~{period['planned_expenses']:,.0f} руб.\n"
+            text += f"     └─ Кредиты: {period['credit_expenses']:,.2f} руб.\n"
+            text += f"   {balance_emoji} Баланс: ~{period['balance']:,.0f} руб.\n"
+            text += f"   ⚠️ Бюджет не создан\n"
         else:
             text += f"   💳 Кредиты: {period['credit_expenses']:,.2f} руб.\n"
             if period['credit_details']:
@@ -1847,7 +1911,7 @@ async def start_budget_forecast(message: types.Message):
     """Обёртка для прогноза бюджета через кнопку меню"""
     return await show_budget_forecast(message)
 
-from utils import NumberFormatter  # импорт добавлен
+from utils import NumberFormatter, pack_sections  # импорт добавлен
 
 # удалить последний доход
 async def handle_delete_last_income(message: types.Message):
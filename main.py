@@ -1,20 +1,30 @@
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.storage.memory import MemoryStorage
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from functools import partial 
 
 from handlers import router 
 
 from config import load_config
-from database import Database
+from database import Database, set_default_shards
+from precompute import precompute_active_users
+from backup_jobs import create_backup_runners
+from change_journal import install_change_journal
+from migrations import run_pending_backfills
+from fsm_storage import SQLiteStorage
+from webhook import run_webhook
+from routing import DispatchTable
+from admission import HEAVY, AdmissionController, AdmissionMiddleware
+from sharding import CurrentUserMiddleware, ShardForwardMiddleware, WorkerPool
 from bot import (
-    cmd_start, cmd_help, handle_main_menu,
+    cmd_start, cmd_help, handle_main_menu, MAIN_MENU_ACTIONS,
     handle_add_credit, show_user_credits, handle_credit_payment,
-    show_credit_recommendations, show_capital_chart, show_financial_report,
+    show_credit_recommendations,
     process_bank_name, process_monthly_payment, process_total_months,
     process_interest_rate, process_remaining_debt, process_start_date,
     process_credit_payment_callback, confirm_credit_payment,
@@ -49,6 +59,7 @@ from handlers import (
     view_budget_details, edit_budget_category_start, edit_specific_category,
     process_edited_category_amount, delete_budget_callback,
     confirm_delete_budget, check_expense_budget_warning,
+    send_report_document,
     cancel_handler
 )
 
@@ -73,28 +84,86 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def build_dispatch_table() -> DispatchTable:
+    """
+    Кнопки меню и inline-кнопки без состояния FSM
+
+    Обработчики по точному тексту кнопки и префиксу callback_data
+    (см. routing.py). Кнопки срабатывают в любом состоянии диалога.
+    """
+    table = DispatchTable()
+    
+    table.add_texts(MAIN_MENU_ACTIONS, handle_main_menu)
+    table.add_text("🏠 Главное меню", cmd_start)
+    
+    # ==================== КРЕДИТНЫЕ КАРТЫ ====================
+    table.add_texts(["💳 Кредитные карты", "◀️ К кредитам"], handle_credit_cards_menu)
+    table.add_text("➕ Добавить карту", handle_add_credit_card)
+    table.add_text("📋 Мои карты", show_user_credit_cards)
+    table.add_text("💰 Пополнить карту", handle_add_money_to_card)
+    table.add_text("🛒 Потратить", handle_spend_from_card)
+    table.add_text("📊 История операций", show_card_transactions)
+    
+    # ==================== БЮДЖЕТ ====================
+    table.add_text("➕ Создать бюджет", start_create_budget)
+    table.add_text("📋 Мои бюджеты", start_show_budgets)
+    table.add_text("📊 Прогноз на 6 месяцев", start_budget_forecast)
+    table.add_prefix("view_budget_", view_budget_details)
+    table.add_prefix("edit_budget_cat_", edit_budget_category_start)
+    table.add_prefix("editcat_", edit_specific_category)
+    table.add_prefix("delete_budget_", delete_budget_callback)
+    table.add_prefix("confirm_delete_", confirm_delete_budget)
+    
+    # Отчёт одним документом
+    table.add_prefix("report_doc_", send_report_document, flags={'cost': HEAVY})
+    
+    # ==================== КРЕДИТЫ ====================
+    table.add_text("➕ Добавить кредит", handle_add_credit)
+    table.add_text("📋 Мои кредиты", show_user_credits)
+    table.add_text("✅ Внести платёж", handle_credit_payment)
+    table.add_text("🎯 Рекомендации", show_credit_recommendations)
+    table.add_text("⚡ Досрочное погашение", handle_early_payment)
+    table.add_text("⚙️ Настроить возможности кредита", handle_credit_capabilities)
+    
+    # ==================== ДОЛГИ ====================
+    table.add_text("➕ Добавить долг", handle_add_debt)
+    table.add_text("📋 Мои долги", show_user_debts)
+    table.add_text("✅ Погасить долг", handle_pay_debt)
+    
+    # ==================== КАТЕГОРИИ ====================
+    # Та же функция с разным cat_type через partial — обёртки не нужны
+    table.add_text("➕ Категория дохода", partial(handle_add_category, cat_type="income"))
+    table.add_text("➕ Категория расхода", partial(handle_add_category, cat_type="expense"))
+    
+    # ==================== РАСХОДЫ ====================
+    table.add_text("➕ Добавить расход", handle_add_expense)
+    table.add_text("📋 Мои расходы", show_user_expenses)
+    table.add_text("🗑 Удалить последний расход", handle_delete_last_expense)
+    table.add_text("🗑 Удалить расход по ID", handle_delete_expense_by_id)
+    
+    # ==================== ДОХОДЫ ====================
+    table.add_text("➕ Добавить доход", handle_add_income)
+    table.add_text("🗑 Удалить последний доход", handle_delete_last_income)
+    table.add_text("🗑 Удалить доход по ID", handle_delete_income_by_id)
+    
+    # ==================== ИНВЕСТИЦИИ ====================
+    table.add_text("➕ Добавить инвестицию", handle_add_investment)
+    table.add_text("📋 Мои инвестиции", show_user_investments)
+    table.add_text("💹 Обновить стоимость", handle_update_investment_value)
+    
+    return table
+
+
 def register_all_handlers(dp: Dispatcher):
     """Регистрация всех обработчиков бота"""
     
     dp.message.register(cmd_start, Command("start"))
     dp.message.register(cmd_help, Command("help"))
     
-    dp.message.register(handle_main_menu, F.text.in_([
-        "💳 Кредиты", "💸 Долги", "💰 Доходы", "🛒 Расходы",
-        "📊 Инвестиции", "🏦 Сбережения", "📈 График капитала",
-        "📋 Отчёт", "📅 Бюджет", "⚙️ Категории", "📊 Аналитика",
-        "📊 Подробный отчёт", "📈 Все графики", "💹 График баланса",
-        "🥧 Диаграмма расходов", "📉 График кредитов"
-    ]))
-    
-    dp.message.register(handle_credit_cards_menu, F.text == "💳 Кредитные карты")
-    dp.message.register(handle_add_credit_card, F.text == "➕ Добавить карту")
-    dp.message.register(show_user_credit_cards, F.text == "📋 Мои карты")
-    dp.message.register(handle_add_money_to_card, F.text == "💰 Пополнить карту")
-    dp.message.register(handle_spend_from_card, F.text == "🛒 Потратить")
-    dp.message.register(show_card_transactions, F.text == "📊 История операций")
-    dp.message.register(handle_credit_cards_menu, F.text == "◀️ К кредитам")
+    # Кнопки - одним поиском по таблице, до обработчиков состояний
+    build_dispatch_table().register(dp)
     
+    # ==================== КРЕДИТНЫЕ КАРТЫ ====================
     dp.message.register(process_card_name, CreditCardStates.waiting_card_name)
     dp.message.register(process_card_bank_name, CreditCardStates.waiting_bank_name)
     dp.message.register(process_card_credit_limit, CreditCardStates.waiting_credit_limit)
@@ -108,12 +177,6 @@ def register_all_handlers(dp: Dispatcher):
     dp.message.register(process_card_spending_amount, CreditCardStates.waiting_spending_amount)
     
     # ==================== БЮДЖЕТ ====================
-    # ==================== БЮДЖЕТ ====================
-    # Меню бюджета
-    dp.message.register(start_create_budget, F.text == "➕ Создать бюджет")
-    dp.message.register(start_show_budgets, F.text == "📋 Мои бюджеты")
-    dp.message.register(start_budget_forecast, F.text == "📊 Прогноз на 6 месяцев")
-
     # FSM для создания бюджета с категориями
     dp.callback_query.register(process_budget_month_selection, BudgetStates.selecting_month)
     dp.callback_query.register(process_income_category_selection, BudgetStates.selecting_income_categories)
@@ -121,30 +184,10 @@ def register_all_handlers(dp: Dispatcher):
     dp.callback_query.register(process_expense_category_selection, BudgetStates.selecting_expense_categories)
     dp.message.register(process_expense_category_amount, BudgetStates.waiting_expense_category_amount)
 
-    # Просмотр бюджетов
-    dp.callback_query.register(view_budget_details, F.data.startswith("view_budget_"))
-
     # Редактирование отдельных категорий
-    dp.callback_query.register(edit_budget_category_start, F.data.startswith("edit_budget_cat_"))
-    dp.callback_query.register(edit_specific_category, F.data.startswith("editcat_"))
     dp.message.register(process_edited_category_amount, BudgetStates.waiting_edited_category_amount)
-
-    # Удаление бюджета
-    dp.callback_query.register(delete_budget_callback, F.data.startswith("delete_budget_"))
-    dp.callback_query.register(confirm_delete_budget, F.data.startswith("confirm_delete_"))
-
-    # Возврат в главное меню
-    dp.message.register(cmd_start, F.text == "🏠 Главное меню")
     
     # ==================== КРЕДИТЫ ====================
-    # Меню кредитов
-    dp.message.register(handle_add_credit, F.text == "➕ Добавить кредит")
-    dp.message.register(show_user_credits, F.text == "📋 Мои кредиты")
-    dp.message.register(handle_credit_payment, F.text == "✅ Внести платёж")
-    dp.message.register(show_credit_recommendations, F.text == "🎯 Рекомендации")
-    dp.message.register(handle_early_payment, F.text == "⚡ Досрочное погашение")
-    dp.message.register(handle_credit_capabilities, F.text == "⚙️ Настроить возможности кредита")
-    
     # FSM для добавления кредита
     dp.message.register(process_bank_name, CreditStates.waiting_bank_name)
     dp.message.register(process_monthly_payment, CreditStates.waiting_monthly_payment)
@@ -188,10 +231,6 @@ def register_all_handlers(dp: Dispatcher):
     )
     
     # ==================== ДОЛГИ ====================
-    dp.message.register(handle_add_debt, F.text == "➕ Добавить долг")
-    dp.message.register(show_user_debts, F.text == "📋 Мои долги")
-    dp.message.register(handle_pay_debt, F.text == "✅ Погасить долг")
-    
     # FSM для добавления долга
     dp.message.register(process_debt_person_name, DebtStates.waiting_person_name)
     dp.message.register(process_debt_amount, DebtStates.waiting_amount)
@@ -204,37 +243,10 @@ def register_all_handlers(dp: Dispatcher):
         StateFilter(DebtStates.selecting_debt_for_payment)
     )
     
-    # ==================== КАТЕГОРИИ ====================
     # ==================== КАТЕГОРИИ ====================
     dp.message.register(process_category_name, CategoryStates.waiting_name)
-
-    # Регистрируем ту же функцию, но с разным cat_type через partial — обёртки не нужны
-    dp.message.register(
-        partial(handle_add_category, cat_type="income"),
-        F.text == "➕ Категория дохода"
-    )
-    dp.message.register(
-        partial(handle_add_category, cat_type="expense"),
-        F.text == "➕ Категория расхода"
-    )
-
-    # ==================== РАСХОДЫ ====================
-    # ==================== РАСХОДЫ ====================
-    dp.message.register(handle_add_expense, F.text == "➕ Добавить расход")
-    dp.message.register(show_user_expenses, F.text == "📋 Мои расходы")
-    # ↓↓↓ добавлено ↓↓↓
-    dp.message.register(handle_delete_last_expense, F.text == "🗑 Удалить последний расход")
-    dp.message.register(handle_delete_expense_by_id, F.text == "🗑 Удалить расход по ID")
-    # ↑↑↑ добавлено ↑↑↑
-
-    # ==================== ДОХОДЫ ====================
-    dp.message.register(handle_add_income, F.text == "➕ Добавить доход")
-    # ↓↓↓ добавлено ↓↓↓
-    dp.message.register(handle_delete_last_income, F.text == "🗑 Удалить последний доход")
-    dp.message.register(handle_delete_income_by_id, F.text == "🗑 Удалить доход по ID")
-    # ↑↑↑ добавлено ↑↑↑
-
     
+    # ==================== ДОХОДЫ И РАСХОДЫ ====================
     # FSM для добавления дохода
     dp.message.register(process_income_amount, IncomeStates.waiting_amount)
     dp.callback_query.register(
@@ -253,10 +265,6 @@ def register_all_handlers(dp: Dispatcher):
     dp.message.register(process_expense_description, ExpenseStates.waiting_description)
     
     # ==================== ИНВЕСТИЦИИ ====================
-    dp.message.register(handle_add_investment, F.text == "➕ Добавить инвестицию")
-    dp.message.register(show_user_investments, F.text == "📋 Мои инвестиции")
-    dp.message.register(handle_update_investment_value, F.text == "💹 Обновить стоимость")
-    
     # FSM для добавления инвестиции
     dp.message.register(process_investment_asset_name, InvestmentStates.waiting_asset_name)
     dp.message.register(process_investment_amount, InvestmentStates.waiting_invested_amount)
@@ -270,10 +278,70 @@ def register_all_handlers(dp: Dispatcher):
     
     # ==================== СБЕРЕЖЕНИЯ ====================
     dp.message.register(process_savings_amount, SavingsStates.waiting_amount)
-    
-    # ==================== ОТЧЁТЫ И ГРАФИКИ ====================
-    dp.message.register(show_capital_chart, F.text == "📈 График капитала")
-    dp.message.register(show_financial_report, F.text == "📋 Отчёт")
+
+
+def create_storage(config):
+    """Хранилище состояний диалогов по конфигурации"""
+    if config.fsm_storage == "memory":
+        return MemoryStorage()
+    return SQLiteStorage(
+        config.fsm_db_path or config.db_path,
+        flush_interval=config.fsm_flush_interval
+    )
+
+
+def create_admission(config) -> AdmissionController:
+    """Очередь тяжёлых запросов по конфигурации"""
+    return AdmissionController(
+        max_running=config.heavy_max_running,
+        per_user=config.heavy_per_user,
+        max_waiting=config.heavy_max_waiting
+    )
+
+
+def schedule_precompute(scheduler: AsyncIOScheduler, config, worker: int = None, executor=None):
+    """
+    Добавить в планировщик ночной предрасчёт графиков и отчётов
+
+    Args:
+        scheduler: Планировщик процесса
+        config: BotConfig
+        worker: Номер рабочего процесса - считать только его пользователей
+        executor: Пул для построения вместо нового пула процессов
+    """
+    scheduler.add_job(
+        precompute_active_users,
+        CronTrigger(
+            hour=config.precompute_hour,
+            minute=config.precompute_minute
+        ),
+        kwargs={
+            'db_path': config.db_path,
+            'charts_dir': config.charts_dir,
+            'active_days': config.precompute_active_days,
+            'max_workers': config.precompute_workers,
+            'worker': worker,
+            'workers': config.workers,
+            'executor': executor
+        },
+        max_instances=1,
+        coalesce=True
+    )
+
+
+def create_dispatcher(storage=None, disable_fsm: bool = False,
+                      admission: AdmissionController = None) -> Dispatcher:
+    """Диспетчер со всеми обработчиками бота"""
+    dp = Dispatcher(storage=storage, disable_fsm=disable_fsm)
+    # Пользователь обновления выбирает шард базы (см. partitions.py)
+    dp.update.outer_middleware(CurrentUserMiddleware())
+    if admission is not None:
+        # Тяжёлые обработчики - через очередь, быстрые - сразу
+        dp.message.middleware(AdmissionMiddleware(admission))
+        dp.callback_query.middleware(AdmissionMiddleware(admission))
+    dp.include_router(router)
+    register_all_handlers(dp)
+    return dp
 
 
 async def on_startup(bot: Bot):
@@ -305,16 +373,25 @@ async def main():
         logger.error(f"Ошибка загрузки конфигурации: {e}")
         return
     
+    # Шарды базы для экземпляров Database в обработчиках
+    set_default_shards(config.db_shards)
+    
     # Инициализация бота и диспетчера
     bot = Bot(token=config.bot_token)
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
-    
-    dp.include_router(router)
-
-    # Регистрируем все обработчики
-    register_all_handlers(dp)
-    logger.info("Обработчики зарегистрированы")
+    pool = None
+    if config.workers > 1:
+        # Обработчики работают в рабочих процессах, здесь обновления только распределяются.
+        # Процессы запускаются методом spawn, поэтому потоки основного процесса им не мешают
+        pool = WorkerPool(config, config.workers)
+        pool.start()
+        storage = None
+        dp = create_dispatcher(disable_fsm=True)
+        dp.update.outer_middleware(ShardForwardMiddleware(pool))
+        logger.info(f"Обновления распределяются по {config.workers} рабочим процессам")
+    else:
+        storage = create_storage(config)
+        dp = create_dispatcher(storage, admission=create_admission(config))
+        logger.info("Обработчики зарегистрированы")
     
     # Настраиваем планировщик для напоминаний
     scheduler = AsyncIOScheduler()
@@ -326,23 +403,111 @@ async def main():
         ),
         args=[bot]
     )
+    
+    # Ночной предрасчёт графиков и отчётов для активных пользователей.
+    # В режиме рабочих процессов его ведёт каждый процесс для своих
+    # пользователей: кэши основного процесса обработчики не видят
+    if pool is None:
+        schedule_precompute(scheduler, config)
+    
+    # Файлы-шарды с данными пользователей (DB_SHARDS); без шардов - основная база
+    shard_paths = Database(config.db_path, config.db_shards).shard_paths()
+    
+    # Незавершённые дозаполнения миграций - один раз при запуске, в потоке
+    # планировщика: для основной базы и каждого шарда (ensure_schema сразу
+    # дозаполняет не больше BackfillRunner.INLINE_KEYS ключей)
+    for db_path in dict.fromkeys([config.db_path] + shard_paths):
+        scheduler.add_job(
+            run_pending_backfills,
+            kwargs={'db_path': db_path},
+            max_instances=1
+        )
+    
+    # Резервные копии, их очистка и проверка целостности в рабочем потоке:
+    # для основной базы и для каждого шарда (DB_SHARDS)
+    backup_runners = []
+    if config.backup_enabled:
+        backup_runners = create_backup_runners(
+            config.db_path,
+            config.backup_dir,
+            shard_paths,
+            pages_per_step=config.backup_pages_per_step,
+            step_sleep=config.backup_step_sleep,
+            keep_count=config.backup_keep_count,
+            keep_full=config.backup_keep_full
+        )
+    for backup_runner in backup_runners:
+        scheduler.add_job(
+            backup_runner.run_backup,
+            IntervalTrigger(hours=config.backup_interval_hours),
+            max_instances=1,
+            coalesce=True
+        )
+        scheduler.add_job(
+            backup_runner.run_retention,
+            CronTrigger(hour=config.backup_retention_hour),
+            max_instances=1,
+            coalesce=True
+        )
+        scheduler.add_job(
+            backup_runner.run_integrity_check,
+            CronTrigger(hour=config.backup_check_hour),
+            max_instances=1,
+            coalesce=True
+        )
+        scheduler.add_job(
+            backup_runner.run_maintenance,
+            CronTrigger(hour=config.maintenance_hour),
+            max_instances=1,
+            coalesce=True
+        )
+        if config.journal_enabled:
+            install_change_journal(backup_runner.manager.db_path)
+            scheduler.add_job(
+                backup_runner.run_journal_archive,
+                IntervalTrigger(minutes=config.journal_archive_minutes),
+                max_instances=1,
+                coalesce=True
+            )
+    
     scheduler.start()
     logger.info(f"Планировщик запущен. Напоминания в {config.reminder_time_hour:02d}:{config.reminder_time_minute:02d}")
+    logger.info(
+        f"Предрасчёт отчётов в {config.precompute_hour:02d}:{config.precompute_minute:02d}"
+        + (" в рабочих процессах" if pool else "")
+    )
+    if backup_runners:
+        logger.info(
+            f"Резервные копии каждые {config.backup_interval_hours} ч. в {config.backup_dir} "
+            f"(файлов базы: {len(backup_runners)}), "
+            f"последние запуски: {backup_runners[0].status() or 'нет'}"
+        )
     
     # Регистрируем startup и shutdown
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
     
-    # Запускаем polling
+    # Запускаем webhook или polling
     try:
         logger.info("Бот готов к работе!")
         logger.info("Нажмите Ctrl+C для остановки")
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if config.webhook_url:
+            await run_webhook(dp, bot, config)
+        else:
+            # Telegram не отдаёт обновления через getUpdates, пока установлен webhook
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     except KeyboardInterrupt:
         logger.info("Получен сигнал остановки")
     finally:
         # Закрываем ресурсы
         scheduler.shutdown()
+        for backup_runner in backup_runners:
+            backup_runner.shutdown()
+        if pool:
+            pool.stop()
+        if storage:
+            await storage.close()
         await bot.session.close()
         logger.info("Бот остановлен")
 
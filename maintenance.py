@@ -0,0 +1,297 @@
+"""
+Обслуживание базы данных
+
+Проверки и статистика, время которых не растёт вместе с размером файла:
+- PRAGMA quick_check вместо integrity_check для регулярной проверки;
+- оценка числа строк по sqlite_stat1 (или по диапазону rowid) вместо COUNT(*);
+- поочерёдная полная проверка таблиц в пределах бюджета времени: за каждый
+  запуск проверяется несколько таблиц, позиция сохраняется между запусками;
+- ANALYZE с ограничением analysis_limit, PRAGMA optimize и incremental_vacuum
+  по расписанию.
+
+Размеры таблиц по страницам (dbstat) читаются вместе с поочерёдной проверкой
+таблицы, поэтому тоже не требуют обхода всей базы за раз.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseMaintenance:
+    """Проверки и обслуживание базы SQLite"""
+
+    # Строк на индекс, которые просматривает ANALYZE (0 - без ограничения)
+    ANALYSIS_LIMIT = 1000
+
+    # Бюджет времени поочерёдной проверки таблиц за один запуск, сек.
+    CHECK_BUDGET = 0.5
+
+    # Страниц, освобождаемых incremental_vacuum за один запуск
+    VACUUM_PAGES = 2000
+
+    def __init__(self, db_path: str = "dohot.db", state_path: Optional[str] = None):
+        """
+        Args:
+            db_path: Путь к базе данных
+            state_path: Файл состояния поочерёдной проверки
+                (по умолчанию <db_path>.maintenance.json)
+        """
+        self.db_path = db_path
+        self.state_path = state_path or f"{db_path}.maintenance.json"
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Получить подключение к базе данных"""
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    # ==================== СОСТОЯНИЕ ====================
+
+    def load_state(self) -> Dict:
+        """Состояние поочерёдной проверки: позиция и результаты по таблицам"""
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'next_table': None, 'tables': {}}
+
+    def _save_state(self, state: Dict):
+        """Сохранить состояние поочерёдной проверки"""
+        try:
+            with open(self.state_path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False, indent=2)
+            os.replace(self.state_path + ".tmp", self.state_path)
+        except OSError as e:
+            logger.error(f"Error saving maintenance state: {e}")
+
+    # ==================== ПРОВЕРКИ ====================
+
+    def _tables(self, cursor: sqlite3.Cursor) -> List[str]:
+        """Пользовательские таблицы базы"""
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def quick_check(self, max_errors: int = 10) -> List[str]:
+        """
+        PRAGMA quick_check: структура страниц без сверки индексов с таблицами
+
+        Returns:
+            Пустой список, если база в порядке, иначе сообщения об ошибках
+        """
+        conn = self.get_connection()
+        rows = conn.execute(f"PRAGMA quick_check({int(max_errors)})").fetchall()
+        conn.close()
+        messages = [row[0] for row in rows]
+        return [] if messages == ['ok'] else messages
+
+    def estimate_row_counts(self) -> Dict[str, int]:
+        """
+        Оценка числа строк в таблицах без COUNT(*)
+
+        Берётся из sqlite_stat1 (обновляется при ANALYZE); для таблиц без
+        статистики - разность MAX(rowid) и MIN(rowid), которая читает только
+        крайние страницы дерева.
+
+        Returns:
+            Словарь {таблица: примерное число строк}
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        tables = self._tables(cursor)
+
+        estimates = {}
+        try:
+            cursor.execute("SELECT tbl, stat FROM sqlite_stat1")
+            for table, stat in cursor.fetchall():
+                if table in tables and stat:
+                    rows = int(stat.split()[0])
+                    estimates[table] = max(estimates.get(table, 0), rows)
+        except sqlite3.OperationalError:
+            pass  # ANALYZE ещё не запускался
+
+        for table in tables:
+            if table in estimates:
+                continue
+            try:
+                low, high = cursor.execute(f'SELECT MIN(rowid), MAX(rowid) FROM "{table}"').fetchone()
+                estimates[table] = high - low + 1 if high is not None else 0
+            except sqlite3.OperationalError:
+                estimates[table] = 0  # Таблица WITHOUT ROWID
+
+        conn.close()
+        return estimates
+
+    def health(self) -> Dict:
+        """
+        Быстрая сводка о состоянии базы
+
+        Returns:
+            Словарь: ok, errors, size_bytes, page_count, page_size,
+            freelist_count, auto_vacuum, rows (оценки), last_table_checks,
+            duration_seconds
+        """
+        started = time.monotonic()
+        errors = self.quick_check()
+
+        conn = self.get_connection()
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        conn.close()
+
+        return {
+            'ok': not errors,
+            'errors': errors,
+            'size_bytes': page_count * page_size,
+            'page_count': page_count,
+            'page_size': page_size,
+            'freelist_count': freelist,
+            'auto_vacuum': {0: 'none', 1: 'full', 2: 'incremental'}.get(auto_vacuum, str(auto_vacuum)),
+            'rows': self.estimate_row_counts(),
+            'last_table_checks': self.load_state()['tables'],
+            'duration_seconds': round(time.monotonic() - started, 3)
+        }
+
+    def check_tables_incrementally(self, budget: float = CHECK_BUDGET) -> Dict[str, Dict]:
+        """
+        Полная проверка следующих по очереди таблиц в пределах бюджета времени
+
+        Для каждой таблицы выполняется PRAGMA integrity_check(таблица) (со
+        сверкой её индексов) и читается её размер из dbstat. Проверяется
+        минимум одна таблица за запуск; следующий запуск продолжает с места
+        остановки, так что за несколько запусков проверяется вся база.
+
+        Args:
+            budget: Бюджет времени в секундах
+
+        Returns:
+            Результаты проверенных в этот запуск таблиц
+        """
+        state = self.load_state()
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        tables = self._tables(cursor)
+        if not tables:
+            conn.close()
+            return {}
+
+        start = tables.index(state['next_table']) if state.get('next_table') in tables else 0
+        order = tables[start:] + tables[:start]
+
+        checked = {}
+        started = time.monotonic()
+        for table in order:
+            if checked and time.monotonic() - started >= budget:
+                break
+
+            table_started = time.monotonic()
+            messages = [row[0] for row in cursor.execute(f'PRAGMA integrity_check("{table}")').fetchall()]
+            try:
+                size = cursor.execute(
+                    "SELECT SUM(pgsize) FROM dbstat WHERE name = ? OR name IN "
+                    "(SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?)",
+                    (table, table)
+                ).fetchone()[0] or 0
+            except sqlite3.OperationalError:
+                size = None  # SQLite собран без dbstat
+
+            checked[table] = {
+                'ok': messages == ['ok'],
+                'errors': [] if messages == ['ok'] else messages[:10],
+                'size_bytes': size,
+                'checked': datetime.now().isoformat(timespec='seconds'),
+                'duration_seconds': round(time.monotonic() - table_started, 3)
+            }
+            if not checked[table]['ok']:
+                logger.error(f"Integrity check failed for table {table}: {messages[:10]}")
+
+        conn.close()
+
+        remaining = order[len(checked):]
+        state['next_table'] = remaining[0] if remaining else order[0]
+        state['tables'] = {t: r for t, r in state.get('tables', {}).items() if t in tables}
+        state['tables'].update(checked)
+        self._save_state(state)
+        return checked
+
+    # ==================== ОБСЛУЖИВАНИЕ ====================
+
+    def optimize(self, analysis_limit: int = ANALYSIS_LIMIT) -> float:
+        """
+        Обновить статистику планировщика: ANALYZE с ограничением и PRAGMA optimize
+
+        С analysis_limit ANALYZE просматривает не больше заданного числа
+        строк каждого индекса, поэтому время не зависит от размера таблиц.
+
+        Returns:
+            Длительность в секундах
+        """
+        started = time.monotonic()
+        conn = self.get_connection()
+        conn.execute(f"PRAGMA analysis_limit = {int(analysis_limit)}")
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA optimize")
+        conn.commit()
+        conn.close()
+        return round(time.monotonic() - started, 3)
+
+    def incremental_vacuum(self, pages: int = VACUUM_PAGES) -> int:
+        """
+        Вернуть системе до pages свободных страниц
+
+        Работает только в режиме auto_vacuum = INCREMENTAL
+        (см. enable_incremental_vacuum).
+
+        Returns:
+            Количество освобождённых страниц
+        """
+        conn = self.get_connection()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.close()
+            return 0
+
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        conn.commit()
+        after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.close()
+        return before - after
+
+    def enable_incremental_vacuum(self):
+        """
+        Перевести базу в режим auto_vacuum = INCREMENTAL
+
+        Требует однократного полного VACUUM (перезапись всего файла),
+        поэтому выполняется вручную при остановленном боте.
+        """
+        conn = self.get_connection()
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.close()
+        logger.info(f"Incremental auto_vacuum enabled for {self.db_path}")
+
+    def run_scheduled(self, check_budget: float = CHECK_BUDGET) -> Dict:
+        """
+        Плановое обслуживание: статистика, освобождение страниц и проверка таблиц
+
+        Returns:
+            Словарь с результатами шагов
+        """
+        analyze_seconds = self.optimize()
+        freed = self.incremental_vacuum()
+        checked = self.check_tables_incrementally(check_budget)
+        return {
+            'ok': all(result['ok'] for result in checked.values()),
+            'analyze_seconds': analyze_seconds,
+            'freed_pages': freed,
+            'checked_tables': sorted(checked),
+            'failed_tables': sorted(t for t, r in checked.items() if not r['ok'])
+        }
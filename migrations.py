@@ -3,31 +3,161 @@
 Система миграций для базы данных DoHot
 
 Миграции позволяют безопасно обновлять структуру БД при выходе новых версий.
+Вся схема базы, включая начальную, создаётся миграциями: Database вызывает
+ensure_schema при первом подключении к файлу, последующие экземпляры
+Database для того же файла схему не проверяют.
+
+Версия схемы хранится в PRAGMA user_version (читается из заголовка файла
+за O(1)), история применения - в таблице schema_migrations. Каждая
+миграция выполняется в отдельной транзакции BEGIN IMMEDIATE вместе с
+записью версии, поэтому при ошибке база остаётся на предыдущей версии.
 
 Использование:
     python migrations.py --check    # Проверить текущую версию
     python migrations.py --migrate  # Применить миграции
     python migrations.py --rollback # Откатить последнюю миграцию
+    python migrations.py --backfill # Выполнить незавершённые дозаполнения
 """
 
 import sqlite3
 import argparse
+import json
+import logging
+import os
 import sys
-from datetime import datetime
-from typing import List, Tuple
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def column_exists(conn: sqlite3.Connection, table: str, column: str) -> bool:
+    """Проверить наличие столбца в таблице"""
+    return any(row[1] == column for row in conn.execute(f'PRAGMA table_info("{table}")'))
+
+
+def add_column(conn: sqlite3.Connection, table: str, column: str, definition: str):
+    """
+    Добавить столбец, если его ещё нет
+
+    Столбец мог появиться в базах, обновлённых прежним запуском миграций
+    без учёта версии; остальные ошибки ALTER TABLE не подавляются.
+    """
+    if not column_exists(conn, table, column):
+        conn.execute(f'ALTER TABLE "{table}" ADD COLUMN {column} {definition}')
+
+
+def drop_column(conn: sqlite3.Connection, table: str, column: str):
+    """Удалить столбец, если он есть (SQLite 3.35+)"""
+    if column_exists(conn, table, column):
+        conn.execute(f'ALTER TABLE "{table}" DROP COLUMN {column}')
+
+
+def table_exists(conn: sqlite3.Connection, table: str) -> bool:
+    """Проверить наличие таблицы"""
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+
+# ==================== ДОЗАПОЛНЕНИЕ ДАННЫХ ====================
+
+class Backfill:
+    """
+    Базовый класс для дозаполнения (перезаписи) существующих строк
+
+    Строки обрабатываются порциями по первичному ключу таблицы key_table:
+    каждая порция (low, high] - отдельная короткая транзакция, между
+    порциями делается пауза, поэтому бот продолжает работать во время
+    дозаполнения. Позиция сохраняется в schema_migrations после каждой
+    порции, и прерванное дозаполнение продолжается с места остановки.
+    """
+
+    name = ""
+    key_table = "users"
+    key_column = "user_id"
+    chunk_size = 200
+
+    def process(self, conn: sqlite3.Connection, low: int, high: int):
+        """
+        Обработать строки с ключом в диапазоне (low, high]
+
+        Выполняется внутри транзакции BackfillRunner и не должен вызывать commit.
+        """
+        raise NotImplementedError
+
+
+def _bump_versions_in_range(conn: sqlite3.Connection, low: int, high: int):
+    """Сбросить кэши пользователей порции: производные данные пересчитаны"""
+    conn.execute("""
+        UPDATE user_data_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+        WHERE user_id > ? AND user_id <= ?
+    """, (low, high))
+
+
+class MonthlyRollupsBackfill(Backfill):
+    """
+    Пересчёт помесячных итогов доходов и расходов
+
+    Итоги порции пользователей удаляются и строятся заново в одной
+    транзакции, поэтому операции, добавленные ботом во время
+    дозаполнения, учитываются ровно один раз.
+    """
+
+    name = "monthly_rollups"
+
+    def process(self, conn: sqlite3.Connection, low: int, high: int):
+        conn.execute("DELETE FROM monthly_rollups WHERE user_id > ? AND user_id <= ?", (low, high))
+        for kind, table in (('income', 'incomes'), ('expense', 'expenses')):
+            conn.execute(f"""
+                INSERT INTO monthly_rollups (user_id, kind, category_id, month, total, count)
+                SELECT user_id, '{kind}', IFNULL(category_id, 0), substr(date, 1, 7),
+                       SUM(amount), COUNT(*)
+                FROM {table}
+                WHERE user_id > ? AND user_id <= ?
+                GROUP BY user_id, IFNULL(category_id, 0), substr(date, 1, 7)
+            """, (low, high))
+        _bump_versions_in_range(conn, low, high)
+
+
+class ExpenseStatsBackfill(Backfill):
+    """Пересчёт статистики расходов по категориям (count, mean, m2)"""
+
+    name = "expense_category_stats"
+
+    def process(self, conn: sqlite3.Connection, low: int, high: int):
+        conn.execute("DELETE FROM expense_category_stats WHERE user_id > ? AND user_id <= ?", (low, high))
+        conn.execute("""
+            INSERT INTO expense_category_stats (user_id, category_id, count, mean, m2)
+            SELECT user_id, IFNULL(category_id, 0), COUNT(*), AVG(amount),
+                   MAX(SUM(amount * amount) - COUNT(*) * AVG(amount) * AVG(amount), 0)
+            FROM expenses
+            WHERE user_id > ? AND user_id <= ?
+            GROUP BY user_id, IFNULL(category_id, 0)
+        """, (low, high))
+        _bump_versions_in_range(conn, low, high)
 
 
 class Migration:
-    """Базовый класс для миграции"""
-    
+    """
+    Базовый класс для миграции
+
+    up и down выполняются внутри транзакции менеджера и не должны
+    вызывать commit. Перезапись существующих строк выносится в backfills:
+    они выполняются порциями после изменения схемы (см. BackfillRunner).
+    """
+
+    backfills: List[Backfill] = []
+
     def __init__(self, version: int, description: str):
         self.version = version
         self.description = description
-    
+
     def up(self, conn: sqlite3.Connection):
         """Применить миграцию"""
         raise NotImplementedError
-    
+
     def down(self, conn: sqlite3.Connection):
         """Откатить миграцию"""
         raise NotImplementedError
@@ -35,73 +165,182 @@ class Migration:
 
 class Migration001_InitialSchema(Migration):
     """Начальная схема базы данных"""
-    
+
     def __init__(self):
         super().__init__(1, "Initial schema")
-    
+
     def up(self, conn: sqlite3.Connection):
-        """Создаёт начальную схему (уже реализовано в database.py)"""
-        pass
-    
+        """Создаёт начальную схему (IF NOT EXISTS - для баз, созданных до миграций)"""
+        cursor = conn.cursor()
+
+        # Таблица пользователей
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Таблица кредитов
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS credits (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                bank_name TEXT NOT NULL,
+                display_name TEXT NOT NULL,
+                monthly_payment REAL NOT NULL,
+                total_months INTEGER NOT NULL,
+                interest_rate REAL NOT NULL,
+                remaining_debt REAL NOT NULL,
+                start_date DATE NOT NULL,
+                current_month INTEGER DEFAULT 0,
+                has_early_full BOOLEAN DEFAULT 1,
+                has_early_partial_period BOOLEAN DEFAULT 1,
+                has_early_partial_payment BOOLEAN DEFAULT 1,
+                has_holidays BOOLEAN DEFAULT 1,
+                is_active BOOLEAN DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        """)
+
+        # Таблица платежей по кредитам
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS credit_payments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                credit_id INTEGER NOT NULL,
+                payment_date DATE NOT NULL,
+                amount REAL NOT NULL,
+                payment_type TEXT NOT NULL,
+                notes TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (credit_id) REFERENCES credits(id)
+            )
+        """)
+
+        # Таблица кредитных каникул
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS credit_holidays (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                credit_id INTEGER NOT NULL,
+                start_date DATE NOT NULL,
+                end_date DATE NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (credit_id) REFERENCES credits(id)
+            )
+        """)
+
+        # Таблица долгов (взятых/выданных)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS debts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                person_name TEXT NOT NULL,
+                amount REAL NOT NULL,
+                debt_type TEXT NOT NULL,
+                description TEXT,
+                date DATE NOT NULL,
+                is_paid BOOLEAN DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        """)
+
+        # Таблица категорий
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS categories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                type TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        """)
+
+        # Таблицы доходов и расходов
+        for table in ('incomes', 'expenses'):
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    category_id INTEGER,
+                    amount REAL NOT NULL,
+                    description TEXT,
+                    date DATE NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(user_id),
+                    FOREIGN KEY (category_id) REFERENCES categories(id)
+                )
+            """)
+
+        # Таблица инвестиций
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS investments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                asset_name TEXT NOT NULL,
+                invested_amount REAL NOT NULL,
+                current_value REAL NOT NULL,
+                last_updated DATE NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        """)
+
+        # Таблица сбережений
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS savings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                amount REAL NOT NULL,
+                date DATE NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        """)
+
     def down(self, conn: sqlite3.Connection):
         """Откат невозможен для начальной схемы"""
-        pass
+        raise RuntimeError("Откат начальной схемы не поддерживается")
 
 
 class Migration002_AddCreditNotes(Migration):
     """Добавляет поле notes в таблицу кредитов"""
-    
+
     def __init__(self):
         super().__init__(2, "Add notes field to credits")
-    
+
     def up(self, conn: sqlite3.Connection):
-        cursor = conn.cursor()
-        try:
-            cursor.execute("ALTER TABLE credits ADD COLUMN notes TEXT")
-            conn.commit()
-            print(f"✅ Migration {self.version}: {self.description} - applied")
-        except sqlite3.OperationalError as e:
-            if "duplicate column" in str(e).lower():
-                print(f"⚠️  Migration {self.version}: Already applied")
-            else:
-                raise
-    
+        add_column(conn, 'credits', 'notes', 'TEXT')
+
     def down(self, conn: sqlite3.Connection):
-        # SQLite не поддерживает DROP COLUMN, нужно пересоздавать таблицу
-        print(f"⚠️  Migration {self.version}: Rollback not supported (SQLite limitation)")
+        drop_column(conn, 'credits', 'notes')
 
 
 class Migration003_AddCategoryIcons(Migration):
     """Добавляет иконки для категорий"""
-    
+
     def __init__(self):
         super().__init__(3, "Add icon field to categories")
-    
+
     def up(self, conn: sqlite3.Connection):
-        cursor = conn.cursor()
-        try:
-            cursor.execute("ALTER TABLE categories ADD COLUMN icon TEXT")
-            conn.commit()
-            print(f"✅ Migration {self.version}: {self.description} - applied")
-        except sqlite3.OperationalError as e:
-            if "duplicate column" in str(e).lower():
-                print(f"⚠️  Migration {self.version}: Already applied")
-            else:
-                raise
-    
+        add_column(conn, 'categories', 'icon', 'TEXT')
+
     def down(self, conn: sqlite3.Connection):
-        print(f"⚠️  Migration {self.version}: Rollback not supported (SQLite limitation)")
+        drop_column(conn, 'categories', 'icon')
 
 
 class Migration004_AddPaymentReminders(Migration):
     """Добавляет таблицу напоминаний о платежах"""
-    
+
     def __init__(self):
         super().__init__(4, "Add payment reminders table")
-    
+
     def up(self, conn: sqlite3.Connection):
-        cursor = conn.cursor()
-        cursor.execute("""
+        conn.execute("""
             CREATE TABLE IF NOT EXISTS payment_reminders (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 credit_id INTEGER NOT NULL,
@@ -111,57 +350,43 @@ class Migration004_AddPaymentReminders(Migration):
                 FOREIGN KEY (credit_id) REFERENCES credits(id)
             )
         """)
-        conn.commit()
-        print(f"✅ Migration {self.version}: {self.description} - applied")
-    
+
     def down(self, conn: sqlite3.Connection):
-        cursor = conn.cursor()
-        cursor.execute("DROP TABLE IF EXISTS payment_reminders")
-        conn.commit()
-        print(f"✅ Migration {self.version}: Rolled back")
+        conn.execute("DROP TABLE IF EXISTS payment_reminders")
 
 
 class Migration005_AddRecurringTransactions(Migration):
     """Добавляет поддержку повторяющихся транзакций"""
-    
+
+    COLUMNS = (
+        ('is_recurring', 'BOOLEAN DEFAULT 0'),
+        ('recurring_type', 'TEXT'),
+        ('recurring_day', 'INTEGER'),
+    )
+
     def __init__(self):
         super().__init__(5, "Add recurring transactions support")
-    
+
     def up(self, conn: sqlite3.Connection):
-        cursor = conn.cursor()
-        
-        # Добавляем поля для повторяющихся доходов
-        try:
-            cursor.execute("ALTER TABLE incomes ADD COLUMN is_recurring BOOLEAN DEFAULT 0")
-            cursor.execute("ALTER TABLE incomes ADD COLUMN recurring_type TEXT")
-            cursor.execute("ALTER TABLE incomes ADD COLUMN recurring_day INTEGER")
-        except sqlite3.OperationalError:
-            pass
-        
-        # Добавляем поля для повторяющихся расходов
-        try:
-            cursor.execute("ALTER TABLE expenses ADD COLUMN is_recurring BOOLEAN DEFAULT 0")
-            cursor.execute("ALTER TABLE expenses ADD COLUMN recurring_type TEXT")
-            cursor.execute("ALTER TABLE expenses ADD COLUMN recurring_day INTEGER")
-        except sqlite3.OperationalError:
-            pass
-        
-        conn.commit()
-        print(f"✅ Migration {self.version}: {self.description} - applied")
-    
+        # Поля для повторяющихся доходов и расходов
+        for table in ('incomes', 'expenses'):
+            for column, definition in self.COLUMNS:
+                add_column(conn, table, column, definition)
+
     def down(self, conn: sqlite3.Connection):
-        print(f"⚠️  Migration {self.version}: Rollback not supported (SQLite limitation)")
+        for table in ('incomes', 'expenses'):
+            for column, _ in self.COLUMNS:
+                drop_column(conn, table, column)
 
 
 class Migration006_AddBudgetPlanning(Migration):
     """Добавляет таблицу планирования бюджета"""
-    
+
     def __init__(self):
         super().__init__(6, "Add budget planning table")
-    
+
     def up(self, conn: sqlite3.Connection):
-        cursor = conn.cursor()
-        cursor.execute("""
+        conn.execute("""
             CREATE TABLE IF NOT EXISTS budget_plans (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER NOT NULL,
@@ -178,222 +403,648 @@ class Migration006_AddBudgetPlanning(Migration):
                 UNIQUE(user_id, month, year)
             )
         """)
-        conn.commit()
-        print(f"✅ Migration {self.version}: {self.description} - applied")
-    
+
     def down(self, conn: sqlite3.Connection):
-        cursor = conn.cursor()
-        cursor.execute("DROP TABLE IF EXISTS budget_plans")
-        conn.commit()
-        print(f"✅ Migration {self.version}: Rolled back")
+        conn.execute("DROP TABLE IF EXISTS budget_plans")
+
 
 class Migration007_BudgetCategoriesSupport(Migration):
     """Добавляет поддержку категорий в бюджете"""
-    
+
     def __init__(self):
         super().__init__(7, "Add budget categories support")
-    
+
+    def up(self, conn: sqlite3.Connection):
+        # Поля для хранения категорий доходов и расходов
+        add_column(conn, 'budget_plans', 'income_categories', 'TEXT')
+        add_column(conn, 'budget_plans', 'expense_categories', 'TEXT')
+
+    def down(self, conn: sqlite3.Connection):
+        drop_column(conn, 'budget_plans', 'income_categories')
+        drop_column(conn, 'budget_plans', 'expense_categories')
+
+
+class Migration008_DerivedTables(Migration):
+    """Версии данных пользователей, помесячные итоги и статистика расходов"""
+
+    def __init__(self):
+        super().__init__(8, "Add data versions, monthly rollups and expense stats")
+
+    # Таблицы производные: заполняются по существующей истории порциями
+    backfills = [MonthlyRollupsBackfill(), ExpenseStatsBackfill()]
+
     def up(self, conn: sqlite3.Connection):
         cursor = conn.cursor()
-        
-        # Добавляем поля для хранения категорий доходов и расходов
-        try:
-            cursor.execute("ALTER TABLE budget_plans ADD COLUMN income_categories TEXT")
-            cursor.execute("ALTER TABLE budget_plans ADD COLUMN expense_categories TEXT")
-        except sqlite3.OperationalError:
-            pass
-        
-        conn.commit()
-        print(f"✅ Migration {self.version}: {self.description} - applied")
-    
+
+        # Версии данных пользователей (для инвалидации кэшей)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS user_data_versions (
+                user_id INTEGER PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Помесячные итоги доходов и расходов по категориям
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS monthly_rollups (
+                user_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                category_id INTEGER NOT NULL DEFAULT 0,
+                month TEXT NOT NULL,
+                total REAL NOT NULL DEFAULT 0,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, kind, category_id, month)
+            )
+        """)
+
+        # Текущая статистика расходов по категориям (алгоритм Уэлфорда)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS expense_category_stats (
+                user_id INTEGER NOT NULL,
+                category_id INTEGER NOT NULL DEFAULT 0,
+                count INTEGER NOT NULL DEFAULT 0,
+                mean REAL NOT NULL DEFAULT 0,
+                m2 REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, category_id)
+            )
+        """)
+
     def down(self, conn: sqlite3.Connection):
-        print(f"⚠️  Migration {self.version}: Rollback not supported (SQLite limitation)")
+        conn.execute("DROP TABLE IF EXISTS expense_category_stats")
+        conn.execute("DROP TABLE IF EXISTS monthly_rollups")
+        conn.execute("DROP TABLE IF EXISTS user_data_versions")
+
+
+class Migration009_CreditCards(Migration):
+    """Добавляет таблицы кредитных карт"""
+
+    def __init__(self):
+        super().__init__(9, "Add credit cards tables")
+
+    def up(self, conn: sqlite3.Connection):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS credit_cards (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                card_name TEXT NOT NULL,
+                bank_name TEXT NOT NULL,
+                credit_limit REAL NOT NULL,
+                current_balance REAL NOT NULL,
+                interest_rate REAL NOT NULL,
+                minimum_payment_percent REAL NOT NULL,
+                grace_period_days INTEGER DEFAULT 55,
+                is_active INTEGER DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        """)
+
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS credit_card_transactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                card_id INTEGER NOT NULL,
+                transaction_date DATE NOT NULL,
+                transaction_type TEXT NOT NULL,
+                amount REAL NOT NULL,
+                balance_before REAL NOT NULL,
+                balance_after REAL NOT NULL,
+                interest_charged REAL DEFAULT 0,
+                notes TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (card_id) REFERENCES credit_cards(id)
+            )
+        """)
+
+    def down(self, conn: sqlite3.Connection):
+        conn.execute("DROP TABLE IF EXISTS credit_card_transactions")
+        conn.execute("DROP TABLE IF EXISTS credit_cards")
+
+
+class Migration010_UserDateIndexes(Migration):
+    """Индексы доходов и расходов по пользователю и дате"""
+
+    def __init__(self):
+        super().__init__(10, "Add user/date indexes on incomes and expenses")
+
+    def up(self, conn: sqlite3.Connection):
+        # Порция дозаполнения по диапазону user_id читает только свои строки
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_incomes_user_date ON incomes (user_id, date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON expenses (user_id, date)")
+
+    def down(self, conn: sqlite3.Connection):
+        conn.execute("DROP INDEX IF EXISTS idx_incomes_user_date")
+        conn.execute("DROP INDEX IF EXISTS idx_expenses_user_date")
+
+
+class Migration011_FsmStates(Migration):
+    """Добавляет таблицу состояний диалогов (FSM)"""
+
+    def __init__(self):
+        super().__init__(11, "Add FSM states table")
+
+    def up(self, conn: sqlite3.Connection):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                bot_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                thread_id INTEGER NOT NULL DEFAULT 0,
+                destiny TEXT NOT NULL,
+                state TEXT,
+                data BLOB,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (bot_id, chat_id, user_id, thread_id, destiny)
+            )
+        """)
+
+    def down(self, conn: sqlite3.Connection):
+        conn.execute("DROP TABLE IF EXISTS fsm_states")
+
+
+MIGRATIONS: List[Migration] = [
+    Migration001_InitialSchema(),
+    Migration002_AddCreditNotes(),
+    Migration003_AddCategoryIcons(),
+    Migration004_AddPaymentReminders(),
+    Migration005_AddRecurringTransactions(),
+    Migration006_AddBudgetPlanning(),
+    Migration007_BudgetCategoriesSupport(),
+    Migration008_DerivedTables(),
+    Migration009_CreditCards(),
+    Migration010_UserDateIndexes(),
+    Migration011_FsmStates(),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
 
 
 class MigrationManager:
     """Менеджер миграций"""
-    
+
     def __init__(self, db_path: str = "dohot.db"):
         self.db_path = db_path
-        self.migrations: List[Migration] = [
-            Migration001_InitialSchema(),
-            Migration002_AddCreditFields(),
-            Migration003_AddDebtFields(),
-            Migration004_AddUserPreferences(),
-            Migration005_AddRecurringTransactions(),
-            Migration006_AddBudgetPlanning(),
-            Migration007_BudgetCategoriesSupport(),
-        ]
-        self._ensure_migrations_table()
-    
-    def _ensure_migrations_table(self):
-        """Создаёт таблицу для отслеживания миграций"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
+        self.migrations: List[Migration] = MIGRATIONS
+
+    def get_connection(self) -> sqlite3.Connection:
+        """
+        Подключение в режиме autocommit: транзакциями управляет менеджер
+        (BEGIN IMMEDIATE ... COMMIT), в том числе вокруг DDL
+        """
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def _ensure_migrations_table(self, conn: sqlite3.Connection):
+        """
+        Создаёт таблицу истории миграций
+
+        backfill_state - JSON с позициями дозаполнений миграции
+        {имя: {"position": ключ, "processed": строк, "done": bool}}.
+        """
+        conn.execute("""
             CREATE TABLE IF NOT EXISTS schema_migrations (
                 version INTEGER PRIMARY KEY,
                 description TEXT NOT NULL,
-                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                backfill_state TEXT
             )
         """)
-        
-        conn.commit()
-        conn.close()
-    
+        add_column(conn, 'schema_migrations', 'backfill_state', 'TEXT')
+
+    def _read_version(self, conn: sqlite3.Connection) -> int:
+        """
+        Текущая версия схемы
+
+        Основной источник - PRAGMA user_version. Для баз, обновлённых до
+        его появления, берётся последняя версия из schema_migrations.
+        """
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0 and table_exists(conn, 'schema_migrations'):
+            row = conn.execute("SELECT MAX(version) FROM schema_migrations").fetchone()
+            version = row[0] or 0
+        return version
+
     def get_current_version(self) -> int:
         """Получить текущую версию схемы"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT MAX(version) FROM schema_migrations")
-        result = cursor.fetchone()
-        
+        conn = self.get_connection()
+        version = self._read_version(conn)
         conn.close()
-        
-        return result[0] if result[0] is not None else 0
-    
+        return version
+
     def get_applied_migrations(self) -> List[Tuple[int, str, str]]:
         """Получить список применённых миграций"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.get_connection()
+        if not table_exists(conn, 'schema_migrations'):
+            conn.close()
+            return []
+
         cursor = conn.cursor()
-        
         cursor.execute("""
-            SELECT version, description, applied_at 
-            FROM schema_migrations 
+            SELECT version, description, applied_at
+            FROM schema_migrations
             ORDER BY version
         """)
-        
+
         migrations = cursor.fetchall()
         conn.close()
-        
+
         return migrations
-    
-    def migrate(self, target_version: int = None):
+
+    def migrate(self, target_version: int = None) -> List[int]:
         """
         Применить миграции
-        
+
+        Каждая миграция выполняется в своей транзакции BEGIN IMMEDIATE:
+        версия перечитывается под блокировкой записи, поэтому несколько
+        процессов, запущенных одновременно, не применят миграцию дважды.
+
         Args:
             target_version: Версия до которой мигрировать (None = последняя)
+
+        Returns:
+            Список применённых версий
         """
-        current_version = self.get_current_version()
-        target = target_version or self.migrations[-1].version
-        
-        print(f"📊 Текущая версия: {current_version}")
-        print(f"🎯 Целевая версия: {target}\n")
-        
-        if current_version >= target:
-            print("✅ База данных уже на целевой версии")
-            return
-        
-        conn = sqlite3.connect(self.db_path)
-        
+        target = target_version or LATEST_VERSION
+        applied = []
+
+        conn = self.get_connection()
         try:
             for migration in self.migrations:
-                if migration.version <= current_version:
-                    continue
-                
                 if migration.version > target:
                     break
-                
-                print(f"🔄 Применяю миграцию {migration.version}: {migration.description}")
-                
-                migration.up(conn)
-                
-                # Записываем в таблицу миграций
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO schema_migrations (version, description)
-                    VALUES (?, ?)
-                """, (migration.version, migration.description))
-                conn.commit()
-            
-            print(f"\n✅ Миграция завершена! Текущая версия: {self.get_current_version()}")
-        
+
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    if self._read_version(conn) >= migration.version:
+                        conn.execute("ROLLBACK")
+                        continue
+
+                    logger.info(f"Applying migration {migration.version}: {migration.description}")
+                    migration.up(conn)
+
+                    # Записываем версию в той же транзакции
+                    self._ensure_migrations_table(conn)
+                    backfill_state = {
+                        backfill.name: {'position': None, 'processed': 0, 'done': False}
+                        for backfill in migration.backfills
+                    }
+                    conn.execute("""
+                        INSERT OR REPLACE INTO schema_migrations (version, description, backfill_state)
+                        VALUES (?, ?, ?)
+                    """, (migration.version, migration.description,
+                          json.dumps(backfill_state) if backfill_state else None))
+                    conn.execute(f"PRAGMA user_version = {migration.version}")
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+
+                applied.append(migration.version)
         except Exception as e:
-            print(f"\n❌ Ошибка при миграции: {e}")
-            conn.rollback()
+            logger.error(f"Error applying migrations to {self.db_path}: {e}")
             raise
-        
         finally:
             conn.close()
-    
-    def rollback(self, steps: int = 1):
+
+        return applied
+
+    def rollback(self, steps: int = 1) -> List[int]:
         """
         Откатить миграции
-        
+
         Args:
             steps: Количество шагов для отката
+
+        Returns:
+            Список откаченных версий
         """
-        current_version = self.get_current_version()
-        
-        if current_version == 0:
-            print("⚠️  Нет миграций для отката")
-            return
-        
-        print(f"📊 Текущая версия: {current_version}")
-        print(f"🔙 Откатываем {steps} миграций\n")
-        
-        conn = sqlite3.connect(self.db_path)
-        
+        rolled_back = []
+        by_version: Dict[int, Migration] = {m.version: m for m in self.migrations}
+
+        conn = self.get_connection()
         try:
-            for i in range(steps):
-                if current_version == 0:
-                    break
-                
-                # Находим миграцию для отката
-                migration = next(
-                    (m for m in self.migrations if m.version == current_version),
-                    None
-                )
-                
-                if migration:
-                    print(f"🔄 Откатываю миграцию {migration.version}: {migration.description}")
-                    migration.down(conn)
-                
-                # Удаляем из таблицы миграций
-                cursor = conn.cursor()
-                cursor.execute("""
-                    DELETE FROM schema_migrations 
-                    WHERE version = ?
-                """, (current_version,))
-                conn.commit()
-                
-                current_version -= 1
-            
-            print(f"\n✅ Откат завершён! Текущая версия: {self.get_current_version()}")
-        
-        except Exception as e:
-            print(f"\n❌ Ошибка при откате: {e}")
-            conn.rollback()
-            raise
-        
+            for _ in range(steps):
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    current_version = self._read_version(conn)
+                    if current_version == 0:
+                        conn.execute("ROLLBACK")
+                        break
+
+                    logger.info(f"Rolling back migration {current_version}")
+                    by_version[current_version].down(conn)
+
+                    conn.execute("DELETE FROM schema_migrations WHERE version = ?", (current_version,))
+                    conn.execute(f"PRAGMA user_version = {current_version - 1}")
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+
+                rolled_back.append(current_version)
         finally:
             conn.close()
-    
+
+        return rolled_back
+
     def status(self):
         """Показать статус миграций"""
         current_version = self.get_current_version()
         applied = self.get_applied_migrations()
-        
+
         print(f"📊 Текущая версия: {current_version}")
         print(f"📝 Доступно миграций: {len(self.migrations)}\n")
-        
+
         print("Применённые миграции:")
-        print(f"{'Версия':<8} {'Описание':<40} {'Применена':<20}")
-        print("-" * 70)
-        
+        print(f"{'Версия':<8} {'Описание':<55} {'Применена':<20}")
+        print("-" * 85)
+
         for version, description, applied_at in applied:
-            print(f"{version:<8} {description:<40} {applied_at:<20}")
-        
+            print(f"{version:<8} {description:<55} {applied_at:<20}")
+
         print("\nДоступные миграции:")
-        print(f"{'Версия':<8} {'Описание':<40} {'Статус':<15}")
-        print("-" * 70)
-        
+        print(f"{'Версия':<8} {'Описание':<55} {'Статус':<15}")
+        print("-" * 85)
+
         for migration in self.migrations:
             status = "✅ Применена" if migration.version <= current_version else "⏳ Ожидает"
-            print(f"{migration.version:<8} {migration.description:<40} {status:<15}")
+            print(f"{migration.version:<8} {migration.description:<55} {status:<15}")
+
+
+class BackfillRunner:
+    """
+    Выполнение дозаполнений порциями с паузами и сохранением позиции
+
+    Позиция каждой порции записывается в schema_migrations.backfill_state
+    в той же транзакции, что и сами изменения.
+    """
+
+    # Пауза между порциями, сек.
+    CHUNK_SLEEP = 0.05
+
+    # Дозаполнение до стольких ключей выполняется сразу при подключении,
+    # большее - в фоне (run_pending из планировщика бота или --backfill)
+    INLINE_KEYS = 5000
+
+    def __init__(self, db_path: str = "dohot.db", sleep: float = CHUNK_SLEEP,
+                 chunk_size: Optional[int] = None):
+        self.db_path = db_path
+        self.sleep = sleep
+        self.chunk_size = chunk_size
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Подключение в режиме autocommit (транзакции - по порциям)"""
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def _load_state(self, conn: sqlite3.Connection, version: int) -> Dict:
+        """Состояние дозаполнений миграции"""
+        row = conn.execute(
+            "SELECT backfill_state FROM schema_migrations WHERE version = ?", (version,)
+        ).fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+
+    def _save_state(self, conn: sqlite3.Connection, version: int, state: Dict):
+        """Записать состояние дозаполнений миграции"""
+        conn.execute(
+            "UPDATE schema_migrations SET backfill_state = ? WHERE version = ?",
+            (json.dumps(state), version)
+        )
+
+    def pending(self) -> List[Tuple[int, Backfill]]:
+        """Незавершённые дозаполнения применённых миграций"""
+        conn = self.get_connection()
+        if not table_exists(conn, 'schema_migrations') or not column_exists(conn, 'schema_migrations', 'backfill_state'):
+            conn.close()
+            return []
+
+        result = []
+        for migration in MIGRATIONS:
+            if not migration.backfills:
+                continue
+            state = self._load_state(conn, migration.version)
+            for backfill in migration.backfills:
+                if backfill.name in state and not state[backfill.name]['done']:
+                    result.append((migration.version, backfill))
+        conn.close()
+        return result
+
+    def remaining_keys(self, backfill: Backfill, version: Optional[int] = None) -> int:
+        """Количество ключей, которые ещё предстоит обработать"""
+        conn = self.get_connection()
+        position = None
+        if version is not None:
+            position = self._load_state(conn, version).get(backfill.name, {}).get('position')
+        remaining = conn.execute(
+            f"SELECT COUNT(*) FROM {backfill.key_table} WHERE {backfill.key_column} > ?",
+            (position if position is not None else -1 << 63,)
+        ).fetchone()[0]
+        conn.close()
+        return remaining
+
+    def run(self, backfill: Backfill, version: Optional[int] = None,
+            progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+        """
+        Выполнить дозаполнение до конца
+
+        Args:
+            backfill: Дозаполнение
+            version: Версия миграции для сохранения позиции
+                (None - без сохранения, например для отдельной копии базы)
+            progress: Функция progress({'backfill', 'processed', 'total',
+                'percent', 'rate', 'eta_seconds'}) после каждой порции
+
+        Returns:
+            {'backfill', 'processed', 'chunks', 'duration_seconds'}
+        """
+        chunk_size = self.chunk_size or backfill.chunk_size
+        conn = self.get_connection()
+
+        state = self._load_state(conn, version) if version is not None else {}
+        entry = state.get(backfill.name, {'position': None, 'processed': 0, 'done': False})
+        if entry['done']:
+            conn.close()
+            return {'backfill': backfill.name, 'processed': 0, 'chunks': 0, 'duration_seconds': 0}
+
+        position = entry['position'] if entry['position'] is not None else -1 << 63
+        total = conn.execute(
+            f"SELECT COUNT(*) FROM {backfill.key_table} WHERE {backfill.key_column} > ?", (position,)
+        ).fetchone()[0]
+
+        started = time.monotonic()
+        processed = 0
+        chunks = 0
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Позиция перечитывается под блокировкой: дозаполнение
+                # могли продвинуть из другого процесса
+                if version is not None:
+                    state = self._load_state(conn, version)
+                    entry = state.get(backfill.name, entry)
+                    if entry['done']:
+                        conn.execute("COMMIT")
+                        break
+                    if entry['position'] is not None:
+                        position = entry['position']
+
+                rows = conn.execute(f"""
+                    SELECT {backfill.key_column} FROM {backfill.key_table}
+                    WHERE {backfill.key_column} > ?
+                    ORDER BY {backfill.key_column} LIMIT ?
+                """, (position, chunk_size)).fetchall()
+
+                if rows:
+                    high = rows[-1][0]
+                    backfill.process(conn, position, high)
+                    position = high
+
+                entry = {
+                    'position': position,
+                    'processed': entry['processed'] + len(rows),
+                    'done': len(rows) < chunk_size
+                }
+                if version is not None:
+                    state[backfill.name] = entry
+                    self._save_state(conn, version, state)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                conn.close()
+                raise
+
+            processed += len(rows)
+            chunks += 1
+
+            if progress:
+                elapsed = time.monotonic() - started
+                rate = processed / elapsed if elapsed > 0 else 0
+                left = max(total - processed, 0)
+                progress({
+                    'backfill': backfill.name,
+                    'processed': processed,
+                    'total': total,
+                    'percent': processed / total * 100 if total else 100,
+                    'rate': rate,
+                    'eta_seconds': left / rate if rate else 0
+                })
+
+            if entry['done']:
+                break
+            if self.sleep:
+                time.sleep(self.sleep)
+
+        conn.close()
+        duration = round(time.monotonic() - started, 3)
+        logger.info(f"Backfill {backfill.name} finished: {processed} keys in {chunks} chunks, {duration} s")
+        return {'backfill': backfill.name, 'processed': processed, 'chunks': chunks, 'duration_seconds': duration}
+
+    def run_pending(self, progress: Optional[Callable[[Dict], None]] = None,
+                    max_keys: Optional[int] = None) -> List[Dict]:
+        """
+        Выполнить все незавершённые дозаполнения
+
+        Args:
+            progress: См. run
+            max_keys: Выполнять только дозаполнения не больше чем на столько ключей
+
+        Returns:
+            Результаты выполненных дозаполнений
+        """
+        results = []
+        for version, backfill in self.pending():
+            if max_keys is not None and self.remaining_keys(backfill, version) > max_keys:
+                logger.info(f"Backfill {backfill.name} left for background run")
+                continue
+            results.append(self.run(backfill, version, progress))
+        return results
+
+
+# ==================== ПРОВЕРКА ПРИ ПОДКЛЮЧЕНИИ ====================
+
+# Файлы, схема которых уже проверена в этом процессе: путь -> (st_dev, st_ino)
+_ready_schemas: Dict[str, Tuple[int, int]] = {}
+_ready_lock = threading.Lock()
+
+
+def _file_identity(path: str):
+    """Идентификатор файла; меняется, если файл удалён и создан заново"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+def ensure_schema(db_path: str, force: bool = False) -> List[int]:
+    """
+    Привести схему базы к последней версии
+
+    Первый вызов для файла в процессе читает PRAGMA user_version и при
+    необходимости применяет миграции; повторные вызовы для того же файла
+    возвращаются сразу, не открывая соединения. Небольшие дозаполнения
+    новых миграций (до BackfillRunner.INLINE_KEYS ключей) выполняются
+    сразу, остальные - в фоне (run_pending_backfills).
+
+    Args:
+        db_path: Путь к базе данных
+        force: Проверить версию, даже если файл уже проверялся
+            (например, после восстановления из копии)
+
+    Returns:
+        Список применённых версий
+    """
+    key = os.path.abspath(db_path)
+    identity = _file_identity(db_path)
+    if not force and identity is not None and _ready_schemas.get(key) == identity:
+        return []
+
+    with _ready_lock:
+        manager = MigrationManager(db_path)
+        conn = manager.get_connection()
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+        conn.close()
+
+        applied = manager.migrate() if current < LATEST_VERSION else []
+        if applied:
+            logger.info(f"Database {db_path} migrated to version {LATEST_VERSION}: {applied}")
+            BackfillRunner(db_path, sleep=0).run_pending(max_keys=BackfillRunner.INLINE_KEYS)
+
+        _ready_schemas[key] = _file_identity(db_path)
+    return applied
+
+
+def run_pending_backfills(db_path: str = "dohot.db") -> List[Dict]:
+    """Выполнить незавершённые дозаполнения в фоне (порциями с паузами)"""
+    try:
+        return BackfillRunner(db_path).run_pending()
+    except Exception as e:
+        logger.error(f"Error running backfills for {db_path}: {e}")
+        return []
+
+
+def run_backfills_cli(db_path: str, chunk_size: Optional[int], sleep: float):
+    """
+    Выполнить незавершённые дозаполнения с выводом прогресса
+    
+    Args:
+        db_path: Путь к базе данных
+        chunk_size: Ключей в порции (None - по умолчанию для дозаполнения)
+        sleep: Пауза между порциями
+    """
+    runner = BackfillRunner(db_path, sleep=sleep, chunk_size=chunk_size)
+    pending = runner.pending()
+    
+    if not pending:
+        print("✅ Незавершённых дозаполнений нет")
+        return
+    
+    def show_progress(info: Dict):
+        print(f"\r   🔄 {info['backfill']}: {info['processed']}/{info['total']} ({info['percent']:.0f}%), "
+              f"{info['rate']:.0f} ключей/сек., осталось ~{info['eta_seconds']:.0f} сек.   ", end="", flush=True)
+    
+    for version, backfill in pending:
+        print(f"📝 Миграция {version}: {backfill.name}")
+        result = runner.run(backfill, version, show_progress)
+        print(f"\n✅ Обработано {result['processed']} ключей за {result['duration_seconds']:.1f} сек.")
 
 
 def main():
@@ -441,6 +1092,25 @@ def main():
         help='Мигрировать до конкретной версии'
     )
     
+    parser.add_argument(
+        '--backfill',
+        action='store_true',
+        help='Выполнить незавершённые дозаполнения данных (можно при работающем боте)'
+    )
+    
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        help='Ключей в одной порции дозаполнения'
+    )
+    
+    parser.add_argument(
+        '--sleep',
+        type=float,
+        default=BackfillRunner.CHUNK_SLEEP,
+        help=f'Пауза между порциями в секундах (по умолчанию: {BackfillRunner.CHUNK_SLEEP})'
+    )
+    
     args = parser.parse_args()
     
     manager = MigrationManager(args.db)
@@ -455,11 +1125,27 @@ def main():
         sys.exit(0)
     
     elif args.migrate:
-        manager.migrate(args.version)
+        print(f"📊 Текущая версия: {manager.get_current_version()}")
+        print(f"🎯 Целевая версия: {args.version or LATEST_VERSION}\n")
+        applied = manager.migrate(args.version)
+        for version in applied:
+            print(f"✅ Миграция {version} применена")
+        if not applied:
+            print("✅ База данных уже на целевой версии")
+        print(f"\n📊 Текущая версия: {manager.get_current_version()}")
+        sys.exit(0)
+    
+    elif args.backfill:
+        run_backfills_cli(args.db, args.chunk_size, args.sleep)
         sys.exit(0)
     
     elif args.rollback:
-        manager.rollback(args.rollback)
+        rolled_back = manager.rollback(args.rollback)
+        for version in rolled_back:
+            print(f"🔙 Миграция {version} откачена")
+        if not rolled_back:
+            print("⚠️  Нет миграций для отката")
+        print(f"\n📊 Текущая версия: {manager.get_current_version()}")
         sys.exit(0)
     
     else:
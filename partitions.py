@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Разделение базы данных на файлы-шарды по пользователям
+
+В режиме шардов данные каждого пользователя хранятся в файле его
+группы: <база>_shards/shard_NNN.db, номер группы - shard_for_user.
+Запись одного пользователя блокирует только свой файл, поэтому запись
+разных пользователей идёт параллельно и масштабируется числом шардов.
+Основной файл базы остаётся для общих данных (состояния FSM, журнал).
+
+Подключения к шардам открываются через LRU открытых подключений
+(отдельный для каждого потока): повторный запрос к тому же шарду не
+открывает файл заново.
+
+Перенос существующей базы в шарды:
+    python partitions.py --split dohot.db --shards 8
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from migrations import ensure_schema
+
+logger = logging.getLogger(__name__)
+
+# Пользователь текущего обновления: по нему выбирается шард для методов,
+# которые получают только ID записи (кредита, бюджета и т.п.)
+current_user_id: ContextVar[Optional[int]] = ContextVar('current_user_id', default=None)
+
+# Таблицы, которые не переносятся в шарды
+SHARED_TABLES = {'schema_migrations', 'sqlite_sequence', 'fsm_states', 'change_journal'}
+
+
+def shard_for_user(user_id: Optional[int], shards: int) -> int:
+    """
+    Номер шарда пользователя
+
+    Обновления без пользователя (например, посты каналов) идут в шард 0.
+
+    Args:
+        user_id: ID пользователя Telegram
+        shards: Количество шардов
+
+    Returns:
+        Номер шарда от 0 до shards - 1
+    """
+    if not user_id or shards <= 1:
+        return 0
+    return user_id % shards
+
+
+def shard_dir(db_path: str) -> str:
+    """Директория шардов базы: dohot.db -> dohot_shards"""
+    return os.path.splitext(db_path)[0] + "_shards"
+
+
+def shard_path(db_path: str, shard: int) -> str:
+    """Путь к файлу шарда"""
+    return os.path.join(shard_dir(db_path), f"shard_{shard:03d}.db")
+
+
+class PooledConnection:
+    """
+    Подключение из пула
+
+    close() не закрывает файл, а возвращает подключение в пул:
+    откатывает незавершённую транзакцию и сбрасывает row_factory.
+    """
+
+    __slots__ = ('_conn', '_entry')
+
+    def __init__(self, conn: sqlite3.Connection, entry: Dict):
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_entry', entry)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def close(self):
+        entry = self._entry
+        entry['borrowed'] -= 1
+        if entry['borrowed'] == 0:
+            if self._conn.in_transaction:
+                self._conn.rollback()
+            self._conn.row_factory = None
+
+
+class ShardRouter:
+    """Выбор файла шарда по пользователю и LRU открытых подключений"""
+
+    # Открытых подключений на поток
+    MAX_OPEN = 64
+
+    def __init__(self, db_path: str, shards: int, max_open: int = MAX_OPEN):
+        """
+        Args:
+            db_path: Путь к основной базе (шарды лежат рядом, см. shard_dir)
+            shards: Количество шардов
+            max_open: Открытых подключений на поток
+        """
+        self.db_path = db_path
+        self.shards = shards
+        self.max_open = max_open
+        self._local = threading.local()
+        self.opened = 0
+        self.reused = 0
+        os.makedirs(shard_dir(db_path), exist_ok=True)
+
+    def paths(self) -> List[str]:
+        """Пути ко всем шардам"""
+        return [shard_path(self.db_path, shard) for shard in range(self.shards)]
+
+    def path_for(self, user_id: int) -> str:
+        """Путь к шарду пользователя"""
+        return shard_path(self.db_path, shard_for_user(user_id, self.shards))
+
+    def connect(self, user_id: int) -> PooledConnection:
+        """Подключение к шарду пользователя"""
+        return self.connect_path(self.path_for(user_id))
+
+    def connect_path(self, path: str) -> PooledConnection:
+        """Подключение к файлу шарда из LRU текущего потока"""
+        pool = getattr(self._local, 'pool', None)
+        if pool is None:
+            pool = self._local.pool = OrderedDict()
+
+        entry = pool.get(path)
+        if entry is not None:
+            pool.move_to_end(path)
+            self.reused += 1
+        else:
+            ensure_schema(path)
+            entry = {'conn': sqlite3.connect(path, timeout=30, check_same_thread=False), 'borrowed': 0}
+            pool[path] = entry
+            self.opened += 1
+            self._evict(pool)
+
+        entry['borrowed'] += 1
+        return PooledConnection(entry['conn'], entry)
+
+    def _evict(self, pool: OrderedDict):
+        """Закрыть самые давно использованные подключения сверх лимита"""
+        for path in list(pool):
+            if len(pool) <= self.max_open:
+                break
+            if pool[path]['borrowed'] == 0:
+                pool.pop(path)['conn'].close()
+
+    def close_all(self):
+        """Закрыть подключения текущего потока"""
+        pool = getattr(self._local, 'pool', None) or {}
+        for entry in pool.values():
+            entry['conn'].close()
+        pool.clear()
+
+    def stats(self) -> Dict:
+        """Счётчики пула подключений"""
+        pool = getattr(self._local, 'pool', None) or {}
+        return {
+            'shards': self.shards,
+            'open': len(pool),
+            'opened': self.opened,
+            'reused': self.reused
+        }
+
+
+# ==================== ПЕРЕНОС ДАННЫХ ====================
+
+def _shard_filter(cursor: sqlite3.Cursor, table: str, shards: int) -> Optional[str]:
+    """
+    Условие отбора строк таблицы для шарда (параметр - номер шарда)
+
+    Таблицы с user_id делятся по нему, дочерние таблицы (платежи по
+    кредитам, операции по картам) - по user_id родительской строки.
+    """
+    columns = [row[1] for row in cursor.execute(f'PRAGMA src.table_info("{table}")')]
+    if 'user_id' in columns:
+        return f"user_id % {shards} = ?"
+
+    for fk in cursor.execute(f'PRAGMA src.foreign_key_list("{table}")').fetchall():
+        parent, column, parent_column = fk[2], fk[3], fk[4]
+        parent_columns = [row[1] for row in cursor.execute(f'PRAGMA src.table_info("{parent}")')]
+        if 'user_id' in parent_columns:
+            return f'"{column}" IN (SELECT "{parent_column}" FROM src."{parent}" WHERE user_id % {shards} = ?)'
+    return None
+
+
+def split_database(db_path: str, shards: int) -> Dict[int, int]:
+    """
+    Разложить данные пользователей существующей базы по шардам
+
+    Строки копируются с теми же ID. Файлы шардов не должны существовать.
+
+    Args:
+        db_path: Путь к базе
+        shards: Количество шардов
+
+    Returns:
+        Словарь {номер шарда: скопировано строк}
+    """
+    if os.path.exists(shard_dir(db_path)) and os.listdir(shard_dir(db_path)):
+        raise FileExistsError(f"Shard directory {shard_dir(db_path)} is not empty")
+    ensure_schema(db_path)
+
+    copied = {}
+    for shard in range(shards):
+        path = shard_path(db_path, shard)
+        os.makedirs(shard_dir(db_path), exist_ok=True)
+        ensure_schema(path)
+
+        conn = sqlite3.connect(path, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute("ATTACH DATABASE ? AS src", (db_path,))
+        tables = [row[0] for row in cursor.execute(
+            "SELECT name FROM main.sqlite_master WHERE type = 'table' ORDER BY name"
+        ).fetchall() if row[0] not in SHARED_TABLES]
+
+        rows = 0
+        for table in tables:
+            condition = _shard_filter(cursor, table, shards)
+            if condition is None:
+                logger.warning(f"Table {table} has no user_id, skipped")
+                continue
+            source_columns = {row[1] for row in cursor.execute(f'PRAGMA src.table_info("{table}")')}
+            columns = ", ".join(
+                f'"{row[1]}"' for row in cursor.execute(f'PRAGMA main.table_info("{table}")')
+                if row[1] in source_columns
+            )
+            cursor.execute(
+                f'INSERT INTO main."{table}" ({columns}) SELECT {columns} FROM src."{table}" WHERE {condition}',
+                (shard,)
+            )
+            rows += cursor.rowcount
+        conn.commit()
+        cursor.execute("DETACH DATABASE src")
+        conn.close()
+
+        copied[shard] = rows
+        logger.info(f"Shard {shard}: {rows} rows copied to {path}")
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Разделение базы данных DoHot на шарды')
+    parser.add_argument('--split', metavar='DB', required=True, help='Путь к базе данных для разделения')
+    parser.add_argument('--shards', type=int, required=True, help='Количество шардов (как DB_SHARDS)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        copied = split_database(args.split, args.shards)
+    except FileExistsError as e:
+        print(f"❌ {e}")
+        return
+
+    print(f"✅ База разделена на {args.shards} шардов в {shard_dir(args.split)}")
+    for shard, rows in copied.items():
+        print(f"   • shard_{shard:03d}.db: {rows} строк")
+    print("\nЗапустите бота с DB_SHARDS=" + str(args.shards))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""
+Ночной предрасчёт графиков и отчётов
+
+В непиковые часы планировщик проходит по пользователям, которые недавно
+вносили данные, и заранее строит для них графики панели и месячный отчёт.
+Работа выполняется в ограниченном пуле процессов (matplotlib/pyplot не
+потокобезопасен), результаты складываются в кэши из cache.py под текущей
+версией данных пользователя, где их и находят обработчики.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from cache import chart_cache, report_cache, request_flight, versioned_key
+from calculations import FinancialCalculator
+from database import Database
+from partitions import shard_for_user
+
+logger = logging.getLogger(__name__)
+
+
+# ==================== РАБОТА С КЭШЕМ ====================
+
+def _charts_exist(charts: List[str]) -> bool:
+    """Проверка, что файлы графиков не были удалены очисткой"""
+    return all(os.path.exists(path) for path in charts)
+
+
+def get_cached_dashboard(db: Database, user_id: int, version: Optional[int] = None) -> Optional[List[str]]:
+    """
+    Получить актуальные графики панели из кэша
+
+    Returns:
+        Список путей к графикам или None, если кэш пуст или устарел
+    """
+    if version is None:
+        version = db.get_data_version(user_id)
+
+    charts = chart_cache.get(versioned_key('dashboard', db.db_path, user_id, version))
+    if charts is None or not _charts_exist(charts):
+        return None
+    return charts
+
+
+def get_dashboard_charts(db: Database, chart_gen, user_id: int) -> List[str]:
+    """
+    Получить графики панели: из кэша, а при его отсутствии построить заново
+
+    Args:
+        db: Экземпляр базы данных
+        chart_gen: Экземпляр ChartGenerator
+        user_id: ID пользователя
+
+    Returns:
+        Список путей к графикам
+    """
+    version = db.get_data_version(user_id)
+    charts = get_cached_dashboard(db, user_id, version)
+    if charts is not None:
+        return charts
+
+    charts = chart_gen.generate_full_financial_dashboard(user_id, db)
+    chart_cache.set(versioned_key('dashboard', db.db_path, user_id, version), charts)
+    return charts
+
+
+async def get_dashboard_charts_async(db: Database, chart_gen, user_id: int) -> List[str]:
+    """
+    Получить графики панели, построив их в потоке графиков
+
+    Повторные запросы, пришедшие во время построения или вскоре после
+    него, получают тот же результат без нового построения.
+
+    Returns:
+        Список путей к графикам
+    """
+    from visualization import render_executor
+
+    version = db.get_data_version(user_id)
+    charts = get_cached_dashboard(db, user_id, version)
+    if charts is not None:
+        return charts
+
+    loop = asyncio.get_running_loop()
+    return await request_flight.run(
+        versioned_key('dashboard', db.db_path, user_id, version),
+        lambda: loop.run_in_executor(render_executor, get_dashboard_charts, db, chart_gen, user_id)
+    )
+
+
+# ==================== ПРЕДРАСЧЁТ ====================
+
+def _precompute_user(db_path: str, shards: int, charts_dir: str, user_id: int, period_days: int) -> Dict:
+    """
+    Построить графики и отчёт для одного пользователя (выполняется в процессе пула)
+
+    Версия читается до построения: если данные изменятся во время расчёта,
+    результат ляжет под старой версией и просто не будет востребован.
+    """
+    from visualization import ChartGenerator
+
+    db = Database(db_path, shards)
+    chart_gen = ChartGenerator(charts_dir)
+
+    version = db.get_data_version(user_id)
+    charts = chart_gen.generate_full_financial_dashboard(user_id, db)
+    report = FinancialCalculator.build_financial_report(user_id, db, period_days)
+
+    return {
+        'user_id': user_id,
+        'version': version,
+        'charts': charts,
+        'report': report
+    }
+
+
+async def precompute_active_users(db_path: str, charts_dir: str, active_days: int = 7,
+                                  max_workers: int = 2, period_days: int = 30,
+                                  worker: Optional[int] = None, workers: int = 1,
+                                  executor: Optional[Executor] = None) -> Dict:
+    """
+    Предрасчёт графиков и отчётов для недавно активных пользователей
+
+    Пропускает пользователей, для текущей версии данных которых всё уже
+    посчитано. В режиме рабочих процессов каждый процесс считает только
+    своих пользователей: результаты ложатся в кэши того процесса, куда
+    попадают их обновления.
+
+    Args:
+        db_path: Путь к базе данных
+        charts_dir: Директория для графиков
+        active_days: За сколько дней учитывать активность
+        max_workers: Размер пула процессов
+        period_days: Период месячного отчёта в днях
+        worker: Номер рабочего процесса (None - все пользователи)
+        workers: Количество рабочих процессов
+        executor: Готовый пул для построения вместо нового пула процессов
+            (рабочие процессы - демоны и не могут запускать дочерние)
+
+    Returns:
+        Статистика: количество активных, пересчитанных, пропущенных и ошибок
+    """
+    db = Database(db_path)
+    since = (datetime.utcnow() - timedelta(days=active_days)).strftime('%Y-%m-%d %H:%M:%S')
+    stats = {'active': 0, 'computed': 0, 'skipped': 0, 'failed': 0}
+
+    try:
+        user_ids = db.get_recently_active_users(since)
+        if worker is not None:
+            user_ids = [uid for uid in user_ids if shard_for_user(uid, workers) == worker]
+    except Exception as e:
+        logger.error(f"Error loading active users for precompute: {e}")
+        return stats
+
+    stats['active'] = len(user_ids)
+
+    # Пропускаем пользователей с актуальным кэшем
+    pending = []
+    for user_id in user_ids:
+        version = db.get_data_version(user_id)
+        report_key = versioned_key('financial', db_path, user_id, version, period_days)
+        if (get_cached_dashboard(db, user_id, version) is not None
+                and report_cache.get(report_key) is not None):
+            stats['skipped'] += 1
+        else:
+            pending.append(user_id)
+
+    if not pending:
+        logger.info(f"Precompute finished: {stats}")
+        return stats
+
+    loop = asyncio.get_running_loop()
+
+    async def run(pool: Executor) -> list:
+        futures = [
+            loop.run_in_executor(pool, _precompute_user, db_path, db.shards, charts_dir, user_id, period_days)
+            for user_id in pending
+        ]
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    if executor is not None:
+        results = await run(executor)
+    else:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as pool:
+            results = await run(pool)
+
+    for user_id, result in zip(pending, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error precomputing data for user {user_id}: {result}")
+            stats['failed'] += 1
+            continue
+
+        version = result['version']
+        chart_cache.set(versioned_key('dashboard', db_path, user_id, version), result['charts'])
+        report_cache.set(versioned_key('financial', db_path, user_id, version, period_days), result['report'])
+        stats['computed'] += 1
+
+    logger.info(f"Precompute finished: {stats}")
+    return stats
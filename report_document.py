@@ -0,0 +1,198 @@
+"""
+Аналитический отчёт одним документом
+
+Подробный отчёт вместе с графиками панели собирается в один HTML- или
+PDF-файл и отправляется одним сообщением вместо десятка текстовых.
+Сборка выполняется в отдельном потоке (один поток на весь бот: pyplot
+не потокобезопасен), поэтому цикл событий не блокируется.
+"""
+
+import asyncio
+import base64
+import html
+import io
+import logging
+import textwrap
+from datetime import date
+from functools import lru_cache
+from typing import List, Optional
+
+import matplotlib
+matplotlib.use('Agg')  # Для работы без GUI
+import matplotlib.image as mpimg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+from matplotlib.font_manager import FontProperties, findfont
+from matplotlib.ft2font import FT2Font
+
+from analytics import FinancialAnalytics
+from database import Database
+from visualization import render_executor
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT_FORMATS = ('html', 'pdf')
+
+# Параметры страницы PDF (A4, моноширинный шрифт)
+PDF_PAGE_SIZE = (8.27, 11.69)
+PDF_FONT_FAMILY = 'DejaVu Sans Mono'
+PDF_FONT_SIZE = 8
+PDF_LINE_WIDTH = 95
+PDF_LINES_PER_PAGE = 80
+
+
+# ==================== HTML ====================
+
+HTML_TEMPLATE = """<!DOCTYPE html>
+<html lang="ru">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: 'DejaVu Sans', Arial, sans-serif; max-width: 960px; margin: 24px auto; padding: 0 16px; color: #222; }}
+pre {{ white-space: pre-wrap; font-family: 'DejaVu Sans Mono', monospace; font-size: 14px; line-height: 1.4; }}
+figure {{ margin: 24px 0; }}
+img {{ max-width: 100%; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+<pre>{report}</pre>
+{charts}
+</body>
+</html>
+"""
+
+
+def render_html(report: str, charts: List[str], title: str) -> bytes:
+    """
+    Собрать HTML-документ с отчётом и встроенными графиками
+
+    Графики встраиваются в base64, поэтому файл самодостаточен.
+    """
+    figures = []
+    for i, chart_path in enumerate(charts, 1):
+        with open(chart_path, 'rb') as f:
+            encoded = base64.b64encode(f.read()).decode('ascii')
+        figures.append(
+            f'<figure><img src="data:image/png;base64,{encoded}" alt="График {i}">'
+            f'<figcaption>График {i} из {len(charts)}</figcaption></figure>'
+        )
+
+    document = HTML_TEMPLATE.format(
+        title=html.escape(title),
+        report=html.escape(report),
+        charts="\n".join(figures)
+    )
+    return document.encode('utf-8')
+
+
+# ==================== PDF ====================
+
+@lru_cache(maxsize=1)
+def _pdf_charset() -> frozenset:
+    """Символы, для которых в шрифте PDF есть глифы"""
+    font = FT2Font(findfont(FontProperties(family=PDF_FONT_FAMILY)))
+    return frozenset(font.get_charmap())
+
+
+def _pdf_lines(report: str) -> List[str]:
+    """Подготовить строки отчёта для PDF: убрать символы без глифов (эмодзи) и перенести длинные"""
+    charset = _pdf_charset()
+    lines = []
+    for line in report.splitlines():
+        line = "".join(ch for ch in line if ord(ch) in charset).rstrip()
+        lines.extend(textwrap.wrap(line, PDF_LINE_WIDTH, drop_whitespace=False) or [""])
+    return lines
+
+
+def render_pdf(report: str, charts: List[str], title: str) -> bytes:
+    """
+    Собрать PDF-документ: страницы с текстом отчёта, затем по графику на страницу
+
+    Используется объектный API matplotlib без pyplot.
+    """
+    buffer = io.BytesIO()
+    lines = _pdf_lines(report)
+
+    with PdfPages(buffer) as pdf:
+        for start in range(0, len(lines), PDF_LINES_PER_PAGE):
+            fig = Figure(figsize=PDF_PAGE_SIZE)
+            fig.text(0.06, 0.96, "\n".join(lines[start:start + PDF_LINES_PER_PAGE]),
+                     family=PDF_FONT_FAMILY, size=PDF_FONT_SIZE, va='top', linespacing=1.3)
+            pdf.savefig(fig)
+
+        for i, chart_path in enumerate(charts, 1):
+            fig = Figure(figsize=PDF_PAGE_SIZE)
+            ax = fig.add_axes([0.05, 0.05, 0.9, 0.9])
+            ax.imshow(mpimg.imread(chart_path))
+            ax.set_axis_off()
+            ax.set_title(f"График {i} из {len(charts)}", fontsize=10)
+            pdf.savefig(fig)
+
+        info = pdf.infodict()
+        info['Title'] = title
+
+    return buffer.getvalue()
+
+
+RENDERERS = {
+    'html': render_html,
+    'pdf': render_pdf,
+}
+
+
+# ==================== СБОРКА ====================
+
+def build_report_document(db: Database, user_id: int, fmt: str = 'html',
+                          charts_dir: str = "charts", period_days: int = 30,
+                          with_charts: bool = True) -> bytes:
+    """
+    Построить документ с подробным отчётом и графиками панели
+
+    Args:
+        db: Экземпляр базы данных
+        user_id: ID пользователя
+        fmt: Формат документа: 'html' или 'pdf'
+        charts_dir: Директория для графиков
+        period_days: Период анализа в днях
+        with_charts: Добавлять ли графики
+
+    Returns:
+        Содержимое файла
+    """
+    from precompute import get_dashboard_charts
+    from visualization import ChartGenerator
+
+    if fmt not in RENDERERS:
+        raise ValueError(f"Неизвестный формат документа: {fmt}")
+
+    report = FinancialAnalytics(db).generate_comprehensive_report(user_id, period_days)
+    charts = get_dashboard_charts(db, ChartGenerator(charts_dir), user_id) if with_charts else []
+    title = f"Финансовый отчёт DoHot от {date.today().strftime('%d.%m.%Y')}"
+
+    return RENDERERS[fmt](report, charts, title)
+
+
+async def build_report_document_async(db: Database, user_id: int, fmt: str = 'html',
+                                      charts_dir: str = "charts",
+                                      period_days: int = 30) -> Optional[bytes]:
+    """
+    Построить документ в потоке сборки, не блокируя цикл событий
+
+    Returns:
+        Содержимое файла или None при ошибке
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(
+            render_executor, build_report_document, db, user_id, fmt, charts_dir, period_days
+        )
+    except Exception as e:
+        logger.error(f"Error building report document for user {user_id}: {e}")
+        return None
+
+
+def document_filename(fmt: str) -> str:
+    """Имя файла документа для отправки"""
+    return f"dohot_report_{date.today().isoformat()}.{fmt}"
@@ -0,0 +1,104 @@
+"""
+Маршрутизация кнопок по таблице
+
+Обработчики кнопок меню и inline-кнопок без состояния FSM собраны в
+одну таблицу: точный текст кнопки -> обработчик и префикс callback_data
+-> обработчик. В диспетчере таблица - один обработчик сообщений и один
+обработчик callback-запросов, поэтому обновление не проверяется по
+очереди фильтрами F.text == "..." всех кнопок, а находит обработчик
+одним поиском в словаре (для callback_data - по одному поиску на каждую
+длину зарегистрированных префиксов).
+
+Найденный обработчик подставляется в data['handler'], поэтому его флаги
+(например, flags={'cost': HEAVY}) видят middleware, как при обычной
+регистрации.
+"""
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+
+from aiogram import Router
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.types import CallbackQuery, Message
+
+
+class DispatchTable:
+    """Таблица обработчиков: текст кнопки и префикс callback_data"""
+
+    def __init__(self):
+        self._texts: Dict[str, HandlerObject] = {}
+        self._prefixes: Dict[str, HandlerObject] = {}
+        self._prefix_lengths: List[int] = []  # по убыванию: сначала самый длинный префикс
+
+    def add_text(self, text: str, callback: Callable, flags: Optional[Dict[str, Any]] = None):
+        """
+        Обработчик сообщения с точным текстом кнопки
+
+        Args:
+            text: Текст кнопки
+            callback: Обработчик (аргументы - как при обычной регистрации)
+            flags: Флаги обработчика
+
+        Raises:
+            ValueError: Кнопка уже есть в таблице
+        """
+        if text in self._texts:
+            raise ValueError(f"Button {text!r} is already routed")
+        self._texts[text] = HandlerObject(callback=callback, flags=dict(flags or {}))
+
+    def add_texts(self, texts: Iterable[str], callback: Callable, flags: Optional[Dict[str, Any]] = None):
+        """Один обработчик для нескольких кнопок"""
+        for text in texts:
+            self.add_text(text, callback, flags)
+
+    def add_prefix(self, prefix: str, callback: Callable, flags: Optional[Dict[str, Any]] = None):
+        """
+        Обработчик callback-запроса, callback_data которого начинается с prefix
+
+        При пересечении префиксов выбирается самый длинный.
+
+        Raises:
+            ValueError: Префикс уже есть в таблице
+        """
+        if prefix in self._prefixes:
+            raise ValueError(f"Callback prefix {prefix!r} is already routed")
+        self._prefixes[prefix] = HandlerObject(callback=callback, flags=dict(flags or {}))
+        self._prefix_lengths = sorted({len(p) for p in self._prefixes}, reverse=True)
+
+    @property
+    def texts(self) -> List[str]:
+        """Тексты кнопок в таблице"""
+        return list(self._texts)
+
+    def match_text(self, text: Optional[str]) -> Optional[HandlerObject]:
+        """Обработчик кнопки с текстом text"""
+        return self._texts.get(text) if text else None
+
+    def match_data(self, data: Optional[str]) -> Optional[HandlerObject]:
+        """Обработчик callback_data по самому длинному подходящему префиксу"""
+        if not data:
+            return None
+        for length in self._prefix_lengths:
+            handler = self._prefixes.get(data[:length])
+            if handler is not None:
+                return handler
+        return None
+
+    async def _message_filter(self, message: Message) -> Union[bool, Dict[str, Any]]:
+        handler = self.match_text(message.text)
+        return {'handler': handler} if handler else False
+
+    async def _callback_filter(self, callback: CallbackQuery) -> Union[bool, Dict[str, Any]]:
+        handler = self.match_data(callback.data)
+        return {'handler': handler} if handler else False
+
+    def register(self, router: Router):
+        """Зарегистрировать таблицу в роутере (или диспетчере)"""
+        if self._texts:
+            router.message.register(_call_route, self._message_filter)
+        if self._prefixes:
+            router.callback_query.register(_call_route, self._callback_filter)
+
+
+async def _call_route(event, handler: HandlerObject, **kwargs) -> Any:
+    """Вызвать найденный в таблице обработчик"""
+    return await handler.call(event, handler=handler, **kwargs)
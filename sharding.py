@@ -0,0 +1,217 @@
+"""
+Распределение обновлений по рабочим процессам
+
+Основной процесс получает обновления (polling или webhook) и передаёт
+каждое в рабочий процесс, выбранный по user_id. Рабочие процессы
+запускают свой диспетчер со всеми обработчиками, поэтому построение
+графиков и отчётов для разных пользователей идёт параллельно, а не
+делит один GIL.
+
+Все обновления одного пользователя попадают в один и тот же процесс:
+кэши процесса (отчёты, показатели, кэш состояний FSM) остаются
+согласованными. Напоминания и резервные копии планирует основной
+процесс, а ночной предрасчёт - каждый рабочий процесс для своих
+пользователей, чтобы результаты легли в кэши, которые видят их
+обработчики.
+"""
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import queue
+import signal
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware, Bot
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from aiogram.types import Update
+
+from partitions import current_user_id, shard_for_user
+
+logger = logging.getLogger(__name__)
+
+
+# ==================== РАБОЧИЙ ПРОЦЕСС ====================
+
+def run_worker(index: int, config, updates: multiprocessing.Queue):
+    """Точка входа рабочего процесса"""
+    # Остановкой рабочих процессов управляет основной процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - worker-{index} - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(_worker_loop(index, config, updates))
+
+
+async def _worker_loop(index: int, config, updates: multiprocessing.Queue):
+    """Получение обновлений из очереди и обработка диспетчером"""
+    # Отложенный импорт: main импортирует этот модуль
+    from database import set_default_shards
+    from main import create_admission, create_dispatcher, create_storage, schedule_precompute
+    from visualization import render_executor
+
+    set_default_shards(config.db_shards)
+    bot = Bot(token=config.bot_token)
+    storage = create_storage(config)
+    dp = create_dispatcher(storage, admission=create_admission(config))
+    # Рабочий процесс - демон и не может запускать пул процессов:
+    # предрасчёт строит графики в потоке графиков процесса
+    scheduler = AsyncIOScheduler()
+    schedule_precompute(scheduler, config, worker=index, executor=render_executor)
+    scheduler.start()
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(config.worker_max_in_flight)
+    tasks = set()
+
+    async def process(update: Dict[str, Any]):
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            logger.error(f"Error processing update {update.get('update_id')} in worker {index}: {e}")
+        finally:
+            slots.release()
+
+    logger.info(f"Worker {index} started")
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, updates.get)
+            if raw is None:
+                break
+            await slots.acquire()
+            task = asyncio.create_task(process(json.loads(raw)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        scheduler.shutdown()
+        await storage.close()
+        await bot.session.close()
+        logger.info(f"Worker {index} stopped")
+
+
+# ==================== ОСНОВНОЙ ПРОЦЕСС ====================
+
+class WorkerPool:
+    """Рабочие процессы и их очереди обновлений"""
+
+    # Обновлений в очереди одного процесса, после которых основной процесс ждёт
+    QUEUE_SIZE = 1000
+
+    # Время на завершение рабочего процесса при остановке, сек.
+    STOP_TIMEOUT = 30
+
+    def __init__(self, config, workers: int):
+        """
+        Args:
+            config: BotConfig (передаётся рабочим процессам)
+            workers: Количество рабочих процессов
+        """
+        self.config = config
+        self.workers = workers
+        # spawn, а не fork: упавший процесс перезапускается из работающего
+        # цикла событий, когда в основном процессе уже есть потоки
+        # (планировщик, резервные копии), и fork унаследовал бы их
+        # захваченные блокировки (logging, sqlite)
+        self._context = multiprocessing.get_context('spawn')
+        self._queues: List[multiprocessing.Queue] = []
+        self._processes: List[Optional[multiprocessing.Process]] = []
+        self.forwarded = [0] * workers
+
+    def _spawn(self, index: int) -> multiprocessing.Process:
+        process = self._context.Process(
+            target=run_worker,
+            args=(index, self.config, self._queues[index]),
+            name=f"dohot-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        return process
+
+    def start(self):
+        """Запустить рабочие процессы"""
+        self._queues = [self._context.Queue(self.QUEUE_SIZE) for _ in range(self.workers)]
+        self._processes = [self._spawn(index) for index in range(self.workers)]
+        logger.info(f"Started {self.workers} worker processes")
+
+    async def submit(self, shard: int, raw_update: str):
+        """
+        Передать обновление рабочему процессу
+
+        Упавший процесс перезапускается; при переполненной очереди
+        ожидание идёт в потоке, не блокируя цикл событий.
+        """
+        process = self._processes[shard]
+        if not process.is_alive():
+            logger.error(f"Worker {shard} exited with code {process.exitcode}, restarting")
+            self._processes[shard] = self._spawn(shard)
+
+        try:
+            self._queues[shard].put_nowait(raw_update)
+        except queue.Full:
+            await asyncio.get_running_loop().run_in_executor(None, self._queues[shard].put, raw_update)
+        self.forwarded[shard] += 1
+
+    def stop(self):
+        """Дождаться обработки очередей и остановить рабочие процессы"""
+        for update_queue in self._queues:
+            update_queue.put(None)
+        for process in self._processes:
+            process.join(self.STOP_TIMEOUT)
+            if process.is_alive():
+                logger.error(f"Worker {process.name} did not stop in time, terminating")
+                process.terminate()
+        logger.info(f"Worker processes stopped, forwarded updates: {self.forwarded}")
+
+
+class ShardForwardMiddleware(BaseMiddleware):
+    """
+    Внешний middleware обновлений основного процесса
+
+    Вместо обработки передаёт обновление рабочему процессу по user_id.
+    Ставится после UserContextMiddleware диспетчера, который уже
+    определил пользователя события.
+    """
+
+    def __init__(self, pool: WorkerPool):
+        self.pool = pool
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        chat = data.get('event_chat')
+        user_id = user.id if user else (chat.id if chat else None)
+
+        raw = event.model_dump_json(exclude_unset=True)
+        await self.pool.submit(shard_for_user(user_id, self.pool.workers), raw)
+
+
+class CurrentUserMiddleware(BaseMiddleware):
+    """
+    Внешний middleware обновлений: пользователь события в current_user_id
+
+    По нему Database выбирает шард для методов, которые получают только
+    ID записи.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        token = current_user_id.set(user.id if user else None)
+        try:
+            return await handler(event, data)
+        finally:
+            current_user_id.reset(token)
@@ -0,0 +1,113 @@
+import asyncio
+import pytest
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.types import Message
+
+from admission import (
+    CHART, HEAVY, LIGHT, PRIORITIES,
+    AdmissionController, AdmissionRejected, handler_cost
+)
+
+
+def make_message(text: str) -> Message:
+    """Текстовое сообщение пользователя"""
+    return Message.model_validate({
+        'message_id': 1,
+        'date': 1700000000,
+        'chat': {'id': 1, 'type': 'private'},
+        'from': {'id': 1, 'is_bot': False, 'first_name': 'Test'},
+        'text': text
+    })
+
+
+class TestAdmissionController:
+    """Тесты для очереди тяжёлых запросов"""
+
+    def test_limits_priority_and_positions(self):
+        """Тест лимитов, порядка по приоритету и места в очереди"""
+        controller = AdmissionController(max_running=1, per_user=1, max_waiting=2)
+        order = []
+        positions = {}
+
+        async def scenario():
+            release = asyncio.Event()
+
+            async def job(name, wait=False):
+                if wait:
+                    await release.wait()
+                order.append(name)
+
+            def submit(user_id, name, cost, wait=False):
+                async def on_queued(position):
+                    positions[name] = position
+                return asyncio.create_task(controller.run(
+                    user_id, PRIORITIES[cost], lambda: job(name, wait), on_queued
+                ))
+
+            first = submit(1, 'first', HEAVY, wait=True)
+            await asyncio.sleep(0)
+            dashboard = submit(2, 'dashboard', HEAVY)
+            await asyncio.sleep(0)
+            chart = submit(3, 'chart', CHART)
+            await asyncio.sleep(0)
+
+            with pytest.raises(AdmissionRejected) as busy:
+                await controller.run(1, PRIORITIES[HEAVY], lambda: job('again'))
+            with pytest.raises(AdmissionRejected) as full:
+                await controller.run(4, PRIORITIES[HEAVY], lambda: job('overflow'))
+            assert controller.stats()['waiting'] == 2
+
+            release.set()
+            await asyncio.gather(first, dashboard, chart)
+            return busy.value.reason, full.value.reason
+
+        busy, full = asyncio.run(scenario())
+
+        assert (busy, full) == ('user_busy', 'queue_full')
+        assert order == ['first', 'chart', 'dashboard']
+        assert positions == {'dashboard': 1, 'chart': 1}
+        assert controller.stats() == {
+            'running': 0, 'waiting': 0, 'admitted': 3, 'queued': 2, 'rejected': 2
+        }
+
+    def test_cancelled_waiter_leaves_queue(self):
+        """Тест освобождения места отменённым ожидающим запросом"""
+        controller = AdmissionController(max_running=1)
+
+        async def scenario():
+            release = asyncio.Event()
+            running = asyncio.create_task(controller.run(1, 0, release.wait))
+            await asyncio.sleep(0)
+            waiting = asyncio.create_task(controller.run(2, 0, lambda: asyncio.sleep(1)))
+            await asyncio.sleep(0)
+
+            waiting.cancel()
+            await asyncio.gather(waiting, return_exceptions=True)
+            release.set()
+            await running
+            return await controller.run(2, 0, lambda: asyncio.sleep(0, 'done'))
+
+        assert asyncio.run(scenario()) == 'done'
+        assert controller.stats()['running'] == 0
+
+    def test_handler_cost(self):
+        """Тест классификации по флагу обработчика и кнопке меню"""
+        async def handler(message):
+            pass
+
+        flagged = {'handler': HandlerObject(callback=handler, flags={'cost': HEAVY})}
+        plain = {'handler': HandlerObject(callback=handler)}
+
+        assert handler_cost(make_message("report_doc_pdf"), flagged) == HEAVY
+        assert handler_cost(make_message("📈 Все графики"), plain) == HEAVY
+        assert handler_cost(make_message("💹 График баланса"), plain) == CHART
+        assert handler_cost(make_message("➕ Добавить расход"), plain) == LIGHT
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
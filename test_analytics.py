@@ -0,0 +1,159 @@
+import asyncio
+import pytest
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database
+from analytics import FinancialAnalytics
+from calculations import FinancialCalculator
+from cache import entity_cache, metrics_cache, report_cache
+from utils import pack_sections
+
+
+@pytest.fixture
+def db():
+    """Создает тестовую базу данных"""
+    test_db_path = "test_dohot.db"
+
+    if os.path.exists(test_db_path):
+        os.remove(test_db_path)
+
+    # Кэши живут в процессе, а тестовая база пересоздаётся с нулевыми версиями
+    metrics_cache.clear()
+    report_cache.clear()
+    entity_cache.clear()
+
+    db = Database(test_db_path)
+    yield db
+
+    if os.path.exists(test_db_path):
+        os.remove(test_db_path)
+
+
+class TestComprehensiveReport:
+    """Тесты для расширенного аналитического отчёта"""
+
+    def test_report_for_empty_user(self, db):
+        """Отчёт строится для пользователя без данных"""
+        db.add_user(12345, "testuser", "Test User")
+
+        report = FinancialAnalytics(db).generate_comprehensive_report(12345)
+
+        assert "РАЗДЕЛ 1: СТРУКТУРА КАПИТАЛА" in report
+        assert "РАЗДЕЛ 9: ПЕРСОНАЛЬНЫЕ РЕКОМЕНДАЦИИ" in report
+
+    def test_report_with_data(self, db):
+        """Все разделы используют общие показатели"""
+        db.add_user(12345, "testuser", "Test User")
+        db.add_income(12345, 100000, db.add_category(12345, "Зарплата", "income"))
+        db.add_expense(12345, 40000, db.add_category(12345, "Продукты", "expense"))
+        db.add_credit(12345, "Сбербанк", 15000, 36, 14.5, 400000)
+        db.add_investment(12345, "Акции", 100000, 120000)
+        db.add_debt(12345, "Иван", 5000, "given")
+
+        report = FinancialAnalytics(db).generate_comprehensive_report(12345)
+
+        assert "Зарплата" in report
+        assert "Продукты" in report
+        assert "Сбербанк" in report
+        assert "Акции" in report
+        assert "Иван" in report
+
+    def test_metrics_computed_once(self, db):
+        """Производные показатели вычисляются один раз"""
+        db.add_user(12345, "testuser", "Test User")
+        db.add_credit(12345, "Сбербанк", 15000, 36, 14.5, 400000)
+
+        metrics = FinancialAnalytics(db).collect_metrics(12345)
+
+        assert metrics.active_credits is metrics.active_credits
+        assert metrics.net_worth['credits'] == metrics.total_credit_debt == 400000
+
+
+class TestReportCache:
+    """Тесты для кэширования отчётов по версии данных"""
+
+    def test_metrics_reused_until_data_changes(self, db):
+        """Показатели берутся из кэша, пока данные не изменились"""
+        db.add_user(12345, "testuser", "Test User")
+        category_id = db.add_category(12345, "Продукты", "expense")
+        analytics = FinancialAnalytics(db)
+
+        first = analytics.collect_metrics(12345)
+        assert analytics.collect_metrics(12345) is first
+
+        db.add_expense(12345, 500, category_id)
+        second = analytics.collect_metrics(12345)
+        assert second is not first
+        assert second.total_expense == 500
+
+    def test_financial_report_invalidated_by_change(self, db):
+        """Текстовый отчёт пересчитывается после изменения данных"""
+        db.add_user(12345, "testuser", "Test User")
+        category_id = db.add_category(12345, "Зарплата", "income")
+
+        report = FinancialCalculator.generate_financial_report(12345, db)
+        assert FinancialCalculator.generate_financial_report(12345, db) is report
+
+        db.add_income(12345, 70000, category_id)
+        assert "70,000.00" in FinancialCalculator.generate_financial_report(12345, db)
+
+
+class TestStreamedReport:
+    """Тесты для отправки отчёта по разделам"""
+
+    def test_sections_match_full_report(self, db):
+        """Потоковые разделы содержат все разделы отчёта"""
+        db.add_user(12345, "testuser", "Test User")
+        db.add_expense(12345, 1500, db.add_category(12345, "Продукты", "expense"))
+        analytics = FinancialAnalytics(db)
+
+        async def collect():
+            return [section async for section in analytics.iter_report_sections(12345)]
+
+        sections = asyncio.run(collect())
+
+        assert len(sections) == len(analytics.report_sections())
+        report = "".join(sections)
+        assert "РАЗДЕЛ 1: СТРУКТУРА КАПИТАЛА" in report
+        assert "Продукты" in report
+
+    def test_pack_sections(self):
+        """Разделы упаковываются в лимит, а при медленном разделе накопленное уходит сразу"""
+        async def sections(delays):
+            for i, delay in enumerate(delays):
+                await asyncio.sleep(delay)
+                yield f"Раздел {i}\n" + "x" * 30 + "\n"
+
+        async def pack(delays):
+            return [part async for part in pack_sections(sections(delays), max_length=100, wait_seconds=0.02)]
+
+        packed = asyncio.run(pack([0, 0, 0, 0, 0]))
+        assert all(len(part) <= 100 for part in packed)
+        assert len(packed) == 3
+        assert "".join(packed).count("Раздел") == 5
+
+        assert len(asyncio.run(pack([0, 0.1, 0]))) == 2
+
+
+class TestReportDocument:
+    """Тесты для отчёта одним документом"""
+
+    def test_html_and_pdf_documents(self, db):
+        """Отчёт собирается в HTML и PDF"""
+        from report_document import build_report_document
+
+        db.add_user(12345, "testuser", "Test User")
+        db.add_expense(12345, 1500, db.add_category(12345, "Продукты & <дом>", "expense"))
+
+        document = build_report_document(db, 12345, 'html', with_charts=False).decode('utf-8')
+        assert "РАЗДЕЛ 1: СТРУКТУРА КАПИТАЛА" in document
+        assert "Продукты &amp; &lt;дом&gt;" in document
+
+        assert build_report_document(db, 12345, 'pdf', with_charts=False).startswith(b"%PDF")
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
@@ -0,0 +1,105 @@
+import asyncio
+import pytest
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import LRUCache, SingleFlight
+
+
+class TestLRUCache:
+    """Тесты для LRU-кэша"""
+    
+    def test_get_set(self):
+        """Тест сохранения и получения значения"""
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert cache.stats()['hits'] == 1
+        assert cache.stats()['misses'] == 1
+    
+    def test_eviction(self):
+        """Вытесняется давно не использованная запись"""
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert len(cache) == 2
+    
+    def test_ttl(self):
+        """Устаревшие записи не возвращаются"""
+        cache = LRUCache(maxsize=2, ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+        
+        assert cache.get('a') is None
+        assert len(cache) == 0
+    
+    def test_invalidate(self):
+        """Тест удаления записей по условию"""
+        cache = LRUCache()
+        cache.set((1, 'dashboard'), 'x')
+        cache.set((2, 'dashboard'), 'y')
+        
+        assert cache.invalidate(lambda key: key[0] == 1) == 1
+        assert cache.get((1, 'dashboard')) is None
+        assert cache.get((2, 'dashboard')) == 'y'
+
+
+class TestSingleFlight:
+    """Тесты для объединения одинаковых расчётов"""
+    
+    def test_concurrent_requests_share_one_run(self):
+        """Тест одного расчёта на несколько одновременных запросов и кэша результата"""
+        flight = SingleFlight(ttl=60)
+        runs = []
+        
+        async def render(user_id):
+            runs.append(user_id)
+            await asyncio.sleep(0.01)
+            return f"charts-{user_id}"
+        
+        async def mash():
+            results = await asyncio.gather(*(
+                flight.run((user_id, 'all_charts'), lambda user_id=user_id: render(user_id))
+                for user_id in (1, 1, 1, 1, 2)
+            ))
+            again = await flight.run((1, 'all_charts'), lambda: render(1))
+            return results, again
+        
+        results, again = asyncio.run(mash())
+        
+        assert results == ['charts-1'] * 4 + ['charts-2']
+        assert again == 'charts-1'
+        assert sorted(runs) == [1, 2]
+        assert flight.stats()['joined'] == 3
+    
+    def test_errors_not_cached(self):
+        """Тест повторного расчёта после ошибки"""
+        flight = SingleFlight(ttl=60)
+        calls = []
+        
+        async def failing():
+            calls.append(1)
+            raise ValueError("boom")
+        
+        async def run_twice():
+            for _ in range(2):
+                with pytest.raises(ValueError):
+                    await flight.run('key', failing)
+        
+        asyncio.run(run_twice())
+        assert len(calls) == 2
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
@@ -293,5 +293,80 @@ class TestEdgeCases:
         assert result['best_strategy'] in ['avalanche', 'snowball']
 
 
+class TestBudgetForecast:
+    """Тесты для оценки месяцев без бюджета и платежей по кредитам"""
+    
+    def _history(self, totals, first_year=2023, first_month=1):
+        history = []
+        for i, total in enumerate(totals):
+            index = first_year * 12 + first_month - 1 + i
+            history.append({'month': f"{index // 12}-{index % 12 + 1:02d}", 'total': total})
+        return history
+    
+    def test_trend_extrapolated(self):
+        """Линейный рост продолжается в прогнозе"""
+        history = self._history([1000 + 100 * i for i in range(24)])
+        
+        estimate = FinancialCalculator.estimate_monthly_series(history, 2025 * 12, 3)
+        
+        assert list(estimate) == pytest.approx([3400, 3500, 3600])
+    
+    def test_seasonality_applied(self):
+        """Регулярный всплеск в декабре переносится на следующий декабрь"""
+        history = self._history([50000 if i % 12 == 11 else 30000 for i in range(24)])
+        
+        estimate = FinancialCalculator.estimate_monthly_series(history, 2025 * 12, 12)
+        
+        assert estimate.argmax() == 11
+        assert estimate[11] - estimate[0] == pytest.approx(20000, rel=0.05)
+    
+    def test_credit_months(self):
+        """Кредит учитывается с первого полного месяца до окончания срока"""
+        credit = {
+            'is_active': True,
+            'start_date': '2025-01-15',
+            'total_months': 3,
+            'monthly_payment': 10000,
+            'remaining_debt': 30000,
+            'display_name': 'Сбербанк'
+        }
+        
+        totals = [
+            FinancialCalculator.calculate_monthly_credit_expenses([credit], month, 2025)['total']
+            for month in range(1, 6)
+        ]
+        
+        assert totals == [0, 10000, 10000, 10000, 0]
+    
+    def test_forecast_current_month_credit_rule(self):
+        """Кредит, взятый после 1-го числа текущего месяца, входит в прогноз со следующего месяца"""
+        today = date.today()
+        first_day = today.replace(day=1)
+        credits = [
+            {'is_active': True, 'start_date': first_day.isoformat(), 'total_months': 12,
+             'monthly_payment': 5000, 'remaining_debt': 60000, 'display_name': 'С 1-го числа'},
+            {'is_active': True, 'start_date': first_day.replace(day=2).isoformat(), 'total_months': 12,
+             'monthly_payment': 10000, 'remaining_debt': 120000, 'display_name': 'Со 2-го числа'},
+        ]
+        
+        class FakeDb:
+            def get_budgets_in_range(self, *args):
+                return {}
+            
+            def get_user_credits(self, user_id):
+                return credits
+            
+            def get_monthly_totals(self, user_id, kind, months):
+                return []
+        
+        forecast = FinancialCalculator.generate_budget_forecast(1, FakeDb(), months_ahead=2)
+        
+        assert (forecast[0]['month'], forecast[0]['year']) == (today.month, today.year)
+        assert [month['credit_expenses'] for month in forecast] == [5000, 15000]
+        for month in forecast:
+            expected = FinancialCalculator.calculate_monthly_credit_expenses(credits, month['month'], month['year'])
+            assert month['credit_expenses'] == expected['total']
+
+
 if __name__ == '__main__':
     pytest.main([__file__, '-v'])
@@ -5,6 +5,7 @@ from datetime import date
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from cache import entity_cache, invalidate_database
 from database import Database
 
 
@@ -17,12 +18,16 @@ def db():
     if os.path.exists(test_db_path):
         os.remove(test_db_path)
     
+    # Кэш сущностей живёт в процессе, а база пересоздаётся с теми же ID
+    entity_cache.clear()
+    
     db = Database(test_db_path)
     yield db
     
     # Очистка после тестов
     if os.path.exists(test_db_path):
         os.remove(test_db_path)
+    invalidate_database(test_db_path)
 
 
 class TestUsers:
@@ -358,5 +363,883 @@ class TestSavings:
         assert savings['amount'] == 200000
 
 
+class TestDataVersions:
+    """Тесты для версий данных пользователей"""
+    
+    def test_version_bumped_on_changes(self, db):
+        """Версия растёт при каждом изменении данных"""
+        db.add_user(12345, "testuser", "Test User")
+        assert db.get_data_version(12345) == 0
+        
+        category_id = db.add_category(12345, "Продукты", "expense")
+        expense_id = db.add_expense(12345, 1500, category_id)
+        version = db.get_data_version(12345)
+        assert version == 2
+        
+        db.delete_expense(12345, expense_id)
+        assert db.get_data_version(12345) == version + 1
+    
+    def test_version_bumped_by_row_id(self, db):
+        """Методы, принимающие ID записи, увеличивают версию её владельца"""
+        db.add_user(12345, "testuser", "Test User")
+        credit_id = db.add_credit(12345, "Сбербанк", 15000, 36, 14.5, 400000)
+        version = db.get_data_version(12345)
+        
+        db.add_credit_payment(credit_id, 15000, 'regular')
+        assert db.get_data_version(12345) == version + 1
+    
+    def test_version_is_per_user(self, db):
+        """Изменения одного пользователя не влияют на версию другого"""
+        db.add_user(1, "user1", "User 1")
+        db.add_user(2, "user2", "User 2")
+        
+        db.add_income(1, 50000, db.add_category(1, "Зарплата", "income"))
+        
+        assert db.get_data_version(1) == 2
+        assert db.get_data_version(2) == 0
+    
+    def test_recently_active_users(self, db):
+        """Активными считаются пользователи, изменявшие данные"""
+        db.add_user(1, "user1", "User 1")
+        db.add_user(2, "user2", "User 2")
+        db.add_expense(1, 300, db.add_category(1, "Кафе", "expense"))
+        
+        assert db.get_recently_active_users("2000-01-01 00:00:00") == [1]
+        assert db.get_recently_active_users("2999-01-01 00:00:00") == []
+
+
+class TestMonthlyRollups:
+    """Тесты для помесячных итогов и сравнения периодов"""
+    
+    def _rollup(self, db, user_id, kind, month):
+        conn = db.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT SUM(total), SUM(count) FROM monthly_rollups
+            WHERE user_id = ? AND kind = ? AND month = ?
+        """, (user_id, kind, month))
+        row = cursor.fetchone()
+        conn.close()
+        return row
+    
+    def test_rollups_follow_add_and_delete(self, db):
+        """Итоги обновляются при добавлении и удалении операций"""
+        db.add_user(12345, "testuser", "Test User")
+        category_id = db.add_category(12345, "Продукты", "expense")
+        
+        db.add_expense(12345, 1000, category_id, expense_date="2025-03-10")
+        expense_id = db.add_expense(12345, 500, category_id, expense_date="2025-03-20")
+        assert self._rollup(db, 12345, 'expense', '2025-03') == (1500, 2)
+        
+        db.delete_expense(12345, expense_id)
+        assert self._rollup(db, 12345, 'expense', '2025-03') == (1000, 1)
+    
+    def test_rollups_backfilled_for_existing_history(self, db):
+        """При создании таблицы миграцией итоги строятся по уже накопленной истории"""
+        from migrations import ensure_schema
+        
+        db.add_user(12345, "testuser", "Test User")
+        db.add_income(12345, 70000, income_date="2025-01-05")
+        
+        conn = db.get_connection()
+        conn.execute("DROP TABLE monthly_rollups")
+        conn.execute("PRAGMA user_version = 7")
+        conn.commit()
+        conn.close()
+        
+        assert 8 in ensure_schema(db.db_path, force=True)
+        reopened = Database(db.db_path)
+        assert self._rollup(reopened, 12345, 'income', '2025-01') == (70000, 1)
+    
+    def test_period_comparison(self, db):
+        """Прирост к прошлому месяцу и скользящее среднее"""
+        from datetime import timedelta
+        
+        db.add_user(12345, "testuser", "Test User")
+        category_id = db.add_category(12345, "Продукты", "expense")
+        
+        this_month = date.today().replace(day=1)
+        last_month = (this_month - timedelta(days=1)).replace(day=1)
+        db.add_expense(12345, 3000, category_id, expense_date=last_month.isoformat())
+        db.add_expense(12345, 4500, category_id, expense_date=this_month.isoformat())
+        
+        rows = db.get_category_period_comparison(12345, periods=2, window=2)
+        current = [r for r in rows if r['month'] == this_month.strftime('%Y-%m')][0]
+        
+        assert len(rows) == 2
+        assert current['category_name'] == "Продукты"
+        assert current['total'] == 4500
+        assert current['prev_total'] == 3000
+        assert current['rolling_avg'] == 3750
+
+
+
+class TestExpenseAnomalies:
+    """Тесты для текущей статистики расходов и выявления аномалий"""
+    
+    def test_stats_match_history(self, db):
+        """Статистика Уэлфорда совпадает с расчётом по всей истории"""
+        import statistics
+        
+        db.add_user(12345, "testuser", "Test User")
+        category_id = db.add_category(12345, "Продукты", "expense")
+        amounts = [500, 750, 620, 480, 900, 530]
+        ids = [db.add_expense(12345, amount, category_id) for amount in amounts]
+        db.delete_expense(12345, ids[-2])
+        del amounts[-2]
+        
+        check = db.check_expense_anomaly(12345, category_id, 600)
+        assert check['count'] == len(amounts)
+        assert check['mean'] == pytest.approx(statistics.mean(amounts))
+        assert check['std'] == pytest.approx(statistics.stdev(amounts))
+    
+    def test_large_expense_flagged(self, db):
+        """Крупный расход отмечается только при достаточной истории"""
+        db.add_user(12345, "testuser", "Test User")
+        category_id = db.add_category(12345, "Кафе", "expense")
+        
+        for amount in (400, 450, 500):
+            db.add_expense(12345, amount, category_id)
+        assert not db.check_expense_anomaly(12345, category_id, 5000)['is_anomaly']
+        
+        for amount in (420, 480, 510):
+            db.add_expense(12345, amount, category_id)
+        assert db.check_expense_anomaly(12345, category_id, 5000)['is_anomaly']
+        assert not db.check_expense_anomaly(12345, category_id, 520)['is_anomaly']
+
+
+class TestDataExporter:
+    """Тесты для потокового экспорта данных"""
+    
+    def test_streamed_export(self, db, tmp_path):
+        """CSV и сжатый JSON Lines выгружаются порциями без потери строк"""
+        import csv
+        import gzip
+        import json
+        from utils import DataExporter
+        
+        db.add_user(12345, "testuser", "Test User")
+        category_id = db.add_category(12345, "Продукты", "expense")
+        for i in range(25):
+            db.add_expense(12345, 100 + i, category_id, description=f"Покупка {i}")
+        
+        exporter = DataExporter(db.db_path, chunk_size=10)
+        
+        csv_files = exporter.export_user(12345, str(tmp_path / "csv"), 'csv')
+        with open(csv_files['expenses']['path'], encoding='utf-8') as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == csv_files['expenses']['rows'] == 25
+        assert rows[-1]['description'] == "Покупка 24"
+        assert 'debts' not in csv_files
+        
+        jsonl_files = exporter.export_user(12345, str(tmp_path / "jsonl"), 'jsonl', 'gzip')
+        assert jsonl_files['expenses']['path'].endswith('.jsonl.gz')
+        with gzip.open(jsonl_files['expenses']['path'], 'rt', encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        assert [r['amount'] for r in records] == [100 + i for i in range(25)]
+    
+    def test_bulk_export_with_manifest(self, db, tmp_path):
+        """Массовая выгрузка раскладывает строки по пользователям и пишет манифест"""
+        import json
+        from utils import DataExporter
+        
+        for user_id in (1, 2, 3):
+            db.add_user(user_id, f"user{user_id}", "Test User")
+            for i in range(user_id * 3):
+                db.add_expense(user_id, 100 * user_id, expense_date="2025-01-01")
+        
+        exporter = DataExporter(db.db_path, chunk_size=2)
+        assert exporter.user_ranges(2) == [(None, 1), (2, None)]
+        
+        manifest_path = exporter.export_all_sharded(str(tmp_path), 'jsonl')
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        
+        assert manifest['total_users'] == 3
+        assert manifest['users']['2']['expenses']['rows'] == 6
+        user_file = os.path.join(os.path.dirname(manifest_path), manifest['users']['3']['expenses']['path'])
+        with open(user_file, encoding='utf-8') as f:
+            assert all(json.loads(line)['user_id'] == 3 for line in f)
+
+
+class TestBackupManager:
+    """Тесты для резервного копирования через Online Backup API"""
+    
+    def test_stepped_backup_and_restore(self, db, tmp_path):
+        """Копия снимается по шагам, проходит quick_check и восстанавливается"""
+        import glob
+        import sqlite3
+        from utils import BackupManager
+        
+        db.add_user(12345, "testuser", "Test User")
+        for i in range(200):
+            db.add_expense(12345, i, description="x" * 200)
+        
+        manager = BackupManager(db.db_path, str(tmp_path), pages_per_step=5, step_sleep=0)
+        steps = []
+        backup_path = manager.create_backup(progress=lambda copied, total: steps.append((copied, total)))
+        
+        assert backup_path and not os.path.exists(backup_path + ".part")
+        assert len(steps) > 1 and steps[-1][0] == steps[-1][1]
+        
+        db.add_expense(12345, 999999)
+        assert manager.restore_backup(backup_path)
+        conn = sqlite3.connect(db.db_path)
+        assert conn.execute("SELECT COUNT(*) FROM expenses").fetchone()[0] == 200
+        conn.close()
+        
+        for path in glob.glob(f"{db.db_path}.before_restore_*"):
+            os.remove(path)
+    
+    def test_incremental_chain(self, db, tmp_path):
+        """Разностные копии хранят только изменения и восстанавливают любую точку"""
+        import glob
+        import sqlite3
+        from utils import BackupManager
+        
+        db.add_user(12345, "testuser", "Test User")
+        for i in range(200):
+            db.add_expense(12345, i, description="x" * 200)
+        
+        manager = BackupManager(db.db_path, str(tmp_path), step_sleep=0)
+        full = manager.create_incremental_backup()
+        db.add_expense(12345, 5000)
+        delta = manager.create_incremental_backup()
+        
+        assert full['kind'] == 'full' and delta['kind'] == 'delta'
+        assert delta['changed_pages'] < full['page_count'] / 4
+        assert delta['stored_bytes'] < full['stored_bytes'] / 4
+        
+        version = db.get_data_version(12345)
+        assert manager.restore_backup(full['id'])
+        conn = sqlite3.connect(db.db_path)
+        assert conn.execute("SELECT COUNT(*) FROM expenses").fetchone()[0] == 200
+        conn.close()
+        assert db.get_data_version(12345) > version
+        
+        assert manager.restore_backup(delta['id'])
+        conn = sqlite3.connect(db.db_path)
+        assert conn.execute("SELECT COUNT(*) FROM expenses").fetchone()[0] == 201
+        conn.close()
+        
+        for path in glob.glob(f"{db.db_path}.before_restore_*"):
+            os.remove(path)
+    
+    def test_journal_chain(self, db, tmp_path, monkeypatch):
+        """С журналом изменений разностные копии хранят записи журнала, а не снимок"""
+        import glob
+        import sqlite3
+        from change_journal import archive_journal, install_change_journal, last_journal_seq
+        from utils import BackupManager
+        
+        db.add_user(12345, "testuser", "Test User")
+        install_change_journal(db.db_path)
+        for i in range(200):
+            db.add_expense(12345, i, description="x" * 200)
+        
+        manager = BackupManager(db.db_path, str(tmp_path), step_sleep=0)
+        full = manager.create_incremental_backup()
+        assert full['kind'] == 'full' and full['journal_active']
+        
+        removed = db.add_expense(12345, 5000)
+        archive_journal(db.db_path, manager.journal_dir)
+        db.delete_expense(12345, removed)
+        db.add_expense(12345, 7000)
+        
+        # Копия по журналу не снимает снимок базы
+        def no_snapshot(*args, **kwargs):
+            raise AssertionError("snapshot taken")
+        monkeypatch.setattr(manager, 'copy_database', no_snapshot)
+        delta = manager.create_incremental_backup()
+        monkeypatch.undo()
+        
+        assert delta['kind'] == 'journal' and delta['records'] >= 4
+        assert delta['stored_bytes'] < full['stored_bytes'] / 4
+        
+        db.add_expense(12345, 9000)
+        conn = sqlite3.connect(db.db_path)
+        live_seq = last_journal_seq(conn)
+        conn.close()
+        assert manager.restore_backup(delta['id'])
+        conn = sqlite3.connect(db.db_path)
+        assert last_journal_seq(conn) == live_seq  # номера записей не повторяются
+        amounts = [row[0] for row in conn.execute("SELECT amount FROM expenses WHERE amount >= 5000")]
+        assert amounts == [7000]
+        assert conn.execute("SELECT COUNT(*) FROM expenses").fetchone()[0] == 201
+        assert BackupManager._journal_active(conn)
+        conn.close()
+        assert db.get_month_category_total(12345, 'expense', None, date.today().month, date.today().year) \
+            == sum(range(200)) + 7000
+        
+        # После восстановления цепочка продолжается полной копией
+        assert manager.create_incremental_backup()['kind'] == 'full'
+        assert manager.create_incremental_backup()['kind'] == 'journal'
+        
+        # Разрыв в журнале (потерян сегмент архива) - постраничная копия
+        db.add_expense(12345, 11000)
+        archive_journal(db.db_path, manager.journal_dir)
+        db.add_expense(12345, 12000)
+        for path in glob.glob(f"{manager.journal_dir}/*"):
+            os.remove(path)
+        assert manager.create_incremental_backup()['kind'] == 'full'
+        
+        for path in glob.glob(f"{db.db_path}.before_restore_*"):
+            os.remove(path)
+    
+    def test_incremental_backup_throttled(self, db, tmp_path, monkeypatch):
+        """Паузы делаются и при копировании снимка, и при разборе его страниц"""
+        import utils
+        from utils import BackupManager
+        
+        db.add_user(12345, "testuser", "Test User")
+        for i in range(200):
+            db.add_expense(12345, i, description="x" * 200)
+        
+        sleeps = []
+        monkeypatch.setattr(utils.time, 'sleep', sleeps.append)
+        manager = BackupManager(db.db_path, str(tmp_path), pages_per_step=5, step_sleep=0.01)
+        full = manager.create_incremental_backup()
+        
+        steps = full['page_count'] // 5
+        assert len(sleeps) >= 2 * steps - 1
+    
+    def test_background_jobs_record_last_runs(self, db, tmp_path):
+        """Фоновые задачи выполняются в рабочем потоке и сохраняют результаты"""
+        import asyncio
+        from backup_jobs import BackupJobRunner, get_last_runs
+        
+        db.add_user(12345, "testuser", "Test User")
+        runner = BackupJobRunner(db.db_path, str(tmp_path), step_sleep=0)
+        
+        async def run_jobs():
+            await runner.run_backup()
+            await runner.run_retention()
+            await runner.run_integrity_check()
+        
+        asyncio.run(run_jobs())
+        runner.shutdown()
+        
+        last_runs = get_last_runs(str(tmp_path))
+        assert set(last_runs) == {'backup', 'retention', 'integrity_check'}
+        assert all(record['ok'] for record in last_runs.values())
+        assert last_runs['backup']['kind'] == 'full'
+        assert last_runs['backup']['size_bytes'] > 0
+    
+    def test_background_jobs_cover_shards(self, tmp_path):
+        """В режиме шардов копии и проверки идут для основной базы и каждого шарда"""
+        import asyncio
+        from backup_jobs import create_backup_runners, get_last_runs
+        
+        sharded = Database(str(tmp_path / "dohot.db"), shards=2)
+        for user_id in (10, 11):
+            sharded.add_user(user_id, f"user{user_id}", "Test")
+            sharded.add_expense(user_id, 100)
+        
+        backup_dir = str(tmp_path / "backups")
+        runners = create_backup_runners(sharded.db_path, backup_dir, sharded.shard_paths(), step_sleep=0)
+        assert [runner.manager.db_path for runner in runners] == [sharded.db_path] + sharded.shard_paths()
+        assert len({id(runner._executor) for runner in runners}) == 1
+        
+        async def run_jobs():
+            for runner in runners:
+                await runner.run_backup()
+                await runner.run_integrity_check()
+        
+        asyncio.run(run_jobs())
+        runners[0].shutdown()
+        
+        for shard in ("shard_000", "shard_001"):
+            last_runs = get_last_runs(os.path.join(backup_dir, "shards", shard))
+            assert last_runs['backup']['ok'] and last_runs['integrity_check']['ok']
+        assert get_last_runs(backup_dir)['backup']['kind'] == 'full'
+    
+    def test_point_in_time_restore(self, db, tmp_path):
+        """Копия цепочки и журнал изменений восстанавливают состояние на момент времени"""
+        import sqlite3
+        import time
+        from datetime import datetime
+        from change_journal import archive_journal, install_change_journal, restore_to_point
+        from utils import BackupManager
+        
+        db.add_user(12345, "testuser", "Test User")
+        install_change_journal(db.db_path)
+        db.add_expense(12345, 100)
+        
+        manager = BackupManager(db.db_path, str(tmp_path / "backups"), step_sleep=0)
+        base = manager.create_incremental_backup()
+        assert base['journal_seq'] > 0
+        
+        kept = db.add_expense(12345, 200)
+        removed = db.add_expense(12345, 300)
+        time.sleep(0.05)
+        moment = datetime.now()
+        time.sleep(0.05)
+        db.delete_expense(12345, removed)
+        db.add_expense(12345, 400)
+        
+        journal_dir = str(tmp_path / "journal")
+        assert archive_journal(db.db_path, journal_dir)['records'] >= 4
+        
+        output = str(tmp_path / "restored.db")
+        result = restore_to_point(manager, journal_dir, moment, output, source_db=db.db_path)
+        assert result['base_backup'] == base['id'] and result['applied'] >= 2
+        
+        conn = sqlite3.connect(output)
+        amounts = [row[0] for row in conn.execute("SELECT amount FROM expenses ORDER BY id")]
+        assert amounts == [100, 200, 300]
+        assert conn.execute("SELECT COUNT(*) FROM expenses WHERE id = ?", (kept,)).fetchone()[0] == 1
+        conn.close()
+        
+        restored = Database(output)
+        totals = restored.get_month_category_total(
+            12345, 'expense', None, moment.month, moment.year
+        )
+        assert totals == 600
+    
+    def test_point_in_time_needs_journaled_base(self, db, tmp_path):
+        """Копия, снятая без журнала, не служит основой восстановления"""
+        import time
+        from datetime import datetime
+        from change_journal import install_change_journal, restore_to_point
+        from utils import BackupManager
+        
+        db.add_user(12345, "testuser", "Test User")
+        manager = BackupManager(db.db_path, str(tmp_path / "backups"), step_sleep=0)
+        assert not manager.create_incremental_backup()['journal_active']
+        
+        # Изменение до включения журнала не записано нигде
+        db.add_expense(12345, 100)
+        install_change_journal(db.db_path)
+        db.add_expense(12345, 200)
+        time.sleep(0.05)
+        
+        with pytest.raises(ValueError):
+            restore_to_point(manager, str(tmp_path / "journal"), datetime.now(),
+                             str(tmp_path / "restored.db"), source_db=db.db_path)
+    
+    def test_retention_prunes_journal_segments(self, db, tmp_path):
+        """Очистка удаляет сегменты журнала до самой старой хранимой основы"""
+        import asyncio
+        import sqlite3
+        import time
+        from datetime import datetime
+        from backup_jobs import BackupJobRunner
+        from change_journal import install_change_journal, list_segments, restore_to_point
+        
+        db.add_user(12345, "testuser", "Test User")
+        install_change_journal(db.db_path)
+        runner = BackupJobRunner(db.db_path, str(tmp_path / "backups"), step_sleep=0, keep_full=2)
+        manager = runner.manager
+        
+        async def archive():
+            return await runner.run_journal_archive()
+        
+        db.add_expense(12345, 100)
+        asyncio.run(archive())
+        manager.create_incremental_backup(full=True)
+        db.add_expense(12345, 200)
+        asyncio.run(archive())
+        kept_base = manager.create_incremental_backup(full=True)
+        
+        db.add_expense(12345, 300)
+        asyncio.run(archive())
+        time.sleep(0.05)
+        moment = datetime.now()
+        time.sleep(0.05)
+        manager.create_incremental_backup(full=True)
+        db.add_expense(12345, 400)
+        asyncio.run(archive())
+        assert len(list_segments(runner.journal_dir)) == 4
+        
+        result = asyncio.run(runner.run_retention())
+        runner.shutdown()
+        assert result['removed'] == 1 and result['segments_removed'] == 2
+        segments = list_segments(runner.journal_dir)
+        assert all(segment['last_seq'] > kept_base['journal_seq'] for segment in segments)
+        
+        output = str(tmp_path / "restored.db")
+        restored = restore_to_point(manager, runner.journal_dir, moment, output)
+        assert restored['base_backup'] == kept_base['id']
+        conn = sqlite3.connect(output)
+        amounts = [row[0] for row in conn.execute("SELECT amount FROM expenses ORDER BY id")]
+        conn.close()
+        assert amounts == [100, 200, 300]
+    
+    def test_point_in_time_base_selected_by_completion(self, db, tmp_path, monkeypatch):
+        """Копия, снятие которой закончилось после целевого момента, не берётся за основу"""
+        import sqlite3
+        import time
+        from datetime import datetime
+        from change_journal import archive_journal, install_change_journal, restore_to_point
+        from utils import BackupManager
+        
+        db.add_user(12345, "testuser", "Test User")
+        install_change_journal(db.db_path)
+        db.add_expense(12345, 100)
+        
+        manager = BackupManager(db.db_path, str(tmp_path / "backups"), step_sleep=0)
+        first = manager.create_incremental_backup()
+        
+        # Целевой момент - после начала второй копии, а изменение
+        # попадает в её снимок уже после этого момента
+        moments = []
+        copy_database = manager.copy_database
+        
+        def slow_copy(*args, **kwargs):
+            time.sleep(0.05)
+            moments.append(datetime.now())
+            time.sleep(0.05)
+            db.add_expense(12345, 500)
+            return copy_database(*args, **kwargs)
+        
+        monkeypatch.setattr(manager, 'copy_database', slow_copy)
+        second = manager.create_incremental_backup(full=True)
+        assert second['created'] < moments[0].isoformat() < second['completed']
+        
+        journal_dir = str(tmp_path / "journal")
+        archive_journal(db.db_path, journal_dir)
+        
+        output = str(tmp_path / "restored.db")
+        result = restore_to_point(manager, journal_dir, moments[0], output, source_db=db.db_path)
+        assert result['base_backup'] == first['id']
+        
+        conn = sqlite3.connect(output)
+        amounts = [row[0] for row in conn.execute("SELECT amount FROM expenses ORDER BY id")]
+        conn.close()
+        assert amounts == [100]
+
+
+class TestDatabaseMaintenance:
+    """Тесты для обслуживания базы данных"""
+    
+    def test_estimates_and_incremental_checks(self, db, tmp_path):
+        """Оценки строк без COUNT(*), проверка таблиц по очереди с сохранением позиции"""
+        from maintenance import DatabaseMaintenance
+        
+        db.add_user(12345, "testuser", "Test User")
+        for i in range(50):
+            db.add_expense(12345, i + 1)
+        
+        maintenance = DatabaseMaintenance(db.db_path, str(tmp_path / "state.json"))
+        assert maintenance.estimate_row_counts()['expenses'] == 50
+        
+        result = maintenance.run_scheduled(check_budget=0)
+        assert result['ok'] and len(result['checked_tables']) == 1
+        assert maintenance.estimate_row_counts()['expenses'] == 50
+        
+        # Следующий запуск продолжает со следующей таблицы
+        second = maintenance.check_tables_incrementally(budget=0)
+        assert list(second) != result['checked_tables']
+        
+        while len(maintenance.load_state()['tables']) < len(maintenance.estimate_row_counts()):
+            maintenance.check_tables_incrementally(budget=0)
+        
+        health = maintenance.health()
+        assert health['ok'] and health['rows']['users'] == 1
+        assert all(check['ok'] for check in health['last_table_checks'].values())
+
+
+class TestMigrations:
+    """Тесты для системы миграций"""
+    
+    def test_new_database_created_by_migrations(self, db):
+        """Новая база получает всю схему и последнюю версию, повторное подключение ничего не применяет"""
+        from migrations import LATEST_VERSION, MigrationManager, ensure_schema
+        
+        manager = MigrationManager(db.db_path)
+        assert manager.get_current_version() == LATEST_VERSION
+        assert [row[0] for row in manager.get_applied_migrations()] == list(range(1, LATEST_VERSION + 1))
+        assert ensure_schema(db.db_path) == []
+        
+        db.add_user(12345, "testuser", "Test User")
+        from credit_cards import CreditCardManager
+        assert CreditCardManager(db.db_path).add_credit_card(12345, "Карта", "Банк", 100000, 25)
+    
+    def test_failed_migration_rolled_back(self, db, monkeypatch):
+        """Ошибка в миграции откатывает её изменения вместе с версией"""
+        import sqlite3
+        from migrations import Migration009_CreditCards, MigrationManager
+        
+        manager = MigrationManager(db.db_path)
+        manager.rollback(manager.get_current_version() - 8)
+        assert manager.get_current_version() == 8
+        
+        def broken_up(self, conn):
+            conn.execute("CREATE TABLE credit_cards (id INTEGER PRIMARY KEY)")
+            conn.execute("SELECT * FROM missing_table")
+        
+        monkeypatch.setattr(Migration009_CreditCards, 'up', broken_up)
+        with pytest.raises(sqlite3.OperationalError):
+            manager.migrate()
+        
+        conn = db.get_connection()
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'credit_cards'").fetchone() is None
+        conn.close()
+        assert manager.get_current_version() == 8
+    
+    def test_backfill_resumes_from_checkpoint(self, db):
+        """Дозаполнение идёт порциями, сохраняет позицию и продолжается после сбоя"""
+        from migrations import BackfillRunner, MonthlyRollupsBackfill
+        
+        for user_id in range(1, 11):
+            db.add_user(user_id, f"user{user_id}", "Test User")
+            db.add_expense(user_id, 100 * user_id, expense_date="2025-03-01")
+        
+        conn = db.get_connection()
+        conn.execute("DELETE FROM monthly_rollups")
+        conn.execute("""
+            UPDATE schema_migrations SET backfill_state = ?
+            WHERE version = 8
+        """, ('{"monthly_rollups": {"position": null, "processed": 0, "done": false}}',))
+        conn.commit()
+        conn.close()
+        
+        class FailingBackfill(MonthlyRollupsBackfill):
+            def process(self, conn, low, high):
+                if low >= 4:
+                    raise RuntimeError("сбой")
+                super().process(conn, low, high)
+        
+        runner = BackfillRunner(db.db_path, sleep=0, chunk_size=4)
+        with pytest.raises(RuntimeError):
+            runner.run(FailingBackfill(), version=8)
+        assert runner.remaining_keys(MonthlyRollupsBackfill(), version=8) == 6
+        
+        updates = []
+        results = runner.run_pending(progress=updates.append)
+        assert [r['processed'] for r in results] == [6]
+        assert updates[-1]['processed'] == updates[-1]['total'] == 6
+        assert runner.pending() == []
+        
+        assert db.get_month_category_total(3, 'expense', None, 3, 2025) == 300
+        assert db.get_month_category_total(10, 'expense', None, 3, 2025) == 1000
+
+
+class TestSQLiteStorage:
+    """Тесты для хранилища состояний FSM в SQLite"""
+    
+    def test_state_survives_restart(self, db):
+        """Состояние пишется пакетом при закрытии и читается новым экземпляром"""
+        import asyncio
+        from aiogram.fsm.storage.base import StorageKey
+        from fsm_storage import SQLiteStorage
+        
+        key = StorageKey(bot_id=1, chat_id=12345, user_id=12345)
+        
+        async def first_run():
+            storage = SQLiteStorage(db.db_path, flush_interval=60)
+            await storage.set_state(key, "BudgetStates:waiting_income_category_amount")
+            await storage.update_data(key, {'income_suggestions': {7: 50000.0}, 'month': 3})
+            assert storage.stats()['pending_writes'] == 1
+            assert (await storage.get_data(key))['income_suggestions'][7] == 50000.0
+            await storage.close()
+        
+        async def second_run():
+            storage = SQLiteStorage(db.db_path)
+            state = await storage.get_state(key)
+            data = await storage.get_data(key)
+            await storage.set_state(key, None)
+            await storage.set_data(key, {})
+            await storage.close()
+            return state, data
+        
+        asyncio.run(first_run())
+        state, data = asyncio.run(second_run())
+        assert state == "BudgetStates:waiting_income_category_amount"
+        assert data == {'income_suggestions': {7: 50000.0}, 'month': 3}
+        
+        conn = db.get_connection()
+        assert conn.execute("SELECT COUNT(*) FROM fsm_states").fetchone()[0] == 0
+        conn.close()
+
+    
+    def test_close_waits_for_running_flush(self, db):
+        """Закрытие во время фонового сброса не даёт старому пакету затереть новый"""
+        import asyncio
+        import time
+        from aiogram.fsm.storage.base import StorageKey
+        from fsm_storage import SQLiteStorage
+        
+        key = StorageKey(bot_id=1, chat_id=12345, user_id=12345)
+        
+        async def scenario():
+            storage = SQLiteStorage(db.db_path, flush_interval=0.01)
+            write_batch = storage._write_batch
+            
+            def slow_write(batch):
+                # Первый пакет пишется медленно, последующие - сразу
+                if batch[storage._row_key(key)][1] == {'step': 1}:
+                    time.sleep(0.2)
+                write_batch(batch)
+            
+            storage._write_batch = slow_write
+            await storage.set_data(key, {'step': 1})
+            while not storage._inflight:
+                await asyncio.sleep(0.01)
+            await storage.set_data(key, {'step': 2})
+            await storage.close()
+            await asyncio.sleep(0.3)
+        
+        asyncio.run(scenario())
+        
+        storage = SQLiteStorage(db.db_path)
+        assert asyncio.run(storage.get_data(key)) == {'step': 2}
+
+
+class TestShardedDatabase:
+    """Тесты для базы, разделённой на шарды по пользователям"""
+
+    def test_default_shards_from_config(self, tmp_path):
+        """Экземпляр, созданный до загрузки конфигурации, получает шарды из неё"""
+        from database import set_default_shards
+
+        db = Database(str(tmp_path / "dohot.db"))
+        assert db.router is None
+        set_default_shards(2)
+        try:
+            assert db.shards == 2 and len(db.shard_paths()) == 2
+            assert Database(str(tmp_path / "dohot.db"), shards=0).router is None
+        finally:
+            set_default_shards(0)
+        assert db.shard_paths() == [db.db_path]
+
+    def test_users_routed_to_own_shards(self, tmp_path):
+        """Данные пользователя пишутся в его шард, общие выборки обходят все шарды"""
+        db = Database(str(tmp_path / "dohot.db"), shards=4)
+        for user_id in (100, 101, 102):
+            db.add_user(user_id, f"user{user_id}", "Test")
+            db.add_credit(user_id, "Банк", 10000, 12, 15, 100000, "2024-01-01")
+
+        assert len(os.listdir(tmp_path / "dohot_shards")) == 3
+        assert db.get_user_credits(101)[0]['user_id'] == 101
+        assert db.get_recently_active_users('2000-01-01 00:00:00') == [100, 101, 102]
+
+        # Методы по ID записи выбирают шард по пользователю обновления
+        credit_id = db.get_user_credits(102)[0]['id']
+        with db.user_scope(102):
+            db.update_credit_debt(credit_id, 50000)
+        assert db.get_user_credits(102)[0]['remaining_debt'] == 50000
+        with pytest.raises(RuntimeError):
+            db.update_credit_debt(credit_id, 1)
+
+        assert db.router.stats()['reused'] > 0
+
+    def test_split_existing_database(self, db):
+        """Перенос общей базы в шарды сохраняет данные и ID"""
+        from partitions import shard_dir, split_database
+        import shutil
+
+        for user_id in (200, 201):
+            db.add_user(user_id, None, "Test")
+            credit_id = db.add_credit(user_id, "Банк", 10000, 12, 15, 100000, "2024-01-01")
+            db.add_credit_payment(credit_id, 10000, 'regular')
+            db.add_expense(user_id, 500, db.add_category(user_id, "Еда", 'expense'))
+
+        try:
+            copied = split_database(db.db_path, 2)
+            assert sum(copied.values()) > 0
+
+            sharded = Database(db.db_path, shards=2)
+            for user_id in (200, 201):
+                assert sharded.get_user_credits(user_id) == db.get_user_credits(user_id)
+                assert len(sharded.get_user_expenses(user_id)) == 1
+            conn = sharded.get_connection(200)
+            assert conn.execute("SELECT COUNT(*) FROM credit_payments").fetchone()[0] == 1
+            assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 1
+            conn.close()
+        finally:
+            shutil.rmtree(shard_dir(db.db_path), ignore_errors=True)
+
+
+class TestEntityCache:
+    """Тесты для кэша категорий, кредитов и карт пользователя"""
+
+    def test_repeated_reads_hit_cache(self, db):
+        """Повторные выборки не обращаются к базе и возвращают копии"""
+        user_id = 300
+        db.add_user(user_id, None, "Test")
+        db.add_category(user_id, "Еда", 'expense')
+
+        before = entity_cache.stats()
+        categories = db.get_user_categories(user_id, 'expense')
+        categories[0]['name'] = "Изменено"
+        assert db.get_user_categories(user_id, 'expense')[0]['name'] == "Еда"
+
+        after = entity_cache.stats()
+        assert after['misses'] - before['misses'] == 1
+        assert after['hits'] - before['hits'] == 1
+
+    def test_clear_resets_generations(self, db):
+        """Очистка сбрасывает и записи, и номера поколений"""
+        user_id = 302
+        db.add_user(user_id, None, "Test")
+        db.add_category(user_id, "Еда", 'expense')
+        assert len(db.get_user_categories(user_id)) == 1
+        assert len(entity_cache._generations) > 0
+
+        entity_cache.clear()
+        assert len(entity_cache._generations) == 0
+        assert len(entity_cache._cache) == 0
+
+    def test_generations_bounded(self):
+        """Номера поколений не копятся, а вытесненный номер означает чтение заново"""
+        from cache import EntityCache
+
+        cache = EntityCache(maxsize=2)
+        loads = []
+
+        def load(user_id):
+            return lambda: loads.append(user_id) or [{'user_id': user_id}]
+
+        for user_id in range(10):
+            cache.get_or_load('categories', 'test.db', user_id, (), load(user_id))
+            cache.invalidate('categories', 'test.db', user_id)
+        assert len(cache._generations) == 2
+
+        cache.get_or_load('categories', 'test.db', 0, (), load(0))
+        cache.get_or_load('categories', 'test.db', 0, (), load(0))
+        assert loads.count(0) == 2
+
+    def test_writes_invalidate(self, db):
+        """Изменения категорий и кредитов сразу видны в выборках"""
+        user_id = 301
+        db.add_user(user_id, None, "Test")
+        assert db.get_user_categories(user_id) == []
+        db.add_category(user_id, "Зарплата", 'income')
+        assert len(db.get_user_categories(user_id)) == 1
+
+        credit_id = db.add_credit(user_id, "Банк", 10000, 12, 15, 100000, "2024-01-01")
+        assert db.get_user_credits(user_id)[0]['remaining_debt'] == 100000
+
+        db.update_credit_debt(credit_id, 50000)
+        assert db.get_user_credits(user_id)[0]['remaining_debt'] == 50000
+
+        db.update_credit_capabilities(credit_id, has_holidays=True)
+        assert db.get_user_credits(user_id)[0]['has_holidays'] == 1
+
+        db.add_credit_payment(credit_id, 50000, 'regular')
+        assert db.get_user_credits(user_id) == []
+        assert db.get_user_credits(user_id, active_only=False)[0]['is_active'] == 0
+
+    def test_credit_cards_invalidate(self, db):
+        """Пополнение, трата и деактивация карты сбрасывают кэш карт"""
+        from credit_cards import CreditCardManager
+
+        user_id = 302
+        db.add_user(user_id, None, "Test")
+        manager = CreditCardManager(db.db_path)
+        card_id = manager.add_credit_card(user_id, "Карта", "Банк", 50000, 25)
+        assert manager.get_user_credit_cards(user_id)[0]['current_balance'] == 50000
+
+        manager.spend_from_card(card_id, 10000)
+        assert manager.get_user_credit_cards(user_id)[0]['current_balance'] == 40000
+
+        manager.add_money_to_card(card_id, 10000)
+        assert manager.get_user_credit_cards(user_id)[0]['current_balance'] > 40000
+
+        manager.deactivate_card(card_id)
+        assert manager.get_user_credit_cards(user_id) == []
+
+
 if __name__ == '__main__':
     pytest.main([__file__, '-v'])
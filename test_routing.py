@@ -0,0 +1,106 @@
+import asyncio
+import pytest
+import os
+import sys
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.dispatcher.flags import get_flag
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+
+from conftest import make_update
+from routing import DispatchTable
+
+
+class DemoStates(StatesGroup):
+    waiting_name = State()
+
+
+class TestDispatchTable:
+    """Тесты для таблицы обработчиков кнопок"""
+
+    def test_match_text_and_longest_prefix(self):
+        """Тест поиска по тексту и самому длинному префиксу"""
+        async def menu(message):
+            pass
+
+        async def edit(callback):
+            pass
+
+        async def edit_category(callback):
+            pass
+
+        table = DispatchTable()
+        table.add_texts(["💳 Кредиты", "💸 Долги"], menu)
+        table.add_prefix("edit_", edit)
+        table.add_prefix("edit_budget_cat_", edit_category)
+
+        assert table.match_text("💸 Долги").callback is menu
+        assert table.match_text("Долги") is None
+        assert table.match_text(None) is None
+        assert table.match_data("edit_budget_cat_5").callback is edit_category
+        assert table.match_data("edit_budget_5").callback is edit
+        assert table.match_data("view_5") is None
+
+        with pytest.raises(ValueError):
+            table.add_text("💳 Кредиты", menu)
+        with pytest.raises(ValueError):
+            table.add_prefix("edit_", edit)
+
+    def test_dispatcher_calls_routed_handlers(self):
+        """Тест вызова обработчиков через диспетчер: аргументы, флаги, состояния"""
+        calls = []
+        seen_flags = []
+
+        async def add_category(message, state: FSMContext, cat_type: str):
+            calls.append(('category', cat_type))
+            await state.set_state(DemoStates.waiting_name)
+
+        async def process_name(message, state: FSMContext):
+            calls.append(('name', message.text))
+            await state.clear()
+
+        async def report(callback):
+            calls.append(('report', callback.data))
+
+        class FlagsMiddleware(BaseMiddleware):
+            async def __call__(self, handler, event, data):
+                seen_flags.append(get_flag(data, 'cost'))
+                return await handler(event, data)
+
+        table = DispatchTable()
+        table.add_text("➕ Категория дохода", partial(add_category, cat_type="income"))
+        table.add_prefix("report_doc_", report, flags={'cost': 'heavy'})
+
+        dp = Dispatcher()
+        dp.message.middleware(FlagsMiddleware())
+        dp.callback_query.middleware(FlagsMiddleware())
+        table.register(dp)
+        dp.message.register(process_name, DemoStates.waiting_name)
+
+        async def scenario():
+            bot = Bot(token="42:TEST")
+            try:
+                await dp.feed_raw_update(bot, make_update(1, 1, "➕ Категория дохода"))
+                # Кнопка в состоянии ввода срабатывает как кнопка
+                await dp.feed_raw_update(bot, make_update(2, 1, "➕ Категория дохода"))
+                await dp.feed_raw_update(bot, make_update(3, 1, "Зарплата"))
+                await dp.feed_raw_update(bot, make_update(4, 1, "Без обработчика"))
+                await dp.feed_raw_update(bot, make_update(5, 1, data="report_doc_pdf"))
+            finally:
+                await bot.session.close()
+
+        asyncio.run(scenario())
+
+        assert calls == [
+            ('category', 'income'), ('category', 'income'),
+            ('name', 'Зарплата'), ('report', 'report_doc_pdf')
+        ]
+        assert seen_flags == [None, None, None, 'heavy']
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
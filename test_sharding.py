@@ -0,0 +1,94 @@
+import asyncio
+import json
+import pytest
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from conftest import make_update
+from sharding import ShardForwardMiddleware, WorkerPool, shard_for_user
+
+
+class FakePool:
+    """Пул без процессов: запоминает переданные обновления"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.submitted = []
+
+    async def submit(self, shard: int, raw_update: str):
+        self.submitted.append((shard, raw_update))
+
+
+class TestSharding:
+    """Тесты для распределения обновлений по рабочим процессам"""
+
+    def test_shard_for_user(self):
+        """Тест стабильного номера шарда"""
+        assert shard_for_user(123456789, 4) == shard_for_user(123456789, 4)
+        assert {shard_for_user(user_id, 4) for user_id in range(1, 100)} == {0, 1, 2, 3}
+        assert shard_for_user(None, 4) == 0
+        assert shard_for_user(123456789, 1) == 0
+
+    def test_workers_spawned_not_forked(self):
+        """Тест запуска рабочих процессов методом spawn (перезапуск идёт при живых потоках)"""
+        assert WorkerPool(config=None, workers=2)._context.get_start_method() == 'spawn'
+
+    def test_updates_forwarded_by_user(self):
+        """Тест передачи обновлений в шард пользователя без обработки в основном процессе"""
+        pool = FakePool(workers=3)
+        dp = Dispatcher(disable_fsm=True)
+        handled = []
+        dp.message.register(lambda message: handled.append(message))
+        dp.update.outer_middleware(ShardForwardMiddleware(pool))
+        bot = Bot(token="123456:test-sharding-token")
+
+        async def feed():
+            for update_id, user_id in enumerate([10, 11, 10, 12], start=1):
+                await dp.feed_raw_update(bot, make_update(update_id, user_id, '💰 Доходы'))
+            await bot.session.close()
+
+        asyncio.run(feed())
+
+        assert handled == []
+        assert [shard for shard, _ in pool.submitted] == [1, 2, 1, 0]
+
+        # Рабочий процесс восстанавливает то же обновление
+        restored = Update.model_validate(json.loads(pool.submitted[0][1]))
+        assert restored.message.from_user.id == 10
+        assert restored.message.text == '💰 Доходы'
+
+    def test_precompute_only_own_users(self, tmp_path, monkeypatch):
+        """Тест предрасчёта в рабочем процессе только для его пользователей"""
+        from concurrent.futures import ThreadPoolExecutor
+        import precompute
+        from database import Database
+
+        db_path = str(tmp_path / "test.db")
+        db = Database(db_path)
+        for user_id in range(10, 16):
+            db.add_user(user_id, f"user{user_id}", "Test")
+            db.add_expense(user_id, 100)
+
+        computed = []
+
+        def fake_precompute(db_path, shards, charts_dir, user_id, period_days):
+            computed.append(user_id)
+            return {'user_id': user_id, 'version': 0, 'charts': [], 'report': {}}
+
+        monkeypatch.setattr(precompute, '_precompute_user', fake_precompute)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            stats = asyncio.run(precompute.precompute_active_users(
+                db_path, str(tmp_path), worker=1, workers=3, executor=executor
+            ))
+
+        assert sorted(computed) == [10, 13]
+        assert stats['active'] == 2 and stats['computed'] == 2
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
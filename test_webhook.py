@@ -0,0 +1,81 @@
+import asyncio
+import pytest
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+from aiohttp import ClientSession, web
+
+from conftest import make_update
+from webhook import WEBHOOK_HANDLER_KEY, create_webhook_app
+
+TOKEN = "123456:test-webhook-token"
+SECRET = "test-secret"
+
+
+async def run_webhook_app(max_in_flight: int, updates: int, secret: str = SECRET) -> dict:
+    """Поднять webhook, отправить updates обновлений одновременно и собрать результаты"""
+    dp = Dispatcher()
+    active = 0
+    peak = 0
+    handled = []
+
+    @dp.message()
+    async def handle(message: Message):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.02)
+        active -= 1
+        handled.append(message.from_user.id)
+
+    app = create_webhook_app(dp, Bot(token=TOKEN), secret_token=SECRET, max_in_flight=max_in_flight)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    async with ClientSession() as session:
+        async def post(update_id: int) -> int:
+            async with session.post(
+                f"http://127.0.0.1:{port}/webhook",
+                json=make_update(update_id),
+                headers={'X-Telegram-Bot-Api-Secret-Token': secret}
+            ) as response:
+                return response.status
+
+        statuses = await asyncio.gather(*(post(i) for i in range(1, updates + 1)))
+
+    await app[WEBHOOK_HANDLER_KEY].drain()
+    stats = app[WEBHOOK_HANDLER_KEY].stats()
+    await runner.cleanup()
+    return {'statuses': statuses, 'peak': peak, 'handled': handled, 'stats': stats}
+
+
+class TestWebhook:
+    """Тесты для режима webhook"""
+
+    def test_updates_processed_within_limit(self):
+        """Тест обработки всех обновлений не больше max_in_flight одновременно"""
+        result = asyncio.run(run_webhook_app(max_in_flight=3, updates=20))
+
+        assert result['statuses'] == [200] * 20
+        assert sorted(result['handled']) == list(range(1, 21))
+        assert 1 < result['peak'] <= 3
+        assert result['stats']['processed'] == 20
+        assert result['stats']['in_flight'] == 0
+
+    def test_wrong_secret_rejected(self):
+        """Тест отклонения запросов с неверным секретом"""
+        result = asyncio.run(run_webhook_app(max_in_flight=3, updates=2, secret="wrong"))
+
+        assert result['statuses'] == [401, 401]
+        assert result['handled'] == []
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
@@ -1,27 +1,126 @@
+import asyncio
+import gzip
+import hashlib
+import itertools
+import json
+import lzma
 import sqlite3
-import shutil
 import os
+import time
+import zlib
 from datetime import datetime, date
-from typing import Optional, Dict, List
+from typing import AsyncIterator, Callable, Iterable, Iterator, Optional, Dict, List
 import logging
 
+from change_journal import JOURNAL_TABLE, TRIGGER_PREFIX, iter_journal, last_journal_seq, replay_journal
+from maintenance import DatabaseMaintenance
+from migrations import ensure_schema
+
 logger = logging.getLogger(__name__)
 
+# Предел длины сообщения Telegram (4096) с запасом
+TELEGRAM_MESSAGE_LIMIT = 4000
+
+
+class BackupRestartedError(Exception):
+    """Пошаговое копирование слишком часто перезапускается из-за записи в базу"""
+
 
 class BackupManager:
-    """Управление резервными копиями базы данных"""
+    """
+    Управление резервными копиями базы данных
     
-    def __init__(self, db_path: str = "dohot.db", backup_dir: str = "backups"):
+    Копии снимаются через SQLite Online Backup API порциями по
+    pages_per_step страниц с паузой между шагами: работающий бот
+    блокируется не дольше одного шага, а копия всегда согласована.
+    """
+    
+    PAGES_PER_STEP = 256
+    STEP_SLEEP = 0.05
+    # Сколько перезапусков пошагового копирования допустимо до перехода на копию за один шаг
+    MAX_RESTARTS = 3
+    
+    def __init__(self, db_path: str = "dohot.db", backup_dir: str = "backups",
+                 pages_per_step: int = PAGES_PER_STEP, step_sleep: float = STEP_SLEEP,
+                 journal_dir: Optional[str] = None):
+        """
+        Args:
+            db_path: Путь к базе данных
+            backup_dir: Директория резервных копий
+            pages_per_step: Страниц за один шаг копирования
+            step_sleep: Пауза между шагами, сек.
+            journal_dir: Архив журнала изменений (по умолчанию backup_dir/journal)
+        """
         self.db_path = db_path
         self.backup_dir = backup_dir
+        self.pages_per_step = pages_per_step
+        self.step_sleep = step_sleep
+        self.journal_dir = journal_dir or os.path.join(backup_dir, "journal")
         
         if not os.path.exists(backup_dir):
             os.makedirs(backup_dir)
     
-    def create_backup(self) -> Optional[str]:
+    def copy_database(self, source_path: str, target_path: str,
+                      progress: Optional[Callable[[int, int], None]] = None) -> int:
+        """
+        Скопировать базу данных через Online Backup API
+        
+        Args:
+            source_path: Путь к исходной базе
+            target_path: Путь к копии (перезаписывается)
+            progress: Функция progress(скопировано страниц, всего страниц)
+            
+        Returns:
+            Количество страниц в копии
+        """
+        state = {'total': 0, 'remaining': None, 'restarts': 0}
+        
+        def on_step(status: int, remaining: int, total: int):
+            # Изменение исходной базы другим соединением перезапускает копирование
+            if state['remaining'] is not None and remaining > state['remaining']:
+                state['restarts'] += 1
+                if state['restarts'] > self.MAX_RESTARTS:
+                    raise BackupRestartedError(f"backup restarted {state['restarts']} times")
+            state['total'] = total
+            state['remaining'] = remaining
+            if progress:
+                progress(total - remaining, total)
+            # Пауза между шагами даёт писателям захватить базу
+            if remaining and self.step_sleep:
+                time.sleep(self.step_sleep)
+        
+        source = sqlite3.connect(source_path)
+        target = sqlite3.connect(target_path)
+        try:
+            try:
+                source.backup(target, pages=self.pages_per_step, progress=on_step)
+            except BackupRestartedError:
+                # Запись идёт чаще, чем успевают шаги: копируем за один шаг
+                # (в режиме WAL это не блокирует писателей)
+                logger.warning(
+                    f"Backup of {source_path} kept restarting under writes, "
+                    f"falling back to a single-step copy"
+                )
+                state['remaining'] = None
+                source.backup(target, pages=-1)
+                if progress:
+                    progress(state['total'], state['total'])
+        finally:
+            target.close()
+            source.close()
+        
+        return state['total']
+    
+    def create_backup(self, progress: Optional[Callable[[int, int], None]] = None) -> Optional[str]:
         """
         Создать резервную копию базы данных
         
+        Копия пишется во временный файл и после успешной проверки
+        PRAGMA quick_check переименовывается в итоговый.
+        
+        Args:
+            progress: Функция progress(скопировано страниц, всего страниц)
+        
         Returns:
             Путь к файлу резервной копии или None при ошибке
         """
@@ -33,9 +132,21 @@ class BackupManager:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             backup_filename = f"dohot_backup_{timestamp}.db"
             backup_path = os.path.join(self.backup_dir, backup_filename)
+            partial_path = backup_path + ".part"
+            
+            started = time.monotonic()
+            pages = self.copy_database(self.db_path, partial_path, progress)
+            
+            if not DatabaseValidator(partial_path).quick_check():
+                os.remove(partial_path)
+                logger.error(f"Backup failed quick_check, discarded: {backup_path}")
+                return None
             
-            shutil.copy2(self.db_path, backup_path)
-            logger.info(f"Backup created: {backup_path}")
+            os.replace(partial_path, backup_path)
+            logger.info(
+                f"Backup created: {backup_path} ({pages} pages, "
+                f"{time.monotonic() - started:.2f}s)"
+            )
             
             return backup_path
         except Exception as e:
@@ -46,31 +157,534 @@ class BackupManager:
         """
         Восстановить базу данных из резервной копии
         
+        Текущая база сначала копируется рядом (.before_restore_*), затем
+        содержимое копии переносится в неё через Online Backup API, так что
+        открытые соединения бота видят восстановленные данные.
+        
         Args:
-            backup_path: Путь к файлу резервной копии
+            backup_path: Путь к файлу резервной копии или ID копии из цепочки
+                (см. create_incremental_backup)
             
         Returns:
             True при успехе, False при ошибке
         """
+        materialized = None
         try:
             if not os.path.exists(backup_path):
-                logger.error(f"Backup file {backup_path} not found")
+                manifest_id = self._chain_manifest_id(backup_path)
+                if manifest_id is None:
+                    logger.error(f"Backup file {backup_path} not found")
+                    return False
+                materialized = self.materialize_chain_backup(manifest_id)
+                backup_path = materialized
+            
+            if not DatabaseValidator(backup_path).quick_check():
+                logger.error(f"Backup file {backup_path} failed quick_check")
                 return False
             
             # Создаём резервную копию текущей БД перед восстановлением
+            live_versions = {}
+            live_journal_seq = 0
             if os.path.exists(self.db_path):
                 safety_backup = f"{self.db_path}.before_restore_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-                shutil.copy2(self.db_path, safety_backup)
+                self.copy_database(self.db_path, safety_backup)
                 logger.info(f"Safety backup created: {safety_backup}")
+                live_versions = self._read_data_versions(self.db_path)
+                conn = sqlite3.connect(self.db_path)
+                live_journal_seq = last_journal_seq(conn)
+                conn.close()
             
             # Восстанавливаем из бэкапа
-            shutil.copy2(backup_path, self.db_path)
+            self.copy_database(backup_path, self.db_path)
+            ensure_schema(self.db_path, force=True)
+            self._advance_data_versions(live_versions)
+            self._restart_journal_chain(live_journal_seq)
             logger.info(f"Database restored from: {backup_path}")
             
             return True
         except Exception as e:
             logger.error(f"Error restoring backup: {e}")
             return False
+        finally:
+            if materialized and os.path.exists(materialized):
+                os.remove(materialized)
+    
+    def _read_data_versions(self, db_path: str) -> Dict[int, int]:
+        """Версии данных пользователей в базе (пусто, если таблицы нет)"""
+        conn = sqlite3.connect(db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT user_id, version FROM user_data_versions")
+            return dict(cursor.fetchall())
+        except sqlite3.OperationalError:
+            return {}
+        finally:
+            conn.close()
+    
+    def _advance_data_versions(self, live_versions: Dict[int, int]):
+        """
+        Сдвинуть версии данных после восстановления и сбросить кэши
+        
+        В восстановленной базе версии откатываются назад. Чтобы ключи
+        кэшей (в том числе в других процессах бота) не совпали с ключами
+        устаревших результатов, каждая версия становится больше любой,
+        которая была до восстановления.
+        """
+        from cache import invalidate_database
+        
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            restored = dict(cursor.execute("SELECT user_id, version FROM user_data_versions").fetchall())
+            updates = [
+                (user_id, max(live_versions.get(user_id, 0), restored.get(user_id, 0)) + 1)
+                for user_id in set(live_versions) | set(restored)
+            ]
+            cursor.executemany("""
+                INSERT INTO user_data_versions (user_id, version, updated_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    version = excluded.version,
+                    updated_at = excluded.updated_at
+            """, updates)
+            conn.commit()
+        except sqlite3.OperationalError:
+            pass  # База без версий данных (старая схема)
+        finally:
+            conn.close()
+        
+        invalidate_database(self.db_path)
+    
+    def _restart_journal_chain(self, live_journal_seq: int):
+        """
+        Продолжить журнал после восстановления без повторных номеров
+        
+        Записи журнала после восстановленного момента (в архиве) относятся
+        к старой линии времени: номера новых записей продолжаются после
+        них, а следующая копия цепочки делается постраничной.
+        """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.execute(
+                "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?",
+                (live_journal_seq, JOURNAL_TABLE)
+            )
+            conn.commit()
+        except sqlite3.OperationalError:
+            pass  # База без журнала
+        finally:
+            conn.close()
+        
+        os.makedirs(self.chain_dir, exist_ok=True)
+        with open(self._full_next_path, 'w', encoding='utf-8') as f:
+            f.write(datetime.now().isoformat())
+    
+    # ==================== ИНКРЕМЕНТАЛЬНАЯ ЦЕПОЧКА ====================
+    #
+    # backup_dir/chain/objects/ab/<sha256> — сжатые страницы базы, каждая
+    #     уникальная страница хранится один раз;
+    # backup_dir/chain/manifests/<id>.json — описание копии: полная копия
+    #     перечисляет все страницы, разностная — только изменившиеся
+    #     относительно предыдущей копии цепочки;
+    # backup_dir/chain/journal/<id>.jsonl.gz — записи журнала изменений
+    #     копии по журналу (kind 'journal'): всё, что изменилось со
+    #     времени предыдущей копии цепочки.
+    
+    FULL_EVERY = 7
+    
+    @property
+    def chain_dir(self) -> str:
+        return os.path.join(self.backup_dir, "chain")
+    
+    @property
+    def _full_next_path(self) -> str:
+        """Отметка: следующая копия цепочки - полная (после восстановления)"""
+        return os.path.join(self.chain_dir, "full_next")
+    
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.chain_dir, "objects", digest[:2], digest)
+    
+    def _manifest_path(self, manifest_id: str) -> str:
+        return os.path.join(self.chain_dir, "manifests", f"{manifest_id}.json")
+    
+    def _chain_manifest_id(self, name: str) -> Optional[str]:
+        """ID копии цепочки по ID или пути к манифесту (None, если такой нет)"""
+        manifest_id = os.path.basename(name)
+        if manifest_id.endswith(".json"):
+            manifest_id = manifest_id[:-5]
+        return manifest_id if os.path.exists(self._manifest_path(manifest_id)) else None
+    
+    def load_manifest(self, manifest_id: str) -> Dict:
+        """Прочитать манифест копии цепочки"""
+        with open(self._manifest_path(manifest_id), encoding='utf-8') as f:
+            return json.load(f)
+    
+    def list_chain(self) -> List[Dict]:
+        """
+        Получить манифесты цепочки от старых к новым
+        
+        Returns:
+            Список манифестов без списков страниц
+        """
+        manifests_dir = os.path.join(self.chain_dir, "manifests")
+        if not os.path.exists(manifests_dir):
+            return []
+        
+        chain = []
+        for filename in sorted(os.listdir(manifests_dir)):
+            if filename.endswith(".json"):
+                manifest = self.load_manifest(filename[:-5])
+                manifest.pop('pages', None)
+                chain.append(manifest)
+        return chain
+    
+    def _journal_file(self, manifest_id: str) -> str:
+        return os.path.join(self.chain_dir, "journal", f"{manifest_id}.jsonl.gz")
+    
+    def _split_lineage(self, manifest_id: str) -> tuple:
+        """
+        Последняя постраничная копия в истории копии и копии по журналу после неё
+        
+        Returns:
+            (ID постраничной копии, манифесты копий по журналу от старых к новым)
+        """
+        journals = []
+        manifest = self.load_manifest(manifest_id)
+        while manifest['kind'] == 'journal':
+            journals.append(manifest)
+            manifest = self.load_manifest(manifest['parent'])
+        return manifest['id'], list(reversed(journals))
+    
+    def resolve_pages(self, manifest_id: str) -> tuple:
+        """
+        Восстановить полный список страниц копии по цепочке манифестов
+        
+        Для копии по журналу возвращаются страницы постраничной копии,
+        к которой применяется её журнал.
+        
+        Returns:
+            (размер страницы, список хэшей страниц по порядку)
+        """
+        manifest_id, _ = self._split_lineage(manifest_id)
+        lineage = []
+        manifest = self.load_manifest(manifest_id)
+        while manifest['kind'] == 'delta':
+            lineage.append(manifest)
+            manifest = self.load_manifest(manifest['parent'])
+        
+        pages = list(manifest['pages'])
+        for delta in reversed(lineage):
+            del pages[delta['page_count']:]
+            pages.extend([None] * (delta['page_count'] - len(pages)))
+            for index, digest in delta['pages'].items():
+                pages[int(index)] = digest
+        
+        return manifest['page_size'], pages
+    
+    def create_incremental_backup(self, progress: Optional[Callable[[int, int], None]] = None,
+                                  full: bool = False) -> Optional[Dict]:
+        """
+        Добавить копию в инкрементальную цепочку
+        
+        Каждая FULL_EVERY-я копия — полная: согласованный снимок снимается
+        через Online Backup API, делится на страницы, и в хранилище сжатыми
+        записываются только страницы, которых там ещё нет.
+        
+        Если в базе ведётся журнал изменений (change_journal.py), остальные
+        копии - по журналу: сохраняются только записи журнала со времени
+        предыдущей копии. Снимок базы при этом не снимается, поэтому и
+        объём, и время такой копии растут с числом изменений, а не с
+        размером базы. Без журнала (или при разрыве в его записях) копия
+        разностная постраничная: объём растёт с числом изменённых страниц,
+        но снимок и чтение всех страниц занимают время, пропорциональное
+        размеру базы.
+        
+        Таблицы без целочисленного ключа (состояния диалогов) журнал не
+        ведёт: в копии по журналу они такие же, как в последней
+        постраничной копии, а производные таблицы пересчитываются при
+        сборке копии.
+        
+        Args:
+            progress: Функция progress(скопировано страниц, всего страниц)
+            full: Принудительно начать новую цепочку с полной копии
+            
+        Returns:
+            Манифест созданной копии (без списка страниц) или None при ошибке
+        """
+        snapshot_path = os.path.join(self.chain_dir, "snapshot.tmp")
+        try:
+            if not os.path.exists(self.db_path):
+                logger.error(f"Database file {self.db_path} not found")
+                return None
+            
+            os.makedirs(os.path.join(self.chain_dir, "manifests"), exist_ok=True)
+            started = time.monotonic()
+            created = datetime.now()
+            
+            full = full or os.path.exists(self._full_next_path)
+            chain = self.list_chain()
+            parent = chain[-1] if chain else None
+            if parent and not full and parent['chain_length'] < self.FULL_EVERY \
+                    and parent.get('journal_active'):
+                manifest = self._create_journal_backup(parent, created, started)
+                if manifest is not None:
+                    return manifest
+            
+            self.copy_database(self.db_path, snapshot_path, progress)
+            # Снимок содержит изменения не позже этого момента
+            completed = datetime.now()
+            if not DatabaseValidator(snapshot_path).quick_check():
+                logger.error("Incremental backup snapshot failed quick_check")
+                return None
+            
+            conn = sqlite3.connect(snapshot_path)
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            journal_seq = last_journal_seq(conn)
+            journal_active = self._journal_active(conn)
+            conn.close()
+            
+            parent_pages = []
+            kind = 'full'
+            if parent and not full and parent['chain_length'] < self.FULL_EVERY \
+                    and parent['kind'] != 'journal' and parent['page_size'] == page_size:
+                kind = 'delta'
+                _, parent_pages = self.resolve_pages(parent['id'])
+            
+            pages = []
+            new_objects = 0
+            stored_bytes = 0
+            with open(snapshot_path, 'rb') as f:
+                while True:
+                    page = f.read(page_size)
+                    if not page:
+                        break
+                    digest = hashlib.sha256(page).hexdigest()
+                    pages.append(digest)
+                    # Чтение, хэширование и сжатие снимка - с теми же паузами, что и копирование
+                    if self.step_sleep and len(pages) % self.pages_per_step == 0:
+                        time.sleep(self.step_sleep)
+                    
+                    object_path = self._object_path(digest)
+                    if not os.path.exists(object_path):
+                        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                        data = zlib.compress(page)
+                        with open(object_path + ".tmp", 'wb') as obj:
+                            obj.write(data)
+                        os.replace(object_path + ".tmp", object_path)
+                        new_objects += 1
+                        stored_bytes += len(data)
+            
+            if kind == 'delta':
+                changed = {
+                    str(index): digest for index, digest in enumerate(pages)
+                    if index >= len(parent_pages) or parent_pages[index] != digest
+                }
+            
+            manifest = {
+                'id': created.strftime("%Y%m%d_%H%M%S_%f"),
+                'kind': kind,
+                'parent': parent['id'] if kind == 'delta' else None,
+                'chain_length': parent['chain_length'] + 1 if kind == 'delta' else 1,
+                'created': created.isoformat(),
+                'completed': completed.isoformat(),
+                'page_size': page_size,
+                'page_count': len(pages),
+                'changed_pages': len(changed) if kind == 'delta' else len(pages),
+                'new_objects': new_objects,
+                'stored_bytes': stored_bytes,
+                'duration_seconds': round(time.monotonic() - started, 3),
+                'journal_seq': journal_seq,
+                'journal_active': journal_active,
+                'pages': changed if kind == 'delta' else pages
+            }
+            
+            self._write_manifest(manifest)
+            if kind == 'full' and os.path.exists(self._full_next_path):
+                os.remove(self._full_next_path)
+            
+            manifest.pop('pages')
+            logger.info(
+                f"Incremental backup {manifest['id']} ({kind}): "
+                f"{manifest['changed_pages']} changed pages, {new_objects} new objects, "
+                f"{stored_bytes} bytes stored"
+            )
+            return manifest
+        except Exception as e:
+            logger.error(f"Error creating incremental backup: {e}")
+            return None
+        finally:
+            if os.path.exists(snapshot_path):
+                os.remove(snapshot_path)
+    
+    def _create_journal_backup(self, parent: Dict, created: datetime, started: float) -> Optional[Dict]:
+        """
+        Копия по журналу: записи журнала изменений после копии parent
+        
+        Returns:
+            Манифест (без списка страниц) или None, если журнала нет или в
+            его записях разрыв - тогда нужна постраничная копия
+        """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            active = self._journal_active(conn)
+            last_seq = last_journal_seq(conn)
+        finally:
+            conn.close()
+        completed = datetime.now()
+        
+        after_seq = parent['journal_seq']
+        if not active or last_seq < after_seq:
+            return None
+        
+        manifest_id = created.strftime("%Y%m%d_%H%M%S_%f")
+        journal_path = self._journal_file(manifest_id)
+        os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+        
+        # Записи журнала идут без пропусков: разрыв значит, что часть
+        # архива потеряна, и изменения восстановить по журналу нельзя
+        expected = after_seq + 1
+        last_ts = None
+        with gzip.open(journal_path + ".tmp", 'wt', encoding='utf-8') as f:
+            for record in iter_journal(self.journal_dir, after_seq, self.db_path):
+                if record['seq'] > last_seq:
+                    break
+                if record['seq'] != expected:
+                    break
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                last_ts = record['ts']
+                expected += 1
+                if self.step_sleep and (expected - after_seq) % self.pages_per_step == 0:
+                    time.sleep(self.step_sleep)
+        
+        if expected != last_seq + 1:
+            os.remove(journal_path + ".tmp")
+            logger.warning(
+                f"Change journal has a gap after seq {expected - 1} (expected up to {last_seq}), "
+                f"taking a page-level backup instead"
+            )
+            return None
+        os.replace(journal_path + ".tmp", journal_path)
+        
+        records = last_seq - after_seq
+        manifest = {
+            'id': manifest_id,
+            'kind': 'journal',
+            'parent': parent['id'],
+            'chain_length': parent['chain_length'] + 1,
+            'created': created.isoformat(),
+            'completed': completed.isoformat(),
+            'page_size': parent['page_size'],
+            'page_count': parent['page_count'],
+            'changed_pages': 0,
+            'records': records,
+            'last_ts': last_ts,
+            'new_objects': 1,
+            'stored_bytes': os.path.getsize(journal_path),
+            'duration_seconds': round(time.monotonic() - started, 3),
+            'journal_seq': last_seq,
+            'journal_active': True
+        }
+        self._write_manifest(manifest)
+        
+        logger.info(
+            f"Incremental backup {manifest_id} (journal): {records} journal records, "
+            f"{manifest['stored_bytes']} bytes stored"
+        )
+        return manifest
+    
+    @staticmethod
+    def _journal_active(conn: sqlite3.Connection) -> bool:
+        """Ведётся ли в базе журнал изменений (есть триггеры журнала)"""
+        return conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name LIKE ? LIMIT 1",
+            (f"{TRIGGER_PREFIX}%",)
+        ).fetchone() is not None
+    
+    def _write_manifest(self, manifest: Dict):
+        """Атомарно записать манифест копии"""
+        manifest_path = self._manifest_path(manifest['id'])
+        with open(manifest_path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+    
+    def materialize_chain_backup(self, manifest_id: str, target_path: Optional[str] = None) -> str:
+        """
+        Собрать файл базы данных на момент копии из цепочки
+        
+        Файл собирается из страниц последней постраничной копии, затем
+        применяются записи журнала копий по журналу после неё.
+        
+        Args:
+            manifest_id: ID копии
+            target_path: Куда записать базу (по умолчанию — рядом с цепочкой)
+            
+        Returns:
+            Путь к собранному файлу
+        """
+        base_id, journals = self._split_lineage(manifest_id)
+        _, pages = self.resolve_pages(base_id)
+        target_path = target_path or os.path.join(self.chain_dir, f"restore_{manifest_id}.db")
+        
+        with open(target_path, 'wb') as f:
+            for digest in pages:
+                with open(self._object_path(digest), 'rb') as obj:
+                    page = zlib.decompress(obj.read())
+                if hashlib.sha256(page).hexdigest() != digest:
+                    raise ValueError(f"Corrupted backup object {digest}")
+                f.write(page)
+        
+        if journals:
+            def records():
+                for manifest in journals:
+                    with gzip.open(self._journal_file(manifest['id']), 'rt', encoding='utf-8') as f:
+                        for line in f:
+                            yield json.loads(line)
+            
+            replay_journal(target_path, records(), self.load_manifest(base_id)['journal_seq'],
+                           keep_triggers=True)
+        
+        return target_path
+    
+    def cleanup_chain(self, keep_full: int = 2) -> int:
+        """
+        Удалить старые цепочки, оставив последние keep_full полных копий с их изменениями
+        
+        Страницы, на которые больше не ссылается ни один манифест, удаляются.
+        
+        Returns:
+            Количество удалённых манифестов
+        """
+        try:
+            chain = self.list_chain()
+            fulls = [m['id'] for m in chain if m['kind'] == 'full']
+            if len(fulls) <= keep_full:
+                return 0
+            
+            oldest_kept = fulls[-keep_full] if keep_full > 0 else None
+            removed = [m for m in chain if oldest_kept is None or m['id'] < oldest_kept]
+            for manifest in removed:
+                os.remove(self._manifest_path(manifest['id']))
+                if manifest['kind'] == 'journal' and os.path.exists(self._journal_file(manifest['id'])):
+                    os.remove(self._journal_file(manifest['id']))
+            
+            referenced = set()
+            for manifest in self.list_chain():
+                _, pages = self.resolve_pages(manifest['id'])
+                referenced.update(pages)
+            
+            objects_dir = os.path.join(self.chain_dir, "objects")
+            deleted_objects = 0
+            for prefix in os.listdir(objects_dir):
+                for digest in os.listdir(os.path.join(objects_dir, prefix)):
+                    if digest not in referenced:
+                        os.remove(os.path.join(objects_dir, prefix, digest))
+                        deleted_objects += 1
+            
+            logger.info(f"Cleaned up {len(removed)} chain backups and {deleted_objects} objects")
+            return len(removed)
+        except Exception as e:
+            logger.error(f"Error cleaning up backup chain: {e}")
+            return 0
     
     def list_backups(self) -> List[Dict]:
         """
@@ -156,6 +770,31 @@ class DatabaseValidator:
             logger.error(f"Error checking database integrity: {e}")
             return False
     
+    def quick_check(self) -> bool:
+        """
+        Быстрая проверка структуры базы (PRAGMA quick_check)
+        
+        В отличие от integrity_check не сверяет индексы с таблицами,
+        поэтому подходит для проверки каждой свежей копии.
+        
+        Returns:
+            True если БД в порядке
+        """
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            cursor.execute("PRAGMA quick_check")
+            result = cursor.fetchone()
+            conn.close()
+            
+            if result[0] == "ok":
+                return True
+            logger.error(f"Database quick_check failed for {self.db_path}: {result[0]}")
+            return False
+        except Exception as e:
+            logger.error(f"Error running quick_check on {self.db_path}: {e}")
+            return False
+    
     def check_tables(self) -> Dict[str, bool]:
         """
         Проверить наличие всех необходимых таблиц
@@ -197,31 +836,29 @@ class DatabaseValidator:
         """
         Получить статистику по базе данных
         
+        Количество записей - оценки DatabaseMaintenance.estimate_row_counts
+        (sqlite_stat1 или диапазон rowid), а не COUNT(*) по каждой таблице.
+        
         Returns:
             Словарь со статистикой
         """
         stats = {}
         
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
             # Размер БД
             if os.path.exists(self.db_path):
                 stats['size_bytes'] = os.path.getsize(self.db_path)
                 stats['size_mb'] = stats['size_bytes'] / (1024 * 1024)
             
             # Количество записей в таблицах
+            estimates = DatabaseMaintenance(self.db_path).estimate_row_counts()
             tables = ['users', 'credits', 'debts', 'incomes', 'expenses', 'investments']
             for table in tables:
-                cursor.execute(f"SELECT COUNT(*) FROM {table}")
-                stats[f'{table}_count'] = cursor.fetchone()[0]
+                stats[f'{table}_count'] = estimates.get(table, 0)
             
-            # Общее количество пользователей
-            cursor.execute("SELECT COUNT(DISTINCT user_id) FROM users")
-            stats['total_users'] = cursor.fetchone()[0]
-            
-            conn.close()
+            # Общее количество пользователей (user_id - первичный ключ users)
+            stats['total_users'] = stats['users_count']
+            stats['estimated'] = True
             
             logger.info(f"Database stats collected: {stats}")
         except Exception as e:
@@ -231,101 +868,347 @@ class DatabaseValidator:
 
 
 class DataExporter:
-    """Экспорт данных в различные форматы"""
+    """
+    Экспорт данных в различные форматы
     
-    def __init__(self, db_path: str = "dohot.db"):
+    Строки читаются из курсора порциями и сразу записываются в файл,
+    поэтому расход памяти не зависит от объёма данных пользователя.
+    """
+    
+    # Таблицы с данными пользователя (отсутствующие в базе пропускаются)
+    EXPORT_TABLES = (
+        'credits', 'debts', 'categories', 'incomes', 'expenses',
+        'investments', 'savings', 'budget_plans', 'credit_cards'
+    )
+    
+    FORMATS = ('csv', 'jsonl')
+    
+    # Сжатие: функция открытия файла и расширение
+    COMPRESSIONS = {
+        None: (open, ''),
+        'gzip': (gzip.open, '.gz'),
+        'lzma': (lzma.open, '.xz'),
+    }
+    
+    CHUNK_SIZE = 1000
+    
+    def __init__(self, db_path: str = "dohot.db", chunk_size: int = CHUNK_SIZE):
         self.db_path = db_path
+        self.chunk_size = chunk_size
+    
+    @classmethod
+    def open_output(cls, filepath: str, compression: Optional[str] = None):
+        """Открыть файл на запись в текстовом режиме с нужным сжатием"""
+        opener, _ = cls.COMPRESSIONS[compression]
+        return opener(filepath, 'wt', newline='', encoding='utf-8')
     
-    def export_to_csv(self, user_id: int, output_dir: str = "exports") -> Dict[str, str]:
+    def iter_chunks(self, cursor: sqlite3.Cursor) -> Iterator[List[tuple]]:
+        """Читать результат запроса порциями по chunk_size строк"""
+        while True:
+            rows = cursor.fetchmany(self.chunk_size)
+            if not rows:
+                return
+            yield rows
+    
+    def write_rows(self, f, columns: List[str], chunks: Iterable[List[tuple]], fmt: str) -> int:
         """
-        Экспортировать все данные пользователя в CSV файлы
+        Записать строки в открытый файл в формате CSV или JSON Lines
+        
+        Args:
+            f: Открытый текстовый файл
+            columns: Названия столбцов
+            chunks: Порции строк (кортежи значений)
+            fmt: 'csv' или 'jsonl'
+            
+        Returns:
+            Количество записанных строк
+        """
+        import csv
+        
+        count = 0
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for rows in chunks:
+                writer.writerows(rows)
+                count += len(rows)
+        else:
+            for rows in chunks:
+                f.writelines(
+                    json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + '\n'
+                    for row in rows
+                )
+                count += len(rows)
+        return count
+    
+    def export_table(self, conn: sqlite3.Connection, table: str, user_id: int, filepath: str,
+                     fmt: str = 'csv', compression: Optional[str] = None) -> int:
+        """
+        Потоково выгрузить строки пользователя из одной таблицы
+        
+        Файл не создаётся, если у пользователя нет строк в таблице.
+        
+        Returns:
+            Количество выгруженных строк
+        """
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT * FROM {table} WHERE user_id = ? ORDER BY id", (user_id,))
+        columns = [col[0] for col in cursor.description]
+        
+        chunks = self.iter_chunks(cursor)
+        first = next(chunks, None)
+        if first is None:
+            return 0
+        
+        with self.open_output(filepath, compression) as f:
+            return self.write_rows(f, columns, itertools.chain([first], chunks), fmt)
+    
+    def export_user(self, user_id: int, output_dir: str = "exports", fmt: str = 'csv',
+                    compression: Optional[str] = None) -> Dict[str, Dict]:
+        """
+        Экспортировать все данные пользователя, по файлу на таблицу
         
         Args:
             user_id: ID пользователя
             output_dir: Директория для сохранения файлов
+            fmt: 'csv' или 'jsonl'
+            compression: None, 'gzip' или 'lzma'
             
         Returns:
-            Словарь с путями к созданным файлам
+            Словарь {таблица: {'path': путь к файлу, 'rows': количество строк}}
         """
+        if fmt not in self.FORMATS:
+            raise ValueError(f"Неизвестный формат экспорта: {fmt}")
+        if compression not in self.COMPRESSIONS:
+            raise ValueError(f"Неизвестный тип сжатия: {compression}")
+        
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         
-        exported_files = {}
+        exported = {}
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        extension = f".{fmt}{self.COMPRESSIONS[compression][1]}"
         
         try:
-            import csv
             conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            existing = {row[0] for row in cursor.fetchall()}
             
-            # Экспортируем кредиты
-            cursor.execute("SELECT * FROM credits WHERE user_id = ?", (user_id,))
-            credits = cursor.fetchall()
-            if credits:
-                filename = f"credits_{user_id}_{timestamp}.csv"
-                filepath = os.path.join(output_dir, filename)
-                with open(filepath, 'w', newline='', encoding='utf-8') as f:
-                    writer = csv.DictWriter(f, fieldnames=credits[0].keys())
-                    writer.writeheader()
-                    writer.writerows([dict(row) for row in credits])
-                exported_files['credits'] = filepath
-            
-            # Экспортируем долги
-            cursor.execute("SELECT * FROM debts WHERE user_id = ?", (user_id,))
-            debts = cursor.fetchall()
-            if debts:
-                filename = f"debts_{user_id}_{timestamp}.csv"
-                filepath = os.path.join(output_dir, filename)
-                with open(filepath, 'w', newline='', encoding='utf-8') as f:
-                    writer = csv.DictWriter(f, fieldnames=debts[0].keys())
-                    writer.writeheader()
-                    writer.writerows([dict(row) for row in debts])
-                exported_files['debts'] = filepath
-            
-            # Экспортируем доходы
-            cursor.execute("SELECT * FROM incomes WHERE user_id = ?", (user_id,))
-            incomes = cursor.fetchall()
-            if incomes:
-                filename = f"incomes_{user_id}_{timestamp}.csv"
-                filepath = os.path.join(output_dir, filename)
-                with open(filepath, 'w', newline='', encoding='utf-8') as f:
-                    writer = csv.DictWriter(f, fieldnames=incomes[0].keys())
-                    writer.writeheader()
-                    writer.writerows([dict(row) for row in incomes])
-                exported_files['incomes'] = filepath
-            
-            # Экспортируем расходы
-            cursor.execute("SELECT * FROM expenses WHERE user_id = ?", (user_id,))
-            expenses = cursor.fetchall()
-            if expenses:
-                filename = f"expenses_{user_id}_{timestamp}.csv"
-                filepath = os.path.join(output_dir, filename)
-                with open(filepath, 'w', newline='', encoding='utf-8') as f:
-                    writer = csv.DictWriter(f, fieldnames=expenses[0].keys())
-                    writer.writeheader()
-                    writer.writerows([dict(row) for row in expenses])
-                exported_files['expenses'] = filepath
-            
-            # Экспортируем инвестиции
-            cursor.execute("SELECT * FROM investments WHERE user_id = ?", (user_id,))
-            investments = cursor.fetchall()
-            if investments:
-                filename = f"investments_{user_id}_{timestamp}.csv"
-                filepath = os.path.join(output_dir, filename)
-                with open(filepath, 'w', newline='', encoding='utf-8') as f:
-                    writer = csv.DictWriter(f, fieldnames=investments[0].keys())
-                    writer.writeheader()
-                    writer.writerows([dict(row) for row in investments])
-                exported_files['investments'] = filepath
+            for table in self.EXPORT_TABLES:
+                if table not in existing:
+                    continue
+                
+                filepath = os.path.join(output_dir, f"{table}_{user_id}_{timestamp}{extension}")
+                rows = self.export_table(conn, table, user_id, filepath, fmt, compression)
+                if rows:
+                    exported[table] = {'path': filepath, 'rows': rows}
             
             conn.close()
-            logger.info(f"Exported {len(exported_files)} files for user {user_id}")
+            logger.info(f"Exported {len(exported)} files for user {user_id}")
             
         except Exception as e:
-            logger.error(f"Error exporting to CSV: {e}")
+            logger.error(f"Error exporting user data: {e}")
+        
+        return exported
+    
+    def export_all(self, output_dir: str, fmt: str = 'csv', compression: Optional[str] = None,
+                   first_user: Optional[int] = None, last_user: Optional[int] = None) -> Dict[str, Dict]:
+        """
+        Выгрузить данные всех пользователей за один проход по каждой таблице
+        
+        Таблица читается одним запросом, упорядоченным по user_id, и строки
+        раскладываются по файлам пользователей: output_dir/<user_id>/<таблица>.<формат>.
+        Одновременно открыт только один файл.
+        
+        Args:
+            output_dir: Директория выгрузки
+            fmt: 'csv' или 'jsonl'
+            compression: None, 'gzip' или 'lzma'
+            first_user: Нижняя граница user_id включительно (None — без ограничения)
+            last_user: Верхняя граница user_id включительно (None — без ограничения)
+            
+        Returns:
+            Словарь {user_id: {таблица: {'path': путь, 'rows': количество}}}
+        """
+        if fmt not in self.FORMATS:
+            raise ValueError(f"Неизвестный формат экспорта: {fmt}")
+        if compression not in self.COMPRESSIONS:
+            raise ValueError(f"Неизвестный тип сжатия: {compression}")
+        
+        extension = f".{fmt}{self.COMPRESSIONS[compression][1]}"
+        conditions, params = [], []
+        if first_user is not None:
+            conditions.append("user_id >= ?")
+            params.append(first_user)
+        if last_user is not None:
+            conditions.append("user_id <= ?")
+            params.append(last_user)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
         
-        return exported_files
+        exported = {}
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            existing = {row[0] for row in cursor.fetchall()}
+            
+            for table in self.EXPORT_TABLES:
+                if table not in existing:
+                    continue
+                
+                cursor.execute(f"SELECT * FROM {table} {where} ORDER BY user_id, id", params)
+                columns = [col[0] for col in cursor.description]
+                user_index = columns.index('user_id')
+                rows = itertools.chain.from_iterable(self.iter_chunks(cursor))
+                
+                for user_id, user_rows in itertools.groupby(rows, key=lambda row: row[user_index]):
+                    user_dir = os.path.join(output_dir, str(user_id))
+                    os.makedirs(user_dir, exist_ok=True)
+                    filepath = os.path.join(user_dir, f"{table}{extension}")
+                    
+                    with self.open_output(filepath, compression) as f:
+                        count = self.write_rows(f, columns, self._batched(user_rows), fmt)
+                    exported.setdefault(str(user_id), {})[table] = {'path': filepath, 'rows': count}
+        finally:
+            conn.close()
+        
+        logger.info(f"Bulk export finished: {len(exported)} users")
+        return exported
+    
+    def _batched(self, rows: Iterable[tuple]) -> Iterator[List[tuple]]:
+        """Разбить поток строк на порции по chunk_size"""
+        iterator = iter(rows)
+        while True:
+            batch = list(itertools.islice(iterator, self.chunk_size))
+            if not batch:
+                return
+            yield batch
+    
+    def user_ranges(self, shards: int) -> List[tuple]:
+        """
+        Разбить пользователей на shards непрерывных диапазонов user_id примерно поровну
+        
+        Крайние диапазоны открыты (None), чтобы не потерять строки
+        пользователей, отсутствующих в таблице users.
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id FROM users ORDER BY user_id")
+        user_ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        
+        shards = max(1, min(shards, len(user_ids)))
+        if shards == 1:
+            return [(None, None)]
+        
+        # Границы — первый пользователь каждого шарда, начиная со второго
+        bounds = [user_ids[len(user_ids) * i // shards] for i in range(1, shards)]
+        ranges = []
+        lower = None
+        for bound in bounds:
+            ranges.append((lower, bound - 1))
+            lower = bound
+        ranges.append((lower, None))
+        return ranges
+    
+    def export_all_sharded(self, output_dir: str = "exports", fmt: str = 'csv',
+                           compression: Optional[str] = None, workers: int = 1) -> str:
+        """
+        Массовая выгрузка всех пользователей с манифестом
+        
+        При workers > 1 диапазоны пользователей выгружаются параллельно
+        в пуле процессов, каждый процесс делает свой проход по таблицам.
+        
+        Args:
+            output_dir: Базовая директория выгрузки
+            fmt: 'csv' или 'jsonl'
+            compression: None, 'gzip' или 'lzma'
+            workers: Количество процессов
+            
+        Returns:
+            Путь к manifest.json
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        
+        started = datetime.now()
+        export_dir = os.path.join(output_dir, f"export_{started.strftime('%Y%m%d_%H%M%S')}")
+        os.makedirs(export_dir, exist_ok=True)
+        
+        ranges = self.user_ranges(workers)
+        args = [(self.db_path, self.chunk_size, export_dir, fmt, compression, lo, hi) for lo, hi in ranges]
+        
+        if len(ranges) == 1:
+            parts = [_export_shard(*args[0])]
+        else:
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=len(ranges), mp_context=context) as pool:
+                parts = list(pool.map(_export_shard, *zip(*args)))
+        
+        users = {}
+        for part in parts:
+            users.update(part)
+        
+        manifest = {
+            'created_at': started.isoformat(),
+            'duration_seconds': round((datetime.now() - started).total_seconds(), 3),
+            'database': os.path.abspath(self.db_path),
+            'format': fmt,
+            'compression': compression,
+            'shards': [{'first_user': lo, 'last_user': hi} for lo, hi in ranges],
+            'total_users': len(users),
+            'total_rows': sum(info['rows'] for tables in users.values() for info in tables.values()),
+            'users': {
+                user_id: {
+                    table: {'path': os.path.relpath(info['path'], export_dir), 'rows': info['rows']}
+                    for table, info in tables.items()
+                }
+                for user_id, tables in sorted(users.items(), key=lambda item: int(item[0]))
+            }
+        }
+        
+        manifest_path = os.path.join(export_dir, "manifest.json")
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        
+        logger.info(f"Bulk export manifest written: {manifest_path}")
+        return manifest_path
+    
+    def export_to_csv(self, user_id: int, output_dir: str = "exports",
+                      compression: Optional[str] = None) -> Dict[str, str]:
+        """
+        Экспортировать все данные пользователя в CSV файлы
+        
+        Args:
+            user_id: ID пользователя
+            output_dir: Директория для сохранения файлов
+            compression: None, 'gzip' или 'lzma'
+            
+        Returns:
+            Словарь с путями к созданным файлам
+        """
+        exported = self.export_user(user_id, output_dir, 'csv', compression)
+        return {table: info['path'] for table, info in exported.items()}
+    
+    def export_to_jsonl(self, user_id: int, output_dir: str = "exports",
+                        compression: Optional[str] = None) -> Dict[str, str]:
+        """
+        Экспортировать все данные пользователя в файлы JSON Lines
+        
+        Returns:
+            Словарь с путями к созданным файлам
+        """
+        exported = self.export_user(user_id, output_dir, 'jsonl', compression)
+        return {table: info['path'] for table, info in exported.items()}
+
+
+def _export_shard(db_path: str, chunk_size: int, output_dir: str, fmt: str,
+                  compression: Optional[str], first_user: Optional[int],
+                  last_user: Optional[int]) -> Dict[str, Dict]:
+    """Выгрузка одного диапазона пользователей (выполняется в процессе пула)"""
+    exporter = DataExporter(db_path, chunk_size)
+    return exporter.export_all(output_dir, fmt, compression, first_user, last_user)
 
 
 class DateHelper:
@@ -484,6 +1367,88 @@ class TextHelper:
         for char in special_chars:
             text = text.replace(char, '\\' + char)
         return text
+    
+    @staticmethod
+    def split_message(text: str, max_length: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+        """
+        Разбить текст на сообщения по границам строк
+        
+        Строка длиннее max_length (что бывает редко) режется по длине.
+        
+        Args:
+            text: Исходный текст
+            max_length: Максимальная длина сообщения
+            
+        Returns:
+            Список частей, каждая не длиннее max_length
+        """
+        parts = []
+        current = ""
+        
+        for line in text.splitlines(keepends=True):
+            while len(line) > max_length:
+                if current:
+                    parts.append(current)
+                    current = ""
+                parts.append(line[:max_length])
+                line = line[max_length:]
+            
+            if len(current) + len(line) > max_length:
+                parts.append(current)
+                current = ""
+            current += line
+        
+        if current:
+            parts.append(current)
+        return parts
+
+
+async def pack_sections(sections: AsyncIterator[str], max_length: int = TELEGRAM_MESSAGE_LIMIT,
+                        wait_seconds: float = 0.05) -> AsyncIterator[str]:
+    """
+    Упаковать поток разделов отчёта в сообщения Telegram
+    
+    Разделы объединяются в сообщения до max_length символов по своим
+    границам. Если следующий раздел ещё не готов через wait_seconds,
+    накопленное отдаётся сразу — пользователь читает начало отчёта,
+    пока считается остальное. Раздел длиннее лимита делится по строкам.
+    
+    Args:
+        sections: Асинхронный поток текстов разделов
+        max_length: Максимальная длина сообщения
+        wait_seconds: Сколько ждать следующий раздел, прежде чем отправить накопленное
+        
+    Yields:
+        Текст очередного сообщения
+    """
+    iterator = sections.__aiter__()
+    buffer = ""
+    pending = asyncio.ensure_future(iterator.__anext__())
+    
+    try:
+        while True:
+            if buffer:
+                done, _ = await asyncio.wait({pending}, timeout=wait_seconds)
+                if not done:
+                    yield buffer
+                    buffer = ""
+            
+            try:
+                section = await pending
+            except StopAsyncIteration:
+                break
+            pending = asyncio.ensure_future(iterator.__anext__())
+            
+            for part in TextHelper.split_message(section, max_length):
+                if buffer and len(buffer) + len(part) > max_length:
+                    yield buffer
+                    buffer = ""
+                buffer += part
+        
+        if buffer:
+            yield buffer
+    finally:
+        pending.cancel()
 
 
 def format_credit_info(credit: Dict, detailed: bool = False) -> str:
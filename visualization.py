@@ -3,13 +3,19 @@ matplotlib.use('Agg')  # Для работы без GUI
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from datetime import datetime, date, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
 import os
+import uuid
 
 # Настройка matplotlib для русского языка
 plt.rcParams['font.family'] = 'DejaVu Sans'
 plt.rcParams['axes.unicode_minus'] = False
 
+# Поток построения графиков и документов вне цикла событий бота.
+# Один поток: pyplot хранит глобальное состояние и не потокобезопасен
+render_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='charts')
+
 
 class ChartGenerator:
     """
@@ -28,6 +34,17 @@ class ChartGenerator:
         if not os.path.exists(charts_dir):
             os.makedirs(charts_dir)
     
+    def _build_chart_path(self, prefix: str) -> str:
+        """
+        Уникальный путь для нового графика
+        
+        Суффикс из uuid исключает перезапись файлов, когда графики разных
+        пользователей строятся в одну и ту же секунду (например, параллельно
+        при ночном предрасчёте).
+        """
+        filename = f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.png"
+        return os.path.join(self.charts_dir, filename)
+    
     def generate_capital_chart(self, net_worth_data: Dict) -> str:
         """
         Генерирует круговую диаграмму капитала
@@ -114,8 +131,7 @@ class ChartGenerator:
             plt.tight_layout()
             
             # Сохраняем график с уникальным именем
-            filename = f"capital_chart_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-            filepath = os.path.join(self.charts_dir, filename)
+            filepath = self._build_chart_path('capital_chart')
             plt.savefig(filepath, dpi=300, bbox_inches='tight')
             plt.close()
             
@@ -195,8 +211,7 @@ class ChartGenerator:
             plt.tight_layout()
             
             # Сохраняем
-            filename = f"income_expense_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-            filepath = os.path.join(self.charts_dir, filename)
+            filepath = self._build_chart_path('income_expense')
             plt.savefig(filepath, dpi=300, bbox_inches='tight')
             plt.close()
             
@@ -271,8 +286,7 @@ class ChartGenerator:
             plt.tight_layout()
             
             # Сохраняем
-            filename = f"credits_timeline_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-            filepath = os.path.join(self.charts_dir, filename)
+            filepath = self._build_chart_path('credits_timeline')
             plt.savefig(filepath, dpi=300, bbox_inches='tight')
             plt.close()
             
@@ -336,8 +350,7 @@ class ChartGenerator:
             plt.tight_layout()
             
             # Сохраняем
-            filename = f"investment_perf_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-            filepath = os.path.join(self.charts_dir, filename)
+            filepath = self._build_chart_path('investment_perf')
             plt.savefig(filepath, dpi=300, bbox_inches='tight')
             plt.close()
             
@@ -508,8 +521,7 @@ class ChartGenerator:
             plt.tight_layout()
             
             # Сохраняем
-            filename = f"balance_trend_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-            filepath = os.path.join(self.charts_dir, filename)
+            filepath = self._build_chart_path('balance_trend')
             plt.savefig(filepath, dpi=300, bbox_inches='tight')
             plt.close()
             
@@ -580,8 +592,7 @@ class ChartGenerator:
             plt.tight_layout()
             
             # Сохраняем
-            filename = f"expense_pie_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-            filepath = os.path.join(self.charts_dir, filename)
+            filepath = self._build_chart_path('expense_pie')
             plt.savefig(filepath, dpi=300, bbox_inches='tight')
             plt.close()
             
@@ -640,8 +651,7 @@ class ChartGenerator:
             plt.tight_layout()
             
             # Сохраняем
-            filename = f"budget_comparison_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-            filepath = os.path.join(self.charts_dir, filename)
+            filepath = self._build_chart_path('budget_comparison')
             plt.savefig(filepath, dpi=300, bbox_inches='tight')
             plt.close()
             
@@ -0,0 +1,179 @@
+"""
+Режим webhook для бота DoHot
+
+Telegram присылает обновления POST-запросами на aiohttp-сервер бота
+(обычно за обратным прокси с TLS). Ответ отправляется сразу, а обновление
+обрабатывается в фоне; одновременно обрабатывается не больше
+max_in_flight обновлений - остальные запросы ждут свободного места, и
+Telegram сам притормаживает отправку (см. max_connections в setWebhook).
+
+Проверка заголовка X-Telegram-Bot-Api-Secret-Token отсекает запросы
+не от Telegram.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Dict
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from cache import entity_cache
+
+logger = logging.getLogger(__name__)
+
+# Количество последних обработок для расчёта задержек
+LATENCY_WINDOW = 1000
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Обработчик webhook с ограничением числа одновременно обрабатываемых обновлений"""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_in_flight: int = 100,
+                 secret_token: str = None, **data: Any):
+        """
+        Args:
+            dispatcher: Диспетчер aiogram
+            bot: Экземпляр бота
+            max_in_flight: Максимум одновременно обрабатываемых обновлений
+            secret_token: Секрет, переданный в setWebhook (None - без проверки)
+        """
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self.max_in_flight = max_in_flight
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+
+    async def _process(self, bot: Bot, update: Dict[str, Any], received: float):
+        """Обработать обновление и освободить место"""
+        try:
+            await self._background_feed_update(bot=bot, update=update)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Error processing webhook update {update.get('update_id')}: {e}")
+        finally:
+            self._latencies.append(time.perf_counter() - received)
+            self.in_flight -= 1
+            self._slots.release()
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        received = time.perf_counter()
+        update = await request.json(loads=bot.session.json_loads)
+
+        # Ждём свободного места: ответ Telegram задерживается, и он снижает темп
+        await self._slots.acquire()
+        self.in_flight += 1
+
+        task = asyncio.create_task(self._process(bot, update, received))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def drain(self):
+        """Дождаться завершения обновлений, принятых в обработку"""
+        if self._background_feed_update_tasks:
+            await asyncio.gather(*self._background_feed_update_tasks, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        """Счётчики и задержки обработки (от приёма запроса до конца обработки), мс"""
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0
+            return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+
+        return {
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'processed': self.processed,
+            'failed': self.failed,
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99)
+        }
+
+
+# Ключ обработчика в приложении aiohttp
+WEBHOOK_HANDLER_KEY = web.AppKey("webhook_handler", BoundedRequestHandler)
+
+
+def create_webhook_app(dp: Dispatcher, bot: Bot, path: str = "/webhook",
+                       secret_token: str = None, max_in_flight: int = 100,
+                       **data: Any) -> web.Application:
+    """
+    Собрать aiohttp-приложение webhook
+
+    Кроме пути webhook регистрирует GET {path}/stats со счётчиками
+    обработчика (для проверки состояния и замеров).
+
+    Args:
+        dp: Диспетчер aiogram
+        bot: Экземпляр бота
+        path: Путь webhook
+        secret_token: Секрет webhook
+        max_in_flight: Максимум одновременно обрабатываемых обновлений
+
+    Returns:
+        Приложение aiohttp
+    """
+    app = web.Application()
+    handler = BoundedRequestHandler(dp, bot, max_in_flight=max_in_flight, secret_token=secret_token, **data)
+    handler.register(app, path=path)
+    app[WEBHOOK_HANDLER_KEY] = handler
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response({**handler.stats(), 'entity_cache': entity_cache.stats()})
+
+    app.router.add_get(f"{path.rstrip('/')}/stats", stats)
+
+    async def drain(app: web.Application):
+        await handler.drain()
+
+    # Перед остановкой диспетчера дожидаемся уже принятых обновлений
+    app.on_shutdown.insert(0, drain)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, config) -> None:
+    """
+    Зарегистрировать webhook в Telegram и обслуживать его до остановки
+
+    Args:
+        dp: Диспетчер aiogram
+        bot: Экземпляр бота
+        config: BotConfig с настройками webhook_*
+    """
+    await bot.set_webhook(
+        url=config.webhook_url.rstrip('/') + config.webhook_path,
+        secret_token=config.webhook_secret or None,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=config.webhook_max_connections
+    )
+
+    app = create_webhook_app(
+        dp, bot,
+        path=config.webhook_path,
+        secret_token=config.webhook_secret or None,
+        max_in_flight=config.webhook_max_in_flight
+    )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, config.webhook_host, config.webhook_port)
+    await site.start()
+    logger.info(
+        f"Webhook listening on {config.webhook_host}:{config.webhook_port}{config.webhook_path}, "
+        f"max in flight {config.webhook_max_in_flight}"
+    )
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()